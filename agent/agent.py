@@ -1,4 +1,5 @@
 import os
+import errno
 import sys
 import socket
 import ssl
@@ -6,6 +7,9 @@ import json
 import time
 import argparse
 import hashlib
+import threading
+import httplib
+import email.utils
 
 import platform
 import multiprocessing
@@ -20,6 +24,7 @@ import urlparse
 from config import Config
 from apache2 import Apache2
 from processmanager import ProcessManager
+from portprobe import PortProber
 import logger
 
 from util import version, str2bool
@@ -29,6 +34,17 @@ from http import HTTPRequest, HTTPResponse, HTTPBadRequest
 
 # default settings
 DEFAULT_RECONNECT_INTERVAL = 10
+DEFAULT_CHANNELS = 1
+
+# Backoff (seconds) between the connection attempts of an extra channel.
+CHANNEL_RETRY_MIN = 1
+CHANNEL_RETRY_MAX = 60
+
+# GET /cli?xid=N&wait=S waits at most this many seconds for the command.
+MAX_CLI_WAIT = 60
+
+REQUEST_ID_HEADER = 'X-Palette-Request-Id'
+CHANNELS_HEADER = 'X-Palette-Channels'
 
 # Accepts commands from the Controller and sends replies.
 # The body of the request and response is JSON.
@@ -101,9 +117,18 @@ class AgentHandler(SimpleHTTPRequestHandler):
         elif req.method == 'GET':
             try:
                 xid = int(req.query['xid'][0])
+                wait = float(req.query.get('wait', [0])[0])
             except (ValueError, KeyError, TypeError):
                 raise http.HTTPBadRequest()
+            if wait > 0:
+                # Long-poll: reply when the command finishes or 'wait'
+                # seconds have passed.  'wait' in the reply tells the
+                # controller there is no need to sleep between requests.
+                wait = min(wait, MAX_CLI_WAIT)
+                self.server.processmanager.wait(xid, wait)
             data = self.server.processmanager.getinfo(xid)
+            if wait > 0:
+                data['wait'] = wait
         else:
             raise http.HTTPBadRequest()
 
@@ -129,6 +154,30 @@ class AgentHandler(SimpleHTTPRequestHandler):
             raise http.HTTPBadRequest()
         return {'status':'ok', 'port':self.server.archive.port }
 
+    def handle_ports(self, req):
+        """Check connectivity to all the {'host', 'port'[, 'timeout']}
+        'targets' concurrently - within 'time-limit' seconds, if given -
+        and return the results in one response."""
+        if req.method != 'POST':
+            raise http.HTTPMethodNotAllowed(req.method)
+        targets = self.get_required_json_parameter(req, 'targets')
+        timeout = req.json.get('timeout', PortProber.DEFAULT_TIMEOUT)
+        time_limit = req.json.get('time-limit', None)
+        try:
+            timeout = float(timeout)
+            if time_limit is not None:
+                time_limit = float(time_limit)
+            for target in targets:
+                int(target['port'])
+                float(target.get('timeout', timeout))
+                if not isinstance(target['host'], basestring):
+                    raise TypeError(target['host'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise http.HTTPBadRequest()
+        ports = self.server.prober.probe_all(targets, timeout=timeout,
+                                             time_limit=time_limit)
+        return {'status': 'ok', 'ports': ports}
+
     def get_path_from_query(self, req):
         if 'path' not in req.query:
             raise HTTPBadRequest("'path' is required.")
@@ -156,41 +205,151 @@ class AgentHandler(SimpleHTTPRequestHandler):
               "uuid": self.server.uuid,
               "install-dir": self.server.install_dir,
               # FIXME
-              "data-dir": self.server.data_dir
+              "data-dir": self.server.data_dir,
+              "channel": self.server.channel
             }
+        if self.server.channel == 0 and CHANNELS_HEADER in self.headers:
+            # The controller supports additional connections.
+            try:
+                limit = int(self.headers[CHANNELS_HEADER])
+            except ValueError:
+                limit = 1
+            self.server.open_channels(limit)
         return d
 
+    def parse_range(self, value, size):
+        """Parse a single 'bytes=first-last' (or 'bytes=first-' or
+           'bytes=-suffix') Range header value.  Returns (first, last)."""
+        try:
+            unit, spec = value.split('=', 1)
+            if unit.strip() != 'bytes' or ',' in spec:
+                raise ValueError(value)
+            first, last = spec.strip().split('-', 1)
+            if first:
+                first = int(first)
+                if last:
+                    last = min(int(last), size - 1)
+                else:
+                    last = size - 1
+            else:
+                # the final 'last' bytes.
+                first = max(size - int(last), 0)
+                last = size - 1
+        except ValueError:
+            raise http.HTTPBadRequest("Invalid Range: " + value)
+        if first > last:
+            raise http.HTTPRequestedRangeNotSatisfiable(value)
+        return first, last
+
+    def parse_content_range(self, value):
+        """Parse a 'bytes first-last/total' Content-Range header value.
+           Returns (first, total), total is None if it is '*'."""
+        try:
+            unit, spec = value.strip().split(' ', 1)
+            if unit != 'bytes':
+                raise ValueError(value)
+            span, total = spec.split('/', 1)
+            first = int(span.split('-', 1)[0])
+            if total == '*':
+                total = None
+            else:
+                total = int(total)
+        except ValueError:
+            raise http.HTTPBadRequest("Invalid Content-Range: " + value)
+        return first, total
+
     def handle_file_GET(self, req):
         path = self.get_path_from_query(req)
         if not os.path.isfile(path):
-            raise HTTPNotFound(path)
+            raise http.HTTPNotFound(path)
         res = req.response
         # FIXME: catch IOError, OSError
-        res.setfile(open(path, 'r'))
-        res.set_content_length()
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        res.headers['Accept-Ranges'] = 'bytes'
+        # Lets a resumed download check the file hasn't changed.
+        res.headers['Last-Modified'] = \
+            email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+        if 'Range' in self.headers and size:
+            first, last = self.parse_range(self.headers['Range'], size)
+            res.status_code = httplib.PARTIAL_CONTENT
+            res.headers['Content-Range'] = \
+                'bytes %d-%d/%d' % (first, last, size)
+            res.setfile(f, first)
+            res.set_content_length(last - first + 1)
+        else:
+            res.setfile(f)
+            res.set_content_length(size)
         return res
 
     def handle_file_PUT(self, req):
         path = self.get_path_from_query(req)
-	self.server.log.info("handle_file_POST: %s", path)
+        self.server.log.info("handle_file_PUT: %s", path)
+        first = total = None
+        if 'Content-Range' in self.headers:
+            first, total = \
+                self.parse_content_range(self.headers['Content-Range'])
+        if req.chunked:
+            length = None
+        else:
+            length = req.content_length
         # FIXME: catch IOError, OSError
-        with open(path, 'w') as f:
-            if req.content_length:
-#                FYI: this hangs:
-#                shutil.copyfileobj(req.rfile, f, req.content_length)
-                # fixme: check to make sure all was read?
-                data = req.rfile.read(req.content_length)
-                f.write(data)
+        if first is None:
+            # The whole file: written next to it and renamed into place
+            # once it is complete and on disk, so a failed transfer
+            # doesn't leave a truncated file.  The channels are threads of
+            # the same process: the thread id keeps concurrent PUTs of the
+            # same path apart.
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                    threading.current_thread().ident)
+            try:
+                with open(tmp, 'wb') as f:
+                    self.receive(req, f, length)
+                os.rename(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        else:
+            if os.path.isfile(path):
+                mode = 'r+b'
+            else:
+                mode = 'wb'
+            # Another range of the same file: keep what is there.
+            with open(path, mode) as f:
+                f.seek(first)
+                self.receive(req, f, length)
+                if total is not None and \
+                        os.fstat(f.fileno()).st_size > total:
+                    f.truncate(total)
         return req.response
 
+    def receive(self, req, f, length):
+        """Copy the request body into 'f' a piece at a time and make sure
+           it is on disk."""
+        rfile = req.rfile
+        if rfile is not None:
+            copied = http.copyfile(rfile, f, length)
+            if length is not None and copied != length:
+                raise http.HTTPBadRequest(
+                    "Expected %d bytes, received %d" % (length, copied))
+        f.flush()
+        os.fsync(f.fileno())
+
     def handle_file_DELETE(self, req):
         path = self.get_path_from_query(req)
         # FIXME: test for OSError
         os.remove(path)
         return req.response
 
-    def compute_sha256(self, data):
-        return hashlib.sha256(data).hexdigest()
+    def compute_sha256(self, f, bufsize=http.COPY_SIZE):
+        sha = hashlib.sha256()
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            sha.update(buf)
+        return sha.hexdigest()
 
     def handle_sha256(self, req):
         path = self.get_required_json_parameter(req, 'path')
@@ -201,9 +360,7 @@ class AgentHandler(SimpleHTTPRequestHandler):
             return d
 
         with open(path, 'rb') as f:
-            data = f.read()
-
-        h = self.compute_sha256(data)
+            h = self.compute_sha256(f)
         d['status'] = 'OK'
         d['hash'] = h
         return d
@@ -262,6 +419,22 @@ class AgentHandler(SimpleHTTPRequestHandler):
             os.makedirs(path)
         return {'status': "OK"}
 
+    def handle_delete(self, req):
+        """Delete the files in 'paths'.  A file already gone counts as
+        deleted; the other failures are returned by path in 'errors'."""
+        paths = self.get_required_json_parameter(req, 'paths')
+        deleted = 0
+        errors = {}
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    errors[path] = str(e)
+                    continue
+            deleted += 1
+        return {'status': "OK", 'deleted': deleted, 'errors': errors}
+
     def handle_file_POST(self, req):
         action = self.get_required_json_parameter(req, 'action').upper()
 	self.server.log.info("handle_file_POST: %s", action)
@@ -275,6 +448,8 @@ class AgentHandler(SimpleHTTPRequestHandler):
             return self.handle_filesize(req)
         if action == 'MKDIRS':
             return self.handle_mkdirs(req)
+        if action == 'DELETE':
+            return self.handle_delete(req)
         raise HTTPBadRequest("Invalid action '" + action + "'")
 
     def handle_file(self, req):
@@ -301,6 +476,8 @@ class AgentHandler(SimpleHTTPRequestHandler):
                 res = self.handle_cli(req)
             elif req.path == '/file':
                 res = self.handle_file(req)
+            elif req.path == '/ports':
+                res = self.handle_ports(req)
             elif req.path == '/ping':
                 res = req.response
             else:
@@ -323,6 +500,10 @@ class AgentHandler(SimpleHTTPRequestHandler):
             res.content_type = 'application/json'
             res.wfile.write(json.dumps(obj))
 
+        # Echo the request id so the controller can match the response.
+        if REQUEST_ID_HEADER in self.headers:
+            res.headers[REQUEST_ID_HEADER] = self.headers[REQUEST_ID_HEADER]
+
         # terminate the request
         req.close()
         # send it
@@ -339,8 +520,7 @@ class AgentHandler(SimpleHTTPRequestHandler):
 	# return self.handle_method('DELETE')
 
     def do_PUT(self):
-        return {'status': "OK"}
-        # return self.handle_method('PUT')
+        return self.handle_method('PUT')
 
 class Agent(TCPServer):
 
@@ -349,8 +529,14 @@ class Agent(TCPServer):
     DEFAULT_LICENSE_KEY = "XXXXXXXX-XXXX-XXXX-XXXX-XXXXXXXXXXXX"
     DEFAULT_DATA_DIR = "/var/palette"
 
-    def __init__(self, config):
+    def __init__(self, config, channel=0, parent=None):
         self.config = config
+        # Channel 0 is the main connection, others are extra connections
+        # opened once the controller says it accepts them.
+        self.channel = channel
+        self.channels = config.getint('controller', 'channels',
+                                      default=DEFAULT_CHANNELS)
+        self.channel_threads = []
         self.host = config.get('controller', 'host', default='localhost')
         self.port = config.getint('controller', 'port', default=8888)
         self.proxy = config.getboolean('controller', 'proxy', default=False)
@@ -382,8 +568,17 @@ class Agent(TCPServer):
         if not os.path.isdir(self.xid_dir):
             os.mkdir(self.xid_dir)
 
+        if parent is not None:
+            # An extra channel shares the state of the main connection
+            # (ProcessManager also prepends 'path' to PATH: only once).
+            self.processmanager = parent.processmanager
+            self.prober = parent.prober
+            self.archive = parent.archive
+            return
+
         pathenv = config.get(self.DEFAULT_SECTION, 'path', default=None)
         self.processmanager = ProcessManager(self.xid_dir, pathenv)
+        self.prober = PortProber()
 
         conf = os.path.join(self.install_dir, 'conf', 'archive', 'httpd.conf')
         port = config.getint("archive", "port", default=8889);
@@ -417,6 +612,19 @@ class Agent(TCPServer):
                 log.info("Proxy connect failed: %s", response)
                 raise IOError("Proxy connect failed: " + response)
 
+    def open_channels(self, limit):
+        """Open the extra connections to the controller, each served
+           by its own thread."""
+        count = min(self.channels, limit)
+        self.channel_threads = [t for t in self.channel_threads \
+                                    if t.is_alive()]
+        for channel in range(len(self.channel_threads) + 1, count):
+            t = threading.Thread(target=serve_channel,
+                                 args=(self, channel))
+            t.daemon = True
+            t.start()
+            self.channel_threads.append(t)
+
     def get_request(self):
         return (self.socket, 'localhost')
 
@@ -424,6 +632,34 @@ class Agent(TCPServer):
         if self.socket is not None:
             self.socket.close()
 
+def serve_channel(parent, channel):
+    """Thread function: serve one extra channel of the 'parent' Agent,
+       reconnecting with a backoff whenever it is closed.  The controller
+       rejects the channels that connect before it has registered the main
+       connection (which is usually the case for the first attempt) or
+       while the main connection is down."""
+    log = parent.log
+    server = Agent(parent.config, channel=channel, parent=parent)
+    server.log = log
+    delay = CHANNEL_RETRY_MIN
+    while True:
+        server.start()
+        started = time.time()
+        try:
+            server.connect()
+            log.info("channel %d connected", channel)
+            server.serve_forever()
+        except EnvironmentError as ex:
+            log.info("channel %d disconnected: %s", channel, str(ex))
+        server.close()
+
+        if time.time() - started >= CHANNEL_RETRY_MAX:
+            # it was in use: not a rejection.
+            delay = CHANNEL_RETRY_MIN
+        log.info("channel %d: reconnecting in %d seconds", channel, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, CHANNEL_RETRY_MAX)
+
 class HttpException(Exception):
     def __init__(self, status_code):
         self.status_code = status_code
@@ -2,10 +2,91 @@ import os
 import httplib
 import urlparse
 import json
-import shutil
 
 from cStringIO import StringIO
 
+# Buffer size used when copying request or response bodies.
+COPY_SIZE = 256 * 1024
+
+def copyfile(source, dest, length=None, bufsize=COPY_SIZE):
+    """Copy exactly 'length' bytes (fewer if 'source' ends first) or, if
+       'length' is None, until 'source' ends.  Returns the number of bytes
+       copied."""
+    copied = 0
+    while length is None or copied < length:
+        if length is None:
+            size = bufsize
+        else:
+            size = min(bufsize, length - copied)
+        buf = source.read(size)
+        if not buf:
+            break
+        dest.write(buf)
+        copied += len(buf)
+    return copied
+
+class LengthReader(object):
+    """Reads at most 'length' bytes of 'rfile': a request body with a
+       Content-Length can't be read to EOF on a persistent connection."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return ''
+        buf = self.rfile.read(size)
+        self.remaining -= len(buf)
+        return buf
+
+class ChunkedReader(object):
+    """Reads a 'Transfer-Encoding: chunked' request body."""
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.remaining = 0  # in the current chunk
+        self.done = False
+
+    def _next_chunk(self):
+        line = self.rfile.readline()
+        try:
+            self.remaining = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise HTTPBadRequest("Invalid chunk size: " + line)
+        if not self.remaining:
+            # skip the trailer.
+            while self.rfile.readline().strip():
+                pass
+            self.done = True
+
+    def read(self, size=-1):
+        chunks = []
+        while not self.done and size != 0:
+            if not self.remaining:
+                self._next_chunk()
+                continue
+            if size < 0 or size > self.remaining:
+                count = self.remaining
+            else:
+                count = size
+            buf = self.rfile.read(count)
+            if not buf:
+                raise HTTPBadRequest("Truncated chunked body")
+            chunks.append(buf)
+            self.remaining -= len(buf)
+            if self.remaining == 0:
+                self.rfile.readline() # CRLF after the chunk data
+            if size > 0:
+                size -= len(buf)
+        return ''.join(chunks)
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
 class HTTPRequest(object):
 
     def __init__(self, handler, method):
@@ -22,25 +103,35 @@ class HTTPRequest(object):
         else:
             self.content_type = 'text/plain'
 
+        self.chunked = self.handler.headers.get('transfer-encoding', '').\
+            lower() == 'chunked'
+
         # Pending data that must still be read?
         self.needs_flush = False
+        self.body_reader = None
 
         self.json = {}
-        if self.content_length:
+        if self.chunked:
+            self.needs_flush = True
+            self.body_reader = ChunkedReader(self.handler.rfile)
+        elif self.content_length:
             if self.content_type == 'application/json' or \
                 self.content_type == 'text/json':
                 body = self.handler.rfile.read(self.content_length)
                 self.json = json.loads(body)
             else:
                 self.needs_flush = True
+                self.body_reader = LengthReader(self.handler.rfile,
+                                                self.content_length)
         self.response = HTTPResponse(self)
 
     def __getattr__(self, name):
         if name == 'rfile':
+            # The body, read in pieces: it may be larger than memory.
             if not self.needs_flush:
                 return None
             self.needs_flush = False # caller must read all data
-            return self.handler.rfile
+            return self.body_reader
         raise AttributeError(name)
 
     def parseurl(self):
@@ -58,7 +149,8 @@ class HTTPRequest(object):
 
     def close(self):
         if self.needs_flush:
-            self.handler.rfile.read()
+            # discard the unread body.
+            copyfile(self.body_reader, NullFile())
 
 class HTTPResponse(object):
 
@@ -68,6 +160,7 @@ class HTTPResponse(object):
         self.status_code = 200
         self.content_type = 'text/plain'
         self.content_length = -1
+        self.headers = {}
         self.wfile = StringIO()
 
     def __getattr__(self, name):
@@ -75,13 +168,17 @@ class HTTPResponse(object):
             return self.req.handler
         raise AttributeError(name)
 
-    def setfile(self, wfile):
+    def setfile(self, wfile, offset=0):
         self.wfile.close()
         self.wfile = wfile
+        if offset:
+            self.wfile.seek(offset)
 
-    def set_content_length(self):
-        info = os.fstat(self.wfile)
-        self.content_length = info.st_size
+    def set_content_length(self, length=None):
+        if length is None:
+            info = os.fstat(self.wfile.fileno())
+            length = info.st_size - self.wfile.tell()
+        self.content_length = length
 
     def flush(self):
         self.handler.send_response(self.status_code)
@@ -92,12 +189,13 @@ class HTTPResponse(object):
             self.content_length = len(body)
 
         self.handler.send_header('Content-Length', self.content_length)
+        for name, value in self.headers.items():
+            self.handler.send_header(name, value)
         self.handler.end_headers()
         if not body is None:
             self.handler.wfile.write(body)
         else:
-            shutil.copyfileobj(self.wfile, self.handler.wfile,
-                               self.content_length)
+            copyfile(self.wfile, self.handler.wfile, self.content_length)
         self.wfile.close()
         self.handler.close_connection = 0
         
@@ -122,3 +220,7 @@ class HTTPMethodNotAllowed(HTTPException):
         super(HTTPMethodNotAllowed, self). \
             __init__(httplib.METHOD_NOT_ALLOWED, body)
 
+class HTTPRequestedRangeNotSatisfiable(HTTPException):
+    def __init__(self, body=None):
+        super(HTTPRequestedRangeNotSatisfiable, self). \
+            __init__(httplib.REQUESTED_RANGE_NOT_SATISFIABLE, body)
@@ -0,0 +1,108 @@
+import socket
+import threading
+import time
+
+class PortProber(object):
+    """Checks TCP connectivity to a batch of host:port targets at once.
+
+    Every target gets its own connect timeout, so an unreachable or
+    filtered port only costs its timeout and not that of the whole batch.
+    """
+
+    DEFAULT_TIMEOUT = 10    # seconds, per target
+    MAX_TIMEOUT = 60
+    MAX_WORKERS = 32
+
+    def __init__(self, workers=MAX_WORKERS):
+        self.workers = workers
+
+    def probe(self, host, port, timeout=DEFAULT_TIMEOUT, deadline=None):
+        """Connect to host:port once.  Returns a dict with the 'ip' and the
+        'milliseconds' it took to connect, or an 'error'.  The name
+        resolution counts against the 'deadline' (a time.time() value):
+        if it is past once the host is resolved, the target is 'skipped'."""
+        result = {'host': host, 'port': port}
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except socket.error, ex:
+            result['error'] = "Could not resolve host '%s': %s" % (host, ex)
+            return result
+        family, socktype, proto, _, addr = infos[0]
+        result['ip'] = addr[0]
+
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining < 0.1:
+                return self.skipped(host, port)
+            timeout = min(timeout, remaining)
+
+        sock = None
+        start = time.time()
+        try:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(timeout)
+            sock.connect(addr)
+            result['milliseconds'] = (time.time() - start) * 1000
+        except socket.timeout:
+            result['error'] = \
+                "Connection to host '%s', port %d timed out after %g seconds" \
+                % (host, port, timeout)
+        except socket.error, ex:
+            result['error'] = \
+                "Connection to host '%s', port %d failed: %s" % \
+                (host, port, ex)
+        finally:
+            if sock is not None:
+                sock.close()
+        return result
+
+    def skipped(self, host, port):
+        """The result of a target not checked for lack of time."""
+        return {'host': host, 'port': port, 'skipped': True,
+                'error': "Connection to host '%s', port %d not checked: " \
+                    "time limit reached" % (host, port)}
+
+    def probe_all(self, targets, timeout=DEFAULT_TIMEOUT, time_limit=None):
+        """Probe a list of {'host', 'port'[, 'timeout']} concurrently.
+        The results are returned in the same order as the targets.
+
+        With a 'time_limit' (seconds) the connects are cut short so the
+        whole batch ends in time: the targets that couldn't be checked
+        get an error with 'skipped' set."""
+        results = [None] * len(targets)
+        pending = list(enumerate(targets))
+        lock = threading.Lock()
+        deadline = None
+        if time_limit is not None:
+            deadline = time.time() + time_limit
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    i, target = pending.pop()
+                host, port = target['host'], int(target['port'])
+                seconds = target.get('timeout', timeout)
+                seconds = min(max(float(seconds), 0.1), self.MAX_TIMEOUT)
+                if deadline is not None and deadline - time.time() < 0.1:
+                    results[i] = self.skipped(host, port)
+                    continue
+                results[i] = self.probe(host, port, seconds, deadline)
+
+        threads = []
+        for _ in range(min(self.workers, len(targets))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            if deadline is None:
+                thread.join()
+            else:
+                # A name resolution can't be interrupted: don't wait for
+                # it past the time limit.
+                thread.join(max(deadline - time.time(), 0) + 1)
+        # A target without a result is still being resolved.
+        return [result or self.skipped(target['host'], int(target['port'])) \
+                    for target, result in zip(targets, results)]
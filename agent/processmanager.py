@@ -2,9 +2,21 @@ import os
 import shutil
 import subprocess
 import copy
+import threading
+import time
 
 class ProcessManager(object):
 
+    # How often wait() checks for commands it didn't start (e.g. started
+    # before the agent restarted).
+    POLL_INTERVAL = 0.5
+
+    # xid -> threading.Event set when the command exits.  Shared by the
+    # ProcessManager of every channel since the status of a command may
+    # be requested on a different channel than the one that started it.
+    events = {}
+    lock = threading.Lock()
+
     def __init__(self, xid_dir, pathenv=None):
         self.xid_dir = xid_dir
         if pathenv:
@@ -35,8 +47,40 @@ class ProcessManager(object):
 
         if immediate:
             p.wait()
-        
+            return
+
+        # 'prun' writes 'returncode' before it exits, so waiters are woken
+        # as soon as the command's status is final.
+        event = threading.Event()
+        with self.lock:
+            self.events[xid] = event
+        t = threading.Thread(target=self._reap, args=(p, event))
+        t.daemon = True
+        t.start()
+
+    def _reap(self, p, event):
+        p.wait()
+        event.set()
+
+    def wait(self, xid, timeout):
+        """Wait up to 'timeout' seconds for the command to finish.
+           Returns True if it has finished."""
+        with self.lock:
+            event = self.events.get(xid)
+        if event is not None:
+            event.wait(timeout)
+            return self.isdone(xid)
+        deadline = time.time() + timeout
+        while not self.isdone(xid):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+        return True
+
     def cleanup(self, xid):
+        with self.lock:
+            self.events.pop(xid, None)
         dirpath = os.path.join(self.xid_dir, str(xid))
         shutil.rmtree(dirpath)
 
@@ -4,6 +4,7 @@ Profiling support for the akiri.framework.
 """
 from __future__ import absolute_import
 import inspect
+import itertools
 import logging
 import sys
 import threading
@@ -126,31 +127,32 @@ class ProfileEntry(object):
 
 
 class Profiler(object):
-    """WSGI profile generator"""
+    """WSGI profile generator
+
+    By default every request is profiled and saved.  With `sample` = N only
+    one request in N is sampled - only those capture the details (i.e. SQL)
+    and are saved - plus every request taking at least `threshold` seconds,
+    with the application timings only.  `sample` = 0 samples none.
+    """
 
     ENTER = '__enter__'
     EXIT = '__exit__'
 
-    def __init__(self, store=None):
+    def __init__(self, store=None, sample=1, threshold=None):
         if store is None:
             self.store = StreamProfileStore()
         else:
             self.store = store
+        self.sample = sample
+        self.threshold = threshold
+        self._requests = itertools.count()
 
     def profile(self, event, app=None):
         """Generate a profile point."""
         # pylint: disable=no-self-use
         if hasattr(_localdata, 'profile'):
-            logmsg = event
-            if app:
-                if isinstance(app, basestring):
-                    logmsg = app + ' ' + event
-                else:
-                    logmsg = app.name() + ' ' + event
-            logger.info(logmsg)
+            logger.debug('%s %s', app or '', event)
             _localdata.profile.append(ProfileEntry(app=app, event=event))
-        else:
-            logger.debug('(empty)')
 
     def profile_enter(self, app=None):
         """Generate a profile ENTER event."""
@@ -173,26 +175,48 @@ class Profiler(object):
                 return None
         return profiler
 
+    def sampled(self):
+        """Return True if the request starting should be sampled."""
+        if self.sample == 1:
+            return True
+        if not self.sample:
+            return False
+        # itertools.count() is atomic (with the GIL)
+        return next(self._requests) % self.sample == 0
+
     def start(self, environ):
         """Enable profiling of this thread/request."""
-        # pylint: disable=no-self-use
-        logger.info('start')
+        logger.debug('start')
         _localdata.profile = []
+        _localdata.sampled = self.sampled()
         environ['__profile__'] = True
         environ['__profiler__'] = self
 
+    def is_sampled(self):
+        """Return True if the current request is sampled."""
+        # pylint: disable=no-self-use
+        return getattr(_localdata, 'sampled', False)
+
+    def is_slow(self, entries):
+        """Return True if the profiled request took at least `threshold`."""
+        if self.threshold is None or not entries:
+            return False
+        return entries[-1].timestamp - entries[0].timestamp >= self.threshold
+
     def finish(self, path_info, environ):
         """
         End profiling and save the resulting data.
         `path_info` is passed as a parameter - instead of being pulled from
         the environment since it may change during the application handling.
         """
+        sampled = self.is_sampled()
         entries = self.end()
         if entries:
             # The __profile__ environment variable lets apps -
             # which are particular URLs - opt-out of profiling.
             if '__profile__' in environ and environ['__profile__']:
-                self.save(path_info, entries)
+                if sampled or self.is_slow(entries):
+                    self.save(path_info, entries)
         if '__profile__' in environ:
             del environ['__profile__']
         if '__profiler__' in environ:
@@ -201,16 +225,17 @@ class Profiler(object):
     def end(self):
         """Disable profiling and return all profile data."""
         # pylint: disable=no-self-use
-        logger.info('end')
+        logger.debug('end')
         result = None
         if hasattr(_localdata, 'profile'):
             result = _localdata.profile
             del _localdata.profile
+        _localdata.sampled = False
         return result
 
     def save(self, url, entries):
         """Send the profiling data for this run to the store."""
-        logger.info('save')
+        logger.debug('save')
         app = None
         for entry in entries:
             if not (entry.app is None) and app != entry.app:
@@ -229,9 +254,12 @@ class SQLProfileHandler(logging.Handler):
             _localdata.profile.append(ProfileEntry(event=record))
 
     def filter(self, record):
-        msg = self.format(record)
-        if msg != '{}':
-            self.add_record(msg)
+        # Only the threads running a sampled request capture (and format)
+        # the records.
+        if getattr(_localdata, 'sql', False):
+            msg = self.format(record)
+            if msg != '{}':
+                self.add_record(msg)
         return False
 
     def emit(self, record):
@@ -256,21 +284,26 @@ class SQLProfiler(Profiler):
 
     def start_logger(self):
         """
-        Enable the logger which generates SQL statements.
+        Enable the capture of SQL statements for this thread.
         This method may be overridden to provide additional data.
         """
+        # The handler stays installed - removing it would stop the capture
+        # for the other threads too.
         self.logger.addHandler(self.handler)
+        _localdata.sql = True
 
     def remove_logger(self):
         """
-        Disable the logger which generates SQL statements.
+        Disable the capture of SQL statements for this thread.
         This method may be overridden to provide additional data.
         """
-        self.logger.removeHandler(self.handler)
+        # pylint: disable=no-self-use
+        _localdata.sql = False
 
     def start(self, environ):
-        self.start_logger()
         super(SQLProfiler, self).start(environ)
+        if self.is_sampled():
+            self.start_logger()
 
     def end(self):
         self.remove_logger()
@@ -2,7 +2,7 @@
 """Database format for profile information."""
 
 from sqlalchemy import Table, Column, ForeignKey
-from sqlalchemy import Integer, Float, String, DateTime
+from sqlalchemy import Integer, Float, String, DateTime, Text
 
 from ..sqlalchemy import create_all, get_metadata
 
@@ -43,3 +43,38 @@ class TraceDatabaseMixin(object):
         self.traces_table = cls.define_traces_table(metadata)
         self.trace_events_table = cls.define_trace_events_table(metadata)
         create_all()
+
+
+class SummaryDatabaseMixin(object):
+    """Mixin to provide the table of the profile summaries."""
+    # pylint: disable=attribute-defined-outside-init
+
+    @classmethod
+    def define_profile_summaries_table(cls, metadata):
+        """Construct the 'profile_summaries' table."""
+        if 'profile_summaries' in metadata.tables:
+            return metadata.tables['profile_summaries']
+        return Table('profile_summaries', metadata,
+                     Column('summaryid', Integer, primary_key=True),
+                     Column('kind', String, nullable=False),
+                     Column('name', String, nullable=False),
+                     Column('started_at', DateTime, nullable=False),
+                     Column('ended_at', DateTime, nullable=False,
+                            index=True),
+                     Column('count', Integer, nullable=False),
+                     Column('total', Float, nullable=False),
+                     Column('maximum', Float, nullable=False),
+                     Column('p50', Float),
+                     Column('p95', Float),
+                     Column('p99', Float),
+                     # JSON of the QuantileSketch, to merge periods.
+                     Column('sketch', Text, nullable=False))
+
+    def summary_create_all(self):
+        """
+        Instantiate the table object.
+        """
+        metadata = get_metadata()
+        self.summaries_table = \
+            SummaryDatabaseMixin.define_profile_summaries_table(metadata)
+        create_all()
@@ -0,0 +1,67 @@
+# Copyright (c) Akiri Solutions, Inc.  All Rights Reserved.
+"""
+Streaming quantile estimates for the profile summaries.
+"""
+import math
+
+class QuantileSketch(object):
+    """
+    Quantiles of a stream of positive values (durations) with a bounded
+    relative error: the values are counted in logarithmic buckets, so the
+    memory used depends on the range of the values - not their number - and
+    two sketches can be merged.
+    """
+    ACCURACY = 0.01
+    MIN_VALUE = 1e-6
+
+    def __init__(self, accuracy=ACCURACY, buckets=None):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        if buckets is None:
+            self.buckets = {}
+        else:
+            self.buckets = buckets
+        self.count = sum(self.buckets.itervalues())
+
+    def add(self, value):
+        """Count a value."""
+        value = max(value, self.MIN_VALUE)
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        """Count all the values of another sketch (of the same accuracy)."""
+        for key, count in other.buckets.iteritems():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1) or None if empty."""
+        if not self.count:
+            return None
+        # nearest-rank: the smallest value with at least q of the values
+        # less or equal to it.
+        rank = max(int(math.ceil(q * self.count)) - 1, 0)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                break
+        # the middle of the bucket (gamma^(key-1), gamma^key]
+        # pylint: disable=undefined-loop-variable
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def todict(self):
+        """Convert to a dict() that can be serialized to JSON."""
+        return {'accuracy': self.accuracy,
+                'buckets': dict([(str(key), count)
+                                 for key, count in self.buckets.iteritems()])}
+
+    @classmethod
+    def fromdict(cls, data):
+        """Re-create a sketch from the todict() data."""
+        buckets = dict([(int(key), count)
+                        for key, count in data['buckets'].iteritems()])
+        return cls(accuracy=data['accuracy'], buckets=buckets)
@@ -0,0 +1,185 @@
+# Copyright (c) Akiri Solutions, Inc.  All Rights Reserved.
+"""
+Profile store keeping summaries - instead of every profile - in memory.
+"""
+from __future__ import absolute_import
+import re
+import threading
+import time
+
+from .. import logger, Profiler
+from ..sketch import QuantileSketch
+from . import ProfileStore
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMS = re.compile(r"\(\s*(?:%\(\w+\)s|%s|\?|:\w+)" + \
+                     r"(?:\s*,\s*(?:%\(\w+\)s|%s|\?|:\w+))*\s*\)")
+_SPACE = re.compile(r"\s+")
+
+MAX_FINGERPRINT = 1000
+
+def fingerprint(statement):
+    """
+    Normalize an SQL statement so that the statements differing only by
+    their literals or the number of bind parameters of a list are the same.
+    """
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _PARAMS.sub('(...)', statement)
+    statement = _SPACE.sub(' ', statement).strip()
+    return statement[:MAX_FINGERPRINT]
+
+def is_parameters(event):
+    """Return True if the logged SQLAlchemy event is the parameters of the
+    previous statement."""
+    return event[:1] in ('{', '(', '[')
+
+
+class Summary(object):
+    """Count, total, maximum and quantiles of a set of durations."""
+
+    def __init__(self, count=0, total=0.0, maximum=0.0, sketch=None):
+        self.count = count
+        self.total = total
+        self.maximum = maximum
+        if sketch is None:
+            self.sketch = QuantileSketch()
+        else:
+            self.sketch = sketch
+
+    def add(self, seconds):
+        """Add a duration."""
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        self.sketch.add(seconds)
+
+    def merge(self, other):
+        """Add all the durations of another summary."""
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+
+    def todict(self):
+        """Convert to a dict() that can be serialized to JSON."""
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.maximum,
+                'p50': self.sketch.quantile(0.50),
+                'p95': self.sketch.quantile(0.95),
+                'p99': self.sketch.quantile(0.99)}
+
+
+class AggregateProfileStore(ProfileStore):
+    """
+    Summarize the profiles by route - the innermost application handling the
+    request - and by SQL statement fingerprint.  The summaries of the last
+    `flush_interval` seconds are passed to write() in one batch (when a
+    profile is saved after the interval) and the summaries since the start
+    are kept for top().  The time of a statement runs until the next event.
+
+    With a sampling Profiler the counts are those of the saved requests.
+    """
+    ROUTE = 'route'
+    SQL = 'sql'
+    OTHER = '(other)'
+
+    FLUSH_INTERVAL = 300    # seconds
+    MAX_NAMES = 1000        # per kind, the others are summarized as OTHER
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.window = {}    # (kind, name) -> Summary since the last flush
+        self.totals = {}    # (kind, name) -> Summary since the start
+        self.names = {self.ROUTE: 0, self.SQL: 0}
+        self.window_start = time.time()
+
+    @classmethod
+    def durations(cls, path_info, entries):
+        """Generate the (kind, name), seconds of a profile."""
+        # pylint: disable=too-many-branches
+        if not entries:
+            return
+        route = None
+        statement = None
+        started_at = None
+        for entry in entries:
+            if entry.event not in (Profiler.ENTER, Profiler.EXIT) and \
+               is_parameters(entry.event):
+                continue
+            if statement is not None:
+                yield (cls.SQL, fingerprint(statement)), \
+                    entry.timestamp - started_at
+                statement = None
+            if entry.event == Profiler.ENTER:
+                if entry.app:
+                    route = entry.name()
+            elif entry.event != Profiler.EXIT:
+                statement = entry.event
+                started_at = entry.timestamp
+        yield (cls.ROUTE, route or path_info), \
+            entries[-1].timestamp - entries[0].timestamp
+
+    def _summary(self, summaries, key):
+        """The summary of 'key' in 'summaries', created if necessary.
+        The caller must hold the lock."""
+        summary = summaries.get(key)
+        if summary is None:
+            summary = summaries[key] = Summary()
+        return summary
+
+    def save(self, path_info, entries):
+        durations = list(self.durations(path_info, entries))
+        with self.lock:
+            for key, seconds in durations:
+                if key not in self.totals:
+                    if self.names[key[0]] >= self.MAX_NAMES:
+                        key = (key[0], self.OTHER)
+                    else:
+                        self.names[key[0]] += 1
+                self._summary(self.totals, key).add(seconds)
+                self._summary(self.window, key).add(seconds)
+            flush = time.time() - self.window_start >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Pass the summaries since the last flush to write()."""
+        with self.lock:
+            window = self.window
+            started_at = self.window_start
+            self.window = {}
+            self.window_start = time.time()
+        if not window:
+            return
+        try:
+            self.write(window, started_at, self.window_start)
+        except StandardError:
+            logger.exception('profile summaries lost')
+
+    def write(self, summaries, started_at, ended_at):
+        """
+        Persist the {(kind, name): Summary} of the period between the
+        epoch seconds started_at and ended_at.  Summaries are kept only in
+        memory by default.
+        """
+        pass
+
+    def top(self, kind, limit=20, order='total'):
+        """
+        Return the summaries of `kind` since the start as a list of dicts,
+        highest `order` (total, count, max, p50, p95 or p99) first.
+        """
+        with self.lock:
+            rows = []
+            for (summary_kind, name), summary in self.totals.iteritems():
+                if summary_kind != kind:
+                    continue
+                row = summary.todict()
+                row['name'] = name
+                rows.append(row)
+        rows.sort(key=lambda row: row[order], reverse=True)
+        return rows[:limit]
@@ -3,10 +3,12 @@
 Backend profile store using SQLAlchemy.
 """
 from datetime import datetime
+import json
 
 from ...sqlalchemy import sqa
-from ..mixin import TraceDatabaseMixin
+from ..mixin import TraceDatabaseMixin, SummaryDatabaseMixin
 from . import ProfileStore
+from .aggregate import AggregateProfileStore
 
 class DatabaseProfileStore(ProfileStore, TraceDatabaseMixin):
     """
@@ -52,3 +54,40 @@ class DatabaseProfileStore(ProfileStore, TraceDatabaseMixin):
                                        timestamp=timestamp)
         finally:
             connection.close()
+
+
+class DatabaseAggregateProfileStore(AggregateProfileStore,
+                                    SummaryDatabaseMixin):
+    """
+    Summarize the profiles in memory and insert the summaries into the
+    'profile_summaries' table every `flush_interval` seconds, with a single
+    statement.
+    """
+
+    def __init__(self, flush_interval=AggregateProfileStore.FLUSH_INTERVAL):
+        super(DatabaseAggregateProfileStore, self).__init__(
+            flush_interval=flush_interval)
+        self.summary_create_all()
+
+    def write(self, summaries, started_at, ended_at):
+        started_at = datetime.utcfromtimestamp(started_at)
+        ended_at = datetime.utcfromtimestamp(ended_at)
+        rows = []
+        for (kind, name), summary in summaries.iteritems():
+            data = summary.todict()
+            rows.append({'kind': kind,
+                         'name': name,
+                         'started_at': started_at,
+                         'ended_at': ended_at,
+                         'count': data['count'],
+                         'total': data['total'],
+                         'maximum': data['max'],
+                         'p50': data['p50'],
+                         'p95': data['p95'],
+                         'p99': data['p99'],
+                         'sketch': json.dumps(summary.sketch.todict())})
+        connection = sqa.connect()
+        try:
+            connection.execute(self.summaries_table.insert(), rows)
+        finally:
+            connection.close()
@@ -7,7 +7,10 @@ This module implements a generic router middleware for the `akiri.framework`.
 
 import logging
 import re
+import sre_constants
+import sre_parse
 from collections import OrderedDict
+from itertools import chain
 from webob import exc
 
 from . import GenericWSGI, ENVIRON_PREFIX
@@ -26,6 +29,74 @@ class Route(object):
         self.preserve_path_info = preserve_path_info
         self.profile = profile
         self.compiled_pattern = re.compile(pattern, self.flags)
+        self.prefix, self.static = literal_prefix(pattern, self.flags)
+
+
+def literal_prefix(pattern, flags=0):
+    """
+    Return the literal text every match of the pattern starts with and
+    whether the pattern matches nothing but that text (a static path
+    i.e. r'/about\Z').
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (sre_constants.error, TypeError):
+        return '', False
+    if parsed.pattern.flags & re.IGNORECASE:
+        return '', False
+
+    prefix = []
+    items = list(parsed)
+    if items and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+        items = items[1:]
+    for i, (opcode, value) in enumerate(items):
+        if opcode == sre_constants.LITERAL and value < 128:
+            prefix.append(chr(value))
+            continue
+        static = i == len(items) - 1 and \
+            (opcode, value) == (sre_constants.AT, sre_constants.AT_END_STRING)
+        return ''.join(prefix), static
+    return ''.join(prefix), False
+
+
+class RouteIndex(object):
+    """
+    The routes of a Router indexed by their literal prefix: only the routes
+    whose prefix starts the path are tried (still in order), and a static
+    path is found with a dict lookup.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self.count = len(self.routes)
+        self.static = {}    # path -> position of the first static route
+        self.prefixes = {}  # length -> {prefix: [positions]}
+        for position, route in enumerate(self.routes):
+            if route.static:
+                self.static.setdefault(route.prefix, position)
+                continue
+            prefixes = self.prefixes.setdefault(len(route.prefix), {})
+            prefixes.setdefault(route.prefix, []).append(position)
+        self.lengths = sorted(self.prefixes)
+
+    def candidates(self, path):
+        """Generate the routes that may match the path, in order."""
+        found = []
+        for length in self.lengths:
+            if length > len(path):
+                break
+            positions = self.prefixes[length].get(path[:length])
+            if positions:
+                found.append(positions)
+        static = self.static.get(path)
+        for position in sorted(chain(*found)):
+            if static is not None and static < position:
+                yield self.routes[static]
+                static = None
+            yield self.routes[position]
+        if static is not None:
+            yield self.routes[static]
 
 # FIXME: change to RouteInfo
 class RouteMatch(object):
@@ -80,6 +151,7 @@ class Router(GenericWSGI):
     def __init__(self):
         super(Router, self).__init__(app=None)
         self.routes = []
+        self._index = None
 
     @property
     def routemap(self):
@@ -97,14 +169,15 @@ class Router(GenericWSGI):
                       preserve_path_info=preserve_path_info,
                       profile=profile)
         self.routes.insert(0, route)
-        logger.info('prepend_route: ' + pattern)
+        self._index = None
+        logger.info('prepend_route: %s', pattern)
         return route
 
     def prepend_routes(self, patterns, app, flags=0,
                        preserve_path_info=False, profile=True):
         """Add a list of routes for a particular app befor existing routes."""
         # pylint: disable=too-many-arguments
-        for pattern in patterns.reverse():
+        for pattern in reversed(patterns):
             self.prepend_route(pattern, app, flags=flags,
                            preserve_path_info=preserve_path_info,
                            profile=profile)
@@ -118,7 +191,8 @@ class Router(GenericWSGI):
                       preserve_path_info=preserve_path_info,
                       profile=profile)
         self.routes.append(route)
-        logger.info('add_route: ' + pattern)
+        self._index = None
+        logger.info('add_route: %s', pattern)
         return route
 
     def add_routes(self, patterns, app, flags=0,
@@ -136,7 +210,8 @@ class Router(GenericWSGI):
                           append_script_name=append_script_name)
         route = Route(pattern, app, flags=flags)
         self.routes.append(route)
-        logger.info('add_redirect: ' + pattern + ' -> ' + location)
+        self._index = None
+        logger.info('add_redirect: %s -> %s', pattern, location)
         return route
 
     def match(self, path):
@@ -144,15 +219,18 @@ class Router(GenericWSGI):
         Find the application object for a particular URL.
         Returns a RouteMatch object containing the results.
         """
-        for route in self.routes:
-            match = re.match(route.compiled_pattern, path)
+        index = self._index
+        if index is None or index.count != len(self.routes):
+            # built on the first request (or after self.routes was changed).
+            index = self._index = RouteIndex(self.routes)
+        for route in index.candidates(path):
+            match = route.compiled_pattern.match(path)
             if not match is None:
                 result = ReRouteMatch(route, path, match)
-                logger.info("%s matched '%s', remainder='%s'", path,
-                            route.pattern, result.remainder)
+                logger.debug("%s matched '%s', remainder='%s'", path,
+                             route.pattern, result.remainder)
                 return result
-            else:
-                logger.debug('mismatch ' + path + " '" + route.pattern + "'")
+        logger.debug("%s: no route matched", path)
         return None
 
     def service(self, req):
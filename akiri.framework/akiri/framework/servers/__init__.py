@@ -4,3 +4,4 @@ import pkg_resources
 pkg_resources.declare_namespace(__name__)
 
 from .map import MapApplication
+from .profile import ProfileSummaryApplication
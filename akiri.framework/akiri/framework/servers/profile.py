@@ -0,0 +1,40 @@
+"""Application that reports the top profile summaries."""
+from __future__ import absolute_import
+from webob import exc
+
+from .. import GenericWSGIApplication
+
+class ProfileSummaryApplication(GenericWSGIApplication):
+    """Shows the routes and SQL statements taking the most time in JSON,
+    from an AggregateProfileStore.
+
+    Addtional dependencies:
+      None
+    Query parameters:
+      limit: the number of summaries of each kind, 20 by default.
+      order: total (default), count, max, p50, p95 or p99.
+    Environment output:
+      None
+    """
+    ORDERS = ('total', 'count', 'max', 'p50', 'p95', 'p99')
+
+    def __init__(self, store):
+        super(ProfileSummaryApplication, self).__init__()
+        self.store = store
+
+    def service_GET(self, req):
+        """Return the top summaries as JSON"""
+        # pylint: disable=invalid-name
+        if '__profile__' in req.environ:
+            # Don't generate more profile data for this request.
+            del req.environ['__profile__']
+        order = req.params.get('order', 'total')
+        if order not in self.ORDERS:
+            raise exc.HTTPBadRequest()
+        try:
+            limit = int(req.params.get('limit', 20))
+        except ValueError:
+            raise exc.HTTPBadRequest()
+        return {'order': order,
+                'routes': self.store.top(self.store.ROUTE, limit, order),
+                'sql': self.store.top(self.store.SQL, limit, order)}
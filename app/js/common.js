@@ -9,8 +9,10 @@ function ($, topic, status, paging, Dropdown)
 {
     /* MONITOR TIMER */
     var interval = 1000; // milliseconds
+    var wait = 25; // seconds the server may hold an unchanged request
     var timer = null;
     var current = null;
+    var etag = null; /* ETag of the current monitor data */
     var needEvents = true;
     var filters_hidden = false;
 
@@ -26,6 +28,10 @@ function ($, topic, status, paging, Dropdown)
         first: 0,
         last: 0,
         count: 0,
+        /* page shown and cursors of its first and last event */
+        page: 0,
+        head: null,
+        tail: null,
         liveUpdate: true, /* update events on next poll cycle? */
 
         queryString: function () {
@@ -52,8 +58,20 @@ function ($, topic, status, paging, Dropdown)
 
             if (paging.getPageNumber() > 1 ) {
                 if (eventFilter.liveUpdate) {
-                    array.push('limit='+paging.limit);
-                    array.push('page='+paging.getPageNumber());
+                    /* page relative to the one shown: the cost doesn't
+                       depend on how deep the page is. */
+                    var page = paging.getPageNumber();
+                    var limit = paging.limit;
+                    if (page == this.page + 1 && this.tail != null) {
+                        array.push('before='+this.tail);
+                    } else if (page == this.page - 1 && this.head != null) {
+                        array.push('after='+this.head);
+                    } else if (page == paging.getPageCount()) {
+                        array.push('oldest=true');
+                        limit = paging.getItemCount() - (page - 1) * limit;
+                    }
+                    array.push('limit='+limit);
+                    array.push('page='+page);
                     array.push('ref='+this.ref);
                 } else {
                     array.push('event=false');
@@ -249,6 +267,15 @@ function ($, topic, status, paging, Dropdown)
     function monitorUpdateEvents(data)
     {
         updateEventList(data);
+
+        var events = data['events'];
+        if (events != null && events.length > 0) {
+            var last = events[events.length-1];
+            eventFilter.page = paging.getPageNumber();
+            eventFilter.head = events[0]['reference-time'] + ',' +
+                events[0].eventid;
+            eventFilter.tail = last['reference-time'] + ',' + last.eventid;
+        }
         Dropdown.setupAll(data);
         paging.config(data);
 
@@ -397,13 +424,31 @@ function ($, topic, status, paging, Dropdown)
 
     function poll() {
         var url = '/rest/monitor?'+eventFilter.queryString();
+        var seq = eventFilter.seq;
+        var headers = {};
+
+        /* Long-poll: the server replies when the data no longer matches
+           the ETag or with a 304 after 'wait' seconds. */
+        if (etag != null) {
+            url += '&wait=' + wait;
+            headers['If-None-Match'] = etag;
+        }
 
         $.ajax({
             url: url,
-            success: function(data) {
+            headers: headers,
+            success: function(data, textStatus, jqXHR) {
                 $().ready(function() {
+                    if (jqXHR.status == 304) {
+                        /* unchanged, unless superseded by another request */
+                        if (seq == eventFilter.seq) {
+                            timer = setTimeout(poll, interval);
+                        }
+                        return;
+                    }
                     var retval = monitorUpdate(data);
                     if (retval) {
+                        etag = jqXHR.getResponseHeader('ETag');
                         timer = setTimeout(poll, interval);
                     }
                 });
@@ -415,6 +460,7 @@ function ($, topic, status, paging, Dropdown)
                     data['text'] = 'Your Browser is Disconnected';
                     data['color'] = 'yellow';
                     data['connected'] = false;
+                    etag = null;
                     monitorUpdate(data); /* can't return false. */
                     timer = setTimeout(poll, interval);
                 });
@@ -5,21 +5,25 @@ import Cookie
 
 class EmptyCsrfStorage():
     """ Interface to implement for CSRF backing storage """
-    def create_token(self, old_token, current_time):
-        """ A function with a signature `(current_time:DateTime) => token:String`
+    def create_token(self, old_token, current_time, session=None):
+        """ A function with a signature
+            `(old_token:String, current_time:DateTime, session:String) => token:String`
 
             that generates a new token that can be validated later using
-            `validateTokenFn(token, current_time)`
+            `validate_token(token, current_time, session)`.  `session` is the
+            value of the session (login) cookie or '' if there is none.
         """
         raise NotImplementedError("createToken() not implemented")
 
-    def validate_token(self, token, current_time):
+    def validate_token(self, token, current_time, session=None):
         """
-            A function with the signature `(token:String, current_time: DateTime) => Bool`
+            A function with the signature
+            `(token:String, current_time: DateTime, session:String) => Bool`
 
-            that return True if `token` is valid at `current_time`.
-            The no-replay guarantee requires this function to remove the token
-            from the list of valid ones after a single use
+            that return True if `token` is valid at `current_time` for
+            `session`.  A storage keeping the tokens should remove the token
+            from the list of valid ones after a single use (no-replay);
+            a stateless one bounds the replay by the token lifetime instead.
         """
         raise NotImplementedError("validateToken() not implemented")
 
@@ -38,6 +42,7 @@ class CsrfMiddleware():
     def __init__(self, app,
                  storage=EmptyCsrfStorage(),
                  token_cookie_name="PaletteCsrfToken",
+                 session_cookie_name="auth_tkt",
                  logger=logging):
         """ Creates a new CSRF middleware.
 
@@ -50,12 +55,16 @@ class CsrfMiddleware():
         token_cookie_name:
             The name of the Cookie that will be used to store the CSRF token
 
+        session_cookie_name:
+            The name of the (login) Cookie the tokens are bound to
+
         logger:
             A python logging compatible logger that will be used for all log messages.
         """
         self._app = app
         self._logger = logger
         self._token_cookie_name = token_cookie_name
+        self._session_cookie_name = session_cookie_name
         # Save the Fns
         self._storage = storage
         # boot
@@ -68,8 +77,10 @@ class CsrfMiddleware():
         # Get the current time so we can save the token with an expiration
         current_time = datetime.datetime.now()
 
-        # Fetch the current time
-        existing_token = self._get_cookie(env)
+        # Fetch the current token and session
+        cookies = self._get_cookies(env)
+        existing_token = self._cookie_value(cookies, self._token_cookie_name)
+        session = self._cookie_value(cookies, self._session_cookie_name) or ''
 
 
         if self._should_check_for_cookie(env):
@@ -79,7 +90,8 @@ class CsrfMiddleware():
                 return self._send_csrf_failiure_response(start_response)
 
             # Fail if token check fails
-            if not self._storage.validate_token(existing_token, current_time):
+            if not self._storage.validate_token(existing_token, current_time,
+                                                session=session):
                 return self._send_csrf_failiure_response(start_response)
 
 
@@ -91,10 +103,17 @@ class CsrfMiddleware():
             # Get the current time so we can save the token with an expiration
             current_time = datetime.datetime.now()
 
-            self.log(logging.INFO, "existing CSRF token = '%s'", existing_token)
+            self.log(logging.DEBUG, "existing CSRF token = '%s'", existing_token)
+
+            # Bind the new token to the session the browser will have
+            # (i.e. the one set by the login response).
+            new_session = self._response_session(headers)
+            if new_session is None:
+                new_session = session
 
             # Generate a new token
-            token = self._storage.create_token(existing_token, current_time)
+            token = self._storage.create_token(existing_token, current_time,
+                                               session=new_session)
 
             # Cookie-fy the token and set it
             session_cookie = Cookie.SimpleCookie()
@@ -125,22 +144,46 @@ class CsrfMiddleware():
         return env['REQUEST_METHOD'] in ['POST', 'PUT']
 
 
-    def _get_cookie(self, env):
-        """ Attempts to return the CSRF token cookie or None if CSRF cookie is not set """
+    def _get_cookies(self, env):
+        """ Returns the parsed request cookies or None if there are none """
         # If no cookies present, then the token is None
         if 'HTTP_COOKIE' not in env:
             return None
 
         # Parse the cookies by using Cookie.SimpleCookie()
         c = Cookie.SimpleCookie()
-        c.load(env["HTTP_COOKIE"])
+        try:
+            c.load(env["HTTP_COOKIE"])
+        except Cookie.CookieError:
+            return None
+        return c
+
 
-        # If no cookie then no cookie
-        if not self._token_cookie_name in c:
+    def _cookie_value(self, cookies, name):
+        """ Returns the value of the cookie `name` or None if it is not set """
+        if cookies is None or name not in cookies:
             return None
 
         # extract the cookie value
-        return c[self._token_cookie_name].value
+        return cookies[name].value
+
+
+    def _response_session(self, headers):
+        """ Returns the session cookie value set by the response headers
+        or None if the response doesn't set it """
+        for name, value in headers:
+            if name.lower() != 'set-cookie':
+                continue
+            if not value.startswith(self._session_cookie_name + '='):
+                continue
+            c = Cookie.SimpleCookie()
+            try:
+                c.load(value)
+            except Cookie.CookieError:
+                continue
+            if self._session_cookie_name in c:
+                return c[self._session_cookie_name].value
+        return None
 
 
     def log(self, lvl, msg, *args, **kwargs):
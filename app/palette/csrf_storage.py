@@ -3,6 +3,15 @@ import uuid
 import threading
 import numbers
 import datetime
+import hashlib
+import hmac
+import os
+import time
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from controller.system import SystemKeys, NOTIFY_CHANNEL
 
 
 def generate_token():
@@ -32,7 +41,7 @@ class InMemoryCsrfStorage(LoggingComponent):
         # Create a lock to protect the tokens dict
         self._lock = threading.Lock()
 
-    def create_token(self, old_token, current_time):
+    def create_token(self, old_token, current_time, session=None):
         token = generate_token()
 
         # Ensure locking
@@ -47,7 +56,7 @@ class InMemoryCsrfStorage(LoggingComponent):
             self._tokens[token] = current_time
             return token
 
-    def validate_token(self, token, current_time):
+    def validate_token(self, token, current_time, session=None):
         self.log(logging.DEBUG, "validating token: %s", token)
         with self._lock:
             return token in self._tokens
@@ -123,6 +132,28 @@ class SqlBackedComponent(LoggingComponent):
         return connection.execute(sql)
 
 
+    def execute(self, sql_string, **params):
+        """ Runs the SQL statement with bind parameters (':name') on a
+        connection of its own and returns the rows, if any, or None if
+        there is no connection available """
+        if self._connectionFn is None:
+            self.log(logging.INFO, "No SqlAlchemy connection function - cannot use backing store")
+            return None
+
+        connection = self._connectionFn()
+        if connection is None:
+            self.log(logging.ERROR, "SqlAlchemy connection function returned None - cannot use backing store")
+            return None
+
+        try:
+            result = connection.execute(text(sql_string), **params)
+            if result.returns_rows:
+                return result.fetchall()
+            return []
+        finally:
+            connection.close()
+
+
     def run_single_value(self, defaultValue, sql_string, *args):
         """ Attempts to run an SQL statement that results in a single value and return that value.
 
@@ -145,44 +176,73 @@ class SqlBackedComponent(LoggingComponent):
 
 
 class SqlCsrfStorage(SqlBackedComponent):
-    """ Generic store for CSRF tokens implemented on top of SqlAlchemy / PostgreSQL """
+    """ Generic store for CSRF tokens implemented on top of SqlAlchemy / PostgreSQL.
+
+    Each response replaces the old token of the browser with a new one, valid
+    for `max_age` seconds.  The tokens that expire without being replaced are
+    deleted at most once every PRUNE_INTERVAL seconds (with the expires_at index).
+    """
+
+    MAX_AGE = 12 * 60 * 60  # seconds
+    PRUNE_INTERVAL = 10 * 60  # seconds
 
     def __init__(self,
                  connectionFn=None,
                  table_name="palette_csrf_tokens",
-                 logger=logging.getLogger('sql-csrf-storage')):
+                 logger=logging.getLogger('sql-csrf-storage'),
+                 max_age=MAX_AGE):
         SqlBackedComponent.__init__(self, connectionFn, table_name=table_name, logger=logger)
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self._pruned_at = None
+        self._lock = threading.Lock()
+        self._create_index()
 
 
-    def create_token(self, old_token, current_time):
-        """ Implementation for createToken """
-
-        def generate_new_token():
-            token = generate_token()
-
-            self.run_sql("INSERT INTO {0} (token_str, expires_at) VALUES ('{1}', '{2}')",
-                         self.table_name, token, current_time)
-            return token
-
-        def delete_old_token():
-            if old_token is None:
-                return
-
-            self.run_sql("DELETE FROM {0} WHERE token_str='{1}'",
-                         self.table_name, old_token)
+    def _create_index(self):
+        """ Creates the expires_at index used by prune() if it does not exist """
+        index = self.table_name + "_expires_at_idx"
+        rows = self.execute("SELECT 1 FROM pg_class WHERE relname = :name", name=index)
+        if rows is not None and not rows:
+            self.execute("CREATE INDEX {0} ON {1} (expires_at)".format(index, self.table_name))
 
 
-        delete_old_token()
-        return generate_new_token()
+    def create_token(self, old_token, current_time, session=None):
+        """ Implementation for createToken: replaces the old token (if any)
+        with a new one in a single statement """
+        token = generate_token()
+        self.execute(("WITH old AS (DELETE FROM {0} WHERE token_str = :old_token) "
+                      "INSERT INTO {0} (token_str, expires_at) "
+                      "VALUES (:token, :expires_at)").format(self.table_name),
+                     old_token=old_token, token=token,
+                     expires_at=current_time + self.max_age)
+        self.prune(current_time)
+        return token
 
 
-    def validate_token(self, token, current_time):
+    def validate_token(self, token, current_time, session=None):
         """ Validate a token by checking it in the DB """
+        rows = self.execute(("SELECT 1 FROM {0} WHERE token_str = :token "
+                             "AND expires_at > :current_time").format(self.table_name),
+                            token=token, current_time=current_time)
+        return bool(rows)
 
-        token_count =  self.run_single_value(0, "SELECT COUNT(1) FROM {0} WHERE token_str = '{1}'",
-                                             self.table_name, token)
 
-        return token_count > 0
+    def prune(self, current_time, force=False):
+        """ Deletes the expired tokens, unless that was done less than
+        PRUNE_INTERVAL seconds ago.  Returns the number of tokens deleted. """
+        with self._lock:
+            if not force and self._pruned_at is not None and \
+               current_time - self._pruned_at < datetime.timedelta(seconds=self.PRUNE_INTERVAL):
+                return 0
+            self._pruned_at = current_time
+
+        rows = self.execute(("DELETE FROM {0} WHERE expires_at <= :current_time "
+                             "RETURNING 1").format(self.table_name),
+                            current_time=current_time)
+        count = len(rows or [])
+        if count:
+            self.log(logging.DEBUG, "pruned %d expired CSRF tokens", count)
+        return count
 
 
     def _table_sql(self):
@@ -195,6 +255,252 @@ class SqlCsrfStorage(SqlBackedComponent):
 
 
 
+class SignedCsrfStorage(SqlBackedComponent):
+    """ Stateless CSRF tokens: a token is signed (HMAC-SHA256) with a secret
+    key, carries its issue time and is bound to the session cookie, so it is
+    validated without any database access and nothing is written per request.
+
+    A token is '<key id>.<issue time>.<nonce>.<signature>' and is valid for
+    `max_age` seconds.  Unlike the stored tokens, a token may be replayed
+    (within the same session) until it expires.
+
+    The keys are kept in the system table: the current one is created once
+    and replaced every `rotate_interval` seconds by whichever process notices
+    first; the previous one is still accepted.  The keys are re-read at most
+    every RELOAD_INTERVAL seconds (sooner for an unknown key id, but not more
+    than every MIN_RELOAD_INTERVAL seconds).
+
+    The times are UTC seconds since the epoch read from `clock`: the naive,
+    local `current_time` passed by the middleware is ambiguous when DST ends.
+    """
+
+    MAX_AGE = 12 * 60 * 60  # seconds
+    ROTATE_INTERVAL = 7 * 24 * 60 * 60  # seconds
+    RELOAD_INTERVAL = 5 * 60  # seconds
+    MIN_RELOAD_INTERVAL = 10  # seconds
+
+    def __init__(self,
+                 connectionFn=None,
+                 table_name="system",
+                 logger=logging.getLogger('signed-csrf-storage'),
+                 max_age=MAX_AGE,
+                 rotate_interval=ROTATE_INTERVAL,
+                 clock=time.time):
+        # The system table already exists: skip _create_table()
+        LoggingComponent.__init__(self, logger)
+        self.table_name = table_name
+        self._connectionFn = connectionFn
+        self.max_age = max_age
+        self.rotate_interval = rotate_interval
+        self._clock = clock
+        self._envid = None
+        self._keys = {}          # key id -> key
+        self._current = None     # (key id, key) used to sign
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+
+    def create_token(self, old_token, current_time, session=None):
+        """ Implementation for createToken: the old token is simply dropped """
+        now = int(self._clock())
+        keyid, key = self._signing_key(now)
+        issued = '%x' % now
+        nonce = os.urandom(8).encode('hex')
+        return '.'.join([keyid, issued, nonce,
+                         sign(key, issued, nonce, session)])
+
+
+    def validate_token(self, token, current_time, session=None):
+        """ Validate a token by checking its signature and age """
+        parts = token.split('.')
+        if len(parts) != 4:
+            return False
+        keyid, issued, nonce, signature = parts
+        now = int(self._clock())
+        try:
+            age = now - int(issued, 16)
+        except ValueError:
+            return False
+        if age < 0 or age > self.max_age:
+            self.log(logging.DEBUG, "expired CSRF token: %s", token)
+            return False
+
+        key = self._verifying_key(keyid, now)
+        if key is None:
+            self.log(logging.INFO, "CSRF token with unknown key: %s", keyid)
+            return False
+        return compare_digest(sign(key, issued, nonce, session), signature)
+
+
+    def _signing_key(self, now):
+        with self._lock:
+            if self._current is None or \
+               now - self._loaded_at >= self.RELOAD_INTERVAL:
+                self._load(now)
+            return self._current
+
+
+    def _verifying_key(self, keyid, now):
+        with self._lock:
+            if self._current is None or \
+               now - self._loaded_at >= self.RELOAD_INTERVAL or \
+               (keyid not in self._keys and \
+                now - self._loaded_at >= self.MIN_RELOAD_INTERVAL):
+                self._load(now)
+            return self._keys.get(keyid)
+
+
+    def _load(self, now):
+        """ (Re-)reads the keys from the system table, creating or rotating
+        the current key when necessary.  The caller must hold the lock. """
+        self._loaded_at = now
+        try:
+            keys = self._read_keys()
+            if keys is not None:
+                current = keys.get(SystemKeys.CSRF_SECRET)
+                if current is None or current[0] + self.rotate_interval <= now:
+                    self._rotate(current, now)
+                    keys = self._read_keys()
+        except StandardError:
+            # pylint: disable=broad-except
+            self.log(logging.ERROR, "cannot read the CSRF keys", exc_info=True)
+            if self._current is not None:
+                return
+            keys = None
+
+        if keys is None or SystemKeys.CSRF_SECRET not in keys:
+            # Without a database the tokens are only valid in this process.
+            if self._current is None:
+                self.log(logging.ERROR, "using a temporary CSRF key")
+                key = os.urandom(32)
+                self._current = (key_id(key), key)
+                self._keys = {self._current[0]: key}
+            return
+
+        self._keys = {}
+        for name in (SystemKeys.CSRF_SECRET_PREVIOUS, SystemKeys.CSRF_SECRET):
+            if name in keys:
+                key = keys[name][1]
+                self._keys[key_id(key)] = key
+        key = keys[SystemKeys.CSRF_SECRET][1]
+        self._current = (key_id(key), key)
+
+
+    def _read_keys(self):
+        """ Returns {system key: (creation time, key)} or None without
+        a database """
+        if self._envid is None:
+            rows = self.execute("SELECT envid FROM environment")
+            if not rows:
+                return None
+            self._envid = rows[0][0]
+
+        rows = self.execute(("SELECT key, value FROM {0} WHERE envid = :envid "
+                             "AND key IN (:current, :previous)").format(self.table_name),
+                            envid=self._envid,
+                            current=SystemKeys.CSRF_SECRET,
+                            previous=SystemKeys.CSRF_SECRET_PREVIOUS)
+        if rows is None:
+            return None
+
+        keys = {}
+        for name, value in rows:
+            try:
+                created, key = value.split(':', 1)
+                keys[name] = (int(created), key.decode('hex'))
+            except (AttributeError, TypeError, ValueError):
+                self.log(logging.ERROR, "invalid %s value in the system table", name)
+        return keys
+
+
+    def _rotate(self, current, now):
+        """ Replaces the `current` (creation time, key) - if any - with a
+        new key, unless another process did so first.  The replaced key
+        becomes the previous one. """
+        value = '%d:%s' % (now, os.urandom(32).encode('hex'))
+        connection = self._connectionFn()
+        transaction = connection.begin()
+        try:
+            if current is None:
+                # no row or a row without a (valid) value
+                result = connection.execute(text(
+                    ("UPDATE {0} SET value = :value, modification_time = now() "
+                     "WHERE envid = :envid AND key = :key "
+                     "AND (value IS NULL OR value !~ '^[0-9]+:[0-9a-f]+$')").format(self.table_name)),
+                                            envid=self._envid, key=SystemKeys.CSRF_SECRET,
+                                            value=value)
+                if result.rowcount == 0:
+                    connection.execute(text(
+                        ("INSERT INTO {0} (envid, key, value) "
+                         "VALUES (:envid, :key, :value)").format(self.table_name)),
+                                       envid=self._envid, key=SystemKeys.CSRF_SECRET,
+                                       value=value)
+            else:
+                old_value = '%d:%s' % (current[0], current[1].encode('hex'))
+                result = connection.execute(text(
+                    ("UPDATE {0} SET value = :value, modification_time = now() "
+                     "WHERE envid = :envid AND key = :key "
+                     "AND value = :old_value").format(self.table_name)),
+                                            envid=self._envid, key=SystemKeys.CSRF_SECRET,
+                                            value=value, old_value=old_value)
+                if result.rowcount != 1:
+                    # Rotated by someone else meanwhile
+                    transaction.rollback()
+                    return
+                self._save_previous(connection, old_value)
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               channel=NOTIFY_CHANNEL, payload=str(self._envid))
+            transaction.commit()
+            self.log(logging.INFO, "new CSRF key")
+        except IntegrityError:
+            # Created by someone else meanwhile
+            transaction.rollback()
+        except StandardError:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+
+    def _save_previous(self, connection, value):
+        result = connection.execute(text(
+            ("UPDATE {0} SET value = :value, modification_time = now() "
+             "WHERE envid = :envid AND key = :key").format(self.table_name)),
+                                    envid=self._envid,
+                                    key=SystemKeys.CSRF_SECRET_PREVIOUS, value=value)
+        if result.rowcount == 0:
+            connection.execute(text(
+                ("INSERT INTO {0} (envid, key, value) "
+                 "VALUES (:envid, :key, :value)").format(self.table_name)),
+                               envid=self._envid,
+                               key=SystemKeys.CSRF_SECRET_PREVIOUS, value=value)
+
+
+def _compare_digest(a, b):
+    """ Constant time string comparison (hmac.compare_digest is 2.7.7+) """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def key_id(key):
+    """ A short, public identifier of a signing key """
+    return hashlib.sha256(key).hexdigest()[:8]
+
+
+def sign(key, issued, nonce, session):
+    """ The token signature binding `issued` and `nonce` to the session """
+    message = '.'.join([issued, nonce, hashlib.sha256(session or '').hexdigest()])
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+
+
 
 class UserLockoutStorage(SqlBackedComponent):
     """ Generic store for User login attempts implemented on top of SqlAlchemy / PostgreSQL """
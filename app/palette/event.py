@@ -1,15 +1,32 @@
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from webob import exc
 import re
 
+from sqlalchemy import and_, or_
+
 import akiri.framework.sqlalchemy as meta
 
-from controller.event import EventEntry
+from controller.event import EventEntry, EventCount
 from controller.profile import Role
 
 __all__ = ["EventHandler"]
 
+def parse_cursor(value):
+    """Convert a 'reference-time,eventid' cursor - as in the event dict -
+    to (timestamp, eventid) or None.  The reference time is epoch seconds
+    with microseconds which are kept exactly."""
+    if not value:
+        return None
+    try:
+        reference_time, eventid = value.split(',')
+        seconds, _, micro = reference_time.partition('.')
+        timestamp = datetime.utcfromtimestamp(int(seconds)) + \
+            timedelta(microseconds=int((micro + '000000')[:6]))
+        return timestamp, int(eventid)
+    except ValueError:
+        raise exc.HTTPBadRequest("Invalid cursor: " + value)
+
 class EventHandler(object):
 
     NAME = 'events'
@@ -74,7 +91,7 @@ class EventHandler(object):
 
         data = {}
         data['events'] = events
-        data['count'] = EventEntry.count(filters) # FIXME: approximate?
+        data['count'] = EventCount.count(filters)
         return data
 
     def query_page(self, envid, page, status=None, event_type=None,
@@ -114,10 +131,69 @@ class EventHandler(object):
 
         data = {}
         data['events'] = events
-        data['count'] = EventEntry.count(filters)
+        data['count'] = EventCount.count(filters)
+        return data
+
+    def query_keyset(self, envid, before=None, after=None, limit=None,
+                     status=None, event_type=None, publisher=None):
+        """Return the page of events older than the 'before' cursor, newer
+        than the 'after' cursor or, with neither, the oldest events.
+        Unlike query_page() the cost doesn't depend on the page number."""
+        # pylint: disable=too-many-arguments
+        # pylint: disable=maybe-no-member
+        filters = OrderedDict({'envid': envid})
+
+        if not publisher is None:
+            filters['userid'] = publisher
+        if status:
+            filters['level'] = status
+        if event_type:
+            filters['event_type'] = event_type
+
+        query = meta.Session.query(EventEntry)
+        query = EventEntry.apply_filters(query, filters)
+
+        if before:
+            timestamp, eventid = before
+            # The first condition is the index range, the second one the
+            # exact (timestamp, eventid) < (:timestamp, :eventid).
+            query = query.filter(and_(EventEntry.timestamp <= timestamp,
+                                      or_(EventEntry.timestamp < timestamp,
+                                          EventEntry.eventid < eventid)))
+            query = query.order_by(EventEntry.timestamp.desc(),
+                                   EventEntry.eventid.desc())
+        else:
+            if after:
+                timestamp, eventid = after
+                query = query.filter(and_(EventEntry.timestamp >= timestamp,
+                                          or_(EventEntry.timestamp > timestamp,
+                                              EventEntry.eventid > eventid)))
+            query = query.order_by(EventEntry.timestamp,
+                                   EventEntry.eventid)
+
+        if limit is None:
+            limit = self.DEFAULT_PAGE_SIZE
+        entries = query.limit(limit).all()
+        if not before:
+            # newest first, as always.
+            entries.reverse()
+
+        events = []
+        for event in entries:
+            evdict = event.todict(pretty=True)
+            self.convert_description_to_html(evdict)
+            self.fixup_icon(evdict)
+            events.append(evdict)
+
+        data = {}
+        data['events'] = events
+        data['count'] = EventCount.count(filters)
         return data
 
     # ts is epoch seconds as a float.
+    # 'before' and 'after' are cursors (see parse_cursor) of the last and
+    # the first event of the page shown: the next and the previous page.
+    # 'oldest' is the last page.
     def handle_GET(self, req):
         timestamp = req.params_getfloat('ts')
         if not timestamp is None:
@@ -127,6 +203,15 @@ class EventHandler(object):
         if req.remote_user.roleid == Role.NO_ADMIN:
             publisher = req.remote_user.userid
 
+        before = parse_cursor(req.params_get('before'))
+        after = parse_cursor(req.params_get('after'))
+        if before or after or req.params_getbool('oldest', False):
+            return self.query_keyset(req.envid, before=before, after=after,
+                                     limit=req.params_getint('limit'),
+                                     status=req.params_get('status'),
+                                     event_type=req.params_get('type'),
+                                     publisher=publisher)
+
         page = req.params_getint('page')
         if page is None:
             return self.query_mostrecent(req.envid,
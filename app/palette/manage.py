@@ -45,9 +45,10 @@ class ManageApplication(PaletteRESTApplication, RestoreMixin):
     def handle_backup(self, req):
         """ Do a backup (duplicated in backup.py) """
         sync = req.params_getbool('sync', default=False)
-        self.commapp.send_cmd('backup', req=req, read_response=sync)
+        result = self.commapp.send_cmd('backup', req=req,
+                                       read_response=sync)
         if sync:
-            return self.commapp.result
+            return result
         return status_ok()
 
     @required_role(Role.MANAGER_ADMIN)
@@ -1,5 +1,10 @@
+import hashlib
+import json
+import threading
+import time
+
 from sqlalchemy import or_
-from webob import exc
+from webob import exc, Response
 from collections import OrderedDict
 
 import akiri.framework.sqlalchemy as meta
@@ -26,6 +31,9 @@ __all__ = ["MonitorApplication"]
 
 BUY_URL = 'https://licensing.palette-software.com/buy'
 
+# Seconds a request may wait (long-poll) for the monitor data to change.
+MAX_MONITOR_WAIT = 30
+
 class Colors(object):
     RED_NUM = 1
     YELLOW_NUM = 2
@@ -85,7 +93,8 @@ def calculate_main_state(req, agents):
     """Determine the main state of the environment from the agents connected.
     This is the overall state as shown to administrators (not publishers)
     """
-    if req.system[SystemKeys.UPGRADING]:
+    system = req.system # read the system table once.
+    if system[SystemKeys.UPGRADING]:
         return StateManager.STATE_UPGRADING
 
     for entry in agents:
@@ -96,17 +105,81 @@ def calculate_main_state(req, agents):
                 # one primary per environment so no need to continue
                 break
 
-    main_state = req.system[SystemKeys.STATE]
+    main_state = system[SystemKeys.STATE]
     if main_state is None:
         return StateManager.STATE_DISCONNECTED
     return main_state
 
 
+class Snapshot(object):
+    """One build of (part of) the monitor data."""
+    # pylint: disable=too-few-public-methods
+    def __init__(self, data, built):
+        self.data = data
+        self.built = built
+
+
+class SnapshotCache(object):
+    """Monitor data shared by all the requests - i.e. all the open browser
+    tabs - served by this process.  An entry is built by at most one
+    request per 'interval' seconds, the other requests use that build (or
+    wait for the one in progress) so the database load doesn't grow with
+    the number of clients."""
+
+    MAX_ENTRIES = 256
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.entries = OrderedDict()
+        self.building = set()
+
+    def get(self, key, build):
+        """Return the Snapshot of 'key', calling build() for the data if
+        there is none or it is more than 'interval' seconds old."""
+        with self.cond:
+            while True:
+                while key in self.building:
+                    self.cond.wait()
+                snapshot = self.entries.get(key)
+                if snapshot is not None and \
+                        time.time() < snapshot.built + self.interval:
+                    return snapshot
+                self.building.add(key)
+                break
+
+        snapshot = None
+        try:
+            snapshot = Snapshot(build(), time.time())
+        finally:
+            with self.cond:
+                self.building.discard(key)
+                if snapshot is not None:
+                    self.entries.pop(key, None)
+                    self.entries[key] = snapshot
+                    while len(self.entries) > self.MAX_ENTRIES:
+                        self.entries.popitem(last=False)
+                self.cond.notify_all()
+        return snapshot
+
+
 class MonitorApplication(PaletteRESTApplication):
-    """The main monitor callback to handle status and event updates."""
+    """The main monitor callback to handle status and event updates.
+
+    The state of the environment (agents, processes, etc.) and each
+    distinct event query are built at most once per INTERVAL for all the
+    clients (see SnapshotCache).  The response carries an ETag: a request
+    with a matching If-None-Match gets a 304 and, with 'wait=S', is held
+    for up to S seconds until the data changes (long-poll) - an unchanged
+    state then costs the client a single response instead of one per
+    INTERVAL."""
+
+    INTERVAL = 1 # seconds
+
     def __init__(self):
         super(MonitorApplication, self).__init__()
         self.event = EventHandler()
+        self.cache = SnapshotCache(self.INTERVAL)
 
     def status_options(self, req):
         valueid = req.params_get('status', '0')
@@ -136,10 +209,7 @@ class MonitorApplication(PaletteRESTApplication):
             return 'yellow'
         return 'green'
 
-    def volume_info(self, req, agent):
-        low = self.disk_watermark(req, 'low')
-        high = self.disk_watermark(req, 'high')
-
+    def volume_info(self, agent, low, high):
         volumes = []
         query = meta.Session.query(AgentVolumesEntry).\
             filter(AgentVolumesEntry.agentid == agent.agentid)
@@ -219,10 +289,9 @@ class MonitorApplication(PaletteRESTApplication):
 
         return lowest_color_num
 
-    def handle_monitor(self, req):
-        """Collect all state for this environment needed by the UI."""
-
-        # FIXME: just generate a list of dicts here using agent.todict()
+    def build_status(self, req):
+        """Build the state of the environment, as shown to administrators
+        (with all the allowable actions) and to publishers."""
         agent_entries = known_agents(req.envid)
 
         main_state = calculate_main_state(req, agent_entries)
@@ -231,47 +300,108 @@ class MonitorApplication(PaletteRESTApplication):
         if not state_control_entry:
             print "UNKNOWN STATE!  State:", main_state
             # fixme: stop everything?  Log this somewhere?
-            return
+            return None
+
+        return {'admin': self.get_admin_view(req, main_state,
+                                             state_control_entry,
+                                             agent_entries),
+                'publisher': self.get_publisher_view(main_state)}
+
+    def build_events(self, req):
+        events = self.event.handle_GET(req)
+        return {'events': events['events'], 'item-count': events['count']}
+
+    def events_key(self, req):
+        """The requests with the same key get the same events."""
+        publisher = None
+        if req.remote_user.roleid == Role.NO_ADMIN:
+            publisher = req.remote_user.userid
+        return ('events', req.envid, publisher) + \
+            tuple([req.params_get(name)
+                   for name in ('status', 'type', 'page', 'limit', 'ts',
+                                'before', 'after', 'oldest')])
+
+    def monitor_data(self, req):
+        """Return the monitor data for this request (or None) and the time
+        of the oldest snapshot it was made from."""
+        snapshot = self.cache.get(('status', req.envid),
+                                  lambda: self.build_status(req))
+        if snapshot.data is None:
+            return None, snapshot.built
+        built = snapshot.built
 
         if req.remote_user.roleid == Role.NO_ADMIN:
             # publisher:
-            monitor_ret = self.get_publisher_view(main_state)
+            view = snapshot.data['publisher']
         else:
-            monitor_ret = self.get_admin_view(req, main_state,
-                                              state_control_entry,
-                                              agent_entries)
+            view = snapshot.data['admin']
+        if view is None:
+            return None, built
+        # The snapshot is shared: only modify a copy.
+        monitor_ret = dict(view)
+        if view['admin'] and req.remote_user.roleid < Role.MANAGER_ADMIN:
+            monitor_ret['allowable-actions'] = []
 
         config = [self.status_options(req), self.type_options(req)]
         monitor_ret['config'] = config
 
-        seq = req.params_getint('seq')
-        if not seq is None:
-            monitor_ret['seq'] = seq
-
         if not 'event' in req.GET or \
            ('event' in req.GET and req.GET['event'] != 'false'):
 
-            events = self.event.handle_GET(req)
-            monitor_ret['events'] = events['events']
-            monitor_ret['item-count'] = events['count']
+            snapshot = self.cache.get(self.events_key(req),
+                                      lambda: self.build_events(req))
+            monitor_ret.update(snapshot.data)
+            built = min(built, snapshot.built)
 
-        monitor_ret['interval'] = 1000 # ms
+        monitor_ret['interval'] = self.INTERVAL * 1000 # ms
 
-        return monitor_ret
+        return monitor_ret, built
+
+    def handle_monitor(self, req):
+        """Collect all state for this environment needed by the UI."""
+        wait = min(max(req.params_getint('wait', 0), 0), MAX_MONITOR_WAIT)
+        deadline = time.time() + wait
+
+        while True:
+            monitor_ret, built = self.monitor_data(req)
+            if monitor_ret is None:
+                return
+            etag = hashlib.sha1(json.dumps(monitor_ret,
+                                           sort_keys=True)).hexdigest()
+            if not etag in req.if_none_match:
+                break
+            now = time.time()
+            if now >= deadline:
+                raise exc.HTTPNotModified(headers=[('ETag', '"%s"' % etag)])
+            # Don't hold a database connection while waiting.
+            meta.Session.close()
+            time.sleep(max(min(deadline, built + self.INTERVAL) - now, 0))
+
+        seq = req.params_getint('seq')
+        if not seq is None:
+            monitor_ret['seq'] = seq
+
+        res = Response(content_type='application/json')
+        res.body = json.dumps(monitor_ret) + '\n'
+        res.etag = etag
+        return res
 
     def get_admin_view(self, req, main_state, state_control_entry,
                        agent_entries):
         # pylint: disable=too-many-branches
         # pylint: disable=too-many-locals
         # pylint: disable=too-many-statements
-        """Return information for an administrator."""
+        """Return information for an administrator.  The allowable actions
+        are those of a manager (or above), see monitor_data()."""
         allowable_actions = []
-        if req.remote_user.roleid >= Role.MANAGER_ADMIN:
-            # Convert the space-separated string to a list, e.g.
-            # "start stop reset" --> ["start", "stop", "reset"]
-            s = state_control_entry.allowable_actions
-            if s:
-                allowable_actions = s.split(' ')
+        # Convert the space-separated string to a list, e.g.
+        # "start stop reset" --> ["start", "stop", "reset"]
+        s = state_control_entry.allowable_actions
+        if s:
+            allowable_actions = s.split(' ')
+
+        low = self.disk_watermark(req, 'low')
+        high = self.disk_watermark(req, 'high')
 
         # The overall color starts at the state_control color.
         # It can get worse (e.g. green to yellow or red) , but not better
@@ -351,7 +481,7 @@ class MonitorApplication(PaletteRESTApplication):
                     if lic_color < agent_color_num:
                         agent_color_num = lic_color
 
-                agent['volumes'] = self.volume_info(req, entry)
+                agent['volumes'] = self.volume_info(entry, low, high)
                 agent['in_ports'] = self.firewall_info(entry)
                 agent['out_ports'] = self.out_ports(entry)
                 cpu_info = self.cpu_info(req.envid, entry)
@@ -500,12 +630,11 @@ class MonitorApplication(PaletteRESTApplication):
                 return
 
             allowable_actions = []
-            if req.remote_user.roleid >= Role.MANAGER_ADMIN:
-                # Convert the space-separated string to a list, e.g.
-                # "start stop reset" --> ["start", "stop", "reset"]
-                s = state_control_entry.allowable_actions
-                if s:
-                    allowable_actions = s.split(' ')
+            # Convert the space-separated string to a list, e.g.
+            # "start stop reset" --> ["start", "stop", "reset"]
+            s = state_control_entry.allowable_actions
+            if s:
+                allowable_actions = s.split(' ')
 
             color = state_control_entry.color
             if color in Colors.color_to_num:
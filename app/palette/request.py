@@ -9,7 +9,7 @@ from controller.domain import Domain
 from controller.environment import Environment
 from controller.profile import UserProfile
 from controller.system import SystemEntry, SystemKeys, SystemMixin
-from controller.system import DEFAULTS, cast
+from controller.system import DEFAULTS, cast, notify
 from controller.util import translate_key
 
 class System(dict, SystemMixin):
@@ -34,6 +34,7 @@ class System(dict, SystemMixin):
         """
         dict.__delitem__(self, key)
         SystemEntry.delete(filters={'envid':self.req.envid, 'key':key})
+        notify(self.req.envid)
 
     def __setitem__(self, key, value):
         """ Update the system table but don't do a database commit """
@@ -46,6 +47,7 @@ class System(dict, SystemMixin):
         session = meta.Session()
         entry = SystemEntry(envid=self.req.envid, key=key, value=value)
         session.merge(entry)
+        notify(self.req.envid)
         dict.__setitem__(self, key, value)
 
     def import_dict(self, envid):
@@ -0,0 +1,111 @@
+import os
+import unittest
+
+# The palette package has its own 'controller' (a link): don't import the
+# controller package a second time.
+from palette.csrf_storage import SignedCsrfStorage, SystemKeys
+
+MAX_AGE = 60
+ROTATE_INTERVAL = 3600
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000000000
+
+    def __call__(self):
+        return self.now
+
+class FakeSignedCsrfStorage(SignedCsrfStorage):
+    """The keys are kept in a dict instead of the system table."""
+
+    def __init__(self, clock):
+        SignedCsrfStorage.__init__(self, logger=None, max_age=MAX_AGE,
+                                   rotate_interval=ROTATE_INTERVAL,
+                                   clock=clock)
+        self.rows = {}
+        self.rotations = 0
+
+    def _read_keys(self):
+        return dict(self.rows)
+
+    def _rotate(self, current, now):
+        if current is not None:
+            self.rows[SystemKeys.CSRF_SECRET_PREVIOUS] = current
+        self.rows[SystemKeys.CSRF_SECRET] = (now, os.urandom(32))
+        self.rotations += 1
+
+class SignedCsrfStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.storage = FakeSignedCsrfStorage(self.clock)
+
+    def create(self, session='auth'):
+        return self.storage.create_token(None, None, session=session)
+
+    def valid(self, token, session='auth'):
+        return self.storage.validate_token(token, None, session=session)
+
+    def test_sign_and_validate(self):
+        token = self.create()
+        self.assertEqual(len(token.split('.')), 4)
+        self.assertTrue(self.valid(token))
+        self.assertEqual(self.storage.rotations, 1)
+
+    def test_bound_to_the_session(self):
+        token = self.create()
+        self.assertFalse(self.valid(token, session='other'))
+        self.assertFalse(self.valid(token, session=''))
+        self.assertFalse(self.valid(self.create(session=''), session='auth'))
+
+    def test_tampered(self):
+        keyid, issued, nonce, signature = self.create().split('.')
+        self.assertFalse(self.valid('.'.join([keyid, issued, nonce, '0' * 64])))
+        later = '%x' % (int(issued, 16) + 1)
+        self.assertFalse(self.valid('.'.join([keyid, later, nonce, signature])))
+        self.assertFalse(self.valid('.'.join([keyid, 'xyz', nonce, signature])))
+        self.assertFalse(self.valid('garbage'))
+
+    def test_expiry(self):
+        token = self.create()
+        self.clock.now += MAX_AGE
+        self.assertTrue(self.valid(token))
+        self.clock.now += 1
+        self.assertFalse(self.valid(token))
+
+    def test_issued_in_the_future(self):
+        token = self.create()
+        self.clock.now -= 1
+        self.assertFalse(self.valid(token))
+
+    def test_rotation(self):
+        self.storage.max_age = 2 * ROTATE_INTERVAL
+        token = self.create()
+        self.clock.now += ROTATE_INTERVAL
+        # The new key signs, the previous one still validates.
+        new_token = self.create()
+        self.assertEqual(self.storage.rotations, 2)
+        self.assertNotEqual(new_token.split('.')[0], token.split('.')[0])
+        self.assertTrue(self.valid(token))
+        self.assertTrue(self.valid(new_token))
+
+        # Two rotations later the first key is forgotten.
+        self.clock.now += ROTATE_INTERVAL
+        self.create()
+        self.assertEqual(self.storage.rotations, 3)
+        self.assertFalse(self.valid(token))
+        self.assertTrue(self.valid(new_token))
+
+    def test_rotated_by_another_process(self):
+        token = self.create()
+        self.storage.rows[SystemKeys.CSRF_SECRET_PREVIOUS] = \
+            self.storage.rows[SystemKeys.CSRF_SECRET]
+        self.storage.rows[SystemKeys.CSRF_SECRET] = \
+            (self.clock.now, os.urandom(32))
+        self.clock.now += SignedCsrfStorage.MIN_RELOAD_INTERVAL
+        # An unknown key id makes it re-read the keys.
+        other = FakeSignedCsrfStorage(self.clock)
+        other.rows = self.storage.rows
+        self.assertTrue(self.valid(other.create_token(None, None,
+                                                      session='auth')))
+        self.assertTrue(self.valid(token))
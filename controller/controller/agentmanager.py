@@ -7,6 +7,8 @@ import threading
 import time
 import json
 import traceback
+import Queue
+from contextlib import contextmanager
 
 import exc
 import httplib
@@ -47,6 +49,14 @@ class AgentConnection(object):
     # pylint: disable=too-many-instance-attributes
     _CID = 1
 
+    # Sent with every request.  Agents that support more than one channel
+    # echo it back so a response can never be matched to the wrong request.
+    REQUEST_ID_HEADER = 'X-Palette-Request-Id'
+
+    # What is left of a response whose reader stopped early is read and
+    # discarded up to this size; beyond it the channel is closed instead.
+    DRAIN_MAX = 1024 * 1024
+
     def __init__(self, server, conn, addr, peername):
         self.server = server
         self.socket = conn
@@ -63,9 +73,22 @@ class AgentConnection(object):
         self.last_activity = time.time()
         self.sent_disconnect_event = False
 
-        # Each agent connection has its own lock to allow only
-        # one thread to send/recv  on the agent socket at a time.
-        self.lockobj = threading.RLock()
+        # Each channel is a reverse HTTP connection that carries one
+        # request/response at a time.  The first channel is the connection
+        # the agent originally opened (httpconn); agents that support it
+        # may attach more (see AgentManager.attach_channel).  Idle channels
+        # wait in the queue: with a single channel this serializes
+        # requests exactly like the old per-connection lock did.
+        self.channels = []
+        self.idle_channels = Queue.Queue()
+
+        # Bulk transfers (files, proxied GETs) may never occupy every
+        # channel so pings and status requests are not stuck behind them.
+        self.bulk_cond = threading.Condition()
+        self.bulk_active = 0
+
+        self.request_id_lock = threading.Lock()
+        self.request_id = 0
 
         # A lock to allow only one user action (backup/restore/etc.)
         # at a time.
@@ -86,20 +109,163 @@ class AgentConnection(object):
         raise exc.HTTPException(res.status, res.reason,
                                 method=method, body=body)
 
-    def http_send(self, method, uri, body=None, headers=None):
+    def add_channel(self, httpconn):
+        """Make another reverse HTTP connection available for requests.
+           The first one added becomes 'httpconn'."""
+        httpconn.aconn = self
+        if not self.httpconn:
+            self.httpconn = httpconn
+        self.channels.append(httpconn)
+        self.idle_channels.put(httpconn)
+        with self.bulk_cond:
+            self.bulk_cond.notify_all()
+
+    def sockets(self):
+        """Return the sockets of all the channels of this connection."""
+        socks = [self.socket]
+        for httpconn in self.channels:
+            if httpconn.sock not in socks:
+                socks.append(httpconn.sock)
+        return socks
+
+    def _next_request_id(self):
+        with self.request_id_lock:
+            self.request_id += 1
+            return self.request_id
+
+    def _bulk_limit(self):
+        return max(1, len(self.channels) - 1)
+
+    def _bulk_acquire(self):
+        with self.bulk_cond:
+            while self.bulk_active >= self._bulk_limit():
+                self.bulk_cond.wait()
+            self.bulk_active += 1
+
+    def _bulk_release(self):
+        with self.bulk_cond:
+            self.bulk_active -= 1
+            self.bulk_cond.notify()
+
+    def _send(self, method, uri, body, headers):
+        """Send the request on the next idle channel.  Returns the channel
+           and the HTTPResponse, whose payload has not been read yet.  The
+           caller must pass the channel to _release()."""
         if headers is None:
             headers = {}
-        # Check to see if state is not PENDING or DISCONNECTED?
-        self.lock()
+        httpconn = self.idle_channels.get()
+        try:
+            reqid = str(self._next_request_id())
+            headers[self.REQUEST_ID_HEADER] = reqid
+            httpconn.request(method, uri, body, headers)
+            res = httpconn.getresponse()
+            echoed = res.getheader(self.REQUEST_ID_HEADER)
+            if not echoed is None and echoed != reqid:
+                raise httplib.HTTPException(
+                    "response for request id %s received for %s %s " \
+                    "(request id %s)" % (echoed, method, uri, reqid))
+        except BaseException:
+            self._release(httpconn, True, method, uri)
+            raise
+        return httpconn, res
+
+    def _release(self, httpconn, broken, method, uri):
+        if not broken:
+            self.idle_channels.put(httpconn)
+            return
+        # The stream state is unknown: the next request must not read
+        # what is left of this response.
+        if httpconn is self.httpconn:
+            # The first channel can't be dropped: close it so the next
+            # request on it fails and the agent reconnects.
+            logger.info("Closing the connection to agent conn_id %d "
+                        "after a failed %s %s",
+                        self.conn_id, method, uri)
+            try:
+                httpconn.sock.close()
+            except socket.error:
+                pass
+            self.idle_channels.put(httpconn)
+        else:
+            logger.info("Dropping channel to agent conn_id %d "
+                        "after a failed %s %s",
+                        self.conn_id, method, uri)
+            self.channels.remove(httpconn)
+            try:
+                httpconn.sock.close()
+            except socket.error:
+                pass
+
+    def _drain(self, res, limit):
+        """Read and discard the rest of the response, at most 'limit'
+           bytes.  Returns whether all of it was read."""
+        total = 0
+        try:
+            while total < limit:
+                data = res.read(65536)
+                if not data:
+                    return True
+                total += len(data)
+        except (EnvironmentError, httplib.HTTPException):
+            pass
+        return False
+
+    def request(self, method, uri, body=None, headers=None, bulk=False):
+        """Send a request on the next idle channel and read the whole
+           response.  Returns the HTTPResponse with the payload read into
+           its 'body' member.  Set 'bulk' for requests that may take a long
+           time to transfer so at least one channel stays free."""
+        # pylint: disable=too-many-arguments
+        if bulk:
+            self._bulk_acquire()
         try:
-            self.httpconn.request(method, uri, body, headers)
-            res = self.httpconn.getresponse()
-            # GONE can be returned from filemanager
-            if res.status not in (httplib.OK, httplib.GONE):
-                self._httpexc(res, method=method)
-            return res.read()
+            httpconn, res = self._send(method, uri, body, headers)
+            broken = True
+            try:
+                res.body = res.read()
+                broken = False
+                return res
+            finally:
+                self._release(httpconn, broken, method, uri)
         finally:
-            self.unlock()
+            if bulk:
+                self._bulk_release()
+
+    @contextmanager
+    def stream(self, method, uri, body=None, headers=None):
+        """Like request() for a response that is read incrementally:
+               with aconn.stream('POST', uri, body) as res:
+                   res.read(n) ...
+           The channel is held until the block exits.  Streams are always
+           'bulk' so they can't take every channel."""
+        self._bulk_acquire()
+        try:
+            httpconn, res = self._send(method, uri, body, headers)
+            broken = True
+            try:
+                yield res
+                # Whatever the caller didn't read must be drained before
+                # the channel can carry another request.
+                while res.read(65536):
+                    pass
+                broken = False
+            finally:
+                if broken:
+                    # The block stopped early (an exception or the
+                    # generator reading it was closed).
+                    broken = not self._drain(res, self.DRAIN_MAX)
+                self._release(httpconn, broken, method, uri)
+        finally:
+            self._bulk_release()
+
+    def http_send(self, method, uri, body=None, headers=None, bulk=False):
+        # pylint: disable=too-many-arguments
+        # Check to see if state is not PENDING or DISCONNECTED?
+        res = self.request(method, uri, body, headers, bulk=bulk)
+        # GONE can be returned from filemanager
+        if res.status not in (httplib.OK, httplib.GONE):
+            self._httpexc(res, method=method, body=res.body)
+        return res.body
 
     def http_send_json(self, uri, data, headers=None):
         if headers is None:
@@ -118,22 +284,11 @@ class AgentConnection(object):
             data['timeout'] = timeout
         body = json.dumps(data)
 
-        self.lock()
-        try:
-            self.httpconn.request('GET', '/proxy', body=body, headers=headers)
-            res = self.httpconn.getresponse()
-            if res.status < 200 or res.status >= 300:
-                self._httpexc(res, method='GET')
-            res.body = res.read()
-            return res
-        finally:
-            self.unlock()
-
-    def lock(self):
-        self.lockobj.acquire()
-
-    def unlock(self):
-        self.lockobj.release()
+        res = self.request('GET', '/proxy', body=body, headers=headers,
+                           bulk=True)
+        if res.status < 200 or res.status >= 300:
+            self._httpexc(res, method='GET', body=res.body)
+        return res
 
     def user_action_lock(self, blocking=True):
         return self.user_action_lockobj.acquire(blocking)
@@ -151,6 +306,9 @@ class AgentManager(threading.Thread):
 
     SSL_HANDSHAKE_TIMEOUT_DEFAULT = 5
 
+    AGENT_CHANNELS = 4
+    CHANNELS_HEADER = 'X-Palette-Channels'
+
     # Agent types
     AGENT_TYPE_PRIMARY = "primary"
     AGENT_TYPE_WORKER = "worker"
@@ -198,6 +356,15 @@ class AgentManager(threading.Thread):
         # A dictionary with all AgentConnections with the key being
         # the unique 'conn_id'.
         self.agents = {}
+        # Changed whenever an agent row is committed after the agent
+        # registers, is renamed or reclassified: see AgentSelectorCache
+        # (clihandler).
+        self.generation = 0
+
+        # The maximum number of connections (channels) an agent may use.
+        self.agent_channels = self.config.getint('controller',
+                                                 'agent_channels',
+                                                 default=self.AGENT_CHANNELS)
 
         self.socket_timeout = self.system[SystemKeys.SOCKET_TIMEOUT]
         self.ping_interval = self.system[SystemKeys.PING_REQUEST_INTERVAL]
@@ -319,6 +486,7 @@ class AgentManager(threading.Thread):
             filter(Agent.agent_type != AgentManager.AGENT_TYPE_PRIMARY).\
             all()
 
+        changed = False
         for entry in rows:
             if self.is_tableau_worker(entry):
                 agent_type = AgentManager.AGENT_TYPE_WORKER
@@ -332,6 +500,7 @@ class AgentManager(threading.Thread):
                              entry.agent_type, agent_type)
                 # Set the agent to the correct type.
                 entry.agent_type = agent_type
+                changed = True
 
                 # We correct displaynames only for workers.
                 if agent_type != AgentManager.AGENT_TYPE_WORKER:
@@ -345,6 +514,8 @@ class AgentManager(threading.Thread):
                     entry.display_order = display_order
 
         session.commit()
+        if changed:
+            self.generation += 1
 
     def _displayname_changeable(self, agent):
         """Determine whether or not we can change the displayname.
@@ -795,6 +966,7 @@ class AgentManager(threading.Thread):
                 filter(Agent.uuid == uuid).one()
             entry.displayname = displayname
             session.commit()
+            self.generation += 1
             if aconn:
                 aconn.displayname = displayname
         except NoResultFound:
@@ -1012,11 +1184,12 @@ class AgentManager(threading.Thread):
                 else:
                     logger.debug("Already sent the disconnect for conn_id %d",
                                  conn_id)
-            logger.debug("remove_agent: closing agent socket.")
-            if self._close(agent.connection.socket):
-                logger.debug("remove_agent: close agent socket succeeded")
-            else:
-                logger.debug("remove_agent: close agent socket failed")
+            logger.debug("remove_agent: closing agent sockets.")
+            for sock in agent.connection.sockets():
+                if self._close(sock):
+                    logger.debug("remove_agent: close agent socket succeeded")
+                else:
+                    logger.debug("remove_agent: close agent socket failed")
 
             del self.agents[conn_id]    # Deletes original one
         else:
@@ -1155,7 +1328,8 @@ class AgentManager(threading.Thread):
             line = traceback_string(all_on_one_line=False)
             self.server.event_control.gen(EventControl.SYSTEM_EXCEPTION,
                                       {'error': line,
-                                       'version': self.server.version})
+                                       'version': self.server.version},
+                                      sync=True)
             logger.error("Fatal: Exiting agent_handle_connection_pre " + \
                          "on exception.")
             # pylint: disable=protected-access
@@ -1204,9 +1378,13 @@ class AgentManager(threading.Thread):
             # on the Windows client when the agent tries to connect.
             time.sleep(.1)
 
-            aconn.httpconn = ReverseHTTPConnection(conn, aconn)
+            aconn.add_channel(ReverseHTTPConnection(conn, aconn))
+            # Agents that understand the header may open up to this many
+            # connections in total and identify the extra ones by
+            # returning a non-zero 'channel' in their /auth reply.
+            headers = {self.CHANNELS_HEADER: str(self.agent_channels)}
             # FIXME: why is this a POST?
-            body_json = aconn.http_send('POST', '/auth')
+            body_json = aconn.http_send('POST', '/auth', headers=headers)
             if body_json:
                 logger.debug("/auth returned " + str(body_json))
                 try:
@@ -1260,6 +1438,11 @@ class AgentManager(threading.Thread):
                     self._close(conn)
                     return
 
+            if body.get('channel'):
+                # An additional connection from an already connected agent.
+                self.attach_channel(aconn, body)
+                return
+
             aconn.auth = body
 
             agent = Agent.build(self.envid, aconn)
@@ -1333,6 +1516,36 @@ class AgentManager(threading.Thread):
 
             meta.Session.remove()   # does a rollback()
 
+    def attach_channel(self, aconn, body):
+        """Add the connection as another channel to the connected agent
+           with the same uuid.  The calling thread returns without closing
+           the socket: the channel lives until the agent is removed."""
+        uuid = body['uuid']
+        self.lock()
+        try:
+            parent = None
+            for key in self.agents:
+                if self.agents[key].uuid == uuid:
+                    parent = self.agents[key].connection
+                    break
+            if parent is None or \
+                    len(parent.channels) >= self.agent_channels:
+                logger.info("Rejecting channel %s from agent uuid %s, "
+                            "peername %s: %s", str(body['channel']), uuid,
+                            aconn.peername,
+                            parent is None and 'agent is not connected' \
+                                or 'too many channels')
+                self._close(aconn.socket)
+                return False
+            parent.add_channel(aconn.httpconn)
+        finally:
+            self.unlock()
+
+        logger.debug("Added channel %s to agent uuid %s, conn_id %d: "
+                     "%d channels", str(body['channel']), uuid,
+                     parent.conn_id, len(parent.channels))
+        return True
+
     def trigger_check_status_event(self):
         self.check_status_event.set()
 
@@ -1381,6 +1594,8 @@ class AgentManager(threading.Thread):
 
         session = meta.Session()
         session.commit()
+        # Only now can the agent selectors find the committed row.
+        self.generation += 1
 
         #fixme: not a great place to do this
         #aconn.displayname = agent.displayname
@@ -1,22 +1,20 @@
 """ Alerts delivery via Email """
 import logging
-import time
 from datetime import datetime
-import threading
 from sqlalchemy.orm.exc import NoResultFound
 
 import akiri.framework.sqlalchemy as meta
 
 from agent import Agent
 from domain import Domain
-from event_control import EventControl
+from event_control import EventControl, TemplateCache
 from email_limit import EmailLimitManager
-from .mailer import Mailer
+from outbox import EmailOutbox
 from profile import UserProfile
 from system import SystemKeys
+from timer_wheel import TimerWheel
 from util import UNDEFINED
 
-from mako.template import Template
 from mako import exceptions
 
 import mako.runtime
@@ -36,6 +34,13 @@ class AlertEmail(object):
         self.system = server.system
         self.server = server
         self.email_limit_manager = EmailLimitManager(server)
+        # Compiled templates, shared with the EventControlManager.
+        self.templates = TemplateCache()
+        self.outbox = EmailOutbox(server)
+        self.outbox.start()
+        # Delayed (disconnect) email checks.
+        self.timers = TimerWheel()
+        self.timers.start()
 
         self.alert_level = self.config.getint("alert", "alert_level",
                                               default=self.DEFAULT_ALERT_LEVEL)
@@ -115,7 +120,8 @@ class AlertEmail(object):
         message = event_entry.email_message
         if message:
             try:
-                mako_template = Template(message)
+                mako_template = self.templates.get(
+                    event_entry.key + ':email', message)
                 message = mako_template.render(**data)
             except StandardError:
                 message = "Email mako template message conversion failure: " + \
@@ -246,68 +252,58 @@ class AlertEmail(object):
         """
         # pylint: disable=too-many-arguments
 
-        if not self.system[SystemKeys.EMAIL_MUTE_RECONNECT_SECONDS]:
+        delay = self.system[SystemKeys.EMAIL_MUTE_RECONNECT_SECONDS]
+        if not delay:
             return True
 
-        tobj = threading.Thread(target=self._dis_thread,
-                args=(data, to_emails, bcc, subject, message))
-        tobj.daemon = True
-        tobj.start()
-
-    def _dis_thread(self, data, to_emails, bcc, subject, message):
-        """
-            Send a disconnect event email only if:
-                  The agent is still disconnected after the agent is
-                  still disconnected after
-                      EMAIL_MUTE_RECONNECT_SECONDS
-        """
-        # pylint: disable=too-many-arguments
-
-#        print "dis thread for", subject
-        logger.debug("_dis_thread for subject %s", subject)
+        logger.debug("_mute_dis_check for subject %s", subject)
         if not 'agentid' in data:
-            logger.error("_dis_thread: missing 'agentid': %s", str(data))
+            logger.error("_mute_dis_check: missing 'agentid': %s", str(data))
             return
         agentid = data['agentid']
 
         old_entry = Agent.get_by_id(agentid)
         if not old_entry:
-            logger.error("_dis_thread: No old row for agentid %d", agentid)
+            logger.error("_mute_dis_check: No old row for agentid %d",
+                         agentid)
             return
-        old_last_disconnect_time = old_entry.last_disconnect_time
 
-#        print "about to sleep"
-        time.sleep(float(self.system[SystemKeys.EMAIL_MUTE_RECONNECT_SECONDS]))
-#        print "woke up"
-        meta.Session.expire(old_entry)
-        entry = Agent.get_by_id(agentid)
-        if not entry:
-            logger.error("_dis_thread: No row for agentid %d", agentid)
-            return
-#        print "dis:\nold last_disconnect_time", old_last_disconnect_time
-#        print "new last_disconnect_time", entry.last_disconnect_time
-#        print "last_connection_time", entry.last_connection_time
-        if entry.connected():
-#            print 'now connected'
-            logger.debug("_dis_thread: agentid %d now connected.", agentid)
-            return
+        self.timers.schedule(float(delay), self._dis_check, agentid,
+                             old_entry.last_disconnect_time,
+                             to_emails, bcc, subject, message)
 
-#        print "not connected"
+    def _dis_check(self, agentid, old_last_disconnect_time,
+                   to_emails, bcc, subject, message):
+        """
+            Runs EMAIL_MUTE_RECONNECT_SECONDS after the disconnect (on the
+            timer wheel thread) and sends the disconnect event email
+            only if the agent is still disconnected since that disconnect.
+        """
+        # pylint: disable=too-many-arguments
+        try:
+            entry = Agent.get_by_id(agentid)
+            if not entry:
+                logger.error("_dis_check: No row for agentid %d", agentid)
+                return
+            if entry.connected():
+                logger.debug("_dis_check: agentid %d now connected.",
+                             agentid)
+                return
 
-        if old_last_disconnect_time != entry.last_disconnect_time:
-#            print "disconnect time changed"
-            logger.debug("_dis_thread: agentid %d disconnect time changed. "
-                         "Ignoring.", agentid)
-            return
+            if old_last_disconnect_time != entry.last_disconnect_time:
+                logger.debug("_dis_check: agentid %d disconnect time " + \
+                             "changed. Ignoring.", agentid)
+                return
 
-        logger.debug("_dis_thread: sending email for agentid %d: %s",
-                     agentid, subject)
-        self._do_send(to_emails, bcc, subject, message)
+            logger.debug("_dis_check: sending email for agentid %d: %s",
+                         agentid, subject)
+            self._do_send(to_emails, bcc, subject, message)
+        finally:
+            meta.Session.remove()
 
     def _do_send(self, to_emails, bcc, subject, message):
-        """ Do the actual send for a plain-text message """
-        mailer = Mailer(self.system[SystemKeys.FROM_EMAIL])
-        mailer.send(to_emails, subject, message, bcc=bcc)
+        """ Queue a plain-text message in the outbox. """
+        self.outbox.put(to_emails, subject, message, bcc=bcc)
 
     def make_default_message(self, event_entry, subject, data):
         """Given the event entry, subject (string)and data (dictionary),
@@ -1,6 +1,11 @@
 import logging
 import unicodedata
 
+from sqlalchemy import text
+
+import akiri.framework.sqlalchemy as meta
+
+from blob_store import BlobEntry
 from place_file import PlaceFile
 from sites import Site
 from profile import UserProfile
@@ -20,6 +25,7 @@ class ArchiveException(Exception):
 
 class ArchiveUpdateMixin(object):
     NAME = "unknown"
+    RETAIN_BATCH = 500
 
     def clean_filename(self, entry, revision=None, date_str=None):
         """Given an archive entry (datasource, workbook), create
@@ -96,6 +102,47 @@ class ArchiveUpdateMixin(object):
 
         return place
 
+    def retain_rows(self, retain_count, table, key, parent_key, order,
+                    archived, file_columns, blob_column=None):
+        """Remove the archived rows (those matching the 'archived' condition)
+           of 'table' beyond the first 'retain_count' per 'parent_key' in
+           'order', with their files and blob, if any.  The surplus rows
+           are found with one query and removed RETAIN_BATCH at a time.
+           Returns the number of rows removed."""
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-locals
+        columns = ', '.join([key] + file_columns + \
+                            (blob_column and [blob_column] or []))
+        stmt = ("SELECT %(columns)s FROM (" + \
+                "SELECT %(columns)s, ROW_NUMBER() OVER (" + \
+                "PARTITION BY %(parent_key)s ORDER BY %(order)s) AS n " + \
+                "FROM %(table)s WHERE %(archived)s) surplus " + \
+                "WHERE n > :retain_count") % \
+                {'columns': columns, 'parent_key': parent_key,
+                 'order': order, 'table': table, 'archived': archived}
+        connection = meta.get_connection()
+        try:
+            rows = connection.execute(text(stmt),
+                                      retain_count=retain_count).fetchall()
+            for i in range(0, len(rows), self.RETAIN_BATCH):
+                batch = rows[i:i + self.RETAIN_BATCH]
+                # The rows go first due to their foreign keys to the files.
+                connection.execute("DELETE FROM %s WHERE %s IN (%s)" % \
+                                   (table, key, ', '.join([str(row[0])
+                                                           for row in batch])))
+                fileids = [row[column] for row in batch
+                           for column in file_columns if row[column]]
+                self.server.files.remove_files(fileids)
+                if blob_column:
+                    for row in batch:
+                        if row[blob_column]:
+                            BlobEntry.release(row[blob_column])
+        finally:
+            connection.close()
+        if rows:
+            logger.debug("%s retain removed %d %s", self.NAME, len(rows), table)
+        return len(rows)
+
     def sendevent(self, key, system_user_id, error, data):
         """Send the event."""
 
@@ -0,0 +1,322 @@
+""" Durable queue and worker pool for workbook and datasource archiving. """
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, func
+from sqlalchemy import UniqueConstraint, text
+from sqlalchemy.schema import ForeignKey
+
+import akiri.framework.sqlalchemy as meta
+
+from agentmanager import AgentManager
+from archive_mixin import ArchiveException
+from manager import Manager
+from mixin import BaseMixin, BaseDictMixin
+from util import traceback_string
+
+logger = logging.getLogger()
+
+class ArchiveTaskEntry(meta.Base, BaseMixin, BaseDictMixin):
+    # pylint: disable=no-init
+    __tablename__ = "archive_tasks"
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+
+    taskid = Column(BigInteger, unique=True, nullable=False,
+                    autoincrement=True, primary_key=True)
+    envid = Column(BigInteger, ForeignKey("environment.envid"))
+    kind = Column(String, nullable=False)           # 'workbook', ...
+    updateid = Column(BigInteger, nullable=False)   # wuid, dsuid
+    site_id = Column(Integer)
+    status = Column(String, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_time = Column(DateTime, nullable=False)
+    last_error = Column(String)
+    creation_time = Column(DateTime, server_default=func.now())
+    modification_time = Column(DateTime, server_default=func.now(),
+                               onupdate=func.current_timestamp())
+
+    __table_args__ = (UniqueConstraint('kind', 'updateid'),)
+
+
+class ArchiveQueue(Manager):
+    """Workbook and datasource updates to archive are queued in the
+       'archive_tasks' table and archived by a pool of 'workers' threads.
+       At most 'agent_workers' tasks run at the same time on an agent
+       (each runs tabcmd on it) and the sites with pending tasks take
+       turns, so one site's bulk republish doesn't hold up the others.
+       A failed task is retried with backoff, up to 'max_attempts' times,
+       then kept as 'failed' until the next fixup(), which re-queues it
+       along with the tasks left 'running' by a restart.
+
+       The managers registered for a kind provide UPDATES, a tuple of the
+       update table, its key, the archived entry table and its key,
+       archive_enabled() and archive_task(agent, updateid) which returns
+       False if the update should be tried again."""
+    # pylint: disable=too-many-instance-attributes
+
+    WORKERS = 4
+    AGENT_WORKERS = 2
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 60        # seconds, doubled after each failure
+    MAX_RETRY_DELAY = 3600  # seconds
+    POLL_INTERVAL = 30      # seconds
+
+    def __init__(self, server):
+        super(ArchiveQueue, self).__init__(server)
+        config = getattr(server, 'config', None)
+        if config:
+            self.workers = config.getint('palette', 'archive_workers',
+                                         default=self.WORKERS)
+            self.agent_workers = config.getint('palette',
+                                               'archive_agent_workers',
+                                               default=self.AGENT_WORKERS)
+            self.max_attempts = config.getint('palette',
+                                              'archive_max_attempts',
+                                              default=self.MAX_ATTEMPTS)
+        else:
+            self.workers = self.WORKERS
+            self.agent_workers = self.AGENT_WORKERS
+            self.max_attempts = self.MAX_ATTEMPTS
+        self.managers = {}
+        self.cond = threading.Condition()
+        self.active = set()     # taskids being run by this process
+        self.running = {}       # agentid -> number of tasks running
+        self.served = {}        # site_id -> claim sequence, for turns
+        self.seq = 0
+        self.retain_locks = {}
+
+    def register(self, kind, manager):
+        self.managers[kind] = manager
+        self.retain_locks[kind] = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='archive-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def retry_delay(self, attempts):
+        """Seconds to wait before the next attempt after 'attempts'
+           failures."""
+        return min(self.RETRY_DELAY * 2 ** (attempts - 1),
+                   self.MAX_RETRY_DELAY)
+
+    def wakeup(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def enqueue(self, kind):
+        """Queue every update of 'kind' that isn't archived or queued yet,
+           with one statement.  Returns the number of tasks added."""
+        table, key, entry_table, entry_key = self.managers[kind].UPDATES
+        stmt = ("INSERT INTO archive_tasks (envid, kind, updateid, " + \
+                "site_id, status, attempts, next_attempt_time) " + \
+                "SELECT :envid, :kind, u.%(key)s, e.site_id, 'pending', " + \
+                "0, :now FROM %(table)s u " + \
+                "JOIN %(entry_table)s e USING (%(entry_key)s) " + \
+                "WHERE e.envid = :envid AND (u.url = '' OR u.url IS NULL) " + \
+                "AND NOT EXISTS (SELECT 1 FROM archive_tasks t " + \
+                "WHERE t.kind = :kind AND t.updateid = u.%(key)s)") % \
+                {'table': table, 'key': key, 'entry_table': entry_table,
+                 'entry_key': entry_key}
+        connection = meta.get_connection()
+        try:
+            # Serialized: a concurrent enqueue would violate the unique key.
+            with self.cond:
+                result = connection.execute(text(stmt), envid=self.envid,
+                                            kind=kind, now=datetime.utcnow())
+                self.cond.notify_all()
+        finally:
+            connection.close()
+        if result.rowcount:
+            logger.debug("archive queue: %d %s updates queued",
+                         result.rowcount, kind)
+        return result.rowcount
+
+    def fixup(self, kind):
+        """Re-queue the tasks of 'kind' left 'running' (i.e. by a restart)
+           or 'failed' (with their attempts reset) and forget the ones whose
+           update is gone, then queue any update missing from the queue.
+           Returns the counts as a body."""
+        table, key = self.managers[kind].UPDATES[:2]
+        connection = meta.get_connection()
+        try:
+            with self.cond:
+                stmt = "UPDATE archive_tasks SET status = 'pending' " + \
+                       "WHERE kind = :kind AND status = 'running'"
+                params = {'kind': kind}
+                if self.active:
+                    stmt += " AND taskid NOT IN (%s)" % \
+                            ', '.join([str(taskid) for taskid in self.active])
+                requeued = connection.execute(text(stmt), **params).rowcount
+                retried = connection.execute(text(
+                    "UPDATE archive_tasks SET status = 'pending', " + \
+                    "attempts = 0, next_attempt_time = :now " + \
+                    "WHERE kind = :kind AND status = 'failed'"),
+                                             kind=kind,
+                                             now=datetime.utcnow()).rowcount
+                self.cond.notify_all()
+            removed = connection.execute(text(
+                ("DELETE FROM archive_tasks t WHERE kind = :kind " + \
+                 "AND NOT EXISTS (SELECT 1 FROM %s u " + \
+                 "WHERE u.%s = t.updateid)") % (table, key)),
+                                         kind=kind).rowcount
+        finally:
+            connection.close()
+        queued = self.enqueue(kind)
+        return {u'status': 'OK',
+                u'tasks-requeued': requeued,
+                u'tasks-retried': retried,
+                u'tasks-removed': removed,
+                u'tasks-queued': queued}
+
+    def counts(self, kind):
+        """The number of tasks of 'kind' by status."""
+        rows = meta.Session.query(ArchiveTaskEntry.status, func.count()).\
+            filter(ArchiveTaskEntry.envid == self.envid).\
+            filter(ArchiveTaskEntry.kind == kind).\
+            group_by(ArchiveTaskEntry.status).\
+            all()
+        return dict(rows)
+
+    def _primary(self):
+        manager = getattr(self.server, 'agentmanager', None)
+        if manager is None:
+            return None
+        return manager.agent_by_type(AgentManager.AGENT_TYPE_PRIMARY)
+
+    def _claim(self, kinds):
+        """Mark the next task 'running' and return it or None.  Each site
+           with pending tasks gets a turn before a site gets a second one.
+           The caller must hold the lock."""
+        session = meta.Session()
+        now = datetime.utcnow()
+        heads = session.query(ArchiveTaskEntry.site_id,
+                              func.min(ArchiveTaskEntry.taskid)).\
+            filter(ArchiveTaskEntry.envid == self.envid).\
+            filter(ArchiveTaskEntry.kind.in_(kinds)).\
+            filter(ArchiveTaskEntry.status == \
+                       ArchiveTaskEntry.STATUS_PENDING).\
+            filter(ArchiveTaskEntry.next_attempt_time <= now).\
+            group_by(ArchiveTaskEntry.site_id).\
+            all()
+        if not heads:
+            return None
+        taskid = self._turn(heads)
+        task = session.query(ArchiveTaskEntry).get(taskid)
+        task.status = ArchiveTaskEntry.STATUS_RUNNING
+        session.commit()
+        return task
+
+    def _turn(self, heads):
+        """Given the first pending (site_id, taskid) of each site, return
+           the taskid of the site served least recently."""
+        site_id, taskid = min(heads,
+                              key=lambda head: (self.served.get(head[0], 0),
+                                                head[1]))
+        self.seq += 1
+        self.served[site_id] = self.seq
+        return taskid
+
+    def _next(self):
+        """Wait for a task that can run now.  Returns (task, agent)."""
+        with self.cond:
+            while True:
+                try:
+                    agent = self._primary()
+                    if agent and self.server.odbc_ok() and \
+                       self.running.get(agent.agentid, 0) < \
+                           self.agent_workers:
+                        kinds = [kind
+                                 for kind, manager in self.managers.items()
+                                 if manager.archive_enabled()]
+                        task = kinds and self._claim(kinds) or None
+                        if task:
+                            self.active.add(task.taskid)
+                            self.running[agent.agentid] = \
+                                self.running.get(agent.agentid, 0) + 1
+                            return task, agent
+                except StandardError:
+                    logger.error("archive queue: %s",
+                                 traceback_string(all_on_one_line=False))
+                    meta.Session.remove()
+                self.cond.wait(self.POLL_INTERVAL)
+
+    def _worker(self):
+        while True:
+            task, agent = self._next()
+            try:
+                self._run(task, agent)
+            except StandardError:
+                logger.error("archive queue: task %d: %s", task.taskid,
+                             traceback_string(all_on_one_line=False))
+            finally:
+                meta.Session.remove()
+                with self.cond:
+                    self.active.discard(task.taskid)
+                    self.running[agent.agentid] -= 1
+                    self.cond.notify_all()
+
+    def _run(self, task, agent):
+        manager = self.managers[task.kind]
+        error = None
+        try:
+            done = manager.archive_task(agent, task.updateid)
+        except ArchiveException as ex:
+            # bad credentials: the manager has disabled archiving.
+            done = False
+            error = str(ex)
+        except StandardError:
+            done = False
+            error = traceback_string()
+            logger.error("archive queue: %s %d failed: %s", task.kind,
+                         task.updateid, error)
+            meta.Session.rollback()
+
+        session = meta.Session()
+        task = session.query(ArchiveTaskEntry).get(task.taskid)
+        if task is None:
+            # removed by fixup() meanwhile.
+            return
+        if done:
+            session.delete(task)
+            session.commit()
+            self._retain(task.kind)
+            return
+
+        task.attempts += 1
+        task.last_error = error or 'archive failed'
+        if task.attempts >= self.max_attempts:
+            task.status = ArchiveTaskEntry.STATUS_FAILED
+            logger.error("archive queue: giving up on %s update %d " + \
+                         "after %d attempts", task.kind, task.updateid,
+                         task.attempts)
+        else:
+            task.status = ArchiveTaskEntry.STATUS_PENDING
+            delay = self.retry_delay(task.attempts)
+            task.next_attempt_time = datetime.utcnow() + \
+                                     timedelta(seconds=delay)
+        session.commit()
+
+    def _retain(self, kind):
+        """Enforce the retention count once the queue of 'kind' is
+           drained (rather than after each archived update)."""
+        lock = self.retain_locks[kind]
+        if not lock.acquire(False):
+            return
+        try:
+            counts = self.counts(kind)
+            if counts.get(ArchiveTaskEntry.STATUS_PENDING) or \
+               counts.get(ArchiveTaskEntry.STATUS_RUNNING):
+                return
+            # pylint: disable=protected-access
+            removed = self.managers[kind]._retain_some()
+            logger.debug("archive queue: %s retain removed %d",
+                         kind, removed)
+        finally:
+            lock.release()
@@ -1,9 +1,10 @@
 import logging
 from datetime import datetime
-from sqlalchemy import not_, func
+from sqlalchemy import func
 
 import akiri.framework.sqlalchemy as meta
 
+from bulk_sync import BulkSync
 from manager import Manager, synchronized
 from event_control import EventControl
 from profile import UserProfile, License, Role
@@ -15,6 +16,13 @@ logger = logging.getLogger()
 # FIXME: use the ODBC class here instead.
 class AuthManager(Manager):
 
+    # The 'users' columns set by load(), in the order of its rows.
+    USER_COLUMNS = ['name', 'email', 'hashed_password', 'salt',
+                    'friendly_name', 'system_admin_level',
+                    'system_created_at', 'system_user_id', 'active',
+                    'login_at', 'user_admin_level', 'licensing_role_id',
+                    'publisher']
+
     # build a cache of the Tableau 'users' table.
     def load_users(self, agent):
         stmt = \
@@ -133,9 +141,6 @@ class AuthManager(Manager):
         if failed(data):
             return data
 
-        session = meta.Session()
-
-        names = ['palette']
         cache = self.load_users(agent)
 
         system_key = SystemKeys.ALERTS_NEW_USER_ENABLED
@@ -151,51 +156,50 @@ class AuthManager(Manager):
         else:
             first_load = False
 
+        rows = []
         for row in data['']:
             name = row[0]
             if name.lower() in excludes:
                 continue
 
             sysid = row[7]
-            names.append(name)
-
-            entry = UserProfile.get_by_name(envid, name)
-            if not entry:
-                entry = UserProfile(envid=envid, name=name)
-                entry.email_level = default_email_level
-                session.add(entry)
-
-            entry.email = row[1]
-            entry.hashed_password = row[2]
-            entry.salt = row[3]
-            entry.friendly_name = row[4]
-            entry.system_admin_level = row[5]
-            entry.system_created_at = row[6]
-            entry.system_user_id = sysid
-
-            if sysid in cache:
-                obj = cache[sysid]
-                entry.login_at = obj.login_at
-                entry.user_admin_level = obj.admin_level
-                entry.licensing_role_id = obj.licensing_role_id
-                entry.publisher = obj.publisher
-
-            # On first user table import, Tableau Server Administrators
-            # are set to Palette Super Admins.
-            if first_load and entry.system_admin_level == 10:
-                entry.roleid = Role.SUPER_ADMIN
-
-        session.commit()
-
-        # deleted entries no longer found in Tableau are marked inactive.
-        session.query(UserProfile).\
-            filter(not_(UserProfile.name.in_(names))).\
-            update({'active': False}, synchronize_session='fetch')
+            # The columns from 'users' are left alone (NULL) for users
+            # who aren't in it.
+            obj = cache.get(sysid, None)
+            if obj is None:
+                obj = TableauUserEntry(admin_level=None,
+                                       licensing_role_id=None,
+                                       publisher=None)
+            rows.append(list(row[:7]) + [sysid, True, obj.login_at,
+                                         obj.admin_level,
+                                         obj.licensing_role_id,
+                                         obj.publisher])
+
+        # Users no longer found in Tableau are marked inactive.
+        sync = BulkSync(UserProfile, envid, key='name', ignore_case=True,
+                        deactivate='active',
+                        keep_null=['login_at', 'user_admin_level',
+                                   'licensing_role_id', 'publisher'],
+                        insert_defaults={'email_level': default_email_level},
+                        retain=[UserProfile.PALETTE_DEFAULT_NAME])
+        d = sync.run(self.USER_COLUMNS, rows)
+
+        # On first user table import, Tableau Server Administrators
+        # are set to Palette Super Admins.
+        if first_load:
+            session = meta.Session()
+            session.query(UserProfile).\
+                filter(UserProfile.envid == envid).\
+                filter(UserProfile.system_admin_level == 10).\
+                update({'roleid': Role.SUPER_ADMIN},
+                       synchronize_session=False)
+            session.commit()
 
         timestamp = datetime.now().strftime(DATEFMT)
         self.system.save(SystemKeys.AUTH_TIMESTAMP, timestamp)
 
-        d = {u'status': 'OK', u'count': len(data[''])}
+        d['status'] = 'OK'
+        d['count'] = len(data[''])
         logger.debug("auth load returning: %s", str(d))
         return d
 
@@ -0,0 +1,280 @@
+""" Content-addressed, compressed storage for archived twb/tds files. """
+import difflib
+import hashlib
+import logging
+import zlib
+
+from sqlalchemy import Column, BigInteger, Integer, String, LargeBinary
+from sqlalchemy import DateTime, func, text
+from sqlalchemy.exc import IntegrityError
+
+import akiri.framework.sqlalchemy as meta
+
+from mixin import BaseMixin
+
+logger = logging.getLogger()
+
+class BlobEntry(meta.Base, BaseMixin):
+    """The contents of a file, stored once however many rows reference it
+    (by the sha256 of the contents) and zlib compressed.  A blob may be
+    stored as a line delta against a 'base' blob - normally the previous
+    revision of the same workbook/datasource - if that is smaller.  The
+    'refcount' counts the rows referencing the blob plus the deltas based
+    on it; the blob is removed when it drops to zero.
+
+    The reference counts are changed in autocommit, so a failed transaction
+    may leave a count too high: recount() at startup fixes that."""
+    # pylint: disable=no-init
+    __tablename__ = "blobs"
+
+    COMPRESSION = 'zlib'
+    LEVEL = 6
+    MAX_DELTA_DEPTH = 8     # bounds the deltas applied to read a blob
+
+    sha256 = Column(String, primary_key=True)
+    compression = Column(String, nullable=False)
+    base = Column(String, index=True)   # sha256 of the delta base or NULL
+    depth = Column(Integer, nullable=False, default=0)
+    size = Column(BigInteger, nullable=False)       # uncompressed
+    data = Column(LargeBinary, nullable=False)
+    refcount = Column(Integer, nullable=False, default=1)
+    creation_time = Column(DateTime, server_default=func.now())
+
+    @classmethod
+    def encode(cls, contents):
+        if isinstance(contents, unicode):
+            contents = contents.encode('utf-8')
+        return contents
+
+    @classmethod
+    def put(cls, contents, base=None):
+        """Add a reference to 'contents', storing it if it's new, and
+        return its sha256.  If 'base' is the sha256 of a similar blob the
+        contents may be stored as a delta against it."""
+        contents = cls.encode(contents)
+        sha256 = hashlib.sha256(contents).hexdigest()
+        connection = meta.get_connection()
+        try:
+            if cls._incref(connection, sha256):
+                return sha256
+            values = cls._pack(connection, contents, base)
+            try:
+                connection.execute(text(
+                    "INSERT INTO blobs (sha256, compression, base, depth, " + \
+                    "size, data, refcount) VALUES (:sha256, :compression, " + \
+                    ":base, :depth, :size, :data, 1)"),
+                                   sha256=sha256, **values)
+            except IntegrityError:
+                # stored by someone else meanwhile.
+                cls._incref(connection, sha256)
+                return sha256
+            if values['base']:
+                cls._incref(connection, values['base'])
+        finally:
+            connection.close()
+        return sha256
+
+    @classmethod
+    def _incref(cls, connection, sha256):
+        result = connection.execute(text(
+            "UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = :sha256"),
+                                    sha256=sha256)
+        return result.rowcount > 0
+
+    @classmethod
+    def _pack(cls, connection, contents, base):
+        """The column values storing 'contents': a delta against 'base'
+        if there is one and it's smaller, otherwise the whole."""
+        data = zlib.compress(contents, cls.LEVEL)
+        values = {'compression': cls.COMPRESSION, 'base': None, 'depth': 0,
+                  'size': len(contents), 'data': data}
+        if base is None:
+            return values
+        row = connection.execute(text(
+            "SELECT depth FROM blobs WHERE sha256 = :sha256"),
+                                 sha256=base).first()
+        if row is None or row[0] >= cls.MAX_DELTA_DEPTH:
+            return values
+        delta = zlib.compress(make_delta(cls.contents(base, connection),
+                                         contents), cls.LEVEL)
+        if len(delta) < len(data):
+            values.update({'base': base, 'depth': row[0] + 1, 'data': delta})
+        return values
+
+    @classmethod
+    def contents(cls, sha256, connection=None):
+        """The contents of the blob 'sha256' as a str or None if there
+        is no such blob."""
+        if connection is None:
+            connection = meta.Session()
+        deltas = []
+        while True:
+            # a Session doesn't take keyword parameters.
+            row = connection.execute(text(
+                "SELECT base, data FROM blobs WHERE sha256 = :sha256"),
+                                     {'sha256': sha256}).first()
+            if row is None:
+                logger.error("blob %s is missing", sha256)
+                return None
+            data = zlib.decompress(row[1])
+            if row[0] is None:
+                break
+            deltas.append(data)
+            sha256 = row[0]
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return data
+
+    @classmethod
+    def get_text(cls, sha256):
+        """The contents of the blob 'sha256' as unicode, like the Text
+        columns they replace."""
+        data = cls.contents(sha256)
+        if data is None:
+            return None
+        return data.decode('utf-8')
+
+    @classmethod
+    def release(cls, sha256):
+        """Drop a reference to 'sha256' and remove the blob, and then
+        possibly its base, when it was the last one."""
+        connection = meta.get_connection()
+        try:
+            while sha256:
+                connection.execute(text(
+                    "UPDATE blobs SET refcount = refcount - 1 " + \
+                    "WHERE sha256 = :sha256"), sha256=sha256)
+                row = connection.execute(text(
+                    "DELETE FROM blobs WHERE sha256 = :sha256 " + \
+                    "AND refcount <= 0 RETURNING base"),
+                                         sha256=sha256).first()
+                sha256 = row and row[0] or None
+        finally:
+            connection.close()
+
+    @classmethod
+    def upgrade(cls, table, key, parent_key, column):
+        """Add the '<column>_sha256' column to 'table', created by an older
+        version, and move the contents of 'column' (i.e. 'twb') of each row
+        into the store, each revision as a delta of the previous one of its
+        'parent_key' when possible.  One row is read at a time."""
+        # pylint: disable=too-many-locals
+        sha_column = column + '_sha256'
+        index = 'ix_%s_%s' % (table, sha_column)
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(text(
+                "SELECT 1 FROM information_schema.columns " + \
+                "WHERE table_name = :table AND column_name = :column"),
+                                        table=table, column=sha_column)
+            if result.first() is None:
+                logger.info("Adding column %s.%s", table, sha_column)
+                connection.execute("ALTER TABLE %s ADD COLUMN %s VARCHAR" % \
+                                   (table, sha_column))
+            result = connection.execute(text(
+                "SELECT 1 FROM pg_class WHERE relname = :name"), name=index)
+            if result.first() is None:
+                connection.execute("CREATE INDEX %s ON %s (%s)" % \
+                                   (index, table, sha_column))
+
+            rows = connection.execute(
+                ("SELECT %(key)s, %(parent_key)s FROM %(table)s " + \
+                 "WHERE %(column)s IS NOT NULL AND %(sha_column)s IS NULL " + \
+                 "ORDER BY %(parent_key)s, timestamp") % \
+                {'key': key, 'parent_key': parent_key, 'table': table,
+                 'column': column, 'sha_column': sha_column}).fetchall()
+            if rows:
+                logger.info("Moving %d %s.%s to the blob store",
+                            len(rows), table, column)
+            previous = {}   # parent_key -> sha256 of the last revision
+            for rowid, parentid in rows:
+                contents = connection.execute(text(
+                    "SELECT %s FROM %s WHERE %s = :rowid" % \
+                    (column, table, key)), rowid=rowid).scalar()
+                sha256 = cls.put(contents, previous.get(parentid))
+                connection.execute(text(
+                    "UPDATE %s SET %s = :sha256, %s = NULL WHERE %s = :rowid" \
+                    % (table, sha_column, column, key)),
+                                   sha256=sha256, rowid=rowid)
+                previous[parentid] = sha256
+        finally:
+            connection.close()
+
+    @classmethod
+    def recount(cls, references):
+        """Set the reference counts from the (table, column) 'references'
+        and the deltas, then remove the blobs no longer referenced."""
+        counts = ' + '.join(
+            ["(SELECT count(*) FROM %s r WHERE r.%s = b.sha256)" % reference
+             for reference in references] + \
+            ["(SELECT count(*) FROM blobs d WHERE d.base = b.sha256)"])
+        connection = meta.get_connection()
+        try:
+            removed = 0
+            while True:
+                connection.execute(
+                    "UPDATE blobs b SET refcount = %s " % counts + \
+                    "WHERE refcount <> %s" % counts)
+                result = connection.execute(
+                    "DELETE FROM blobs WHERE refcount <= 0")
+                if not result.rowcount:
+                    break
+                removed += result.rowcount
+        finally:
+            connection.close()
+        if removed:
+            logger.info("Removed %d unreferenced blobs", removed)
+        return removed
+
+
+def make_delta(base, contents):
+    """A line delta turning 'base' into 'contents': a sequence of
+    'c<start> <end>\\n' (copy base lines start to end) and
+    'i<length>\\n<bytes>' (insert) operations."""
+    a = base.splitlines(True)
+    b = contents.splitlines(True)
+    # Trim the common head and tail first: revisions usually differ in a
+    # few places and the SequenceMatcher is slow on long sequences.
+    head = 0
+    while head < len(a) and head < len(b) and a[head] == b[head]:
+        head += 1
+    tail = 0
+    while tail < len(a) - head and tail < len(b) - head and \
+          a[-1 - tail] == b[-1 - tail]:
+        tail += 1
+
+    ops = []
+    if head:
+        ops.append('c%d %d\n' % (0, head))
+    matcher = difflib.SequenceMatcher(None, a[head:len(a) - tail],
+                                      b[head:len(b) - tail])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append('c%d %d\n' % (head + i1, head + i2))
+        elif j2 > j1:
+            data = ''.join(b[head + j1:head + j2])
+            ops.append('i%d\n' % len(data))
+            ops.append(data)
+    if tail:
+        ops.append('c%d %d\n' % (len(a) - tail, len(a)))
+    return ''.join(ops)
+
+def apply_delta(base, delta):
+    """The contents produced by a make_delta() delta from 'base'."""
+    lines = base.splitlines(True)
+    out = []
+    pos = 0
+    while pos < len(delta):
+        end = delta.index('\n', pos)
+        op = delta[pos:end]
+        pos = end + 1
+        if op[0] == 'c':
+            start, stop = op[1:].split(' ')
+            out.extend(lines[int(start):int(stop)])
+        elif op[0] == 'i':
+            length = int(op[1:])
+            out.append(delta[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError("bad delta operation: " + op)
+    return ''.join(out)
@@ -0,0 +1,256 @@
+""" Set-based copy of a Tableau repository table into a local table. """
+import logging
+import time
+
+from sqlalchemy import text
+
+import akiri.framework.sqlalchemy as meta
+
+from odbc import ODBCError
+
+logger = logging.getLogger()
+
+class BulkSync(object):
+    """Copy rows into the local table of 'model' with a few statements
+       instead of a SELECT (and an UPDATE or INSERT) per row: the rows are
+       staged in a temporary table and then a single statement updates
+       the local rows that differ, inserts the missing ones and deletes
+       the local rows that are no longer staged (or, with 'deactivate',
+       sets that boolean column to FALSE).  It is all one transaction.
+
+       There is no INSERT ... ON CONFLICT before PostgreSQL 9.5, so the
+       UPDATE and the INSERT are separate CTEs and the local table is
+       locked against other writers for the duration of the sync.
+
+       'keep_null' columns keep their local value when the staged value
+       is NULL, 'insert_defaults' are only set on new rows and the keys
+       in 'retain' are never deleted/deactivated.  New rows also get the
+       (scalar) ORM defaults of the columns that aren't staged, since the
+       INSERT doesn't go through the ORM."""
+    # pylint: disable=too-many-instance-attributes
+
+    BATCH_SIZE = 500
+
+    def __init__(self, model, envid, key='id', ignore_case=False,
+                 deactivate=None, keep_null=None, insert_defaults=None,
+                 retain=None):
+        # pylint: disable=too-many-arguments
+        self.model = model
+        self.envid = envid
+        self.key = key
+        self.ignore_case = ignore_case
+        self.deactivate = deactivate
+        self.keep_null = keep_null or []
+        self.insert_defaults = insert_defaults or {}
+        self.retain = retain or []
+
+        self.table = model.__tablename__
+        self.stage = 'sync_' + self.table
+        # Local-only columns: never copied from Tableau.
+        primary_key = [column.name
+                       for column in model.__table__.primary_key.columns]
+        self.excludes = set(['envid'] + primary_key) - set([key])
+        self.columns = [column.name for column in model.__table__.columns
+                        if column.name not in self.excludes]
+        self.column_defaults = {}
+        for column in model.__table__.columns:
+            default = getattr(column, 'default', None)
+            if column.name in self.columns and default is not None and \
+                    default.is_scalar:
+                self.column_defaults[column.name] = default.arg
+
+    def _insert_defaults(self, columns):
+        """The {column: value} set on new rows besides 'columns'."""
+        defaults = dict([(name, value)
+                         for name, value in self.column_defaults.items()
+                         if name not in columns])
+        defaults.update(self.insert_defaults)
+        return defaults
+
+    def _match(self, left, right):
+        if self.ignore_case:
+            return "lower(%s.%s) = lower(%s.%s)" % \
+                (left, self.key, right, self.key)
+        return "%s.%s = %s.%s" % (left, self.key, right, self.key)
+
+    def _stage_rows(self, connection, columns, rows):
+        """Insert 'rows' into the staging table, BATCH_SIZE per statement.
+           Returns the number of rows staged."""
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.BATCH_SIZE:
+                self._stage_batch(connection, columns, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._stage_batch(connection, columns, batch)
+            count += len(batch)
+        return count
+
+    def _stage_batch(self, connection, columns, batch):
+        values = []
+        params = {}
+        for i, row in enumerate(batch):
+            names = []
+            for j, value in enumerate(row):
+                name = 'v%d_%d' % (i, j)
+                params[name] = value
+                names.append(':' + name)
+            values.append('(' + ', '.join(names) + ')')
+        stmt = "INSERT INTO %s (%s) VALUES %s" % \
+               (self.stage, ', '.join(columns), ', '.join(values))
+        connection.execute(text(stmt), **params)
+
+    def apply_sql(self, columns):
+        """Return the statement that applies the staged rows to the local
+           table and selects the number of staged keys and the number of
+           rows inserted, updated and removed."""
+        # pylint: disable=too-many-locals
+        assign = []
+        old = []
+        new = []
+        for name in columns:
+            if name == self.key:
+                continue
+            if name in self.keep_null:
+                value = "COALESCE(s.%s, t.%s)" % (name, name)
+            else:
+                value = "s." + name
+            assign.append("%s = %s" % (name, value))
+            old.append("t." + name)
+            new.append(value)
+
+        args = {'table': self.table, 'stage': self.stage, 'key': self.key,
+                'match': self._match('t', 's')}
+
+        ctes = []
+        if assign:
+            args['assign'] = ', '.join(assign)
+            # A ROW() is needed when there is only one column.
+            args['old'] = 'ROW(' + ', '.join(old) + ')'
+            args['new'] = 'ROW(' + ', '.join(new) + ')'
+            ctes.append(("upd AS (UPDATE %(table)s t SET %(assign)s " + \
+                         "FROM %(stage)s s " + \
+                         "WHERE t.envid = :envid AND %(match)s " + \
+                         "AND %(old)s IS DISTINCT FROM %(new)s " + \
+                         "RETURNING 1)") % args)
+        else:
+            ctes.append("upd AS (SELECT 1 WHERE FALSE)")
+
+        if self.ignore_case:
+            args['distinct'] = "lower(s.%s)" % self.key
+        else:
+            args['distinct'] = "s." + self.key
+        names = ['envid'] + list(columns)
+        values = [':envid'] + ['s.' + name for name in columns]
+        for name in sorted(self._insert_defaults(columns)):
+            names.append(name)
+            values.append(':default_' + name)
+        args['names'] = ', '.join(names)
+        args['values'] = ', '.join(values)
+        # Duplicate keys in the result would fail the INSERT.
+        ctes.append(("ins AS (INSERT INTO %(table)s (%(names)s) " + \
+                     "SELECT DISTINCT ON (%(distinct)s) %(values)s " + \
+                     "FROM %(stage)s s WHERE NOT EXISTS (" + \
+                     "SELECT 1 FROM %(table)s t " + \
+                     "WHERE t.envid = :envid AND %(match)s) " + \
+                     "RETURNING 1)") % args)
+
+        args['retain'] = ''
+        if self.retain:
+            args['retain'] = "AND t.%s NOT IN (%s) " % \
+                (self.key, ', '.join([':retain_%d' % i
+                                      for i in range(len(self.retain))]))
+        if self.deactivate:
+            args['deactivate'] = self.deactivate
+            ctes.append(("rm AS (UPDATE %(table)s t " + \
+                         "SET %(deactivate)s = FALSE " + \
+                         "WHERE t.envid = :envid " + \
+                         "AND t.%(deactivate)s IS NOT FALSE %(retain)s" + \
+                         "AND NOT EXISTS (SELECT 1 FROM %(stage)s s " + \
+                         "WHERE %(match)s) RETURNING 1)") % args)
+        else:
+            ctes.append(("rm AS (DELETE FROM %(table)s t " + \
+                         "WHERE t.envid = :envid %(retain)s" + \
+                         "AND NOT EXISTS (SELECT 1 FROM %(stage)s s " + \
+                         "WHERE %(match)s) RETURNING 1)") % args)
+
+        return "WITH " + ",\n".join(ctes) + "\n" + \
+               ("SELECT (SELECT count(DISTINCT %(distinct)s) " + \
+                "FROM %(stage)s s), " + \
+                "(SELECT count(*) FROM ins), " + \
+                "(SELECT count(*) FROM upd), " + \
+                "(SELECT count(*) FROM rm)") % args
+
+    def run(self, columns, rows):
+        """Sync the local table to 'rows', an iterable of sequences with
+           the values of 'columns' (which must include the key).
+           Returns the statistics as a dict."""
+        start = time.time()
+        columns = list(columns)
+        params = {'envid': self.envid}
+        for name, value in self._insert_defaults(columns).items():
+            params['default_' + name] = value
+        for i, value in enumerate(self.retain):
+            params['retain_%d' % i] = value
+
+        connection = meta.get_connection()
+        try:
+            with connection.begin():
+                # Readers aren't blocked, another sync of this table is.
+                connection.execute("LOCK TABLE %s " % self.table + \
+                                   "IN SHARE ROW EXCLUSIVE MODE")
+                connection.execute(
+                    ("CREATE TEMP TABLE %s ON COMMIT DROP AS " + \
+                     "SELECT %s FROM %s WITH NO DATA") % \
+                    (self.stage, ', '.join(columns), self.table))
+                count = self._stage_rows(connection, columns, rows)
+                result = connection.execute(text(self.apply_sql(columns)),
+                                            **params)
+                staged, inserted, updated, removed = result.first()
+        finally:
+            connection.close()
+
+        stats = {'count': count,
+                 'inserted': inserted,
+                 'updated': updated,
+                 'unchanged': staged - inserted - updated,
+                 'seconds': round(time.time() - start, 3)}
+        if self.deactivate:
+            stats['deactivated'] = removed
+        else:
+            stats['deleted'] = removed
+        logger.info("sync %s: %s", self.table, str(stats))
+        return stats
+
+    def run_odbc(self, agent, stmt):
+        """Run 'stmt' against the Tableau repository and sync the local
+           table to the result.  Only the columns that also exist locally
+           are copied.  Raises ODBCError if the query fails."""
+        rows = agent.odbc.execute_iter(stmt)
+        first = next(rows, None)
+        if first is None:
+            return self.run([self.key], [])
+        columns = [name for name in first.schema if name in self.columns]
+
+        def values(odbcdata):
+            return [odbcdata.data[name] for name in columns]
+
+        def generate():
+            yield values(first)
+            for odbcdata in rows:
+                yield values(odbcdata)
+
+        return self.run(columns, generate())
+
+    def sync(self, agent, stmt):
+        """run_odbc() as a result body: 'status' and the statistics or
+           'error'."""
+        try:
+            body = self.run_odbc(agent, stmt)
+        except ODBCError as ex:
+            return {'error': str(ex)}
+        body['status'] = 'OK'
+        return body
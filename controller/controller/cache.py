@@ -1,9 +1,58 @@
+import threading
+from collections import OrderedDict
+
 from manager import Manager
 from profile import UserProfile
 from util import UNDEFINED
 
 # FIXME: merge with mixin
 
+class LRUCache(object):
+    """A thread-safe dict-like cache that holds at most 'size' entries,
+       discarding the least recently used one when full."""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value  # now the most recently used
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'max-size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
+
 # Holds a cache of system_ids per site_id/user_id
 class TableauUserCache(object):
 
@@ -129,14 +129,12 @@ class CliCmd(object):
 
     def _send_cli(self, cli_command, agent, env=None, immediate=False):
         """Send a "cli" command to an Agent.
-            Returns a body with the results.
-            Called without the connection lock."""
+            Returns a body with the results."""
         # pylint: disable=too-many-return-statements
 
         logger.debug("_send_cli")
 
         aconn = agent.connection
-        aconn.lock()
 
         req = CliStartRequest(cli_command, env=env, immediate=immediate)
 
@@ -149,16 +147,11 @@ class CliCmd(object):
                      displayname, aconn.conn_id, agent.agent_type,
                      req.xid, safecmd(cli_command))
         try:
-            aconn.httpconn.request('POST', '/cli', req.send_body, headers)
-            logger.debug('sent cli command.')
-
-            res = aconn.httpconn.getresponse()
+            res = aconn.request('POST', '/cli', req.send_body, headers)
 
             logger.debug('_send_cli: command: cli: ' + \
                          str(res.status) + ' ' + str(res.reason))
-            # print "headers:", res.getheaders()
-            logger.debug("_send_cli reading...")
-            body_json = res.read()
+            body_json = res.body
 
             if res.status != httplib.OK:
                 logger.error("_send_cli: command: '%s', %d %s : %s",
@@ -179,8 +172,6 @@ class CliCmd(object):
                                      "Error: " + str(ex))
             return self.server.error("_send_cli: '%s' command failed with: %s" %
                               (safecmd(cli_command), str(ex)))
-        finally:
-            aconn.unlock()
 
         logger.debug("_send_cli done reading, body_json: " + body_json)
         body = json.loads(body_json)
@@ -209,14 +200,10 @@ class CliCmd(object):
             On success, returns the body of the reply.
             On failure, throws an exception.
 
-            orig_cli_command is used only for debugging/printing.
-
-            Called without the connection lock."""
+            orig_cli_command is used only for debugging/printing."""
 
         logger.debug("_send_cleanup")
         aconn = agent.connection
-        aconn.lock()
-        logger.debug("_send_cleanup got lock")
 
         req = CleanupRequest(xid)
         headers = {"Content-Type": "application/json"}
@@ -224,12 +211,10 @@ class CliCmd(object):
 
         logger.debug('about to send the cleanup command, xid %d', xid)
         try:
-            aconn.httpconn.request('POST', uri, req.send_body, headers)
-            logger.debug('sent cleanup command')
-            res = aconn.httpconn.getresponse()
+            res = aconn.request('POST', uri, req.send_body, headers)
             logger.debug('command: cleanup: ' + \
                          str(res.status) + ' ' + str(res.reason))
-            body_json = res.read()
+            body_json = res.body
             if res.status != httplib.OK:
                 logger.error("_send_cleanup: POST %s for cmd '%s' failed,"
                              "%d %s : %s", uri, orig_cli_command,
@@ -241,7 +226,6 @@ class CliCmd(object):
                                              uri=uri, body=body_json)
 
             logger.debug("headers: " + str(res.getheaders()))
-            logger.debug("_send_cleanup reading...")
 
         except (httplib.HTTPException, EnvironmentError) as ex:
             # bad agent
@@ -251,11 +235,6 @@ class CliCmd(object):
                                      + "Error: " + str(ex))
             return self.server.error("'%s' failed for command '%s' with: %s" % \
                                      (uri, orig_cli_command, str(ex)), {})
-        finally:
-            # Must call aconn.unlock() even after self.server.remove_agent(),
-            # since another thread may waiting on the lock.
-            aconn.unlock()
-            logger.debug("_send_cleanup unlocked")
 
         logger.debug("done reading.")
         body = json.loads(body_json)
@@ -265,6 +244,19 @@ class CliCmd(object):
                               return_dict={})
         return body
 
+    def _status_wait(self, aconn, remaining):
+        """The number of seconds the agent should hold a status request
+           until the command finishes (0 to reply immediately).
+           Long-polling is only used with agents that have a spare
+           channel: it would otherwise block every other request to the
+           agent.  The wait is kept well under the socket timeout."""
+        if len(aconn.channels) < 2:
+            return 0
+        socket_timeout = self.server.agentmanager.socket_timeout
+        wait = min(self.server.cli_status_wait, socket_timeout / 2,
+                   int(remaining))
+        return max(wait, 0)
+
     def _get_cli_status(self, xid, agent, orig_cli_command, timeout):
         """Gets status on the command and xid.  The timeout is the
            maximum amount of time the command is allowed to take before
@@ -275,10 +267,6 @@ class CliCmd(object):
             Body in json with status/results.
 
             orig_cli_command is used only for debugging/printing.
-
-            Note: Do not call this with the agent lock since
-            we keep requesting status until the command is
-            finished and that could be a long time.
         """
         # pylint: disable=too-many-branches
         # pylint: disable=too-many-return-statements
@@ -288,13 +276,18 @@ class CliCmd(object):
 #        time.sleep(5)
 #        print "awake"
 
-        uri = self.server.CLI_URI + "?xid=" + str(xid)
+        status_uri = self.server.CLI_URI + "?xid=" + str(xid)
         headers = {"Content-Type": "application/json"}
 
         aconn = agent.connection
         start_time = time.time()
         while True:
             now = time.time()
+            wait = self._status_wait(aconn, timeout - (now - start_time))
+            if wait:
+                uri = status_uri + "&wait=" + str(wait)
+            else:
+                uri = status_uri
             if now - start_time > timeout:
                 logger.info("timeout for command '%s', xid %s, " + \
                             "conn_id %d, timeout %d, " + \
@@ -329,14 +322,12 @@ class CliCmd(object):
                     (agent.displayname, agent.agent_type, agent.uuid,
                     aconn.conn_id, uri))
 
-            aconn.lock()
             logger.debug("Sending GET " + uri)
 
             try:
-                aconn.httpconn.request("GET", uri, None, headers)
-
-                logger.debug("Getting response from GET " +  uri)
-                res = aconn.httpconn.getresponse()
+                # A long-poll may hold a channel for 'wait' seconds.
+                res = aconn.request("GET", uri, None, headers,
+                                    bulk=bool(wait))
                 logger.debug("status: " + str(res.status) + ' ' + \
                                                             str(res.reason))
                 if res.status != httplib.OK:
@@ -351,8 +342,7 @@ class CliCmd(object):
 #                time.sleep(5)
 #                print "awake"
 
-                logger.debug("_get_status reading.")
-                body_json = res.read()
+                body_json = res.body
                 body = json.loads(body_json)
                 if body == None:
                     return self.server.error(
@@ -372,8 +362,6 @@ class CliCmd(object):
                                   "agent. Unexpected error: " + str(ex))
                 return self.server.error("GET %s failed with: %s" % \
                                          (uri, str(ex)))
-            finally:
-                aconn.unlock()
 
             if not 'run-status' in body:
                 self.server.remove_agent(agent,
@@ -401,7 +389,9 @@ class CliCmd(object):
                                                         body['exit-status']
                 return body
             elif body['run-status'] == 'running':
-                time.sleep(self.server.cli_get_status_interval)
+                if not 'wait' in body:
+                    # The agent doesn't support long-polling.
+                    time.sleep(self.server.cli_get_status_interval)
                 continue
             else:
                 self.server.remove_agent(agent,
@@ -7,6 +7,8 @@ import SocketServer as socketserver
 import socket
 import json
 import time
+import threading
+import copy
 from datetime import datetime
 import traceback
 import subprocess
@@ -20,7 +22,6 @@ import akiri.framework.sqlalchemy as meta
 
 from agent import Agent
 from agentmanager import AgentManager
-from domain import Domain
 from event_control import EventControl
 from files import FileManager
 from get_file import GetFile
@@ -34,6 +35,7 @@ from tableau import TableauProcess
 import exc
 import httplib
 import clierror
+import rpc
 from util import success, failed, traceback_string, upgrade_rwlock
 from util import is_cloud_url
 
@@ -59,6 +61,37 @@ class CommandException(Exception):
         Exception.__init__(self, errmsg)
 
 
+class AgentSelectorCache(object):
+    """
+    The uuids of the agent selectors (/uuid, /hostname, /type) of previous
+    commands.  The agent rows only change when an agent registers, is
+    renamed or reclassified - which changes AgentManager.generation once
+    the change is committed - so the cache is emptied whenever the
+    generation differs.
+    """
+    def __init__(self, agentmanager):
+        self.agentmanager = agentmanager
+        self.lock = threading.Lock()
+        self.generation = None
+        self.uuids = {}
+
+    def lookup(self, key, resolve):
+        """Return the cached uuid of 'key' or the (cached) resolve()."""
+        generation = self.agentmanager.generation
+        with self.lock:
+            if generation != self.generation:
+                self.uuids = {}
+                self.generation = generation
+            elif key in self.uuids:
+                return self.uuids[key]
+        uuid = resolve()
+        with self.lock:
+            # not if an agent changed while resolving
+            if generation == self.generation:
+                self.uuids[key] = uuid
+        return uuid
+
+
 class Command(object):
 
     def __init__(self, server, line):
@@ -106,8 +139,7 @@ class Command(object):
 
         # FIXME: domain/env HACK
         if 'domainid' not in opts:
-            entry = Domain.getone()
-            opts['domainid'] = entry.domainid
+            opts['domainid'] = self.server.domain.domainid
         if 'envid' not in opts:
             opts['envid'] = self.server.environment.envid
 
@@ -124,21 +156,39 @@ class Command(object):
         # passed, and there is a (unique) primary in the database
         # for this domain, then use it.
         #
+        # The displaynames are also changed by the web application, so
+        # only the other selectors are cached.
+        #
         if 'uuid' in opts and 'displayname' not in opts \
                 and 'hostname' not in opts and 'type' not in opts:
             pass
-        elif 'uuid' not in opts and 'displayname' not in opts \
+        elif 'displayname' not in opts:
+            key = (opts['envid'], opts.get('uuid'), opts.get('hostname'),
+                   opts.get('type'))
+            opts['uuid'] = self.server.agent_selectors.lookup(key,
+                                                              self.find_agent)
+        else:
+            opts['uuid'] = self.find_agent()
+
+        if 'userid' in opts:
+            if not opts['userid'].isdigit():
+                raise CommandException("Invalid userid: must be an integer.")
+
+    def find_agent(self):
+        """The uuid of the agent selected by the options."""
+        opts = self.dict
+        if 'uuid' not in opts and 'displayname' not in opts \
                 and 'hostname' not in opts and 'type' not in opts:
             query = meta.Session.query(Agent)
             query = query.filter(Agent.envid == opts['envid'])
             query = query.filter(Agent.agent_type == 'primary')
             try:
                 entry = query.one()
-                opts['uuid'] = entry.uuid
+                return entry.uuid
             except sqlalchemy.orm.exc.NoResultFound:
-                opts['uuid'] = None
+                return None
             except sqlalchemy.orm.exc.MultipleResultsFound:
-                opts['uuid'] = None
+                return None
         else:
             query = meta.Session.query(Agent)
             query = query.filter(Agent.envid == opts['envid'])
@@ -153,16 +203,12 @@ class Command(object):
                 query = query.filter(Agent.agent_type == opts['type'])
             try:
                 entry = query.one()
-                opts['uuid'] = entry.uuid
+                return entry.uuid
             except sqlalchemy.orm.exc.NoResultFound:
                 raise CommandException("no matching agent found")
             except sqlalchemy.orm.exc.MultipleResultsFound:
                 raise CommandException("agent must be unique")
 
-        if 'userid' in opts:
-            if not opts['userid'].isdigit():
-                raise CommandException("Invalid userid: must be an integer.")
-
 
 class CliHandler(socketserver.StreamRequestHandler):
 
@@ -170,6 +216,13 @@ class CliHandler(socketserver.StreamRequestHandler):
     STATUS_OK = "OK"
     STATUS_ERROR = "error"
 
+    # Requests of an rpc connection running at the same time.
+    RPC_MAX_REQUESTS = 16
+
+    # Set on the copy of the handler running an rpc request.
+    rpc_writer = None
+    rpc_id = None
+
     SUPPORT_CRON_FILENAME = "support-control"
     CRON_DIR = "/etc/cron.d"
 
@@ -254,6 +307,12 @@ class CliHandler(socketserver.StreamRequestHandler):
                 'NFKD', line).encode(
                 'ascii', 'ignore')
 
+        self._write_line(line)
+
+    def _write_line(self, line):
+        if self.rpc_writer is not None:
+            self._send_frame({'id': self.rpc_id, 'line': line})
+            return
         try:
             print >> self.wfile, line
         except EnvironmentError:
@@ -1635,6 +1694,20 @@ class CliHandler(socketserver.StreamRequestHandler):
 
         self.report_status(body)
 
+    @usage('events')
+    def do_events(self, cmd):
+        """Show the event queue and template cache statistics."""
+
+        if len(cmd.args):
+            self.print_usage(self.do_events.__usage__)
+            return
+
+        self.ack()
+
+        body = self.server.event_control.stats()
+
+        self.report_status(body)
+
     @usage('prune')
     @upgrade_rwlock
     def do_prune(self, cmd):
@@ -2107,8 +2180,7 @@ class CliHandler(socketserver.StreamRequestHandler):
             self.print_usage(self.do_exit.__usage__)
             return
         self.ack()
-        # pylint: disable=protected-access
-        os._exit(0)
+        self.server.exit(0)
 
     def _runcmd(self, cmd):
         process = subprocess.Popen(cmd,
@@ -2659,11 +2731,12 @@ class CliHandler(socketserver.StreamRequestHandler):
         else:
             self.print_client("%s", json.dumps(body))
 
-    @usage('system <SET|GET|DELETE> <key> [value]')
+    @usage('system <SET|GET|DELETE> <key> [value]\n' +
+           'system STATS')
     def do_system(self, cmd):
-        """ Set or Delete a 'system' table entry for the current environment."""
+        """ Set, Get or Delete a 'system' table entry for the current
+        environment or show the system cache statistics. """
         # pylint: disable=too-many-branches
-        value = None
         body = {}
 
         if len(cmd.args) < 1:
@@ -2675,15 +2748,16 @@ class CliHandler(socketserver.StreamRequestHandler):
             if len(cmd.args) != 3:
                 self.print_usage(self.do_system.__usage__)
                 return
-            value = cmd.args[2]
-        elif action == 'GET':
+        elif action in ('GET', 'DELETE'):
             if len(cmd.args) != 2:
                 self.print_usage(self.do_system.__usage__)
                 return
-        elif action == 'DELETE':
-            if len(cmd.args) != 2:
+        elif action == 'STATS':
+            if len(cmd.args) != 1:
                 self.print_usage(self.do_system.__usage__)
                 return
+            self.ack()
+            return self.report_status(self.server.system.stats())
         else:
             self.print_usage(self.do_system.__usage__)
             return
@@ -2692,30 +2766,24 @@ class CliHandler(socketserver.StreamRequestHandler):
 
         key = cmd.args[1]
 
-        entry = None
-        try:
-            entry = self.server.system.entry(key)
-        except ValueError:
-            pass
-
-        session = meta.Session()
+        # Go through the SystemManager so that its cache stays current.
         if action == 'SET':
-            if entry:
-                entry.value = value
-            else:
-                self.server.system[key] = value
-            body['status'] = 'OK'
+            try:
+                self.server.system[key] = cmd.args[2]
+                body['status'] = 'OK'
+            except ValueError as ex:
+                body['error'] = str(ex)
         elif action == 'GET':
+            entry = self.server.system.entry(key)
             if not entry:
                 body['error'] = 'Key not found'
             else:
                 body['key'] = entry.key
                 body['value'] = entry.value
         elif action == 'DELETE':
-            if entry:
-                session.delete(entry)
+            del self.server.system[key]
             body['status'] = 'OK'
-        session.commit()
+        meta.Session.commit()
         return self.report_status(body)
 
     @usage('support-case [filename.zip]')
@@ -2972,9 +3040,11 @@ class CliHandler(socketserver.StreamRequestHandler):
 
         line += traceback_string(all_on_one_line=False)
         self.error(clierror.ERROR_COMMAND_FAILED, line)
+        # The process exits right after: don't leave it on the event bus.
         self.server.event_control.gen(EventControl.SYSTEM_EXCEPTION,
                                       {'error': line,
-                                       'version': self.server.version})
+                                       'version': self.server.version},
+                                      sync=True)
 
     def handle(self):
         while True:
@@ -2989,45 +3059,110 @@ class CliHandler(socketserver.StreamRequestHandler):
             if not data:
                 break
 
-            logger.debug("telnet command: '%s'", data)
-            stateman = self.server.state_manager
-            before_state = stateman.get_state()
+            if data == rpc.RPC_COMMAND:
+                self.handle_rpc()
+                break
+
+            self.run_line(data)
+
+    def run_line(self, data):
+        """Run one command line."""
+        logger.debug("telnet command: '%s'", data)
+        stateman = self.server.state_manager
+        before_state = stateman.get_state()
+
+        try:
+            cmd = Command(self.server, data)
+        except CommandException as ex:
+            self.error(clierror.ERROR_COMMAND_SYNTAX_ERROR, str(ex))
+            return
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except BaseException:
+            self.handle_exception(before_state, data)
+            logger.error("Fatal: Exiting clihandler command " +
+                         " parse '%s' on exception.", data)
+            # pylint: disable=protected-access
+            os._exit(91)
+
+        if not hasattr(self, 'do_' + cmd.name):
+            self.error(clierror.ERROR_NO_SUCH_COMMAND,
+                       'invalid command: %s', cmd.name)
+            return
 
+        # <command> /displayname=X /type=..., /uuid=Y, /hostname=Z [args]
+        session = meta.Session()
+        try:
+            f = getattr(self, 'do_' + cmd.name)
+            f(cmd)
+        # fixme on exceptions: reset state?
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except exc.InvalidStateError as ex:
+            self.error(clierror.ERROR_WRONG_STATE, ex.message)
+        except BaseException:
+            self.handle_exception(before_state, data)
+            logger.error("Fatal: Exiting clihandler command " +
+                         "'%s' on exception.", data)
+            # pylint: disable=protected-access
+            os._exit(92)
+        finally:
+            session.rollback()
+            meta.Session.remove()
+
+    def handle_rpc(self):
+        """
+        Switch the connection to framed requests (see rpc.py).  Each request
+        runs in a thread of its own - at most RPC_MAX_REQUESTS at a time -
+        so a slow command doesn't hold the ones sent after it.
+        """
+        self.print_client("OK RPC %d", rpc.RPC_VERSION)
+        writer = rpc.FrameWriter(self.wfile)
+        slots = threading.BoundedSemaphore(self.RPC_MAX_REQUESTS)
+        while True:
             try:
-                cmd = Command(self.server, data)
-            except CommandException as ex:
-                self.error(clierror.ERROR_COMMAND_SYNTAX_ERROR, str(ex))
-                continue
-            except (SystemExit, KeyboardInterrupt, GeneratorExit):
-                raise
-            except BaseException:
-                self.handle_exception(before_state, data)
-                logger.error("Fatal: Exiting clihandler command " +
-                             " parse '%s' on exception.", data)
-                # pylint: disable=protected-access
-                os._exit(91)
-
-            if not hasattr(self, 'do_' + cmd.name):
-                self.error(clierror.ERROR_NO_SUCH_COMMAND,
-                           'invalid command: %s', cmd.name)
+                frame = rpc.read_frame(self.rfile)
+            except (EnvironmentError, ValueError, rpc.RpcError) as ex:
+                logger.info("CliHandler: rpc connection failure: %s", str(ex))
+                break
+            if frame is None:
+                break
+
+            handler = copy.copy(self)
+            handler.rpc_writer = writer
+            handler.rpc_id = frame.get('id')
+            line = frame.get('command')
+            if not isinstance(line, basestring) or not line.strip():
+                handler.error(clierror.ERROR_COMMAND_SYNTAX_ERROR,
+                              "Missing command: %s" % str(line))
+                handler.rpc_done()
                 continue
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+
+            slots.acquire()
+            thread = threading.Thread(target=self._run_request,
+                                      args=(handler, line.strip(), slots),
+                                      name='rpc-%s' % str(handler.rpc_id))
+            thread.daemon = True
+            thread.start()
+
+    def _run_request(self, handler, line, slots):
+        """Run a request on a copy of the handler: the lines a telnet
+        client would get are sent as frames with the id of the request."""
+        try:
+            handler.run_line(line)
+        finally:
+            slots.release()
+            handler.rpc_done()
 
-            # <command> /displayname=X /type=..., /uuid=Y, /hostname=Z [args]
-            session = meta.Session()
-            try:
-                f = getattr(self, 'do_' + cmd.name)
-                f(cmd)
-            # fixme on exceptions: reset state?
-            except (SystemExit, KeyboardInterrupt, GeneratorExit):
-                raise
-            except exc.InvalidStateError as ex:
-                self.error(clierror.ERROR_WRONG_STATE, ex.message)
-            except BaseException:
-                self.handle_exception(before_state, data)
-                logger.error("Fatal: Exiting clihandler command " +
-                             "'%s' on exception.", data)
-                # pylint: disable=protected-access
-                os._exit(92)
-            finally:
-                session.rollback()
-                meta.Session.remove()
+    def rpc_done(self):
+        """Tell the rpc client the response is complete."""
+        self._send_frame({'id': self.rpc_id, 'done': True})
+
+    def _send_frame(self, frame):
+        try:
+            self.rpc_writer.send(frame)
+        except (EnvironmentError, ValueError):
+            # The client is gone (or the connection closed).
+            pass
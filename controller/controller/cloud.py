@@ -208,13 +208,18 @@ class CloudManager(Manager):
             raise IOError("No such cloudid: %d for file %s" % \
                           (file_entry.storageid, file_entry.name))
 
+        self.delete_cloud_file(cloud_entry, file_entry.name)
+
+    def delete_cloud_file(self, cloud_entry, path):
+        """Delete 'path' from the cloud storage of 'cloud_entry' (without
+           database access, so it may be called from other threads)."""
         if cloud_entry.cloud_type == CloudManager.CLOUD_TYPE_S3:
-            self.s3.delete_file(cloud_entry, file_entry.name)
+            self.s3.delete_file(cloud_entry, path)
         elif cloud_entry.cloud_type == CloudManager.CLOUD_TYPE_GCS:
-            self.gcs.delete_file(cloud_entry, file_entry.name)
+            self.gcs.delete_file(cloud_entry, path)
         else:
             msg = "delete_cloud_file: Unknown cloud_type %s for file: %s" % \
-                  (cloud_entry.cloud_type, file_entry.name)
+                  (cloud_entry.cloud_type, path)
             logging.error(msg)
             raise IOError(msg)
 
@@ -1,5 +1,6 @@
 """ The main server instance of the controller. """
 import logging
+import signal
 import sys
 import os
 import SocketServer as socketserver
@@ -26,19 +27,22 @@ from agentmanager import AgentManager
 from agent import Agent, AgentVolumesEntry
 from alert_email import AlertEmail
 from alert_setting import AlertSetting
+from archive_queue import ArchiveQueue
 from auth import AuthManager
+from blob_store import BlobEntry
 from cli_cmd import CliCmd
 from cloud import CloudEntry
 from config import Config
 from passwd import aes_encrypt
 from credential import CredentialEntry, CredentialManager
 from diskcheck import DiskCheck, DiskException
-from datasources import DataSourceManager
+from datasources import DataSourceManager, DataSourceUpdateEntry
 from data_source_types import DataSourceTypes
 from domain import Domain
 from environment import Environment
+from event import EventEntry, EventCount
 from event_control import EventControl, EventControlManager
-from extracts import ExtractManager
+from extracts import ExtractManager, ExtractEntry
 from extract_archive import ExtractRefreshManager
 from files import FileManager
 from firewall_manager import FirewallManager
@@ -53,7 +57,7 @@ from profile import UserProfile, Role
 from sched import Sched, Crontab
 from state import StateManager
 from state_control import StateControl
-from system import SystemManager, SystemKeys
+from system import SystemManager, SystemKeys, SystemListener
 from tableau import TableauStatusMonitor, TableauProcess
 from workbooks import WorkbookEntry, WorkbookUpdateEntry, WorkbookManager
 from yml import YmlEntry, YmlManager
@@ -71,7 +75,7 @@ from place_file import PlaceFile
 from get_file import GetFile
 from cloud import CloudManager
 
-from clihandler import CliHandler
+from clihandler import CliHandler, AgentSelectorCache
 
 from util import version, success, failed, sizestr
 
@@ -359,13 +363,10 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
     def kill_cmd(self, xid, agent):
         """Send a "kill" command to an Agent to end a process by XID.
-            Returns the body of the reply.
-            Called without the connection lock."""
+            Returns the body of the reply."""
 
         logger.debug("kill_cmd")
         aconn = agent.connection
-        aconn.lock()
-        logger.debug("kill_cmd got lock")
 
         data = {'action': 'kill', 'xid': xid}
         send_body = json.dumps(data)
@@ -375,12 +376,10 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         logger.debug('about to send the kill command, xid %d', xid)
         try:
-            aconn.httpconn.request('POST', uri, send_body, headers)
-            logger.debug('sent kill command')
-            res = aconn.httpconn.getresponse()
+            res = aconn.request('POST', uri, send_body, headers)
             logger.debug('command: kill: ' + \
                                str(res.status) + ' ' + str(res.reason))
-            body_json = res.read()
+            body_json = res.body
             if res.status != httplib.OK:
                 logger.error("kill_cmd: POST failed: %d\n", res.status)
                 alert = "Agent command failed with status: " + str(res.status)
@@ -398,11 +397,6 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
             self.remove_agent(agent, "Command to agent failed. " \
                                   + "Error: " + str(ex))
             return self.error(msg)
-        finally:
-            # Must call aconn.unlock() even after self.remove_agent(),
-            # since another thread may waiting on the lock.
-            aconn.unlock()
-            logger.debug("kill_cmd unlocked")
 
         logger.debug("done reading.")
         body = json.loads(body_json)
@@ -510,6 +504,10 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
         if success(copy_body):
             filename = src.path.basename(source_path)
             copy_body['path'] = dst.path.join(target_dir, filename)
+            # phttp reports the sha256 it computed during the transfer.
+            for line in (copy_body.get('stdout') or '').splitlines():
+                if line.startswith('sha256: '):
+                    copy_body['sha256'] = line[len('sha256: '):].strip()
         return copy_body
 
     def restore_local(self, agent, path, userid=None,
@@ -819,28 +817,24 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         error_msg = ""
         sync_dict = {}
+        stats = {}
 
-        body = Site.sync(agent)
-        if 'error' in body:
-            error_msg += "Site sync failure: " + body['error']
-        else:
-            sync_dict['sites'] = body['count']
-
-        body = Project.sync(agent)
-        if 'error' in body:
-            if error_msg:
-                error_msg += ", "
-            error_msg += "Project sync failure: " + body['error']
-        else:
-            sync_dict['projects'] = body['count']
+        for name, label, cls in (('sites', 'Site', Site),
+                                 ('projects', 'Project', Project),
+                                 ('data-connections', 'DataConnection',
+                                  DataConnection)):
+            body = cls.sync(agent)
+            if 'error' in body:
+                if error_msg:
+                    error_msg += ", "
+                error_msg += label + " sync failure: " + body['error']
+            else:
+                sync_dict[name] = body['count']
+                del body['status']
+                stats[name] = body
 
-        body = DataConnection.sync(agent)
-        if 'error' in body:
-            if error_msg:
-                error_msg += ", "
-            error_msg += "DataConnection sync failure: " + body['error']
-        else:
-            sync_dict['data-connections'] = body['count']
+        # rows inserted/updated/unchanged/deleted and seconds per table.
+        sync_dict['stats'] = stats
 
         if error_msg:
             sync_dict['error'] = error_msg
@@ -1110,13 +1104,11 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
                      agent.displayname, aconn.conn_id, agent.agent_type,
                      method, uri, send_body)
 
-        aconn.lock()
         body = {}
         try:
-            aconn.httpconn.request(method, uri, send_body, headers)
-            res = aconn.httpconn.getresponse()
+            res = aconn.request(method, uri, send_body, headers)
 
-            rawbody = res.read()
+            rawbody = res.body
             if res.status != httplib.OK:
                 # bad agent
                 logger.error("immediate command to %s failed "
@@ -1144,8 +1136,6 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
                             (method, uri, str(ex)))
             return self.error("send_immediate method %s, uri %s failed: %s" % \
                               (method, uri, str(ex)))
-        finally:
-            aconn.unlock()
 
         logger.debug("send immediate %s %s success, conn_id %d, response: %s",
                      method, uri, aconn.conn_id, str(body))
@@ -1452,6 +1442,22 @@ class Controller(socketserver.ThreadingMixIn, socketserver.TCPServer):
         else:
             self.system.save(SystemKeys.DATASOURCE_RETAIN_COUNT, 0)
 
+    def flush_on_exit(self):
+        """Don't lose queued events or buffered samples on a clean
+           shutdown."""
+        if self.event_control.bus:
+            self.event_control.bus.drain()
+        self.metrics.shutdown()
+
+    def exit(self, status=0):
+        """Flush and end the process.  sys.exit() isn't enough: the
+           non-daemon threads (the status monitor, the agent connections)
+           would keep it alive."""
+        self.flush_on_exit()
+        logger.info("Controller exiting with status %d.", status)
+        # pylint: disable=protected-access
+        os._exit(status)
+
 class StreamLogger(object):
     """
     File-like stream class that writes to a logger.
@@ -1534,6 +1540,8 @@ def main():
 
     server.cli_get_status_interval = \
       config.getint('controller', 'cli_get_status_interval', default=10)
+    server.cli_status_wait = \
+      config.getint('controller', 'cli_status_wait', default=20)
     server.noping = args.noping
     server.event_debug = config.getboolean('default',
                                            'event_debug',
@@ -1550,6 +1558,7 @@ def main():
     # Must be the first 'manager'
     server.system = SystemManager(server)
     SystemManager.populate()
+    SystemListener(server.system).start()
 
     # Set version info
     server.previous_version = server.system[SystemKeys.PALETTE_VERSION]
@@ -1582,6 +1591,14 @@ def main():
     server.yml = YmlManager(server)
 
     EventControl.populate_upgrade(server.previous_version, server.version)
+    EventEntry.upgrade_indexes()
+    EventCount.populate()
+    WorkbookUpdateEntry.upgrade_blobs()
+    DataSourceUpdateEntry.upgrade_blobs()
+    BlobEntry.recount([('workbook_updates', 'twb_sha256'),
+                       ('datasource_updates', 'tds_sha256')])
+    ExtractEntry.upgrade()
+    HttpRequestEntry.upgrade_indexes()
     server.event_control = EventControlManager(server)
 
     # Send controller started/restarted and potentially "new version" events.
@@ -1591,6 +1608,9 @@ def main():
 
     server.workbooks = WorkbookManager(server)
     server.datasources = DataSourceManager(server)
+    server.archive_queue = ArchiveQueue(server)
+    server.archive_queue.register(server.workbooks.NAME, server.workbooks)
+    server.archive_queue.register(server.datasources.NAME, server.datasources)
     server.files = FileManager(server)
     server.cloud = CloudManager(server)
     server.firewall_manager = FirewallManager(server)
@@ -1599,6 +1619,8 @@ def main():
 #    server.package = Package()
     server.notifications = NotificationManager(server)
     server.metrics = MetricManager(server)
+    server.metrics.populate()
+    server.metrics.start()
 
     server.ports = PortManager(server)
     server.ports.populate()
@@ -1610,12 +1632,15 @@ def main():
 
     manager = AgentManager(server)
     server.agentmanager = manager
+    server.agent_selectors = AgentSelectorCache(manager)
 
     manager.update_last_disconnect_time()
 
     logger.debug("Starting agent listener.")
     manager.start()
 
+    server.archive_queue.start()
+
     # Need to instantiate to initialize state and status tables,
     # even if we don't run the status thread.
     statusmon = TableauStatusMonitor(server, manager)
@@ -1631,4 +1656,15 @@ def main():
         logger.debug("Starting status monitor.")
         statusmon.start()
 
-    server.serve_forever()
+    def sigterm(signum, frame):
+        # pylint: disable=unused-argument
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, sigterm)
+
+    try:
+        server.serve_forever()
+    except SystemExit:
+        # SIGTERM
+        server.exit(0)
+    finally:
+        server.flush_on_exit()
@@ -1,11 +1,11 @@
 from sqlalchemy import Column, String, DateTime, Boolean, Integer, BigInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
 
+from bulk_sync import BulkSync
 from mixin import BaseMixin
-from odbc import ODBC
 
 class DataConnection(meta.Base, BaseMixin):
     # pylint: disable=no-init
@@ -42,33 +42,5 @@ class DataConnection(meta.Base, BaseMixin):
     def sync(cls, agent):
         stmt = 'SELECT * FROM data_connections'
 
-        data = agent.odbc.execute(stmt)
-        if 'error' in data:
-            return data
-        if '' not in data:
-            data['error'] = "Missing '' key in query response."
-            return data
-
-        ids = []
-
         envid = agent.server.environment.envid
-
-        session = meta.Session()
-        for odbcdata in ODBC.load(data):
-            tid = odbcdata.data['id']
-            entry = DataConnection.get(envid, tid, default=None)
-            if not entry:
-                entry = DataConnection(envid=envid)
-                session.add(entry)
-            entry.envid = envid
-            odbcdata.copyto(entry)
-            ids.append(entry.dcid)
-
-        session.query(DataConnection).\
-            filter(not_(DataConnection.dcid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
-
-        d = {u'status': 'OK', u'count': len(data[''])}
-        return d
+        return BulkSync(cls, envid).sync(agent, stmt)
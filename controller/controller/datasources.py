@@ -5,12 +5,12 @@ from sqlalchemy import UniqueConstraint, Text
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm import relationship, backref, deferred
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import func, or_
 
 import akiri.framework.sqlalchemy as meta
 
 from odbc import ODBC
 
+from blob_store import BlobEntry
 from archive_mixin import ArchiveUpdateMixin, ArchiveException, ArchiveError
 from mixin import BaseMixin, BaseDictMixin
 from cache import TableauCacheManager #FIXME
@@ -123,7 +123,10 @@ class DataSourceUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     system_user_id = Column(Integer)
     url = Column(String)  # FIXME: make this unique.
     note = Column(String)
-    tds = deferred(Column(Text))    # the contents of the .tds file
+    # the contents of the .tds file are in the blob store.
+    tds_sha256 = Column(String, index=True)
+    # before the blob store: the contents of the .tds file.
+    tds_text = deferred(Column('tds', Text))
 
     # NOTE: system_user_id is not a foreign key to avoid load dependencies.
 
@@ -147,6 +150,34 @@ class DataSourceUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     def get_by_url(cls, url, **kwargs):
         return cls.get_unique_by_keys({'url': url}, **kwargs)
 
+    @property
+    def tds(self):
+        if self.tds_sha256:
+            return BlobEntry.get_text(self.tds_sha256)
+        return self.tds_text
+
+    def set_tds(self, contents):
+        """Store 'contents' as the .tds file, as a delta of the previous
+           revision if possible."""
+        session = meta.Session()
+        previous = session.query(DataSourceUpdateEntry.tds_sha256).\
+            filter(DataSourceUpdateEntry.dsid == self.dsid).\
+            filter(DataSourceUpdateEntry.dsuid != self.dsuid).\
+            filter(DataSourceUpdateEntry.tds_sha256 != None).\
+            order_by(DataSourceUpdateEntry.timestamp.desc()).\
+            first()
+        old = self.tds_sha256
+        self.tds_sha256 = BlobEntry.put(contents, previous and previous[0])
+        self.tds_text = None
+        if old:
+            BlobEntry.release(old)
+
+    @classmethod
+    def upgrade_blobs(cls):
+        """Move the .tds contents stored by an older version to the
+           blob store."""
+        BlobEntry.upgrade(cls.__tablename__, 'dsuid', 'dsid', 'tds')
+
 class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
     NAME = 'datasource'
     PCMD = 'ptdsx'
@@ -246,8 +277,9 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
             result = {u'error':
                       'Can not load datasources: missing credentials.'}
         else:
-            # Second pass - build the archive files.
-            result = self._archive_updates(agent, updates)
+            # Second pass - the archive files are built by the ArchiveQueue.
+            queued = self.server.archive_queue.enqueue(self.NAME)
+            result = {u'status': 'OK', u'updates-queued': queued}
 
         result[u'schema'] = self.schema(data)
         result[u'updates-new'] = len(updates)
@@ -267,12 +299,16 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                     "(select dsid, max(timestamp) "+ \
                     "from datasource_updates where url='' " + \
                     "group by dsid) " + \
-                    "and url='';"
+                    "and url='' returning tds_sha256;"
 
         connection = meta.get_connection()
         result = connection.execute(stmt)
+        shas = [row[0] for row in result if row[0]]
         connection.close()
 
+        for sha256 in shas:
+            BlobEntry.release(sha256)
+
         if result.rowcount:
             logger.debug("datasource _prune_missed_revisions pruned %d",
                            result.rowcount)
@@ -289,113 +325,41 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
         if not retain_count or retain_count == -1:
             return 0
 
-        removed_count = 0
-
-        session = meta.Session()
-        # List of datasources that have excess archived versions:
-        #   [(dsid, total-count), ...]
-        # Note we select only successfully archived datasource versions
+        # Note we count only successfully archived datasource versions
         # (url != '').  We don't want want to count unsuccessfully
         # archived versions in the count of how many we have.
-        results = session.query(DataSourceUpdateEntry.dsid, func.count()).\
-                  filter(DataSourceUpdateEntry.url != '').\
-                  group_by(DataSourceUpdateEntry.dsid).\
-                  having(func.count() > retain_count).\
-                  all()
-
-#        logger.debug("datasources _retain_some len: %d, results: %s",
-#                                                len(results), str(results))
-
-        for result in results:
-            # Get list of old datasource archive entries to delete
-            rows = session.query(DataSourceUpdateEntry).\
-                    filter(DataSourceUpdateEntry.dsid == result[0]).\
-                    filter(DataSourceUpdateEntry.url != '').\
-                    order_by(DataSourceUpdateEntry.timestamp.asc()).\
-                    limit(result[1] - retain_count).\
-                    all()
-
-            for row in rows:
-                # We have to remove the DataSourceUpdateEntry first
-                # due to the foreign key constraint in files pointing to it.
-                session.query(DataSourceUpdateEntry).\
-                            filter(DataSourceUpdateEntry.dsuid == row.dsuid).\
-                            delete()
-                session.commit()
-
-                self.server.files.remove_file_by_id(row.fileid_tds)
-                if row.fileid_tdsx:
-                    self.server.files.remove_file_by_id(row.fileid_tdsx)
-
-                # Fixme: We could increment only if it successfully deleted.
-                removed_count += 1
-
-        return removed_count
-
-    @synchronized('datasource.fixup')
+        return self.retain_rows(retain_count, 'datasource_updates', 'dsuid',
+                                'dsid', 'timestamp DESC, dsuid DESC',
+                                "url != ''", ['fileid_tds', 'fileid_tdsx'],
+                                blob_column='tds_sha256')
+
+    # The ArchiveQueue interface.
+    UPDATES = ('datasource_updates', 'dsuid', 'datasources', 'dsid')
+
+    def archive_enabled(self):
+        return bool(self.system[SystemKeys.DATASOURCE_RETAIN_COUNT])
+
+    def archive_task(self, agent, dsuid):
+        """Archive one update for the ArchiveQueue.
+           Returns False if it should be tried again."""
+        update = DataSourceUpdateEntry.get_by_id(dsuid, default=None)
+        if update is None or update.url:
+            # pruned, removed or already archived.
+            return True
+        logger.debug("Datasource archive update %d", dsuid)
+        self._archive_ds(agent, update)
+        return bool(update.url)
+
     def fixup(self, agent):
+        """Re-queue the archive tasks left running and queue any update
+           that isn't archived or queued."""
+        # pylint: disable=unused-argument
         if not self.system[SystemKeys.DATASOURCE_RETAIN_COUNT]:
             logger.debug("Datasource archives are disabled. Fixup not done.")
             return {u'disabled':
                     'Datasource Archives are not enabled.  Fixup not done.'}
 
-        session = meta.Session()
-
-        # potentially serveral thousand?
-        updates = session.query(DataSourceUpdateEntry).\
-                  filter(or_(DataSourceUpdateEntry.url == "",
-                         DataSourceUpdateEntry.url == None)).\
-                         all()
-
-        return self._archive_updates(agent, updates)
-
-    def _archive_updates(self, agent, updates):
-        """Attempt to archive datasources from DataSourceUpdate rows."""
-
-        session = meta.Session()
-
-        count = 0
-
-        logger.debug("Datasource Archive update count: %d", len(updates))
-
-        for update in updates:
-            if not self.system[SystemKeys.DATASOURCE_RETAIN_COUNT]:
-                logger.info(
-                          "Datasource Archive disabled during fixup." + \
-                          "  Exiting for now.")
-                break
-
-            if not self.server.odbc_ok():
-                logger.info("Datasource Archive Fixup: Archive build " + \
-                          "stopping due to current state")
-                break
-
-            logger.debug("Datasource Archive update refresh dsid %d",
-                           update.dsid)
-
-            session.refresh(update)
-            try:
-                self._archive_ds(agent, update)
-            except ArchiveException as ex:
-                if ex.value == ArchiveError.BAD_CREDENTIALS:
-                    msg = "datasource _archive_updates: tabcmd failed due " + \
-                          "to bad credentials. " + \
-                          "Skipping any remaining datasource updates now."
-                    logger.info(msg)
-                    break
-                else:
-                    raise   # should never happen
-            count += 1
-
-        # Retain only configured number of versions
-        if count:
-            retain_removed_count = self._retain_some()
-        else:
-            retain_removed_count = 0
-
-        return {u'status': 'OK',
-                u'updates-archived': count,
-                u'retain-removed-count': retain_removed_count}
+        return self.server.archive_queue.fixup(self.NAME)
 
     # Archive the data source, set the url, etc.
     def _archive_ds(self, agent, update):
@@ -539,6 +503,8 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                            update.dsuid)
             return
         session.commit()
+        if update.tds_sha256:
+            BlobEntry.release(update.tds_sha256)
 
     def _extract_tds_from_tdsx(self, agent, update, dst_tdsx):
         """
@@ -585,7 +551,7 @@ class DataSourceManager(TableauCacheManager, ArchiveUpdateMixin):
                                                                 str(ex))
             return None
 
-        update.tds = contents
+        update.set_tds(contents)
         return True
 
     # Generate an event in case of a failure.
@@ -1,5 +1,7 @@
+import logging
+
 from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean
-from sqlalchemy import Index, func
+from sqlalchemy import Index, func, text
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -7,6 +9,8 @@ import akiri.framework.sqlalchemy as meta
 from mixin import BaseMixin, BaseDictMixin
 from util import utctotimestamp
 
+logger = logging.getLogger()
+
 class EventEntry(meta.Base, BaseMixin, BaseDictMixin):
     # pylint: disable=too-many-instance-attributes
     __tablename__ = "events"
@@ -44,8 +48,102 @@ class EventEntry(meta.Base, BaseMixin, BaseDictMixin):
             data['reference_time'] = timestamp
         return data
 
-Index('events_envid_timestamp_idx', EventEntry.envid, EventEntry.timestamp)
-Index('events_envid_level_timestamp_idx', \
-          EventEntry.envid, EventEntry.level, EventEntry.timestamp)
-Index('events_envid_event_type_timestamp_idx', \
-          EventEntry.envid, EventEntry.event_type, EventEntry.timestamp)
+    @classmethod
+    def upgrade_indexes(cls):
+        """Create the INDEXES missing from a table created by an older
+        version (create_all() only creates indexes with their table) and
+        drop the ones they replace."""
+        connection = meta.get_connection()
+        try:
+            for index in INDEXES:
+                result = connection.execute(text(
+                    "SELECT 1 FROM pg_class WHERE relname = :name"),
+                                            name=index.name)
+                if result.first() is None:
+                    logger.info("Creating index %s", index.name)
+                    index.create(bind=connection)
+            for name in OLD_INDEXES:
+                connection.execute("DROP INDEX IF EXISTS " + name)
+        finally:
+            connection.close()
+
+# The event list is ordered by (timestamp, eventid) and paged by keyset,
+# i.e. from the (timestamp, eventid) of the last row shown.
+INDEXES = [
+    Index('events_envid_timestamp_eventid_idx',
+          EventEntry.envid, EventEntry.timestamp, EventEntry.eventid),
+    Index('events_envid_level_timestamp_eventid_idx',
+          EventEntry.envid, EventEntry.level, EventEntry.timestamp,
+          EventEntry.eventid),
+    Index('events_envid_event_type_timestamp_eventid_idx',
+          EventEntry.envid, EventEntry.event_type, EventEntry.timestamp,
+          EventEntry.eventid)
+]
+OLD_INDEXES = ['events_envid_timestamp_idx',
+               'events_envid_level_timestamp_idx',
+               'events_envid_event_type_timestamp_idx']
+
+
+class EventCount(meta.Base, BaseMixin):
+    """The number of events per (envid, level, event_type, userid), kept up
+    to date as events are added so that the count of any filtered event
+    list is the sum of a few rows instead of a scan of the events table.
+
+    There is no unique constraint: two rows for the same key (from
+    concurrent inserts) are harmless since the counts are summed."""
+    __tablename__ = "event_counts"
+
+    countid = Column(BigInteger, unique=True, nullable=False, \
+                         autoincrement=True, primary_key=True)
+    envid = Column(BigInteger, ForeignKey("environment.envid"),
+                   nullable=False)
+    level = Column(String(1))
+    event_type = Column(String)
+    userid = Column(Integer)
+    total = Column(BigInteger, nullable=False, default=0)
+
+    KEY = ('envid', 'level', 'event_type', 'userid')
+
+    @classmethod
+    def populate(cls):
+        """Count the existing events, once."""
+        session = meta.Session()
+        if session.query(cls).first() is not None:
+            return
+        session.execute(
+            "INSERT INTO event_counts (envid, level, event_type, userid, " + \
+            "total) SELECT envid, level, event_type, userid, count(*) " + \
+            "FROM events GROUP BY envid, level, event_type, userid")
+        session.commit()
+
+    @classmethod
+    def key(cls, entry):
+        return tuple([getattr(entry, name) for name in cls.KEY])
+
+    @classmethod
+    def increment(cls, session, counts):
+        """Add 'counts' - {key(): number of new events} - in the
+        transaction of 'session'."""
+        match = ' AND '.join(["%s IS NOT DISTINCT FROM :%s" % (name, name)
+                              for name in cls.KEY])
+        update = text("UPDATE event_counts SET total = total + :count " + \
+                      "WHERE countid = (SELECT countid FROM event_counts " + \
+                      "WHERE " + match + " LIMIT 1)")
+        insert = text("INSERT INTO event_counts " + \
+                      "(envid, level, event_type, userid, total) " + \
+                      "VALUES (:envid, :level, :event_type, :userid, :count)")
+        for key, count in counts.items():
+            params = dict(zip(cls.KEY, key))
+            params['count'] = count
+            result = session.execute(update, params)
+            if not result.rowcount:
+                session.execute(insert, params)
+
+    @classmethod
+    def count(cls, filters=None):
+        """The number of events matching 'filters', a dict of KEY columns
+        to values."""
+        query = meta.Session.query(func.sum(cls.total))
+        if filters:
+            query = cls.apply_filters(query, filters)
+        return int(query.scalar() or 0)
@@ -0,0 +1,234 @@
+""" Asynchronous delivery of events: EventControlManager.gen() only queues
+an EventRecord and worker threads render, store and email them. """
+import logging
+import threading
+import time
+from collections import deque
+import Queue
+
+import akiri.framework.sqlalchemy as meta
+
+from util import traceback_string
+
+logger = logging.getLogger()
+
+class EventRecord(object):
+    """The arguments of one EventControlManager.gen() call."""
+    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, key, data, userid, site_id, timestamp):
+        self.key = key
+        self.data = data
+        self.userid = userid
+        self.site_id = site_id
+        self.timestamp = timestamp
+        self.enqueued = time.time()
+        # number of gen() calls merged into this record.
+        self.count = 1
+
+    def coalesce_key(self):
+        """Records with the same event key for the same agent may be
+           merged when the queue is full."""
+        data = self.data
+        for name in ('agentid', 'uuid', 'displayname'):
+            if name in data:
+                return (self.key, name, data[name])
+        return (self.key, None, None)
+
+
+class EventQueue(object):
+    """A bounded FIFO of EventRecords.  When full, a new record replaces
+       a queued one with the same event key and agent (keeping its place
+       in the queue), otherwise put() waits up to 'timeout' seconds and
+       then drops the record."""
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.records = deque()
+        self.index = {}     # coalesce_key() -> queued record
+        self.cond = threading.Condition()
+
+        self.max_depth = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        with self.cond:
+            return len(self.records)
+
+    def put(self, record):
+        """Returns False if the record was dropped."""
+        ckey = record.coalesce_key()
+        with self.cond:
+            if len(self.records) >= self.maxsize:
+                queued = self.index.get(ckey)
+                if queued is not None:
+                    queued.data = record.data
+                    queued.userid = record.userid
+                    queued.site_id = record.site_id
+                    queued.timestamp = record.timestamp
+                    queued.count += 1
+                    self.coalesced += 1
+                    return True
+                deadline = time.time() + self.timeout
+                while len(self.records) >= self.maxsize:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.dropped += 1
+                        return False
+                    self.cond.wait(remaining)
+            self.records.append(record)
+            self.index[ckey] = record
+            if len(self.records) > self.max_depth:
+                self.max_depth = len(self.records)
+            self.cond.notify_all()
+            return True
+
+    def get_batch(self, size, timeout=None):
+        """Remove and return up to 'size' records, waiting up to 'timeout'
+           seconds (forever if None) for the first one."""
+        with self.cond:
+            if not self.records:
+                self.cond.wait(timeout)
+            batch = []
+            while self.records and len(batch) < size:
+                record = self.records.popleft()
+                ckey = record.coalesce_key()
+                if self.index.get(ckey) is record:
+                    del self.index[ckey]
+                batch.append(record)
+            if batch:
+                self.cond.notify_all()
+            return batch
+
+
+class EventBus(object):
+    """Worker threads take batches of records from the EventQueue and
+       pass them to 'handler' (which stores them with a single commit).
+       Alert email goes through a separate queue and thread so a slow
+       mail server doesn't hold up the events."""
+    # pylint: disable=too-many-instance-attributes
+
+    DEFAULT_QUEUE_SIZE = 1000
+    DEFAULT_WORKERS = 2
+    DEFAULT_BATCH_SIZE = 50
+    DEFAULT_PUT_TIMEOUT = 5  # seconds
+    EMAIL_QUEUE_SIZE = 1000
+
+    def __init__(self, handler, emailer, queue_size=DEFAULT_QUEUE_SIZE,
+                 workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                 put_timeout=DEFAULT_PUT_TIMEOUT):
+        # pylint: disable=too-many-arguments
+        self.handler = handler
+        self.emailer = emailer
+        self.queue = EventQueue(queue_size, put_timeout)
+        self.email_queue = Queue.Queue(self.EMAIL_QUEUE_SIZE)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.threads = []
+        self.stopped = False
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.emails_dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name='event-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._email_worker,
+                                  name='event-email')
+        thread.daemon = True
+        thread.start()
+
+    def put(self, record):
+        if not self.queue.put(record):
+            logger.error("event queue full: dropped event '%s', data: %s",
+                         record.key, str(record.data))
+
+    def email(self, item):
+        """Queue (event_entry, data, eventid) for the email thread."""
+        try:
+            self.email_queue.put_nowait(item)
+        except Queue.Full:
+            with self.lock:
+                self.emails_dropped += 1
+            logger.error("event email queue full: not sending '%s'",
+                         item[0].key)
+
+    def _worker(self):
+        while not self.stopped:
+            batch = self.queue.get_batch(self.batch_size, timeout=1)
+            if batch:
+                self.process(batch)
+
+    def process(self, batch):
+        try:
+            self.handler(batch)
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except BaseException:
+            logger.error("event batch failed: %s, keys: %s",
+                         traceback_string(all_on_one_line=False),
+                         str([record.key for record in batch]))
+        finally:
+            meta.Session.remove()
+
+        now = time.time()
+        with self.lock:
+            for record in batch:
+                latency = now - record.enqueued
+                self.processed += 1
+                self.latency_total += latency
+                if latency > self.latency_max:
+                    self.latency_max = latency
+
+    def _email_worker(self):
+        while True:
+            event_entry, data, eventid = self.email_queue.get()
+            try:
+                self.emailer(event_entry, data, eventid=eventid)
+            except StandardError:
+                logger.error("alert_email: Failed for event '%s', "
+                             "data '%s'.  Will not send email. %s",
+                             event_entry.key, str(data),
+                             traceback_string(all_on_one_line=False))
+            finally:
+                meta.Session.remove()
+
+    def drain(self):
+        """Stop the workers and process whatever is still queued in the
+           calling thread (used at shutdown)."""
+        self.stopped = True
+        for thread in self.threads:
+            thread.join(2)
+        while True:
+            batch = self.queue.get_batch(self.batch_size, timeout=0)
+            if not batch:
+                break
+            self.process(batch)
+
+    def stats(self):
+        with self.lock:
+            processed = self.processed
+            if processed:
+                latency_avg = self.latency_total / processed
+            else:
+                latency_avg = 0.0
+            data = {'processed': processed,
+                    'latency-avg': round(latency_avg, 3),
+                    'latency-max': round(self.latency_max, 3),
+                    'emails-dropped': self.emails_dropped}
+        data['depth'] = len(self.queue)
+        data['max-depth'] = self.queue.max_depth
+        data['coalesced'] = self.queue.coalesced
+        data['dropped'] = self.queue.dropped
+        data['email-depth'] = self.email_queue.qsize()
+        return data
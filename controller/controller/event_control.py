@@ -2,6 +2,7 @@ import logging
 import sys
 import traceback
 import datetime
+import hashlib
 import re
 
 from mako.template import Template
@@ -14,10 +15,12 @@ from sqlalchemy.orm.exc import NoResultFound
 
 import akiri.framework.sqlalchemy as meta
 
-from event import EventEntry
+from event import EventEntry, EventCount
+from event_bus import EventBus, EventRecord
 from system import SystemKeys
 from profile import UserProfile
-from util import DATEFMT, UNDEFINED, utc2local
+from cache import LRUCache
+from util import DATEFMT, UNDEFINED, utc2local, traceback_string
 from mixin import BaseMixin, BaseDictMixin
 from manager import Manager
 import tz
@@ -286,14 +289,69 @@ class EventControl(meta.Base, BaseMixin, BaseDictMixin):
     defaults_filename = 'event_control.json'
 
 
+class TemplateCache(object):
+    """An LRU of compiled mako templates.  The key includes a hash of the
+       template source, so editing an event_control row gets a new
+       template without any explicit invalidation."""
+
+    DEFAULT_SIZE = 256
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.lru = LRUCache(size)
+
+    def get(self, key, source, **kwargs):
+        """Return the compiled template for 'source' (the template named
+           'key', e.g. the event key), compiling it if necessary.
+           'kwargs' are passed to the mako Template()."""
+        if isinstance(source, unicode):
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        else:
+            digest = hashlib.sha1(source).hexdigest()
+        cache_key = (key, digest, tuple(sorted(kwargs.items())))
+        template = self.lru.get(cache_key)
+        if template is None:
+            # Compile errors propagate and are not cached.
+            template = Template(source, **kwargs)
+            self.lru.put(cache_key, template)
+        return template
+
+    def clear(self):
+        self.lru.clear()
+
+    def stats(self):
+        return self.lru.stats()
+
+
 class EventControlManager(Manager):
+    """Events are generated asynchronously: gen() queues an EventRecord on
+       the EventBus and the bus workers render and store them in batches
+       (see handle()).  With [controller] events_async = False, gen() does
+       all the work in the calling thread as before."""
 
     def __init__(self, server):
         super(EventControlManager, self).__init__(server)
         self.alert_email = server.alert_email
         self.indented = self.alert_email.indented
+        self.templates = self.alert_email.templates
         self.envid = server.environment.envid
 
+        self.bus = None
+        config = getattr(server, 'config', None)
+        if config and config.getboolean('controller', 'events_async',
+                                        default=True):
+            self.bus = EventBus(
+                self.handle, self.alert_email.send,
+                queue_size=config.getint(
+                    'controller', 'events_queue_size',
+                    default=EventBus.DEFAULT_QUEUE_SIZE),
+                workers=config.getint(
+                    'controller', 'events_workers',
+                    default=EventBus.DEFAULT_WORKERS),
+                batch_size=config.getint(
+                    'controller', 'events_batch_size',
+                    default=EventBus.DEFAULT_BATCH_SIZE))
+            self.bus.start()
+
     def get_event_control_entry(self, key):
         try:
             entry = meta.DBSession.query(EventControl).\
@@ -303,11 +361,9 @@ class EventControlManager(Manager):
 
         return entry
 
-    def gen(self, key, data=None, userid=None, site_id=None, timestamp=None):
+    def gen(self, key, data=None, userid=None, site_id=None, timestamp=None,
+            sync=False):
         # pylint: disable=too-many-arguments
-        # pylint: disable=too-many-locals
-        # pylint: disable=too-many-statements
-        # pylint: disable=too-many-branches
 
         """Generate an event.
             Arguments:
@@ -336,6 +392,10 @@ class EventControlManager(Manager):
                                     version
                                     listen-port
                                     install-dir
+
+                sync:   Store the event (and send its email) before
+                        returning instead of queueing it on the event
+                        bus: for callers about to exit the process.
         """
 
         if data == None:
@@ -346,16 +406,111 @@ class EventControlManager(Manager):
                          "generated.  key: %s, data: %s", key, data)
             return
 
-        event_entry = self.get_event_control_entry(key)
-        if event_entry:
-            subject = event_entry.subject
-            event_description = event_entry.event_description
+        # FIXME: remove when browser-aware timezone support is available.
+        if timestamp is None:
+            timestamp = datetime.datetime.now(tz=tz.tzlocal())
+            logger.debug(key + " timestamp : " + timestamp.strftime(DATEFMT))
+
+        # Copy: the caller may change its dict after we return.
+        record = EventRecord(key, dict(data), userid, site_id, timestamp)
+        if self.bus and not sync:
+            self.bus.put(record)
         else:
-            logger.error("No such event key: %s. data: %s\n", key, str(data))
+            self.handle([record], sync=sync)
+
+    def stats(self):
+        """Queue/latency counters of the event bus and template cache."""
+        data = {'templates': self.templates.stats()}
+        if self.bus:
+            data.update(self.bus.stats())
+        return data
+
+    def _allocate_eventids(self, session, count):
+        """Reserve 'count' eventids with one round trip."""
+        stmt = "SELECT nextval('events_eventid_seq') " + \
+               "FROM generate_series(1, %d)" % count
+        return [row[0] for row in session.execute(stmt)]
+
+    def handle(self, records, sync=False):
+        """Render the queued records and store all of them with a single
+           commit, then hand off any alert email (or send it now if
+           'sync')."""
+        session = meta.DBSession()
+
+        keys = set([record.key for record in records])
+        controls = {}
+        for entry in session.query(EventControl).\
+                filter(EventControl.key.in_(keys)):
+            controls[entry.key] = entry
+
+        records = [record for record in records \
+                       if self._known(record, controls)]
+        if not records:
             return
+        eventids = self._allocate_eventids(session, len(records))
+
+        emails = []
+        counts = {}
+        for record, eventid in zip(records, eventids):
+            event_entry = controls[record.key]
+            try:
+                entry, data = self._render(record, event_entry, eventid)
+            except StandardError:
+                # Don't lose the rest of the batch.
+                logger.error("event '%s' failed: %s, data: %s", record.key,
+                             traceback_string(all_on_one_line=False),
+                             str(record.data))
+                continue
+            session.add(entry)
+            key = EventCount.key(entry)
+            counts[key] = counts.get(key, 0) + 1
+            if event_entry.send_email:
+                emails.append((event_entry, data, eventid))
+        EventCount.increment(session, counts)
+
+        # The email thread uses the event_control rows after this session
+        # is gone: detach them so the commit doesn't expire them.
+        for event_entry in controls.values():
+            session.expunge(event_entry)
+        session.commit()
+
+        for item in emails:
+            if self.bus and not sync:
+                self.bus.email(item)
+                continue
+            try:
+                self.alert_email.send(item[0], item[1], eventid=item[2])
+            except StandardError:
+                exc_traceback = sys.exc_info()[2]
+                tback = ''.join(traceback.format_tb(exc_traceback))
+                report = "Error: %s.  Traceback: %s" % (sys.exc_info()[1],
+                                                        tback)
+
+                logger.error("alert_email: Failed for event '%s', '"
+                             "data '%s'.  Will not send email. %s",
+                             item[0].key, str(item[1]), report)
+
+    def _known(self, record, controls):
+        if record.key in controls:
+            return True
+        logger.error("No such event key: %s. data: %s\n",
+                     record.key, str(record.data))
+        return False
+
+    def _render(self, record, event_entry, eventid):
+        # pylint: disable=too-many-locals
+        # pylint: disable=too-many-statements
+        # pylint: disable=too-many-branches
+        """Build the EventEntry for 'record'.
+           Returns the entry and the data dict used for the templates."""
+        key = record.key
+        userid = record.userid
+        timestamp = record.timestamp
+        subject = event_entry.subject
+        event_description = event_entry.event_description
 
         # add all system table entries to the data dictionary.
-        data = dict(data.items() + \
+        data = dict(record.data.items() + \
                     self.system.todict(include_defaults=True).items())
 
         logger.debug(key + " DATA: " + str(data))
@@ -364,11 +519,9 @@ class EventControlManager(Manager):
             data['exit_status'] = data['exit-status']
             del data['exit-status']
 
-        # FIXME: remove when browser-aware timezone support is available.
-        if timestamp is None:
-            timestamp = datetime.datetime.now(tz=tz.tzlocal())
-            logger.debug(key + " timestamp : " + timestamp.strftime(DATEFMT))
         data['timestamp'] = timestamp.strftime(DATEFMT)
+        if record.count > 1:
+            data['coalesced'] = record.count
 
         # The userid for other events is the Palette "userid".
         profile = None
@@ -415,16 +568,7 @@ class EventControlManager(Manager):
             if not project is None:
                 data['project'] = project
 
-        # Create the row to get the eventid before doing subject/description
-        # substitution.
-        session = meta.DBSession()
-        entry = EventEntry(complete=False, key='incomplete')
-        # set the timestamp here in case it has tzinfo.
-        entry.timestamp = timestamp
-        session.add(entry)
-        session.commit()
-
-        data['eventid'] = entry.eventid
+        data['eventid'] = eventid
 
         # Use the data dict for template substitution.
         try:
@@ -436,8 +580,9 @@ class EventControlManager(Manager):
 
         if event_description:
             try:
-                mako_template = Template(event_description,
-                                         default_filters=['h'])
+                mako_template = self.templates.get(key + ':description',
+                                                   event_description,
+                                                   default_filters=['h'])
                 event_description = mako_template.render(**data)
             except MakoException:
                 event_description = \
@@ -468,7 +613,7 @@ class EventControlManager(Manager):
         else:
             summary = timestamp.strftime(DATEFMT)
 
-        # Log the event to the database
+        entry = EventEntry(eventid=eventid)
         entry.complete = True
         entry.key = key
         entry.envid = self.envid
@@ -480,26 +625,10 @@ class EventControlManager(Manager):
         entry.event_type = event_entry.event_type
         entry.summary = summary
         entry.userid = userid
-        entry.site_id = site_id
-        #entry.timestamp = timestamp
-
-        session.merge(entry)
-        session.commit()
-
-        if not event_entry.send_email:
-            return
-
-        try:
-            self.alert_email.send(event_entry, data, eventid=entry.eventid)
-        except StandardError:
-            exc_traceback = sys.exc_info()[2]
-            tback = ''.join(traceback.format_tb(exc_traceback))
-            report = "Error: %s.  Traceback: %s" % (sys.exc_info()[1],
-                                                    tback)
-
-            logger.error("alert_email: Failed for event '%s', '"
-                         "data '%s'.  Will not send email. %s",
-                         event_entry.key, str(data), report)
+        entry.site_id = record.site_id
+        # set the timestamp here in case it has tzinfo.
+        entry.timestamp = timestamp
+        return entry, data
 
     def make_default_description(self, data):
         """Create a default event message given the incoming dictionary."""
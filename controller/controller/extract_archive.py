@@ -338,47 +338,12 @@ class ExtractRefreshManager(Manager, ArchiveUpdateMixin):
                 - The object class (WorkbookExtractEntry or
                                     DataSourceExtractEntry)
         """
-
-        session = meta.Session()
-        # List of parentids that have excess archived versions:
-        #   [(parentid, total-count), ...]
-        # Note we select only successfully archived extracts when
-        # fileid != None.  We don't want want to count unsuccessfully
+        # Note we count only successfully archived extracts
+        # (fileid != None).  We don't want want to count unsuccessfully
         # archived extracts in the count of how many we have.
-        results = session.query(obj_class.parentid, func.count()).\
-                  filter(obj_class.fileid != None).\
-                  group_by(obj_class.parentid).\
-                  having(func.count() > retain_count).\
-                  all()
-
-        logger.debug("refresh _retain_some_obj %s len: %d, results: %s",
-                     obj_class.__tablename__, len(results), str(results))
-
-        removed_count = 0
-        for result in results:
-            # Get the list of rows to delete
-            rows = session.query(obj_class).\
-                    filter(obj_class.parentid == result[0]).\
-                    filter(obj_class.fileid != None).\
-                    order_by(obj_class.sid.asc()).\
-                    limit(result[1] - retain_count).\
-                    all()
-
-            for row in rows:
-                # We have to remove the extract row first
-                # due to the foreign key constraint in the files table
-                # pointing to it.
-                session.query(obj_class).\
-                            filter(obj_class.sid == row.sid).\
-                            delete()
-                session.commit()
-
-                self.server.files.remove_file_by_id(row.fileid)
-
-                # Fixme: We could increment only if it successfully deleted.
-                removed_count += 1
-
-        return removed_count
+        return self.retain_rows(retain_count, obj_class.__tablename__, 'sid',
+                                'parentid', 'sid DESC', 'fileid IS NOT NULL',
+                                ['fileid'])
 
     # Generate an event in case of a failure.
     def _eventgen(self, update, error=None, data=None,
@@ -1,10 +1,12 @@
 """Manages events for the Tableau background_jobs table."""
 # pylint: enable=relative-import,missing-docstring
 
+import heapq
 import logging
+from datetime import timedelta
 
 from sqlalchemy import Column, BigInteger, Integer, String, DateTime
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index, text
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -13,7 +15,7 @@ from event_control import EventControl
 from profile import UserProfile
 from mixin import BaseMixin, BaseDictMixin
 from manager import synchronized, Manager
-from odbc import ODBC
+from odbc import ODBCError
 from util import timedelta_total_seconds, utc2local, to_hhmmss
 from .system import SystemKeys
 from datasources import DataSourceEntry
@@ -28,6 +30,37 @@ class ExtractNotification(object):
     EXTRACT_DELAY_WARN = 1 << 2
     EXTRACT_DELAY_ERROR = 1 << 3
 
+class ExtractState(object):
+    """The states of an extract job: queued -> running -> success/failed.
+       A job may also finish between two loads without being seen
+       running."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILED = 'failed'
+
+    UNFINISHED = (QUEUED, RUNNING)
+    FINISHED = (SUCCESS, FAILED)
+
+    TRANSITIONS = {
+        None: (QUEUED, RUNNING, SUCCESS, FAILED),
+        QUEUED: (QUEUED, RUNNING, SUCCESS, FAILED),
+        RUNNING: (RUNNING, SUCCESS, FAILED),
+        SUCCESS: (SUCCESS,),
+        FAILED: (FAILED,)
+    }
+
+    @classmethod
+    def of(cls, entry):
+        """The state of the job from its background_jobs columns."""
+        if entry.completed_at is not None:
+            if entry.finish_code == 0:
+                return cls.SUCCESS
+            return cls.FAILED
+        if entry.started_at is not None:
+            return cls.RUNNING
+        return cls.QUEUED
+
 class ExtractEntry(meta.Base, BaseMixin, BaseDictMixin):
     """The extracts table, from the Tableau background_jobs table."""
     __tablename__ = "extracts"
@@ -60,6 +93,7 @@ class ExtractEntry(meta.Base, BaseMixin, BaseDictMixin):
     project_id = Column(Integer)
     system_user_id = Column(Integer)
     notification_state = Column(Integer, default=0, nullable=False)
+    state = Column(String)          # ExtractState
 
     __table_args__ = (UniqueConstraint('envid', 'id'),)
 
@@ -69,9 +103,124 @@ class ExtractEntry(meta.Base, BaseMixin, BaseDictMixin):
         keys = {'envid':envid, 'id':extract_id}
         return cls.get_unique_by_keys(keys, **kwargs)
 
+    @classmethod
+    def unfinished(cls, envid):
+        """The queued and running extracts (from the partial index)."""
+        return meta.Session.query(cls).\
+            filter(cls.envid == envid).\
+            filter(cls.state.in_(ExtractState.UNFINISHED)).\
+            all()
+
+    @classmethod
+    def upgrade(cls):
+        """Add the 'state' column to a table created by an older version,
+        set it from the other columns and create the partial index."""
+        connection = meta.get_connection()
+        try:
+            result = connection.execute(text(
+                "SELECT 1 FROM information_schema.columns " + \
+                "WHERE table_name = :table AND column_name = 'state'"),
+                                        table=cls.__tablename__)
+            if result.first() is None:
+                logger.info("Adding column %s.state", cls.__tablename__)
+                connection.execute("ALTER TABLE extracts " + \
+                                   "ADD COLUMN state VARCHAR")
+            connection.execute(text(
+                "UPDATE extracts SET state = CASE " + \
+                "WHEN completed_at IS NOT NULL AND finish_code = 0 " + \
+                "THEN :success " + \
+                "WHEN completed_at IS NOT NULL THEN :failed " + \
+                "WHEN started_at IS NOT NULL THEN :running " + \
+                "ELSE :queued END WHERE state IS NULL"),
+                               success=ExtractState.SUCCESS,
+                               failed=ExtractState.FAILED,
+                               running=ExtractState.RUNNING,
+                               queued=ExtractState.QUEUED)
+            result = connection.execute(text(
+                "SELECT 1 FROM pg_class WHERE relname = :name"),
+                                        name=UNFINISHED_INDEX.name)
+            if result.first() is None:
+                logger.info("Creating index %s", UNFINISHED_INDEX.name)
+                UNFINISHED_INDEX.create(bind=connection)
+        finally:
+            connection.close()
+
+# Most extracts are finished: only the unfinished ones are indexed.
+UNFINISHED_INDEX = Index('extracts_unfinished_idx',
+                         ExtractEntry.envid, ExtractEntry.extractid,
+                         postgresql_where=ExtractEntry.state.in_(
+                             ExtractState.UNFINISHED))
+
+
+class ExtractDeadlines(object):
+    """The times at which the unfinished extracts cross their delay (if
+       queued) or duration (if running) thresholds, in a heap, so that
+       only the extracts due are checked instead of all the unfinished
+       ones.  An extract is scheduled once per state: stale deadlines,
+       i.e. of an extract that has since started or finished, are
+       harmless as the checks depend on the state and notification_state
+       of the extract."""
+
+    DELAY_KEYS = (SystemKeys.EXTRACT_DELAY_WARN,
+                  SystemKeys.EXTRACT_DELAY_ERROR)
+    DURATION_KEYS = (SystemKeys.EXTRACT_DURATION_WARN,
+                     SystemKeys.EXTRACT_DURATION_ERROR)
+
+    def __init__(self):
+        self.heap = []          # (deadline, extractid)
+        self.scheduled = {}     # extractid -> state scheduled
+        self.thresholds = None
+
+    def reset(self, thresholds):
+        """Forget everything: the deadlines depend on the 'thresholds'."""
+        self.heap = []
+        self.scheduled = {}
+        self.thresholds = self.key(thresholds)
+
+    def key(self, thresholds):
+        return dict([(key, thresholds[key])
+                     for key in self.DELAY_KEYS + self.DURATION_KEYS])
+
+    def is_current(self, thresholds):
+        return self.thresholds == self.key(thresholds)
+
+    def schedule(self, entry):
+        if entry.state not in ExtractState.UNFINISHED:
+            self.scheduled.pop(entry.extractid, None)
+            return
+        if self.scheduled.get(entry.extractid) == entry.state:
+            return
+        self.scheduled[entry.extractid] = entry.state
+        if entry.state == ExtractState.QUEUED:
+            start = entry.created_at
+            keys = self.DELAY_KEYS
+        else:
+            start = entry.started_at
+            keys = self.DURATION_KEYS
+        if start is None:
+            return
+        for key in keys:
+            if self.thresholds[key]:
+                heapq.heappush(self.heap,
+                               (start + timedelta(seconds=self.thresholds[key]),
+                                entry.extractid))
+
+    def due(self, now):
+        """Remove and return the extractids with a deadline up to 'now'."""
+        extractids = set()
+        while self.heap and self.heap[0][0] <= now:
+            extractids.add(heapq.heappop(self.heap)[1])
+        return extractids
+
 class ExtractManager(Manager):
     """Manages alerting for background_jobs."""
 
+    LOAD_BATCH = 500        # background_jobs rows per lookup and commit
+
+    def __init__(self, server):
+        super(ExtractManager, self).__init__(server)
+        self.deadlines = ExtractDeadlines()
+
     def _add_info(self, entry):
         """Look up the extract in the entry as specified in the args
            column of the passed entry and fill in information, if available,
@@ -156,61 +305,119 @@ class ExtractManager(Manager):
                     last_updated_at + "'"
         stmt += " ORDER BY id ASC"
 
-        datadict = agent.odbc.execute(stmt)
-
-        if 'error' in datadict or '' not in datadict:
-            return datadict
-
         # Get the tableau system's idea of time which may be different
         # than ours (maybe somebody isn't running ntp or equivalent).
+        # This is another request to the agent, so it must be done before
+        # the rows are streamed.
         db_now_utc = agent.odbc.get_db_now_utc()
+        if isinstance(db_now_utc, dict):
+            return db_now_utc
 
         extract_thresholds = self._get_thresholds()
 
-        # Get the latest rows and row updates here
+        if not self.deadlines.is_current(extract_thresholds):
+            # First load or the thresholds changed.
+            self.deadlines.reset(extract_thresholds)
+            for entry in ExtractEntry.unfinished(envid):
+                self.deadlines.schedule(entry)
+
+        # Get the latest rows and row updates here, a batch at a time.
         session = meta.Session()
-        for odbcdata in ODBC.load(datadict):
-            exid = odbcdata.data['id']
-            entry = ExtractEntry.get(envid, exid, default=None)
+        count = 0
+        batch = []
+        try:
+            for odbcdata in agent.odbc.execute_iter(stmt):
+                count += 1
+                batch.append(odbcdata)
+                if len(batch) == self.LOAD_BATCH:
+                    self._load_batch(agent, envid, session, batch,
+                                     db_now_utc, extract_thresholds)
+                    batch = []
+        except ODBCError as ex:
+            return {u'error': str(ex)}
+        if batch:
+            self._load_batch(agent, envid, session, batch,
+                             db_now_utc, extract_thresholds)
 
+        db_now_utc = agent.odbc.get_db_now_utc()
+        if isinstance(db_now_utc, dict):
+            return db_now_utc
+        self._check_deadlines(agent, envid, session, db_now_utc,
+                              extract_thresholds)
+
+        return {u'status': 'OK', u'count': count}
+
+    def _load_batch(self, agent, envid, session, batch,
+                    db_now_utc, extract_thresholds):
+        """Insert or update the extracts of a batch of background_jobs rows
+           with one lookup and one commit."""
+        # pylint: disable=too-many-arguments
+        ids = [odbcdata.data['id'] for odbcdata in batch]
+        entries = dict([(entry.id, entry) for entry in
+                        session.query(ExtractEntry).\
+                            filter(ExtractEntry.envid == envid).\
+                            filter(ExtractEntry.id.in_(ids)).\
+                            all()])
+
+        for odbcdata in batch:
+            exid = odbcdata.data['id']
+            entry = entries.get(exid)
             if entry is None:
                 entry = ExtractEntry(envid=envid)
                 session.add(entry)
+                entries[exid] = entry
             odbcdata.copyto(entry)
 
             data = dict(agent.todict().items() + extract_thresholds.items())
             self._process(data, db_now_utc, entry)
-            session.commit()    # can move this after proven reliable
-
-        self._check_existing_unfinished(agent, extract_thresholds)
-
-        return {u'status': 'OK', u'count': len(datadict[''])}
-
-    def _check_existing_unfinished(self, agent, extract_thresholds):
-        """Go through our unfinished extracts db to see if any have exceeded
-           their start delay or duration thresholds.
-        """
+        session.commit()
+
+        # The new entries have an extractid now.
+        for entry in entries.values():
+            self.deadlines.schedule(entry)
+
+    def _check_deadlines(self, agent, envid, session, db_now_utc,
+                         extract_thresholds):
+        """Check the unfinished extracts that have crossed a start delay or
+           duration threshold since the last check."""
+        # pylint: disable=too-many-arguments
+        extractids = self.deadlines.due(db_now_utc)
+        if not extractids:
+            return
 
-        session = meta.Session()
         rows = session.query(ExtractEntry).\
-            filter(ExtractEntry.progress != 100).\
+            filter(ExtractEntry.envid == envid).\
+            filter(ExtractEntry.extractid.in_(extractids)).\
+            filter(ExtractEntry.state.in_(ExtractState.UNFINISHED)).\
             all()
 
-        db_now_utc = agent.odbc.get_db_now_utc()
-
         for row in rows:
             data = dict(agent.todict().items() + extract_thresholds.items())
-            self._process(data, db_now_utc, row)
-            session.commit()    # can move this after proven reliable
+            self._check_thresholds(data, db_now_utc, row)
+        session.commit()
 
     def _process(self, data, db_now_utc, entry):
-        """Send events as appropriate:
+        """Move the entry to its new state and send events as appropriate:
             - delayed start
             - duration exeeded
             - EXTRACT OK
-            - EXTRACT FAILED
+            - EXTRACT FAILED (once, on entering the state)
         """
+        state = ExtractState.of(entry)
+        if state not in ExtractState.TRANSITIONS[entry.state]:
+            # Tableau is right: go along.
+            logger.info("extract %d: unexpected transition %s -> %s",
+                        entry.id, entry.state, state)
+        previous = entry.state
+        entry.state = state
+
+        self._check_thresholds(data, db_now_utc, entry)
 
+        if state != previous and state in ExtractState.FINISHED:
+            self._check_finished(data, entry)
+
+    def _check_thresholds(self, data, db_now_utc, entry):
+        """Send the delayed start or duration exceeded events due."""
         if entry.notification_state is None:
             entry.notification_state = 0
 
@@ -219,8 +426,6 @@ class ExtractManager(Manager):
         else:
             self._check_duration_exceeded(data, db_now_utc, entry)
 
-        self._check_finished(data, entry)
-
     def _check_start_delay(self, data, db_now_utc, entry):
         """Check for delayed start time.
            Sends an event on start time exceeded.
@@ -1,5 +1,6 @@
 import logging
 import os
+import tempfile
 import urllib
 import json
 import exc
@@ -9,6 +10,8 @@ logger = logging.getLogger()
 
 class FileManager(object):
 
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, agent):
         self.server = agent.server
         self.agent = agent
@@ -25,13 +28,52 @@ class FileManager(object):
             self.checkpath(path)
             uri = self.uri(path)
             logger.debug("FileManager GET %s", uri)
-            return self.agent.connection.http_send('GET', uri)
+            return self.agent.connection.http_send('GET', uri, bulk=True)
         except (exc.HTTPException, httplib.HTTPException,
                 EnvironmentError) as ex:
             raise IOError("filemanager.get failed: %s" % str(ex))
 
+    def read(self, path, chunk_size=None):
+        """Yield the contents of a remote file in chunks of at most
+           'chunk_size' bytes instead of reading all of it into memory.
+           NOTE: an agent channel is in use until the iteration finishes.
+        """
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        self.checkpath(path)
+        uri = self.uri(path)
+        logger.debug("FileManager GET (streamed) %s", uri)
+        error = None
+        try:
+            with self.agent.connection.stream('GET', uri) as res:
+                if res.status != httplib.OK:
+                    error = "%d %s: %s" % (res.status, res.reason,
+                                           res.read())
+                else:
+                    while True:
+                        buf = res.read(chunk_size)
+                        if not buf:
+                            break
+                        yield buf
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError) as ex:
+            raise IOError("filemanager.read failed: %s" % str(ex))
+        if error:
+            raise IOError("filemanager.read failed: %s" % error)
+
+    def copyto(self, path, fileobj):
+        """Write a remote file to the file object 'fileobj'.
+           Returns the number of bytes written."""
+        size = 0
+        for buf in self.read(path):
+            fileobj.write(buf)
+            size += len(buf)
+        return size
+
     def save(self, path, target='.'):
-        """Retrieves a remote file and saves it locally."""
+        """Retrieves a remote file and saves it locally.  It is written
+           to a temporary file in the same directory that is renamed to
+           'target' once complete (and on disk)."""
         target = os.path.abspath(os.path.expanduser(target))
         self.checkpath(path)
 
@@ -39,29 +81,45 @@ class FileManager(object):
             target = os.path.join(target, self.agent.path.basename(path))
 
         try:
-            with open(target, "w") as f:
-                data = self.get(path)
-                f.write(data)
-            return {
-                'target': target,
-                'path': path,
-                'size': len(data)
-                }
-        except (exc.HTTPException, httplib.HTTPException,
-                EnvironmentError) as ex:
+            f = tempfile.NamedTemporaryFile(dir=os.path.dirname(target),
+                                            prefix='.' + \
+                                                os.path.basename(target),
+                                            delete=False)
+        except EnvironmentError as ex:
             raise IOError("filemanager.save failed: %s" % str(ex))
+        try:
+            with f:
+                size = self.copyto(path, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(f.name, target)
+        except BaseException as ex:
+            os.remove(f.name)
+            if isinstance(ex, EnvironmentError):
+                raise IOError("filemanager.save failed: %s" % str(ex))
+            raise
+        return {
+            'target': target,
+            'path': path,
+            'size': size
+            }
 
     def put(self, path, data):
+        """'data' is a string or a file object, which is sent from its
+           current position to the end a piece at a time."""
         self.checkpath(path)
         uri = self.uri(path)
-        headers = {}
-        if not data:
-            # http://bugs.python.org/issue14721
-            headers['content-length'] = 0
-        logger.debug("FileManager PUT %s: %d", uri, len(data))
+        if hasattr(data, 'read'):
+            size = os.fstat(data.fileno()).st_size - data.tell()
+        else:
+            size = len(data)
+        # Also a work-around for an empty body:
+        # http://bugs.python.org/issue14721
+        headers = {'content-length': str(size)}
+        logger.debug("FileManager PUT %s: %d", uri, size)
         try:
             body = self.agent.connection.http_send('PUT', uri, data,
-                                                   headers=headers)
+                                                   headers=headers, bulk=True)
             if body:
                 return json.loads(body)
             else:
@@ -128,15 +186,26 @@ class FileManager(object):
     def sendfile(self, path, source):
         source = os.path.abspath(os.path.expanduser(source))
         with open(source, "rb") as f:
-            data = f.read()
-            body = self.put(path, data)
+            size = os.fstat(f.fileno()).st_size
+            body = self.put(path, f)
         logger.debug("sendfile source '%s' path '%s' size %d.",
-                     source, path, len(data))
+                     source, path, size)
         body['source'] = source
         body['path'] = path
-        body['size'] = len(data)
+        body['size'] = size
         return body
 
+    def delete_files(self, paths):
+        """Delete several files with one request.  Returns the body with
+           the number 'deleted' and the 'errors' by path."""
+        data = {'action':'DELETE', 'paths':paths}
+        try:
+            body = self.agent.connection.http_send_json('/file', data)
+            return json.loads(body)
+        except (exc.HTTPException, httplib.HTTPException,
+                EnvironmentError, ValueError) as ex:
+            raise IOError("filemanager.delete_files failed: %s" % str(ex))
+
     def delete(self, path):
         self.checkpath(path)
         uri = self.uri(path)
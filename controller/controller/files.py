@@ -1,4 +1,5 @@
 import logging
+import threading
 import urllib
 from collections import OrderedDict
 
@@ -13,7 +14,7 @@ from agent import AgentVolumesEntry
 from cloud import CloudEntry
 from manager import Manager
 from mixin import BaseDictMixin
-from util import failed
+from util import failed, traceback_string
 
 STORAGE_TYPE_VOL = "vol"
 STORAGE_TYPE_CLOUD = "cloud"
@@ -82,6 +83,32 @@ class FileEntry(meta.Base, BaseDictMixin):
         return data
 
 
+def run_concurrently(jobs, workers):
+    """Call each function in 'jobs' with at most 'workers' of them running
+       at the same time, and return once they are done.  A job that raises
+       an exception is logged."""
+    jobs = list(jobs)
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                job = jobs.pop(0)
+            try:
+                job()
+            except StandardError:
+                logger.error("run_concurrently: %s",
+                             traceback_string(all_on_one_line=False))
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(jobs)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
 class FileManager(Manager):
 
     STORAGE_TYPE_VOL = STORAGE_TYPE_VOL
@@ -92,6 +119,11 @@ class FileManager(Manager):
     FILE_TYPE_WORKBOOK = "workbook"
     FILE_TYPE_DATASOURCE = "datasource"
 
+    DELETE_BATCH = 100          # paths per agent delete request
+    AGENT_DELETE_WORKERS = 2    # delete requests running on an agent
+    CLOUD_DELETE_WORKERS = 8    # deletes running on a cloud
+    ROW_BATCH = 1000            # fileids per files table statement
+
     # FIXME: replace this with kwargs variant.
     def add(self, name, file_type, storage_type, storageid,
             size=0, auto=True, encrypted=False, username=None):
@@ -223,6 +255,123 @@ class FileManager(Manager):
 
         return remove_body
 
+    def remove_files(self, fileids):
+        """Remove many files from disk or cloud and their rows from the
+           files table: the files on an agent are deleted DELETE_BATCH
+           at a time, the agents and clouds concurrently, with at most
+           AGENT_DELETE_WORKERS requests running on an agent and
+           CLOUD_DELETE_WORKERS on a cloud.  As remove_file_by_id() does,
+           the row of a file on a connected agent is removed even if the
+           delete failed (it was probably gone already) while the rows of
+           files on a disconnected agent or that failed to be deleted from
+           the cloud are kept.
+           Returns the number of rows removed."""
+        entries = []
+        fileids = list(fileids)
+        for i in range(0, len(fileids), self.ROW_BATCH):
+            entries += meta.Session.query(FileEntry).\
+                filter(FileEntry.envid == self.envid).\
+                filter(FileEntry.fileid.in_(fileids[i:i + self.ROW_BATCH])).\
+                all()
+        if not entries:
+            return 0
+
+        # Resolve the agents and clouds here: the workers don't use the db.
+        volids = set([entry.storageid for entry in entries
+                      if entry.storage_type == STORAGE_TYPE_VOL])
+        agentids = {}
+        if volids:
+            for vol_entry in meta.Session.query(AgentVolumesEntry).\
+                    filter(AgentVolumesEntry.volid.in_(volids)).\
+                    all():
+                agentids[vol_entry.volid] = vol_entry.agentid
+
+        agents = {}     # agentid -> [entry, ...]
+        clouds = {}     # cloudid -> [entry, ...]
+        for entry in entries:
+            if entry.storage_type == STORAGE_TYPE_CLOUD:
+                clouds.setdefault(entry.storageid, []).append(entry)
+            elif entry.storageid in agentids:
+                agents.setdefault(agentids[entry.storageid], []).append(entry)
+            else:
+                logger.info("remove_files: volid %d not found for %s",
+                            entry.storageid, entry.name)
+
+        removed = []
+        jobs = []
+        for agentid, group in agents.items():
+            agent = self.server.agentmanager.agent_by_id(agentid)
+            if agent is None:
+                logger.info("remove_files: agentid %d not connected, " + \
+                            "%d files not removed.", agentid, len(group))
+                continue
+            batches = [group[i:i + self.DELETE_BATCH]
+                       for i in range(0, len(group), self.DELETE_BATCH)]
+            jobs.append(lambda agent=agent, batches=batches: removed.extend(
+                self._delete_agent_files(agent, batches)))
+        for cloudid, group in clouds.items():
+            cloud_entry = self.server.cloud.get_by_cloudid(cloudid)
+            if not cloud_entry:
+                logger.info("remove_files: cloudid %d not found, " + \
+                            "%d files not removed.", cloudid, len(group))
+                continue
+            jobs.append(lambda cloud_entry=cloud_entry, group=group:
+                        removed.extend(self._delete_cloud_files(cloud_entry,
+                                                                group)))
+
+        run_concurrently(jobs, len(jobs))
+
+        session = meta.Session()
+        for i in range(0, len(removed), self.ROW_BATCH):
+            session.query(FileEntry).\
+                filter(FileEntry.fileid.in_(removed[i:i + self.ROW_BATCH])).\
+                delete(synchronize_session=False)
+            session.commit()
+        logger.debug("remove_files removed %d of %d files",
+                     len(removed), len(entries))
+        return len(removed)
+
+    def _delete_agent_files(self, agent, batches):
+        """Delete the batches of file entries on 'agent'.
+           Returns the fileids done."""
+        done = []
+        def delete(batch):
+            paths = [entry.name for entry in batch]
+            try:
+                body = agent.filemanager.delete_files(paths)
+            except IOError as ex:
+                # An agent without the bulk delete: one at a time.
+                logger.debug("remove_files: %s: %s", agent.displayname,
+                             str(ex))
+                for path in paths:
+                    try:
+                        agent.filemanager.delete(path)
+                    except IOError as ex:
+                        logger.info("filemanager.delete('%s') failed: %s",
+                                    path, str(ex))
+            else:
+                for path, error in body.get('errors', {}).items():
+                    logger.info("remove_files: '%s' on %s: %s",
+                                path, agent.displayname, error)
+            done.extend([entry.fileid for entry in batch])
+        run_concurrently([(lambda batch=batch: delete(batch))
+                          for batch in batches], self.AGENT_DELETE_WORKERS)
+        return done
+
+    def _delete_cloud_files(self, cloud_entry, group):
+        """Delete the file entries in a cloud.  Returns the fileids done."""
+        done = []
+        def delete(entry):
+            try:
+                self.server.cloud.delete_cloud_file(cloud_entry, entry.name)
+            except IOError as ex:
+                logger.info("remove_files: %s", str(ex))
+                return
+            done.append(entry.fileid)
+        run_concurrently([(lambda entry=entry: delete(entry))
+                          for entry in group], self.CLOUD_DELETE_WORKERS)
+        return done
+
     def find_by_name(self, name):
         try:
             return meta.Session.query(FileEntry).\
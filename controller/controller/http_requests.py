@@ -4,22 +4,22 @@ from urllib import unquote
 from urlparse import urlparse
 
 from sqlalchemy import Column, String, DateTime, Integer, BigInteger
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, Index, text
 from sqlalchemy.schema import ForeignKey
-from sqlalchemy.orm.exc import MultipleResultsFound
 
 import akiri.framework.sqlalchemy as meta
 
-from cache import TableauCacheManager
+from cache import TableauCacheManager, LRUCache
 from manager import synchronized
 from mixin import BaseMixin, BaseDictMixin
 from http_control import HttpControlData
 from event_control import EventControl
 from util import timedelta_total_seconds, utc2local
 from sites import Site
+from projects import Project
 from workbooks import WorkbookEntry
 from profile import UserProfile
-from odbc import ODBC, ODBCData
+from odbc import ODBCError
 from system import SystemKeys
 
 logger = logging.getLogger()
@@ -73,12 +73,102 @@ class HttpRequestEntry(meta.Base, BaseMixin, BaseDictMixin):
 #
         return row
 
+    @classmethod
+    def get_by_vizql_sessions(cls, envid, vizql_sessions, action):
+        """The most recent row with 'action' of each of the
+           'vizql_sessions' as a dict."""
+        rows = meta.Session.query(HttpRequestEntry).\
+            filter(HttpRequestEntry.envid == envid).\
+            filter(HttpRequestEntry.vizql_session.in_(vizql_sessions)).\
+            filter(HttpRequestEntry.action == action).\
+            order_by(HttpRequestEntry.created_at.desc()).\
+            all()
+        found = {}
+        for row in rows:
+            found.setdefault(row.vizql_session, row)
+        return found
+
     @classmethod
     def maxid(cls, envid):
         return cls.max('id', filters={'envid':envid})
 
+    @classmethod
+    def upgrade_indexes(cls):
+        """Create the INDEXES missing from a table created by an older
+        version (create_all() only creates indexes with their table)."""
+        connection = meta.get_connection()
+        try:
+            for index in INDEXES:
+                result = connection.execute(text(
+                    "SELECT 1 FROM pg_class WHERE relname = :name"),
+                                            name=index.name)
+                if result.first() is None:
+                    logger.info("Creating index %s", index.name)
+                    index.create(bind=connection)
+        finally:
+            connection.close()
+
+# The 'show' row of a vizql session is looked up for load alerts.
+INDEXES = [
+    Index('http_requests_envid_vizql_session_action_idx',
+          HttpRequestEntry.envid, HttpRequestEntry.vizql_session,
+          HttpRequestEntry.action)
+]
+
+
+class VizqlIndex(object):
+    """The rows of a batch by (vizql_session, action) - the first one, as
+       the linear search did - plus the rows of earlier batches looked up
+       with resolve()."""
+
+    def __init__(self, rows):
+        self.rows = {}
+        for row in rows:
+            if row.vizql_session:
+                self.rows.setdefault((row.vizql_session, row.action), row)
+
+    def resolve(self, envid, vizql_sessions, action):
+        """Look up the rows with 'action' of the 'vizql_sessions' not in
+           the batch with one query."""
+        missing = [vizql_session for vizql_session in set(vizql_sessions)
+                   if (vizql_session, action) not in self.rows]
+        if not missing:
+            return
+        found = HttpRequestEntry.get_by_vizql_sessions(envid, missing, action)
+        for vizql_session, row in found.items():
+            self.rows[(vizql_session, action)] = row
+
+    def find(self, vizql_session, action):
+        return self.rows.get((vizql_session, action))
+
+
+class WorkbookInfo(object):
+    """What the events need of a workbook, cached across loads."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, entry, projects, sites):
+        self.name = entry.name
+        self.system_user_id = entry.system_user_id
+        self.project = projects.get(entry.project_id)
+        self.site = sites.get(entry.site_id)
+
+# WorkbookInfo placeholders in the cache.
+WORKBOOK_NOT_FOUND = 'not-found'
+WORKBOOK_DUPLICATE = 'duplicate'
+
+
 class HttpRequestManager(TableauCacheManager):
 
+    # rows committed (and tested for alerts) at a time
+    BATCH_SIZE = 1000
+    # (site_id, repository_url) -> WorkbookInfo
+    WORKBOOK_CACHE_SIZE = 10000
+
+    def __init__(self, server):
+        super(HttpRequestManager, self).__init__(server)
+        # Cleared by the WorkbookManager when the workbooks change.
+        self.workbooks = LRUCache(self.WORKBOOK_CACHE_SIZE)
+
     def get_maxid_statement(self, maxid):
         stmt = ''
         if maxid is None:
@@ -100,44 +190,58 @@ class HttpRequestManager(TableauCacheManager):
         userdata = self.load_users(agent)
 
         maxid = HttpRequestEntry.maxid(envid)
-        datadict = agent.odbc.execute(self.get_maxid_statement(maxid))
-        if 'error' in datadict:
-            return datadict
-        if '' not in datadict:
-            datadict['error'] = "Missing '' key in query response."
-            return datadict
+        stmt = self.get_maxid_statement(maxid)
 
+        # Rows are streamed from the agent and committed in batches so
+        # memory use doesn't depend on the size of the delta.
+        session = meta.Session()
         rows = []
-        schema = ODBC.schema(datadict)
         counter = 0
-        session = None
-        for row in datadict['']:
-            if counter % 1000 == 0:
-                if session != None:
-                    session.commit()
-                    # Our table was empty so don't test for alerts on the one
-                    # placeholder row we brought in.
-                    if maxid is not None:
-                        for entry in rows:
-#                           print "entry: id", entry.id, "action", entry.action,
-#                           print "vizal_session", entry.vizql_session
-                            self._test_for_alerts(rows,
-                                entry, agent, controldata)
-                session = meta.Session()
-                rows = []
-            counter += 1
-            odbcdata = ODBCData(schema, row)
-            entry = HttpRequestEntry()
-            entry.envid = envid
-            odbcdata.copyto(entry)
-            system_user_id = userdata.get(entry.site_id, entry.user_id)
-            entry.system_user_id = system_user_id
-            session.add(entry)
-            rows.append(entry)
-
-        if session != None:
+        try:
+            for odbcdata in agent.odbc.execute_iter(stmt):
+                counter += 1
+                entry = HttpRequestEntry()
+                entry.envid = envid
+                odbcdata.copyto(entry)
+                system_user_id = userdata.get(entry.site_id, entry.user_id)
+                entry.system_user_id = system_user_id
+                session.add(entry)
+                rows.append(entry)
+                if len(rows) == self.BATCH_SIZE:
+                    self._commit_batch(session, rows, maxid, agent,
+                                       controldata)
+                    rows = []
+        except ODBCError as ex:
             session.commit()
-        return {u'status': 'OK', u'count': len(datadict[''])}
+            return {'error': str(ex)}
+
+        self._commit_batch(session, rows, maxid, agent, controldata)
+        return {u'status': 'OK', u'count': counter}
+
+    def _commit_batch(self, session, rows, maxid, agent, controldata):
+        # pylint: disable=too-many-arguments
+        session.commit()
+        # Our table was empty so don't test for alerts on the one
+        # placeholder row we brought in.
+        if maxid is None:
+            return
+
+        index = VizqlIndex(rows)
+        if self.system[SystemKeys.HTTP_LOAD_ERROR] or \
+           self.system[SystemKeys.HTTP_LOAD_WARN]:
+            # The load alerts of bootstrapSession rows use the 'show' row.
+            index.resolve(self.server.environment.envid,
+                          [entry.vizql_session for entry in rows
+                           if entry.action == 'bootstrapSession' and \
+                              entry.vizql_session],
+                          'show')
+
+        # The events are sent once the lookups they need are done for all.
+        events = []
+        for entry in rows:
+            self._test_for_alerts(index, entry, controldata, events)
+        if events:
+            self._send_events(agent, events)
 
     def _parseuri(self, uri, body):
         # Keep body['uri'] to be the whole uri, even if it includes a
@@ -172,7 +276,7 @@ class HttpRequestManager(TableauCacheManager):
                 body['repository_url'] = tokens[2]
                 body['view'] = tokens[4]
 
-    def _test_for_alerts(self, rows, entry, agent, controldata):
+    def _test_for_alerts(self, index, entry, controldata, events):
         if entry.http_request_uri.startswith('/admin'):
             return
 
@@ -181,16 +285,15 @@ class HttpRequestManager(TableauCacheManager):
 
         if entry.status >= 400 and entry.action == 'show':
             if not controldata.status_exclude(entry.status, body['uri']):
-                self._eventgen(EventControl.HTTP_BAD_STATUS,
-                               agent, entry, body=body)
+                events.append((EventControl.HTTP_BAD_STATUS, entry, body))
         elif entry.action in ('show', 'bootstrapSession',
                                 'performPostLoadOperations', 'sessions',
                                 'get_customized_views'):
             if controldata.load_exclude(body['uri']):
                 return
-            self._test_for_load_alerts(rows, entry, agent, body)
+            self._test_for_load_alerts(index, entry, body, events)
 
-    def _test_for_load_alerts(self, rows, entry, agent, body):
+    def _test_for_load_alerts(self, index, entry, body, events):
     # pylint: disable=too-many-return-statements
     # pylint: disable=too-many-branches
     # Different event types are described in PD-5352.
@@ -232,7 +335,7 @@ class HttpRequestManager(TableauCacheManager):
                                       entry.completed_at, entry.created_at))
                 body['view_compute_duration'] = seconds_compute
 
-                show_entry = self._find_vizql_entry(rows, entry, 'show')
+                show_entry = index.find(entry.vizql_session, 'show')
 
                 if not show_entry:
                     logger.error("http load test Type 1: http_requests "
@@ -260,7 +363,7 @@ class HttpRequestManager(TableauCacheManager):
                 self._parseuri(entry.http_request_uri, body)
             elif entry.vizql_session and entry.status == 500:
                 # Type 3: Failed Initial View Generation
-                show_entry = self._find_vizql_entry(rows, entry, 'show')
+                show_entry = index.find(entry.vizql_session, 'show')
 
                 if not show_entry:
                     logger.error("http load test Type 3: "
@@ -275,8 +378,7 @@ class HttpRequestManager(TableauCacheManager):
                 body = {}
                 entry = show_entry
                 self._parseuri(entry.http_request_uri, body)
-                self._eventgen(EventControl.HTTP_LOAD_TYPE_3,
-                               agent, entry, body=body)
+                events.append((EventControl.HTTP_LOAD_TYPE_3, entry, body))
                 return
 #            elif not entry.currentsheet and not entry.vizql_session:
 #                # Type 4: currentsheet is blank or empty and vizql_session
@@ -303,35 +405,9 @@ class HttpRequestManager(TableauCacheManager):
 #        print 'body:', body, 'seconds:', seconds
 
         if errorlevel != 0 and seconds >= errorlevel:
-            self._eventgen(EventControl.HTTP_LOAD_ERROR,
-                           agent, entry, body=body)
+            events.append((EventControl.HTTP_LOAD_ERROR, entry, body))
         elif warnlevel != 0 and seconds >= warnlevel:
-            self._eventgen(EventControl.HTTP_LOAD_WARN,
-                           agent, entry, body=body)
-
-    def _find_vizql_entry(self, rows, entry, action):
-#        rows = []  # for debugging to remove the cache and force db search
-        for row in rows:
-            if row.vizql_session == entry.vizql_session and \
-                                        row.action == action:
-#                print "found it in the cache:", row.reqid
-                return row
-#            print "not this one. looking for", entry.vizql_session,
-#            print "instead it is:", row.reqid, row.vizql_session
-
-        # fixme: search through db
-#        return None
-#   pylint: disable=unreachable
-        # We didn't find it in our latest odbc request so we'll dig through
-        # all of the http rows.
-        envid = self.server.environment.envid
-        db_row = HttpRequestEntry.get_by_vizql_action(envid,
-                                                entry.vizql_session, action)
-#        if db_row == None:
-#            print "Didn't find it in the cache OR db", entry.reqid
-#        else:
-#            print "Didn't find it in the cache.  db find was:", db_row.reqid
-        return db_row
+            events.append((EventControl.HTTP_LOAD_WARN, entry, body))
 
     def _get_last_http_requests_id(self, agent):
         stmt = "SELECT MAX(id) FROM http_requests"
@@ -343,28 +419,104 @@ class HttpRequestManager(TableauCacheManager):
             return 0
         return int(row[0])
 
-    # translate workbook.repository_url -> system_user_id -> owner
-    def _translate_workbook(self, body, entry):
+    def _send_events(self, agent, events):
+        """Send the (key, entry, body) events of a batch, with one query
+           each for the workbooks (not cached), users and sites they
+           refer to."""
         envid = self.server.environment.envid
 
+        workbooks = self._workbooks(envid,
+                                    [(entry.site_id, body['repository_url'])
+                                     for _, entry, body in events
+                                     if 'repository_url' in body])
+
+        system_user_ids = set()
+        for _, entry, _ in events:
+            system_user_id = int_or_none(entry.system_user_id)
+            if system_user_id is not None and system_user_id != -1:
+                system_user_ids.add(system_user_id)
+        for workbook in workbooks.values():
+            if isinstance(workbook, WorkbookInfo):
+                system_user_ids.add(workbook.system_user_id)
+        profiles = {}
+        if system_user_ids:
+            for profile in meta.Session.query(UserProfile).\
+                    filter(UserProfile.envid == envid).\
+                    filter(UserProfile.system_user_id.in_(system_user_ids)).\
+                    all():
+                profiles[profile.system_user_id] = profile
+
+        site_ids = set([entry.site_id for _, entry, _ in events
+                        if entry.site_id])
+        sites = names_by_id(Site, envid, site_ids)
+
+        for key, entry, body in events:
+            self._eventgen(key, agent, entry, body, workbooks, profiles, sites)
+
+    def _workbooks(self, envid, keys):
+        """The WorkbookInfo (or placeholder) of each (site_id,
+           repository_url) in 'keys' as a dict, from the cache or else
+           with one query."""
+        result = {}
+        missing = set()
+        for key in keys:
+            workbook = self.workbooks.get(key)
+            if workbook is None:
+                missing.add(key)
+            else:
+                result[key] = workbook
+        if not missing:
+            return result
+
+        found = {}
+        for entry in meta.Session.query(WorkbookEntry).\
+                filter(WorkbookEntry.envid == envid).\
+                filter(WorkbookEntry.repository_url.in_(
+                    set([url for _, url in missing]))).\
+                all():
+            key = (entry.site_id, entry.repository_url)
+            if key in missing:
+                found.setdefault(key, []).append(entry)
+
+        entries = [rows[0] for rows in found.values()]
+        projects = names_by_id(Project, envid,
+                               set([entry.project_id for entry in entries]))
+        sites = names_by_id(Site, envid,
+                            set([entry.site_id for entry in entries]))
+
+        for key in missing:
+            rows = found.get(key)
+            if not rows:
+                workbook = WORKBOOK_NOT_FOUND
+            elif len(rows) > 1:
+                # technically the Tableau database does not guarantee
+                # uniqueness.
+                workbook = WORKBOOK_DUPLICATE
+            else:
+                workbook = WorkbookInfo(rows[0], projects, sites)
+            self.workbooks.put(key, workbook)
+            result[key] = workbook
+        return result
+
+    # translate workbook.repository_url -> system_user_id -> owner
+    def _translate_workbook(self, body, entry, workbooks, profiles, sites):
+        # pylint: disable=too-many-arguments
         url = body['repository_url']
-        try:
-            workbook = WorkbookEntry.get_by_url(envid, url, entry.site_id,
-                                            default=None)
-        except MultipleResultsFound:
+        workbook = workbooks.get((entry.site_id, url))
+        if workbook == WORKBOOK_DUPLICATE:
             logger.warning("Multiple rows found for url '%s', site_id: '%s'",
                            url, entry.site_id)
             body['workbook'] = 'Unknown: Duplicate repository url'
             body['owner'] = 'Unknown: Duplicate repository url'
             return
 
-        if not workbook:
+        if not isinstance(workbook, WorkbookInfo):
             logger.warning("repository_url '%s' Not Found.", url)
             return
         body['workbook'] = workbook.name
 
         # Send this userid on event generation (workbook owner, not viewer).
-        user = UserProfile.get_by_system_user_id(envid, workbook.system_user_id)
+        user = profiles.get(workbook.system_user_id)
         if user:
             body['userid'] = user.userid
             body['owner'] = user.display_name()
@@ -376,24 +528,20 @@ class HttpRequestManager(TableauCacheManager):
         if workbook.site:
             body['site'] = workbook.site
         else:
-            if entry.site_id:
-                site = Site.get(entry.envid, entry.site_id)
-                if site:
-                    body['site'] = site.name
-
-    def _eventgen(self, key, agent, entry, body=None):
-        if body is None:
-            body = {}
+            if entry.site_id and entry.site_id in sites:
+                body['site'] = sites[entry.site_id]
+
+    def _eventgen(self, key, agent, entry, body, workbooks, profiles, sites):
+        # pylint: disable=too-many-arguments
         body = dict(body.items() +\
                         agent.todict().items() +\
                         entry.todict().items())
 
         body['http_status'] = responses[entry.status]
 
-        system_user_id = entry.system_user_id
-        if system_user_id != -1:
-            profile = UserProfile.get_by_system_user_id(entry.envid,
-                                                        entry.system_user_id)
+        system_user_id = int_or_none(entry.system_user_id)
+        if system_user_id is not None and system_user_id != -1:
+            profile = profiles.get(system_user_id)
             if profile:
                 # This is the browser/viewer user, and not the
                 # workbook publisher/owner.
@@ -408,7 +556,7 @@ class HttpRequestManager(TableauCacheManager):
         body['userid'] = None       # default
 
         if 'repository_url' in body:
-            self._translate_workbook(body, entry)
+            self._translate_workbook(body, entry, workbooks, profiles, sites)
 
         if 'http_referer' in body:
             body['http_referer'] = unquote(body['http_referer']).decode('utf8')
@@ -434,3 +582,20 @@ class HttpRequestManager(TableauCacheManager):
             filter(HttpRequestEntry.envid == envid).\
             filter(HttpRequestEntry.id > maxid).\
             delete(synchronize_session='fetch')
+
+
+def int_or_none(value):
+    """The system_user_id column is a string."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def names_by_id(cls, envid, ids):
+    """The names of the Site or Project rows with the Tableau 'ids'."""
+    if not ids:
+        return {}
+    return dict(meta.Session.query(cls.id, cls.name).\
+                filter(cls.envid == envid).\
+                filter(cls.id.in_(ids)).\
+                all())
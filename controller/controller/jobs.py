@@ -0,0 +1,222 @@
+""" Scheduled jobs that run inside the controller process. """
+import logging
+import threading
+import Queue
+
+import akiri.framework.sqlalchemy as meta
+
+from agentmanager import AgentManager
+from event_control import EventControl
+from state import StateManager
+from util import failed, traceback_string
+
+logger = logging.getLogger()
+
+class Job(object):
+    """A pending run of a native job.
+       'background' jobs do not make the scheduler wait for them, which
+       matches the sched scripts that forked before doing their work."""
+
+    def __init__(self, name, func, priority, background):
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.background = background
+        self.done = threading.Event()
+        self.body = None
+
+    def wait(self):
+        self.done.wait()
+        return self.body
+
+class JobExecutor(object):
+    """A bounded pool of worker threads that runs native scheduled jobs.
+       Jobs are taken from the queue in 'priority' order (lower is sooner,
+       None is last) and a job that is still queued or running is not
+       queued again."""
+
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, server, workers=DEFAULT_WORKERS):
+        self.server = server
+        self.queue = Queue.PriorityQueue()
+        self.lockobj = threading.Lock()
+        self.pending = {}   # name -> Job, for queued and running jobs
+        self.seq = 0
+        self.jobs = {}
+
+        self.register('sync', self.sync)
+        self.register('auth_import', self.auth_import)
+        self.register('workbook', self.workbook, background=True)
+        self.register('datasource', self.datasource, background=True)
+        self.register('extract', self.extract, background=True)
+        self.register('cpu_load', self.cpu_load)
+        self.register('yml', self.yml)
+        self.register('checkports', self.checkports)
+
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def register(self, name, func, background=False):
+        """Map a cron job name to a callable taking no arguments."""
+        self.jobs[name] = (func, background)
+
+    def __contains__(self, name):
+        return name in self.jobs
+
+    def submit(self, name, priority=None):
+        """Queue the named job.  Returns the queued Job or None if a run
+           of the same job is still pending."""
+        func, background = self.jobs[name]
+        with self.lockobj:
+            if name in self.pending:
+                logger.debug("sched job '%s' is still pending: skipping",
+                             name)
+                return None
+            job = Job(name, func, priority, background)
+            self.pending[name] = job
+            self.seq += 1
+            # The cron query sorts a NULL priority last but python 2
+            # sorts None before any integer.
+            if priority is None:
+                key = float('inf')
+            else:
+                key = priority
+            self.queue.put((key, self.seq, job))
+        return job
+
+    def _worker(self):
+        while True:
+            _, _, job = self.queue.get()
+            try:
+                job.body = self._run(job)
+            finally:
+                with self.lockobj:
+                    del self.pending[job.name]
+                job.done.set()
+
+    def _run(self, job):
+        logger.debug("sched native job: %s", job.name)
+        self.server.upgrade_rwlock.read_acquire()
+        session = meta.Session()
+        try:
+            body = job.func()
+        except (SystemExit, KeyboardInterrupt, GeneratorExit):
+            raise
+        except BaseException:
+            line = traceback_string(all_on_one_line=False)
+            logger.error("sched job '%s' failed: %s", job.name, line)
+            self.server.event_control.gen(
+                EventControl.SCHEDULED_JOB_FAILED,
+                {'error': "Job '%s' failed: %s" % (job.name, line)})
+            return {'error': line}
+        finally:
+            session.rollback()
+            meta.Session.remove()
+            self.server.upgrade_rwlock.read_release()
+
+        if body is None:
+            body = {}
+        logger.debug("sched job '%s' result: %s", job.name, str(body))
+        return body
+
+    def _primary(self):
+        """Returns the connected, enabled primary or None."""
+        manager = self.server.agentmanager
+        return manager.agent_by_type(AgentManager.AGENT_TYPE_PRIMARY)
+
+    def _odbc_primary(self, name):
+        """Returns the primary if odbc commands can be run on it now,
+           otherwise logs why the job is skipped and returns None."""
+        agent = self._primary()
+        if not agent:
+            logger.info("sched job '%s' skipped: no primary agent", name)
+            return None
+        if not self.server.odbc_ok():
+            logger.info("sched job '%s' skipped: main state is %s", name,
+                        self.server.state_manager.get_state())
+            return None
+        return agent
+
+    # The jobs.  Each does the same work as the 'telnet' command(s)
+    # the corresponding script in the sched_dir sends.
+    def sync(self):
+        agent = self._odbc_primary('sync')
+        if agent:
+            return self.server.sync_cmd(agent)
+
+    def auth_import(self):
+        agent = self._odbc_primary('auth_import')
+        if agent:
+            return self.server.auth.load(agent)
+
+    def workbook(self):
+        agent = self._odbc_primary('workbook')
+        if not agent:
+            return
+        # Like the sched script: every step runs whatever the result of
+        # the previous ones; the first failure is the one reported.
+        body = self.server.workbooks.load(agent)
+        fixup_body = self.server.workbooks.fixup(agent)
+        if not failed(body):
+            body = fixup_body
+        if self.server.odbc_ok():
+            hrman_body = self.server.hrman.load(agent)
+            if not failed(body):
+                body = hrman_body
+        return body
+
+    def datasource(self):
+        agent = self._odbc_primary('datasource')
+        if not agent:
+            return
+        # Like the sched script: the fixup runs whatever the load result.
+        body = self.server.datasources.load(agent)
+        fixup_body = self.server.datasources.fixup(agent)
+        if failed(body):
+            return body
+        return fixup_body
+
+    def extract(self):
+        agent = self._odbc_primary('extract')
+        if not agent:
+            return
+        # Like the sched script: the refresh runs whatever the load result.
+        body = self.server.extract.load(agent)
+        if self.server.odbc_ok():
+            refresh_body = self.server.extract_archive.refresh(agent)
+            if not failed(body):
+                body = refresh_body
+        return body
+
+    def cpu_load(self):
+        return self.server.metrics.check()
+
+    def yml(self):
+        agent = self._primary()
+        if not agent:
+            logger.info("sched job 'yml' skipped: no primary agent")
+            return
+        try:
+            return self.server.yml_sync(agent)
+        except IOError as ex:
+            logger.debug("FAIL: Can't get yml: %s", str(ex))
+            return {'error': "Can't get yml: %s" % str(ex)}
+
+    def checkports(self):
+        main_state = self.server.state_manager.get_state()
+        if main_state in (StateManager.STATE_PENDING,
+                          StateManager.STATE_DISCONNECTED):
+            logger.info("sched job 'checkports' skipped: main state is %s",
+                        main_state)
+            return
+        ports = self.server.ports
+        if not ports.check_ports_lock(blocking=False):
+            logger.info("sched job 'checkports' skipped: already running")
+            return
+        try:
+            return ports.check_ports()
+        finally:
+            ports.check_ports_unlock()
@@ -4,6 +4,8 @@ from __future__ import absolute_import
 
 import logging
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.header import Header
 
@@ -14,15 +16,82 @@ DEFAULT_MAX_SUBJECT_LEN = 1000
 
 logger = logging.getLogger()
 
+class SMTPPool(object):
+    """ A pool of persistent SMTP connections to one server.  A connection
+    that has been idle for more than 'check_interval' seconds is checked
+    with NOOP before it is reused. """
+
+    DEFAULT_SIZE = 2
+    CHECK_INTERVAL = 30 # seconds
+    TIMEOUT = 60 # seconds
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, size=DEFAULT_SIZE,
+                 check_interval=CHECK_INTERVAL):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.check_interval = check_interval
+        self.idle = [] # (connection, time released)
+        self.lock = threading.Lock()
+
+    def _healthy(self, conn, released):
+        if time.time() - released < self.check_interval:
+            return True
+        try:
+            return conn.noop()[0] == 250
+        except (smtplib.SMTPException, EnvironmentError):
+            return False
+
+    def acquire(self):
+        """ Return a connected smtplib.SMTP instance. """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, released = self.idle.pop()
+            if self._healthy(conn, released):
+                return conn
+            self._close(conn)
+        return smtplib.SMTP(self.host, self.port, timeout=self.TIMEOUT)
+
+    def release(self, conn, broken=False):
+        """ Return 'conn' to the pool, closing it if it failed or the
+        pool is full. """
+        if not broken:
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, EnvironmentError):
+            conn.close()
+
+    def close(self):
+        """ Close all idle connections. """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, _ in idle:
+            self._close(conn)
+
+
 class Mailer(object):
-    """ Main email handler. """
+    """ Main email handler.  If a 'pool' is given, messages are sent over
+    its persistent connections, otherwise a new connection is used for
+    every message. """
 
     def __init__(self, sender, host=SMTP_HOST, port=SMTP_PORT,
-                 max_subject_len=DEFAULT_MAX_SUBJECT_LEN):
+                 max_subject_len=DEFAULT_MAX_SUBJECT_LEN, pool=None):
+        # pylint: disable=too-many-arguments
         self.sender = sender
         self.smtp_host = host
         self.smtp_port = port
         self.max_subject_len = max_subject_len
+        self.pool = pool
 
     def send_msg(self, recipients, subject, msg, bcc=None):
         """ Send a generic MIME message object"""
@@ -50,9 +119,7 @@ class Mailer(object):
                     recipients.append(recipient)
 
         try:
-            mail_server = smtplib.SMTP(self.smtp_host, self.smtp_port)
-            mail_server.sendmail(self.sender, recipients, msg.as_string())
-            mail_server.quit()
+            self._sendmail(recipients, msg.as_string())
         except (smtplib.SMTPException, EnvironmentError) as ex:
             logger.error("Email send failed, text: %s, exception: %s, "
                          "server: %s, port: %d",
@@ -63,6 +130,25 @@ class Mailer(object):
                     ",".join(recipients), subject, msg.as_string())
         return True
 
+    def _sendmail(self, recipients, text):
+        if not self.pool:
+            mail_server = smtplib.SMTP(self.smtp_host, self.smtp_port)
+            mail_server.sendmail(self.sender, recipients, text)
+            mail_server.quit()
+            return
+
+        mail_server = self.pool.acquire()
+        try:
+            mail_server.sendmail(self.sender, recipients, text)
+        except smtplib.SMTPRecipientsRefused:
+            # The session itself is still fine.
+            self.pool.release(mail_server)
+            raise
+        except (smtplib.SMTPException, EnvironmentError):
+            self.pool.release(mail_server, broken=True)
+            raise
+        self.pool.release(mail_server)
+
     def send(self, recipients, subject, message, bcc=None):
         """ Send a generic (plain-text) message """
 
@@ -1,11 +1,14 @@
 import datetime
 import logging
+import threading
 import time
 
 import akiri.framework.sqlalchemy as meta
 from event_control import EventControl
 from manager import Manager
 from sqlalchemy import Column, BigInteger, Float, String, DateTime, func
+from sqlalchemy import Index, text
+from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.schema import ForeignKey
 from system import SystemKeys
 
@@ -29,37 +32,390 @@ class MetricEntry(meta.Base):
     creation_time = Column(DateTime, server_default=func.now())
 
 
+class MetricRollupMixin(object):
+    """count/sum/min/max of the samples of one agent process per time
+       bucket.  The average over a period is sum(sum) / sum(count) of the
+       buckets in the period, so it can be read without scanning the raw
+       'metrics' rows."""
+    # pylint: disable=no-init
+
+    @declared_attr
+    def agentid(cls):
+        # pylint: disable=no-self-argument
+        # A foreign key column on a mixin must be created for each table.
+        return Column(BigInteger,
+                      ForeignKey("agent.agentid", ondelete='CASCADE'),
+                      primary_key=True)
+
+    process_name = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+
+    cpu_count = Column(BigInteger, nullable=False, default=0)
+    cpu_sum = Column(Float, nullable=False, default=0)
+    cpu_min = Column(Float)
+    cpu_max = Column(Float)
+    memory_count = Column(BigInteger, nullable=False, default=0)
+    memory_sum = Column(Float, nullable=False, default=0)
+    memory_min = Column(Float)
+    memory_max = Column(Float)
+
+
+class MetricMinuteEntry(meta.Base, MetricRollupMixin):
+    # pylint: disable=no-init
+    __tablename__ = "metrics_minute"
+    __table_args__ = (Index('metrics_minute_bucket_idx', 'bucket'),)
+
+
+class MetricHourEntry(meta.Base, MetricRollupMixin):
+    # pylint: disable=no-init
+    __tablename__ = "metrics_hour"
+    __table_args__ = (Index('metrics_hour_bucket_idx', 'bucket'),)
+
+
+# (table, date_trunc() unit) of the rollups maintained at ingest.
+ROLLUPS = (('metrics_minute', 'minute'), ('metrics_hour', 'hour'))
+
+ROLLUP_COLUMNS = ('cpu_count', 'cpu_sum', 'cpu_min', 'cpu_max',
+                  'memory_count', 'memory_sum', 'memory_min', 'memory_max')
+
+
 class MetricManager(Manager):
-    def add(self, agent, process_name, cpu, memory):
-        session = meta.Session()
+    """Samples from the agent pings are buffered in memory and written by
+       a flusher thread with one multi-row INSERT (and one commit) per
+       batch, instead of one INSERT+COMMIT per counter.
+
+       A batch is written when 'batch_size' samples are pending or every
+       'flush_interval' seconds, whichever comes first.  If the database
+       falls behind and 'max_pending' samples are buffered, add() blocks
+       the caller (up to 'flush_interval' seconds) before dropping the
+       sample.  A batch that fails to insert is retried by the next
+       flushes, then dropped after 'MAX_RETRIES' failures.
+
+       The same statement adds the batch into the per-minute and hourly
+       rollup tables that the threshold checks read.  Raw rows go into
+       one 'metrics_YYYYMMDD' child table of 'metrics' per (UTC) day so
+       prune() can drop whole days."""
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 10  # seconds
+    MAX_PENDING = 10000
+    # Failed inserts of a batch before it is dropped.
+    MAX_RETRIES = 3
+    # The per-minute buckets only need to cover the longest alert period.
+    MINUTE_SAVE_DAYS = 7
+
+    def __init__(self, server):
+        super(MetricManager, self).__init__(server)
+        config = getattr(server, 'config', None)
+        if config:
+            self.batch_size = config.getint('controller',
+                                            'metrics_batch_size',
+                                            default=self.BATCH_SIZE)
+            self.flush_interval = config.getint('controller',
+                                                'metrics_flush_interval',
+                                                default=self.FLUSH_INTERVAL)
+            self.max_pending = config.getint('controller',
+                                             'metrics_max_pending',
+                                             default=self.MAX_PENDING)
+            self.minute_save_days = config.getint(
+                'controller', 'metrics_minute_save_days',
+                default=self.MINUTE_SAVE_DAYS)
+        else:
+            self.batch_size = self.BATCH_SIZE
+            self.flush_interval = self.FLUSH_INTERVAL
+            self.max_pending = self.MAX_PENDING
+            self.minute_save_days = self.MINUTE_SAVE_DAYS
+        self.partitions = set()
+
+        self.pending = []
+        self.dropped = 0
+        # Consecutive failed inserts of the batch at the head of 'pending'.
+        self.failures = 0
+        self.cond = threading.Condition()
+        # Serializes the writers: the flusher thread, check() and shutdown().
+        self.flush_lock = threading.Lock()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        """Start the flusher thread."""
+        self.thread = threading.Thread(target=self._flusher,
+                                       name='metrics-flusher')
+        self.thread.daemon = True
+        self.thread.start()
 
-        entry = MetricEntry(agentid=agent.agentid, process_name=process_name,
-                            cpu=cpu, memory=memory)
-        session.add(entry)
-        session.commit()
+    def add(self, agent, process_name, cpu, memory):
+        """Queue a sample for the metrics table."""
+        # The time the sample was taken: the database 'creation_time'
+        # is computed from its age when the batch is written.
+        sample = (time.time(), agent.agentid, process_name, cpu, memory)
+        with self.cond:
+            if len(self.pending) >= self.max_pending and not self.stopped:
+                self.cond.notify_all()
+                self.cond.wait(self.flush_interval)
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logger.error("metrics: buffer full, dropped %d samples",
+                                 self.dropped)
+                return
+            self.pending.append(sample)
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify_all()
+
+    def _flusher(self):
+        while True:
+            with self.cond:
+                if len(self.pending) < self.batch_size and not self.stopped:
+                    self.cond.wait(self.flush_interval)
+                if self.stopped:
+                    return
+            try:
+                self.flush()
+            except StandardError as ex:
+                logger.error("metrics: flush failed: %s", str(ex))
+                time.sleep(self.flush_interval)
+
+    def _take(self):
+        with self.cond:
+            samples = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            # Wake up any add() waiting for room.
+            self.cond.notify_all()
+        return samples
+
+    def flush(self):
+        """Write all pending samples to the database.
+           Returns the number of rows inserted."""
+        count = 0
+        with self.flush_lock:
+            connection = meta.get_connection()
+            try:
+                while True:
+                    samples = self._take()
+                    if not samples:
+                        break
+                    try:
+                        self._insert(connection, samples)
+                    except StandardError:
+                        self._failed(samples)
+                        raise
+                    self.failures = 0
+                    count += len(samples)
+            finally:
+                connection.close()
+        if count:
+            logger.debug("metrics: flushed %d samples", count)
+        return count
+
+    def _failed(self, samples):
+        """Put a batch that failed to insert back so it isn't lost, unless
+           it already failed MAX_RETRIES times: then it is dropped."""
+        self.failures += 1
+        with self.cond:
+            if self.failures < self.MAX_RETRIES:
+                self.pending[0:0] = samples
+                return
+            self.dropped += len(samples)
+        logger.error("metrics: dropped a batch of %d samples after %d "
+                     "failed inserts", len(samples), self.failures)
+        self.failures = 0
+
+    @classmethod
+    def partition_name(cls, when):
+        """The 'metrics' child table for raw samples taken at 'when'."""
+        return time.strftime('metrics_%Y%m%d', time.gmtime(when))
+
+    def _partition(self, connection, now):
+        name = self.partition_name(now)
+        if name not in self.partitions:
+            # The FOREIGN KEY isn't inherited from the parent.
+            connection.execute(
+                ("CREATE TABLE IF NOT EXISTS %s " + \
+                 "(FOREIGN KEY (agentid) REFERENCES agent (agentid) " + \
+                 "ON DELETE CASCADE) INHERITS (metrics)") % name)
+            self.partitions.add(name)
+        return name
+
+    @classmethod
+    def _rollup_sql(cls, table, unit):
+        """Return the CTEs that add the 'batch' CTE into 'table'.
+           There is only one writer (the flusher) so an UPDATE of the
+           existing buckets followed by an INSERT of the missing ones is
+           safe (no ON CONFLICT before PostgreSQL 9.5)."""
+        agg = ("%(table)s_agg AS (" + \
+               "SELECT agentid, process_name, " + \
+               "date_trunc('%(unit)s', creation_time) AS bucket, " + \
+               "count(cpu) AS cpu_count, " + \
+               "COALESCE(sum(cpu), 0) AS cpu_sum, " + \
+               "min(cpu) AS cpu_min, max(cpu) AS cpu_max, " + \
+               "count(memory) AS memory_count, " + \
+               "COALESCE(sum(memory), 0) AS memory_sum, " + \
+               "min(memory) AS memory_min, max(memory) AS memory_max " + \
+               "FROM batch WHERE process_name IS NOT NULL " + \
+               "GROUP BY 1, 2, 3)")
+        # LEAST() and GREATEST() ignore NULLs.
+        upd = ("%(table)s_upd AS (" + \
+               "UPDATE %(table)s r SET " + \
+               "cpu_count = r.cpu_count + a.cpu_count, " + \
+               "cpu_sum = r.cpu_sum + a.cpu_sum, " + \
+               "cpu_min = LEAST(r.cpu_min, a.cpu_min), " + \
+               "cpu_max = GREATEST(r.cpu_max, a.cpu_max), " + \
+               "memory_count = r.memory_count + a.memory_count, " + \
+               "memory_sum = r.memory_sum + a.memory_sum, " + \
+               "memory_min = LEAST(r.memory_min, a.memory_min), " + \
+               "memory_max = GREATEST(r.memory_max, a.memory_max) " + \
+               "FROM %(table)s_agg a " + \
+               "WHERE r.agentid = a.agentid " + \
+               "AND r.process_name = a.process_name " + \
+               "AND r.bucket = a.bucket " + \
+               "RETURNING r.agentid, r.process_name, r.bucket)")
+        ins = ("%(table)s_ins AS (" + \
+               "INSERT INTO %(table)s " + \
+               "(agentid, process_name, bucket, %(columns)s) " + \
+               "SELECT agentid, process_name, bucket, %(columns)s " + \
+               "FROM %(table)s_agg a WHERE NOT EXISTS (" + \
+               "SELECT 1 FROM %(table)s_upd u " + \
+               "WHERE u.agentid = a.agentid " + \
+               "AND u.process_name = a.process_name " + \
+               "AND u.bucket = a.bucket) RETURNING 1)")
+        args = {'table': table, 'unit': unit,
+                'columns': ', '.join(ROLLUP_COLUMNS)}
+        return [agg % args, upd % args, ins % args]
+
+    def _insert(self, connection, samples):
+        """Insert 'samples' and update the rollups with a single
+           statement (and so a single transaction)."""
+        now = time.time()
+        values = []
+        params = {}
+        for i, sample in enumerate(samples):
+            sampled, agentid, process_name, cpu, memory = sample
+            values.append(("(:agentid_%d, :process_name_%d, :cpu_%d, " + \
+                           ":memory_%d, " + \
+                           "NOW() - :age_%d * INTERVAL '1 second')") % \
+                          (i, i, i, i, i))
+            params['agentid_%d' % i] = agentid
+            params['process_name_%d' % i] = process_name
+            params['cpu_%d' % i] = cpu
+            params['memory_%d' % i] = memory
+            params['age_%d' % i] = max(0.0, now - sampled)
+
+        partition = self._partition(connection, now)
+
+        ctes = [("batch AS (INSERT INTO %s " + \
+                 "(agentid, process_name, cpu, memory, creation_time) " + \
+                 "VALUES %s " + \
+                 "RETURNING agentid, process_name, cpu, memory, " + \
+                 "creation_time)") % (partition, ", ".join(values))]
+        for table, unit in ROLLUPS:
+            ctes.extend(self._rollup_sql(table, unit))
+        # Every data-modifying CTE runs even though only 'batch' is used.
+        stmt = "WITH " + ",\n".join(ctes) + "\nSELECT count(*) FROM batch"
+
+        with connection.begin():
+            connection.execute(text(stmt), **params)
+
+    def populate(self):
+        """Fill empty rollup tables from the raw samples (on upgrade)."""
+        connection = meta.get_connection()
+        try:
+            for table, unit in ROLLUPS:
+                result = connection.execute(
+                    "SELECT 1 FROM %s LIMIT 1" % table)
+                if result.first():
+                    continue
+                if unit == 'minute':
+                    where = "AND creation_time >= " + \
+                            "NOW() - INTERVAL '%d DAYS'" % \
+                            self.minute_save_days
+                else:
+                    where = ""
+                stmt = ("INSERT INTO %(table)s " + \
+                        "(agentid, process_name, bucket, %(columns)s) " + \
+                        "SELECT agentid, process_name, " + \
+                        "date_trunc('%(unit)s', creation_time), " + \
+                        "count(cpu), COALESCE(sum(cpu), 0), " + \
+                        "min(cpu), max(cpu), " + \
+                        "count(memory), COALESCE(sum(memory), 0), " + \
+                        "min(memory), max(memory) " + \
+                        "FROM metrics WHERE process_name IS NOT NULL " + \
+                        "%(where)s GROUP BY 1, 2, 3")
+                stmt = stmt % {'table': table, 'unit': unit, 'where': where,
+                               'columns': ', '.join(ROLLUP_COLUMNS)}
+                result = connection.execute(stmt)
+                logger.info("metrics: populated %s with %d buckets",
+                            table, result.rowcount)
+        finally:
+            connection.close()
+
+    def shutdown(self):
+        """Stop the flusher thread and write whatever is still pending."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(self.flush_interval)
+        try:
+            self.flush()
+        except StandardError as ex:
+            logger.error("metrics: final flush failed: %s", str(ex))
 
     def prune(self):
-        """Prune/remove old rows from the metrics table."""
+        """Prune/remove old samples: drop the daily 'metrics' partitions
+           and the rollup buckets that are older than METRIC_SAVE_DAYS
+           (MINUTE_SAVE_DAYS for the per-minute buckets)."""
 
         metric_save_days = self.system[SystemKeys.METRIC_SAVE_DAYS]
         logger.debug("metrics: prune save %d days", metric_save_days)
 
-        stmt = ("DELETE FROM metrics " + \
-                "WHERE creation_time < NOW() - INTERVAL '%d DAYS'") % \
-               (metric_save_days,)
+        # Keep an extra day: a partition holds a whole (UTC) day.
+        oldest = self.partition_name(time.time() -
+                                     (metric_save_days + 1) * 24 * 60 * 60)
+        pruned = 0
 
         connection = meta.get_connection()
-        result = connection.execute(stmt)
-        connection.close()
-
-        logger.debug("metrics: pruned %d rows", result.rowcount)
-        return {'status': "OK", 'pruned': result.rowcount}
+        try:
+            stmt = "SELECT c.relname FROM pg_inherits i " + \
+                   "JOIN pg_class c ON c.oid = i.inhrelid " + \
+                   "JOIN pg_class p ON p.oid = i.inhparent " + \
+                   "WHERE p.relname = 'metrics'"
+            partitions = [row[0] for row in connection.execute(stmt)]
+            dropped = []
+            for name in sorted(partitions):
+                if name >= oldest:
+                    break
+                connection.execute("DROP TABLE %s" % name)
+                self.partitions.discard(name)
+                dropped.append(name)
+
+            # Rows written before the table was partitioned.
+            stmt = ("DELETE FROM ONLY metrics " + \
+                    "WHERE creation_time < NOW() - INTERVAL '%d DAYS'") % \
+                   (metric_save_days,)
+            pruned += connection.execute(stmt).rowcount
+
+            for table, days in (('metrics_minute', self.minute_save_days),
+                                ('metrics_hour', metric_save_days)):
+                stmt = ("DELETE FROM %s " + \
+                        "WHERE bucket < NOW() - INTERVAL '%d DAYS'") % \
+                       (table, days)
+                pruned += connection.execute(stmt).rowcount
+        finally:
+            connection.close()
+
+        logger.debug("metrics: dropped partitions %s, pruned %d rows",
+                     str(dropped), pruned)
+        return {'status': "OK", 'pruned': pruned, 'dropped': dropped}
 
     def check(self, metric='cpu'):
         # pylint: disable=too-many-locals
         if metric != 'cpu':
             return {'error': 'Unknown metric: %s' % metric}
 
+        # Include the samples still in the buffer.
+        self.flush()
+
         cpu_load_warn = self.system[SystemKeys.CPU_LOAD_WARN]
         cpu_load_error = self.system[SystemKeys.CPU_LOAD_ERROR]
         cpu_period_warn = self.system[SystemKeys.CPU_PERIOD_WARN]
@@ -162,7 +518,7 @@ class MetricManager(Manager):
                                             threshold,
                                             period,
                                             level,
-                                            avg(value) as average_value
+                                            sum(value_sum) / NULLIF(sum(value_count), 0) as average_value
                                     FROM (
                                             SELECT
                                                     '%(metric_type)s_' || config.process_name AS name,
@@ -170,8 +526,8 @@ class MetricManager(Manager):
                                                     config.threshold,
                                                     config.period,
                                                     config.level,
-                                                    creation_time,
-                                                    %(metric_type)s as value
+                                                    m.%(metric_type)s_sum as value_sum,
+                                                    m.%(metric_type)s_count as value_count
                                             FROM
                                                     (SELECT
                                                              process_name,
@@ -195,9 +551,9 @@ class MetricManager(Manager):
                                                              AND period_error > 0
                                                              AND alert_type = '%(metric_type)s'
                                                     ) config
-                                                    LEFT JOIN metrics m
+                                                    LEFT JOIN metrics_minute m
                                                             ON m.process_name = config.process_name
-                                                            AND m.creation_time >= NOW() - (config.period * '1 minutes' :: INTERVAL)
+                                                            AND m.bucket >= date_trunc('minute', NOW() - (config.period * '1 minutes' :: INTERVAL))
                                                             AND m.agentid = %(agentid)d
                                     ) details
                                              GROUP BY
@@ -332,10 +688,14 @@ class MetricManager(Manager):
                          time.time() - last_connection_time)
             return {"above": "unknown"}
 
-        stmt = ("SELECT AVG(cpu) FROM metrics WHERE " + \
+        # Read the per-minute buckets: the period starts at the beginning
+        # of its first minute.
+        stmt = ("SELECT SUM(cpu_sum) / NULLIF(SUM(cpu_count), 0) " + \
+                "FROM metrics_minute WHERE " + \
                 "agentid = %d AND " + \
                 "process_name = '_Total' AND " + \
-                "creation_time >= NOW() - INTERVAL '%d seconds'") % \
+                "bucket >= date_trunc('minute', " + \
+                "NOW() - INTERVAL '%d seconds')") % \
                (agent.agentid, period)
 
         report_value = -1
@@ -1,5 +1,7 @@
 import logging
 import time
+import json
+import httplib
 from datetime import datetime
 
 from collections import OrderedDict
@@ -9,10 +11,25 @@ from mixin import CredentialMixin
 
 logger = logging.getLogger()
 
+class ODBCError(RuntimeError):
+    """A query run with ODBC.execute_iter() failed."""
+    pass
+
 class ODBC(CredentialMixin):
 
     URI = '/sql'
 
+    # Agents that support it send the result of a query that asks for
+    # streaming as newline-delimited JSON frames:
+    #     {"$schema": {...}, "": [rows...]}     (first frame)
+    #     {"": [rows...]}                       (more row batches)
+    #     {"status": "OK", "count": N}          (last frame)
+    # or {"error": "..."} at any point.  Other agents send the usual
+    # single JSON document.
+    STREAM_HEADER = 'X-Palette-Stream'
+    STREAM_CONTENT_TYPE = 'application/x-ndjson'
+    STREAM_READ_SIZE = 64 * 1024
+
     DRIVER = '' # filled in later depending on bitness of tableau install
     SERVER = '127.0.0.1'
     PORT = 8060
@@ -87,6 +104,84 @@ class ODBC(CredentialMixin):
 
         return self.server.send_immediate(self.agent, 'POST', self.URI, data)
 
+    def execute_iter(self, stmt):
+        """Run 'stmt' and yield the rows as ODBCData instances without
+           holding the whole result in memory (when the agent supports
+           streaming).  Raises ODBCError on failure.
+           NOTE: the agent channel is in use until the iteration finishes,
+           so don't send other requests to this agent from inside the loop.
+        """
+        try:
+            data = {'connection': self._connection(),
+                    'select-statement': stmt}
+        except RuntimeError as ex:
+            raise ODBCError(str(ex))
+
+        aconn = self.agent.connection
+        headers = {'Content-Type': 'application/json'}
+        if len(aconn.channels) > 1:
+            # A single channel would be blocked for the whole query.
+            headers[self.STREAM_HEADER] = 'ndjson'
+
+        try:
+            with aconn.stream('POST', self.URI, json.dumps(data),
+                              headers) as res:
+                if res.status != httplib.OK:
+                    raise ODBCError("%s failed with status %d: %s" % \
+                                    (self.URI, res.status, res.read()))
+                ctype = res.getheader('Content-Type', '')
+                if ctype.startswith(self.STREAM_CONTENT_TYPE):
+                    for odbcdata in self._frames(res):
+                        yield odbcdata
+                    return
+                rawbody = res.read()
+        except (httplib.HTTPException, EnvironmentError) as ex:
+            msg = "odbc %s failed: %s" % (self.URI, str(ex))
+            logger.error(msg)
+            self.server.remove_agent(self.agent, msg)
+            raise ODBCError(msg)
+
+        # Non-streaming agent: the channel has been released already.
+        datadict = json.loads(rawbody)
+        if 'error' in datadict:
+            raise ODBCError(datadict['error'])
+        if '' not in datadict:
+            raise ODBCError("Missing '' key in query response.")
+        schema = self.schema(datadict)
+        for row in datadict['']:
+            yield ODBCData(schema, row)
+
+    def _lines(self, res):
+        buf = ''
+        while True:
+            chunk = res.read(self.STREAM_READ_SIZE)
+            if not chunk:
+                break
+            lines = (buf + chunk).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buf.strip():
+            yield buf
+
+    def _frames(self, res):
+        schema = None
+        for line in self._lines(res):
+            frame = json.loads(line)
+            if 'error' in frame:
+                raise ODBCError(frame['error'])
+            if '$schema' in frame:
+                schema = self.schema(frame)
+            if 'status' in frame:
+                return
+            if '' in frame:
+                if schema is None:
+                    raise ODBCError("Rows received before the schema.")
+                for row in frame['']:
+                    yield ODBCData(schema, row)
+        raise ODBCError("Query result truncated.")
+
     def get_db_now_utc(self):
         """
             Get the tableau postgres database's idea of the current
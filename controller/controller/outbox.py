@@ -0,0 +1,148 @@
+""" Durable queue of outgoing email. """
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, func
+from sqlalchemy.schema import ForeignKey
+
+import akiri.framework.sqlalchemy as meta
+
+from mailer import Mailer, SMTPPool
+from manager import Manager
+from system import SystemKeys
+from util import traceback_string
+
+logger = logging.getLogger()
+
+class EmailOutboxEntry(meta.Base):
+    # pylint: disable=no-init
+    __tablename__ = "email_outbox"
+
+    outboxid = Column(BigInteger, unique=True, nullable=False,
+                      autoincrement=True, primary_key=True)
+    envid = Column(BigInteger, ForeignKey("environment.envid"))
+
+    # comma separated lists of addresses
+    recipients = Column(String)
+    bcc = Column(String)
+    subject = Column(String)
+    message = Column(String)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_time = Column(DateTime, nullable=False, index=True)
+    last_error = Column(String)
+    creation_time = Column(DateTime, server_default=func.now())
+
+
+class EmailOutbox(Manager):
+    """Email is stored in the 'email_outbox' table and sent by a single
+       delivery thread over a pool of persistent SMTP connections, so
+       a burst of alerts reuses the same SMTP sessions.  A failed message
+       is retried with exponential backoff, up to 'max_attempts' times.
+       Messages left in the table by a restart are sent when the
+       controller starts again."""
+
+    MAX_ATTEMPTS = 8
+    RETRY_DELAY = 30        # seconds, doubled after each failure
+    MAX_RETRY_DELAY = 3600  # seconds
+    BATCH_SIZE = 50
+    POLL_INTERVAL = 60      # seconds
+
+    def __init__(self, server):
+        super(EmailOutbox, self).__init__(server)
+        config = getattr(server, 'config', None)
+        if config:
+            pool_size = config.getint('alert', 'smtp_pool_size',
+                                      default=SMTPPool.DEFAULT_SIZE)
+            self.max_attempts = config.getint('alert', 'email_max_attempts',
+                                              default=self.MAX_ATTEMPTS)
+        else:
+            pool_size = SMTPPool.DEFAULT_SIZE
+            self.max_attempts = self.MAX_ATTEMPTS
+        self.pool = SMTPPool(size=pool_size)
+        self.cond = threading.Condition()
+        self.wakeup = False
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='email-outbox')
+        thread.daemon = True
+        thread.start()
+
+    def put(self, recipients, subject, message, bcc=None):
+        """Queue a plain text message and commit it."""
+        session = meta.Session()
+        entry = EmailOutboxEntry(envid=self.envid,
+                                 recipients=','.join(recipients or []),
+                                 bcc=','.join(bcc or []),
+                                 subject=subject, message=message,
+                                 next_attempt_time=datetime.utcnow())
+        session.add(entry)
+        session.commit()
+        with self.cond:
+            self.wakeup = True
+            self.cond.notify()
+
+    def retry_delay(self, attempts):
+        """Seconds to wait before the next attempt after 'attempts'
+           failures."""
+        return min(self.RETRY_DELAY * 2 ** (attempts - 1),
+                   self.MAX_RETRY_DELAY)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.wakeup:
+                    self.cond.wait(self.POLL_INTERVAL)
+                self.wakeup = False
+            try:
+                while self.deliver() == self.BATCH_SIZE:
+                    pass
+            except StandardError:
+                logger.error("email outbox: %s",
+                             traceback_string(all_on_one_line=False))
+            finally:
+                meta.Session.remove()
+
+    def deliver(self):
+        """Send the messages that are due, stopping at the first failure
+           (most likely the SMTP server is unavailable, so the rest would
+           fail too).  Returns the number of messages sent."""
+        session = meta.Session()
+        now = datetime.utcnow()
+        entries = session.query(EmailOutboxEntry).\
+            filter(EmailOutboxEntry.envid == self.envid).\
+            filter(EmailOutboxEntry.next_attempt_time <= now).\
+            order_by(EmailOutboxEntry.next_attempt_time).\
+            limit(self.BATCH_SIZE).\
+            all()
+        if not entries:
+            return 0
+
+        sent = 0
+        mailer = Mailer(self.system[SystemKeys.FROM_EMAIL], pool=self.pool)
+        for entry in entries:
+            recipients = [x for x in entry.recipients.split(',') if x]
+            bcc = [x for x in (entry.bcc or '').split(',') if x]
+            if mailer.send(recipients, entry.subject, entry.message,
+                           bcc=bcc or None):
+                session.delete(entry)
+                sent += 1
+                continue
+
+            entry.attempts += 1
+            if entry.attempts >= self.max_attempts:
+                logger.error("email outbox: giving up on '%s' to %s " + \
+                             "after %d attempts", entry.subject,
+                             entry.recipients, entry.attempts)
+                session.delete(entry)
+                break
+            delay = self.retry_delay(entry.attempts)
+            entry.next_attempt_time = now + timedelta(seconds=delay)
+            entry.last_error = 'send failed'
+            logger.info("email outbox: '%s' failed, attempt %d, " + \
+                        "retry in %d seconds", entry.subject,
+                        entry.attempts, delay)
+            break
+        session.commit()
+        return sent
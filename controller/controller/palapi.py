@@ -7,6 +7,7 @@ import ntpath
 import posixpath
 
 import clierror
+import rpc
 
 class CommError(object):
     COULD_NOT_CONNECT_TO_HOST = 1
@@ -19,6 +20,59 @@ class CommException(StandardError):
         self.errnum = errnum
         self.message = message
 
+class TextChannel(object):
+    """A telnet connection to the controller used for a single command."""
+
+    def __init__(self, hostname, port):
+        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.conn.connect((hostname, port))
+        except socket.error, ex:
+            raise CommException(CommError.COULD_NOT_CONNECT_TO_HOST,
+                ("Could not connect to host '%s', port '%d': %s") %
+                                (hostname, port, ex))
+        self.sock = self.conn.makefile('w+', 1)
+
+    def send(self, line):
+        self.sock.write(line + '\n')
+        self.sock.flush()
+
+    def readline(self):
+        return self.sock.readline()
+
+    def close(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn.close()
+            self.sock.close()
+        except socket.error:
+            print "Couldn't close socket. Ignoring."
+
+
+class RpcChannel(object):
+    """A command sent on a pooled, persistent connection (see rpc.py)."""
+
+    def __init__(self, pool):
+        self.conn = pool.get()
+        self.call = None
+
+    def send(self, line):
+        try:
+            self.call = self.conn.call(line)
+        except rpc.RpcError as ex:
+            raise CommException(CommError.COMMAND_FAILED_TO_RUN, str(ex))
+
+    def readline(self):
+        try:
+            return self.call.readline()
+        except rpc.RpcError as ex:
+            raise CommException(CommError.COMMAND_FAILED_TO_RUN, str(ex))
+
+    def close(self):
+        if self.call is not None:
+            self.call.close()
+
+
 class CommBase(object):
     # pylint: disable=too-many-instance-attributes
     def __init__(self):
@@ -30,9 +84,6 @@ class CommBase(object):
 
         self.preamble = ""
 
-        self.connected = False
-        self.sock = None
-        self.conn = None
         self.command = ""
         self.result = ""
         self.response = ""
@@ -43,24 +94,16 @@ class CommBase(object):
         self.verbose = 1
 
     def connect(self):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.conn.connect((self.hostname, self.port))
-        except socket.error, ex:
-            raise CommException(CommError.COULD_NOT_CONNECT_TO_HOST,
-                ("Could not connect to host '%s', port '%d': %s") %
-                                (self.hostname, self.port, ex))
-
-        self.sock = self.conn.makefile('w+', 1)
-        self.connected = True
+        """Open the channel used to send a single command."""
+        return TextChannel(self.hostname, self.port)
 
-    # pylint: disable=too-many-branches
     def send_cmd(self, cmd, req=None, read_response=True,
                  skip_on_wrong_state=False):
-
-        if not self.connected:
-            self.connect()
-
+        """
+        Send a command to the controller and return its (JSON) response,
+        which is also saved in self.result - only use the return value when
+        the instance is shared by several threads.
+        """
         self.command = cmd
         self.response = ""
         self.result = {}
@@ -74,9 +117,21 @@ class CommBase(object):
             preamble += " /userid=%d" % userid
 
         full_command = preamble + ' ' + cmd
-        self.sock.write(full_command +'\n')
-        self.sock.flush()
-        ack = self.sock.readline().strip()
+        channel = self.connect()
+        try:
+            channel.send(full_command)
+            result = self._read_result(channel, cmd, full_command,
+                                       read_response, skip_on_wrong_state)
+        finally:
+            channel.close()
+        if result is not None:
+            self.result = result
+        return result
+
+    # pylint: disable=too-many-branches
+    def _read_result(self, channel, cmd, full_command, read_response,
+                     skip_on_wrong_state):
+        ack = channel.readline().strip()
         if self.verbose > 1:
             print "Acknowledgment response:", ack
         if ack != 'OK':
@@ -84,7 +139,7 @@ class CommBase(object):
             if len(parts) < 2 or not parts[1].isdigit():
                 raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                                     "Command '%s' failed: %s" % \
-                                        (self.command, ack))
+                                        (cmd, ack))
             errnum = int(parts[1])
             # Skip on BUSY or WRONG_STATE if requested
             if skip_on_wrong_state and errnum in \
@@ -96,58 +151,47 @@ class CommBase(object):
                 print >> sys.stderr, \
                     "Skipping command due to wrong state: '%s': %s" % \
                                                                     (cmd, ack)
-                return
+                return None
 
             raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                                 "Command '%s' failed. Error: %s" % \
-                                    (self.command, ack))
+                                    (cmd, ack))
 
         if not read_response:
-            self._close()
-            return
+            return None
 
         if self.verbose > 1:
             print "Reading command response."
-        self.response = self.sock.readline()
+        response = channel.readline()
+        self.response = response
 
         try:
-            self.result = json.loads(self.response)
+            result = json.loads(response)
         except ValueError as ex:
             raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                 ("Can't decode json from command '%s' from " + \
-                "response: '%s': %s") % (self.command, self.response, str(ex)))
-        finally:
-            self._close()
+                "response: '%s': %s") % (cmd, response, str(ex)))
 
         if self.verbose > 1:
-            print 'Response:', self.response
+            print 'Response:', response
 
-        if 'error' in self.result:
+        if 'error' in result:
             raise CommException(CommError.COMMAND_RESULT_ERROR,
                 ('Error in command ("%s") response: %s') % \
-                            (full_command, self.result['error']))
+                            (full_command, result['error']))
 
-        if not 'status' in self.result:
+        if not 'status' in result:
             raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                 ('Error in command ("%s").  Missing "status" in ' + \
                   'response: %s') % \
-                            (full_command, str(self.result)))
+                            (full_command, str(result)))
 
-        if self.result['status'] != "OK":
+        if result['status'] != "OK":
             raise CommException(CommError.COMMAND_FAILED_TO_RUN,
                 ('Error in command ("%s").  status not "OK" in ' + \
                   'response: %s') % \
-                            (full_command, self.result['status']))
-
-
-    def _close(self):
-        self.connected = False
-        try:
-            self.conn.shutdown(socket.SHUT_RDWR)
-            self.conn.close()
-            self.sock.close()
-        except socket.error:
-            print "Couldn't close socket. Ignoring."
+                            (full_command, result['status']))
+        return result
 
     def checksum(self, path, buf_size=2**16):
         sha = hashlib.sha256()
@@ -221,6 +265,24 @@ class CommHandlerApp(CommBase):
         self.app = app
         self.hostname = hostname
         self.port = port
+        # False once the controller is known not to support 'rpc'.
+        self.use_rpc = True
+
+    def connect(self):
+        """
+        Commands from the web application share the persistent connections
+        of the process: the instance is used by all the request threads.
+        """
+        if self.use_rpc:
+            try:
+                return RpcChannel(rpc.get_pool(self.hostname, self.port))
+            except rpc.RpcUnsupported:
+                self.use_rpc = False
+            except socket.error, ex:
+                raise CommException(CommError.COULD_NOT_CONNECT_TO_HOST,
+                    ("Could not connect to host '%s', port '%d': %s") %
+                                    (self.hostname, self.port, ex))
+        return super(CommHandlerApp, self).connect()
 
 
 class CommHandlerArgs(CommBase):
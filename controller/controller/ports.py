@@ -1,6 +1,7 @@
 import logging
 import threading
 import json
+import httplib
 
 from sqlalchemy import Column, Integer, BigInteger, String, DateTime, func
 from sqlalchemy import Boolean, Float
@@ -66,6 +67,14 @@ class PortEntry(meta.Base, BaseMixin):
 
 class PortManager(Manager):
 
+    # Agents checking all their ports with one request (see check_ports).
+    PROBE_URI = '/ports'
+    # Connect timeout of a target (at most).
+    PROBE_TIMEOUT = 30
+    # The agent is asked to finish the whole batch this many seconds
+    # before the agent socket timeout, however many targets are filtered.
+    PROBE_MARGIN = 10
+
     def __init__(self, server):
         super(PortManager, self).__init__(server)
 
@@ -84,56 +93,133 @@ class PortManager(Manager):
         self.port_lock_obj.release()
 
     def check_ports(self):
+        """Check all the active ports: an agent checks all its ports
+           concurrently with a single request, then all the rows are
+           updated in one transaction."""
         ports = PortManager.find_by_envid(self.envid)
 
-        report = []
+        by_agentid = {}
         for port in ports:
-            if port.active == False:
-                # update color and notified_color to neutral
-                meta.Session.query(PortEntry).\
-                    filter(PortEntry.portid == port.portid).\
-                    update({'color': None, 'notified_color': None},
-                           synchronize_session=False)
+            if port.active != False:
+                by_agentid.setdefault(port.agentid, []).append(port)
+
+        # Check first so the rows aren't locked while the agents work.
+        checks = []
+        for agentid in sorted(by_agentid):
+            entries = by_agentid[agentid]
+            agent = self.server.agentmanager.agent_by_agentid(agentid)
+            if not agent:
+                results = [None] * len(entries)
+            else:
+                results = self.probe_ports(agent, entries)
+                if results is None:
+                    results = [self.pok(agent, entry) for entry in entries]
+            checks.extend([(entry, agent, result) \
+                               for entry, result in zip(entries, results)])
+
+        inactive = [port.portid for port in ports if port.active == False]
+        if inactive:
+            # update color and notified_color to neutral
+            meta.Session.query(PortEntry).\
+                filter(PortEntry.portid.in_(inactive)).\
+                update({'color': None, 'notified_color': None},
+                       synchronize_session=False)
 
-                meta.Session.commit()
-                continue
+        report = []
+        events = []
+        for entry, agent, result in checks:
+            report.append(self.update_port(entry, agent, result, events))
 
-            results_dict = self.check_port(port)
+        meta.Session.commit()
 
-            report.append(results_dict)
+        for key, data in events:
+            self.server.event_control.gen(key, data)
 
         return {'status': 'OK', 'ports': report}
 
     def check_port(self, entry):
-        # pylint: disable=too-many-branches
-        # pylint: disable=too-many-statements
         """Tests connectivity from an agent to a host/port.
-           Returns "success", "fail", or "unknown" (if agent
-           isn't connected)."""
-
-        details = {
-                    'service_name': entry.service_name,
-                    'dest_port': entry.dest_port,
-                    'dest_hostname': entry.dest_host
-                   }
-
-        if entry.max_time:
-            details['max_time'] = entry.max_time
-
+           Returns the details of the check with an 'error' on
+           failure (or if the agent isn't connected)."""
         agent = self.server.agentmanager.agent_by_agentid(entry.agentid)
-        if not agent:
-            logger.debug("check_port: agentid %d not connected.  Will not " + \
-                         "check service_name %s dest_host '%s' dest_port '%d'",
-                         entry.agentid, entry.service_name, entry.dest_host,
-                         entry.dest_port)
-            details['error'] = \
-                "agent %d not connected.  Can't do port check." % entry.agentid
-            return details
+        result = None
+        if agent:
+            results = self.probe_ports(agent, [entry])
+            if results is None:
+                result = self.pok(agent, entry)
+            else:
+                result = results[0]
+
+        events = []
+        details = self.update_port(entry, agent, result, events)
+        meta.Session.commit()
 
+        for key, data in events:
+            self.server.event_control.gen(key, data)
+        return details
+
+    def probe_ports(self, agent, entries):
+        """Ask the agent to check all 'entries' at once.  Returns a
+           result for each entry (see update_port) or None if the agent
+           doesn't support it.  The ports the agent couldn't check, or
+           all of them if the request failed, get an 'exit-status' of
+           None: their state is unknown."""
+        time_limit = max(self.server.agentmanager.socket_timeout - \
+                             self.PROBE_MARGIN, 1)
+        targets = []
+        for entry in entries:
+            timeout = min(entry.max_time or self.PROBE_TIMEOUT,
+                          self.PROBE_TIMEOUT, time_limit)
+            targets.append({'host': entry.dest_host,
+                            'port': entry.dest_port,
+                            'timeout': timeout})
+        body = json.dumps({'targets': targets, 'time-limit': time_limit})
+        headers = {'Content-Type': 'application/json'}
+        try:
+            res = agent.connection.request('POST', self.PROBE_URI, body,
+                                           headers)
+            if res.status == httplib.NOT_FOUND:
+                logger.debug("probe_ports: agent '%s' does not support %s",
+                             agent.displayname, self.PROBE_URI)
+                return None
+            if res.status != httplib.OK:
+                raise httplib.HTTPException(
+                    "status %d: %s" % (res.status, res.body))
+            ports = json.loads(res.body)['ports']
+            if len(ports) != len(entries):
+                raise ValueError("%d results for %d ports" % \
+                                     (len(ports), len(entries)))
+        except (httplib.HTTPException, EnvironmentError,
+                ValueError, KeyError, TypeError) as ex:
+            logger.error("probe_ports: agent '%s' %s failed: %s",
+                         agent.displayname, self.PROBE_URI, str(ex))
+            error = "Port check failed: %s" % str(ex)
+            return [{'exit-status': None, 'error': error}] * len(entries)
+
+        results = []
+        for port in ports:
+            result = dict(port)
+            if port.get('skipped'):
+                result['exit-status'] = None
+            else:
+                result['exit-status'] = failed(port) and 1 or 0
+            results.append(result)
+        return results
+
+    def pok(self, agent, entry):
+        """Check a port with the agent 'pok' command (agents without
+           PROBE_URI).  Returns the result (see update_port)."""
         command = "pok %s %d" % (entry.dest_host, entry.dest_port)
 
         body = self.server.cli_cmd(command, agent, timeout=60*5)
-        data = agent.todict()
+
+        result = {}
+        if 'stdout' in body:
+            try:
+                result = json.loads(body['stdout'])
+            except ValueError as ex:
+                logger.error("check_port: Bad json in stdout: %s: %s\n",
+                             str(ex), body['stdout'])
 
         if failed(body):
             logger.error(
@@ -141,7 +227,7 @@ class PortManager(Manager):
                 "failed: %s",
                 entry.agentid, command, entry.service_name,
                 body['error'])
-            details['error'] = body['error']
+            result['error'] = body['error']
 
         if not 'exit-status' in body:
             logger.error(
@@ -149,31 +235,57 @@ class PortManager(Manager):
                 "did not have 'exit-status' in returned body: %s",
                 entry.agentid, command, entry.service_name,
                 str(body))
-            details['error'] = 'Missing exit-status from port check.'
-            return dict(data.items() + details.items())
+            result['error'] = 'Missing exit-status from port check.'
+            result['exit-status'] = None
+        else:
+            result['exit-status'] = body['exit-status']
+        return result
 
-        if 'stdout' in body:
+    def update_port(self, entry, agent, result, events):
+        # pylint: disable=too-many-branches
+        """Update the row of 'entry' from the 'result' of its check - a
+           dict with 'exit-status' and optional 'milliseconds', 'ip' and
+           'error', or None if the agent isn't connected - without
+           committing.  The (key, data) of the event to generate, if any,
+           is appended to 'events'.  Returns the details of the check."""
+        details = {
+                    'service_name': entry.service_name,
+                    'dest_port': entry.dest_port,
+                    'dest_hostname': entry.dest_host
+                   }
+
+        if entry.max_time:
+            details['max_time'] = entry.max_time
+
+        if result is None:
+            logger.debug("check_port: agentid %d not connected.  Will not " + \
+                         "check service_name %s dest_host '%s' dest_port '%d'",
+                         entry.agentid, entry.service_name, entry.dest_host,
+                         entry.dest_port)
+            details['error'] = \
+                "agent %d not connected.  Can't do port check." % entry.agentid
+            return details
+
+        data = agent.todict()
+
+        if 'milliseconds' in result:
             try:
-                stdout = json.loads(body['stdout'])
-            except ValueError as ex:
-                logger.error("check_port: Bad json in stdout: %s: %s\n",
-                             str(ex), body['stdout'])
-                stdout = {}
+                details['connect_time'] = result['milliseconds']/1000.
+            except TypeError as ex:
+                logger.error("check_port: Bad milliseconds value: %s: %s\n",
+                             str(ex), str(result))
 
-            if 'milliseconds' in stdout:
-                try:
-                    details['connect_time'] = stdout['milliseconds']/1000.
-                except TypeError as ex:
-                    logger.error("check_port: Bad milliseconds value: %s: %s\n",
-                                 str(ex), str(stdout))
+        if 'ip' in result:
+            details['ip'] = result['ip']
 
-            if 'ip' in stdout:
-                details['ip'] = stdout['ip']
+        if failed(result):
+            details['error'] = result['error']
 
-            if failed(stdout):
-                details['error'] = stdout['error']
+        if result['exit-status'] is None:
+            # The state of the port is unknown: leave the row alone.
+            return dict(data.items() + details.items())
 
-        if body['exit-status'] or failed(details):
+        if result['exit-status'] or failed(details):
             # Non-zero exit status means failure to connect or
             # resolve hostname.
             if not 'error' in details:
@@ -196,14 +308,14 @@ class PortManager(Manager):
 
         # Generate an event if appropriate
         if color == 'red' and entry.notified_color != 'red':
-            self.server.event_control.gen(EventControl.PORT_CONNECTION_FAILED,
-                                          dict(data.items() + details.items()))
+            events.append((EventControl.PORT_CONNECTION_FAILED,
+                           dict(data.items() + details.items())))
         elif entry.notified_color == 'red' and color == 'green':
             data['info'] = \
                     "Connection to '%s' is now okay: host '%s', port %d" % \
                     (entry.service_name, entry.dest_host, entry.dest_port)
-            self.server.event_control.gen(EventControl.PORT_CONNECTION_OKAY,
-                                          dict(data.items() + details.items()))
+            events.append((EventControl.PORT_CONNECTION_OKAY,
+                           dict(data.items() + details.items())))
 
         # Update the row
         update_dict = {'color': color, 'notified_color': color}
@@ -217,8 +329,6 @@ class PortManager(Manager):
             update(update_dict,
                    synchronize_session=False)
 
-        meta.Session.commit()
-
         return details
 
     def populate(self):
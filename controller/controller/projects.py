@@ -1,9 +1,10 @@
 from sqlalchemy import Column, String, DateTime, Integer, BigInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
 
+from bulk_sync import BulkSync
 from mixin import BaseMixin
 
 class Project(meta.Base, BaseMixin):
@@ -54,39 +55,7 @@ class Project(meta.Base, BaseMixin):
             'state, description, site_id, special ' +\
             'FROM projects'
 
-        data = agent.odbc.execute(stmt)
-        if 'error' in data:
-            return data
-        if '' not in data:
-            data['error'] = "Missing '' key in query response."
-
-        ids = []
-
-        session = meta.Session()
-        for row in data['']:
-            entry = Project.get(envid, row[0], default=None)
-            if not entry:
-                entry = Project(envid=envid, id=row[0])
-                session.add(entry)
-            entry.name = row[1]
-            entry.owner_id = row[2]
-            entry.created_at = row[3]
-            entry.updated_at = row[4]
-            entry.state = row[5]
-            entry.description = row[6]
-            entry.site_id = row[7]
-            entry.special = row[8]
-            ids.append(entry.projectid)
-
-        # FIXME: don't delete - mark inactive.
-        session.query(Project).\
-            filter(not_(Project.projectid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
-
-        d = {u'status': 'OK', u'count': len(data[''])}
-        return d
+        return BulkSync(cls, envid).sync(agent, stmt)
 
     @classmethod
     def cache(cls, envid):
@@ -0,0 +1,235 @@
+"""
+Framed JSON requests between the web application and the controller.
+
+A client connects to the CLI port and sends the line 'rpc'.  The controller
+answers 'OK RPC <version>' and from then on both sides exchange frames:
+a 4-byte big-endian length followed by that many bytes of UTF-8 JSON.
+
+A request is {"id": <n>, "command": "<command line>"}.  For every line a
+telnet client would have received, the controller answers with a frame
+{"id": <n>, "line": "<text>"} and finishes with {"id": <n>, "done": true}.
+Requests run concurrently so the frames of different ids interleave and
+a connection can be kept open for any number of requests.
+
+The telnet protocol is unchanged for people using the CLI.
+"""
+import json
+import socket
+import struct
+import threading
+import Queue
+
+RPC_COMMAND = 'rpc'
+RPC_VERSION = 1
+
+MAX_FRAME = 64 * 1024 * 1024
+_HEADER = struct.Struct('>I')
+
+class RpcError(StandardError):
+    pass
+
+class RpcUnsupported(RpcError):
+    """The server does not understand the 'rpc' command."""
+    pass
+
+def read_frame(rfile):
+    """Read a frame from a file object.  Returns None at end of file."""
+    header = rfile.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise RpcError('truncated frame header')
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise RpcError('frame too large: %d bytes' % length)
+    data = rfile.read(length)
+    if len(data) < length:
+        raise RpcError('truncated frame')
+    return json.loads(data)
+
+def encode_frame(obj):
+    data = json.dumps(obj)
+    return _HEADER.pack(len(data)) + data
+
+
+class FrameWriter(object):
+    """Send frames to a file object from any number of threads."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, obj):
+        data = encode_frame(obj)
+        with self.lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+
+class RpcCall(object):
+    """
+    The response of one request, read like the telnet socket: readline()
+    returns the lines of the response and '' once it is complete.
+    """
+    def __init__(self, connection, reqid, queue):
+        self.connection = connection
+        self.reqid = reqid
+        self.queue = queue
+        self.done = False
+
+    def readline(self):
+        if self.done:
+            return ''
+        item = self.queue.get()
+        if item is None:
+            self.done = True
+            return ''
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+        return item + '\n'
+
+    def close(self):
+        """Stop waiting for the response: the frames still to come for this
+        request are dropped."""
+        self.connection.forget(self.reqid)
+
+
+class RpcConnection(object):
+    """
+    A connection to the controller carrying concurrent requests.  A reader
+    thread hands each frame to the call waiting for its id.  When the
+    connection is lost every pending call gets an RpcError.
+    """
+    def __init__(self, hostname, port):
+        self.sock = socket.create_connection((hostname, port))
+        self.rfile = self.sock.makefile('rb')
+        wfile = self.sock.makefile('wb', 0)
+        try:
+            wfile.write(RPC_COMMAND + '\n')
+            line = self.rfile.readline().strip()
+        except EnvironmentError:
+            self._shutdown()
+            raise
+        if line != 'OK RPC %d' % RPC_VERSION:
+            self._shutdown()
+            raise RpcUnsupported("unexpected answer to '%s': %s" % \
+                                     (RPC_COMMAND, line))
+        self.writer = FrameWriter(wfile)
+        self.lock = threading.Lock()
+        self.calls = {}     # request id -> Queue of the response lines
+        self.next_id = 0
+        self.closed = False
+
+        thread = threading.Thread(target=self._reader, name='rpc-reader')
+        thread.daemon = True
+        thread.start()
+
+    def call(self, command):
+        """Send a command line: returns an RpcCall to read the response."""
+        with self.lock:
+            if self.closed:
+                raise RpcError('connection closed')
+            self.next_id += 1
+            reqid = self.next_id
+            queue = self.calls[reqid] = Queue.Queue()
+        try:
+            self.writer.send({'id': reqid, 'command': command})
+        except EnvironmentError as ex:
+            self._fail(RpcError(str(ex)))
+            raise RpcError(str(ex))
+        return RpcCall(self, reqid, queue)
+
+    def forget(self, reqid):
+        with self.lock:
+            self.calls.pop(reqid, None)
+
+    def _reader(self):
+        error = RpcError('connection closed by the controller')
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if frame is None:
+                    break
+                reqid = frame.get('id')
+                with self.lock:
+                    if frame.get('done'):
+                        queue = self.calls.pop(reqid, None)
+                    else:
+                        queue = self.calls.get(reqid)
+                if queue is None:
+                    # an abandoned request
+                    continue
+                if frame.get('done'):
+                    queue.put(None)
+                else:
+                    queue.put(frame.get('line', ''))
+        except (EnvironmentError, ValueError, RpcError) as ex:
+            error = RpcError('connection lost: %s' % str(ex))
+        self._fail(error)
+
+    def _fail(self, error):
+        with self.lock:
+            self.closed = True
+            calls = self.calls
+            self.calls = {}
+        for queue in calls.itervalues():
+            queue.put(error)
+        self._shutdown()
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except EnvironmentError:
+            pass
+        self.sock.close()
+
+    def close(self):
+        self._fail(RpcError('connection closed'))
+
+
+class RpcPool(object):
+    """Up to 'size' connections to the controller, shared by all threads and
+    re-opened once lost."""
+    SIZE = 2
+
+    def __init__(self, hostname, port, size=SIZE):
+        self.hostname = hostname
+        self.port = port
+        self.size = size
+        self.lock = threading.Lock()
+        self.connections = []
+        self.index = 0
+
+    def get(self):
+        with self.lock:
+            self.connections = [conn for conn in self.connections \
+                                    if not conn.closed]
+            if len(self.connections) < self.size:
+                conn = RpcConnection(self.hostname, self.port)
+                self.connections.append(conn)
+                return conn
+            self.index = (self.index + 1) % len(self.connections)
+            return self.connections[self.index]
+
+    def call(self, command):
+        """Send the command on one of the connections: returns an RpcCall."""
+        return self.get().call(command)
+
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            conn.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(hostname, port):
+    """The pool shared by everything in this process for hostname:port."""
+    with _pools_lock:
+        pool = _pools.get((hostname, port))
+        if pool is None:
+            pool = _pools[(hostname, port)] = RpcPool(hostname, port)
+        return pool
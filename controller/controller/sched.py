@@ -15,6 +15,7 @@ import akiri.framework.sqlalchemy as meta
 from mixin import BaseDictMixin
 from event_control import EventControl
 from croniter import Croniter
+from jobs import JobExecutor
 
 logger = logging.getLogger()
 
@@ -38,6 +39,15 @@ class Sched(threading.Thread):
                                            "sched_dir",
                                            default="/var/palette/sched")
 
+        # Jobs with a native implementation run on a pool of threads
+        # in this process; any other job runs its script in sched_dir.
+        if server.config.getboolean("palette", "sched_native", default=True):
+            workers = server.config.getint("palette", "sched_workers",
+                                           default=JobExecutor.DEFAULT_WORKERS)
+            self.executor = JobExecutor(server, workers=workers)
+        else:
+            self.executor = None
+
         # Don't start until populate() is called and finishes or
         # the two threads (popualte and scheduler) can conflict with
         # the database
@@ -54,7 +64,7 @@ class Sched(threading.Thread):
                 if not job.enabled:
                     continue
                 try:
-                    self.handler(job.name)
+                    self.handler(job.name, priority=job.priority)
                 except StandardError, ex:
                     self.server.error("Job '%s':" + str(ex))
                 job.set_next_run_time()
@@ -237,13 +247,21 @@ class JobHandler(object):
         self.scheduler = scheduler
         self.server = self.scheduler.server
 
-    def __call__(self, name):
+    def __call__(self, name, priority=None):
         if self.server.state_manager.upgrading():
             logger.info(
                 "sched command will be SKIPPED due to upgrading.  "
                 "command: %s", name)
             return
 
+        executor = self.scheduler.executor
+        if executor and name in executor:
+            job = executor.submit(name, priority=priority)
+            if job and not job.background:
+                # Like the script: later jobs wait for this one.
+                job.wait()
+            return
+
         logger.debug("sched command: %s", name)
         path = os.path.join(self.scheduler.sched_dir, name)
 
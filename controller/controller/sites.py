@@ -1,10 +1,11 @@
 from sqlalchemy import Column, String, DateTime, Boolean
 from sqlalchemy import Integer, BigInteger, SmallInteger
-from sqlalchemy import not_, UniqueConstraint
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
 
+from bulk_sync import BulkSync
 from mixin import BaseMixin
 
 class Site(meta.Base, BaseMixin):
@@ -60,47 +61,7 @@ class Site(meta.Base, BaseMixin):
             'luid, query_limit, url_namespace ' +\
             'FROM sites'
 
-        data = agent.odbc.execute(stmt)
-        if 'error' in data:
-            return data
-        if '' not in data:
-            data['error'] = "Missing '' key in query response."
-            return data
-
-        ids = []
-
-        session = meta.Session()
-        for row in data['']:
-            entry = Site.get(envid, row[0], default=None)
-            if not entry:
-                entry = Site(envid=envid, id=row[0])
-                session.add(entry)
-            entry.name = row[1]
-            entry.status = row[2]
-            entry.created_at = row[3]
-            entry.updated_at = row[4]
-            entry.user_quota = row[5]
-            entry.content_admin_mode = row[6]
-            entry.storage_quota = row[7]
-            entry.metrics_level = row[8]
-            entry.status_reason = row[9]
-            entry.subscriptions_enabled = row[10]
-            entry.custom_subscription_footer = row[11]
-            entry.custom_subscription_email = row[12]
-            entry.luid = row[13]
-            entry.query_limit = row[14]
-            entry.url_namespace = row[15]
-            ids.append(entry.siteid)
-
-        # FIXME: don't delete
-        session.query(Site).\
-            filter(not_(Site.siteid.in_(ids))).\
-            delete(synchronize_session='fetch')
-
-        session.commit()
-
-        d = {u'status': 'OK', u'count': len(data[''])}
-        return d
+        return BulkSync(cls, envid).sync(agent, stmt)
 
     @classmethod
     def cache(cls, envid):
@@ -1,10 +1,14 @@
 """ Module represent the 'system' table - a key/value settings store for a
 particular environment. """
 # pylint: enable=missing-docstring,relative-import
+import logging
+import select
+import threading
+import time
 from UserDict import DictMixin
 
 from sqlalchemy import Column, String, BigInteger, DateTime
-from sqlalchemy import func
+from sqlalchemy import event, func, text
 from sqlalchemy.schema import ForeignKey
 
 import akiri.framework.sqlalchemy as meta
@@ -13,9 +17,22 @@ from ..mixin import BaseMixin, BaseDictMixin
 from ..manager import Manager
 from ..util import str2bool, translate_key
 
-from .keys import SystemKeys
+from .keys import SystemKeys, SECRET_KEYS
 from .defaults import DEFAULTS
 
+logger = logging.getLogger()
+
+# PostgreSQL channel used to tell other processes (the webapp or the
+# controller) that the system table changed.  The payload is the envid.
+NOTIFY_CHANNEL = 'system_changed'
+
+def notify(envid):
+    """ Queue a change notification in the current transaction.
+    PostgreSQL only delivers it when (and if) the transaction commits. """
+    session = meta.Session()
+    session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                    {'channel': NOTIFY_CHANNEL, 'payload': str(envid)})
+
 def cast(key, value):
     """ Find the native type of key in DEFAULTS and return 'value'
     converted to that type."""
@@ -72,8 +89,79 @@ class SystemMixin(object):
         meta.commit()
 
 class SystemManager(Manager, DictMixin, SystemMixin):
-    """ Non-caching manager for the system table.  It can behave like a dict
-    with get/set performaning the database operation.  """
+    """ Write-through caching manager for the system table.  It can behave
+    like a dict with get/set performing the database operation.
+
+    The whole table is read once into memory (typed) and reloaded after
+    invalidate(), which the SystemListener calls whenever another process
+    (or transaction) commits a change.  The changes made here only reach
+    the cache once the session commits them. """
+
+    # Where the changes waiting for the commit are kept in session.info.
+    INFO_KEY = 'system-changes'
+    # Marks a key deleted in those changes.
+    DELETED = object()
+
+    def __init__(self, server):
+        super(SystemManager, self).__init__(server)
+        self.cache = None
+        self.hits = 0
+        self.misses = 0
+
+    def _data(self):
+        """ Return the cached {key: typed value} dict, loading it from the
+        database if necessary.  The caller must hold the lock. """
+        if self.cache is None:
+            self.misses += 1
+            data = {}
+            for entry in SystemEntry.get_all(self.envid):
+                data[entry.key] = entry.typed()
+            self.cache = data
+        else:
+            self.hits += 1
+        return self.cache
+
+    def invalidate(self):
+        """ Discard the cached table: the next access reloads it. """
+        with self._lock:
+            self.cache = None
+
+    def _pending(self, session):
+        """ Return the {key: typed value or DELETED} changes of 'session'
+        not committed yet.  They are applied to the cache after the commit
+        and dropped on rollback. """
+        changes = session.info.get(self.INFO_KEY)
+        if changes is None:
+            changes = session.info[self.INFO_KEY] = {}
+            event.listen(session, 'after_commit', self._committed)
+            event.listen(session, 'after_soft_rollback', self._rolled_back)
+        return changes
+
+    def _committed(self, session):
+        changes = session.info.get(self.INFO_KEY)
+        if not changes:
+            return
+        with self._lock:
+            if self.cache is not None:
+                for key, value in changes.iteritems():
+                    if value is self.DELETED:
+                        self.cache.pop(key, None)
+                    else:
+                        self.cache[key] = value
+        changes.clear()
+
+    def _rolled_back(self, session, previous_transaction):
+        # pylint: disable=unused-argument
+        changes = session.info.get(self.INFO_KEY)
+        if changes:
+            changes.clear()
+
+    def stats(self):
+        """ Return the cache hit/miss counters. """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'loaded': self.cache is not None}
 
     def entry(self, key, **kwargs):
         """ Return the SystemEntry for this key. """
@@ -85,9 +173,10 @@ class SystemManager(Manager, DictMixin, SystemMixin):
     def __getitem__(self, key):
         """ Returns the value of the system key from the database or the
         keys default if not overridden in the database."""
-        entry = self.entry(key)
-        if entry:
-            return cast(key, entry.value)
+        with self._lock:
+            data = self._data()
+            if key in data:
+                return data[key]
         if key not in DEFAULTS:
             raise KeyError("Invalid system key : " + key)
         value = DEFAULTS[key]
@@ -104,22 +193,32 @@ class SystemManager(Manager, DictMixin, SystemMixin):
         session = meta.Session()
         entry = SystemEntry(envid=self.envid, key=key, value=str(value))
         session.merge(entry)
+        notify(self.envid)
+        # round-trip through str() exactly like a reload would.
+        self._pending(session)[key] = cast(key, str(value))
 
     def __delitem__(self, key):
         """ Delete a row from the system table. """
         SystemEntry.delete(filters={'envid':self.envid, 'key':key})
+        notify(self.envid)
+        self._pending(meta.Session())[key] = self.DELETED
+
+    def keys(self):
+        with self._lock:
+            return self._data().keys()
 
     def todict(self, pretty=False, include_defaults=False):
-        """ Import the system table as a dict (used by event_control) """
+        """ Return the system table as a dict (used by event_control)
+        without the SECRET_KEYS. """
         if include_defaults:
             data = DEFAULTS.todict(pretty=pretty)
         else:
             data = {}
-        for entry in SystemEntry.get_all(self.envid):
-            try:
-                data[translate_key(entry.key, pretty=pretty)] = entry.typed()
-            except ValueError:
-                raise
+        with self._lock:
+            for key, value in self._data().iteritems():
+                if key in SECRET_KEYS:
+                    continue
+                data[translate_key(key, pretty=pretty)] = value
         return data
 
     @classmethod
@@ -141,3 +240,52 @@ class SystemManager(Manager, DictMixin, SystemMixin):
             entry = SystemEntry(envid=1, key=key, value=str(value))
             session.add(entry)
         session.commit()
+
+
+class SystemListener(threading.Thread):
+    """ Invalidate a SystemManager cache when any process commits a change
+    to the system table.  A dedicated connection LISTENs on NOTIFY_CHANNEL;
+    if it is lost the cache is invalidated (a notification may have been
+    missed) and the connection is re-established. """
+
+    TIMEOUT = 60       # seconds between checks of a quiet connection
+    RETRY_DELAY = 10   # seconds to wait before reconnecting
+
+    def __init__(self, manager):
+        super(SystemListener, self).__init__(name='system-listener')
+        self.daemon = True
+        self.manager = manager
+
+    def _listen(self):
+        # pylint: disable=no-member
+        conn = meta.sqa.engine.raw_connection()
+        try:
+            dbconn = conn.connection
+            dbconn.autocommit = True
+            cursor = dbconn.cursor()
+            cursor.execute("LISTEN " + NOTIFY_CHANNEL)
+            self.manager.invalidate()
+            envid = str(self.manager.envid)
+            while True:
+                readable, _, _ = select.select([dbconn], [], [],
+                                               self.TIMEOUT)
+                if not readable:
+                    continue
+                dbconn.poll()
+                changed = False
+                while dbconn.notifies:
+                    if dbconn.notifies.pop(0).payload == envid:
+                        changed = True
+                if changed:
+                    self.manager.invalidate()
+        finally:
+            conn.invalidate()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except StandardError as ex:
+                logger.error("system listener: %s", str(ex))
+            self.manager.invalidate()
+            time.sleep(self.RETRY_DELAY)
@@ -13,7 +13,7 @@ If the default value is a dict, then it may contains the following:
 """
 # pylint: enable=missing-docstring, relative-import
 from ..util import translate_key
-from .keys import SystemKeys
+from .keys import SystemKeys, SECRET_KEYS
 
 UNDEFINED_INTEGER = {"value": None, "data-type": int}
 
@@ -62,6 +62,8 @@ class SystemDefaults(dict):
         """Create a copy of the default values without nested dicts"""
         data = {}
         for key in self:
+            if key in SECRET_KEYS:
+                continue
             data[translate_key(key, pretty=pretty)] = self.default(key)
         return data
 
@@ -191,6 +193,9 @@ DEFAULTS = SystemDefaults({
 
     SystemKeys.AUTH_TIMESTAMP: None,
 
+    SystemKeys.CSRF_SECRET: None,
+    SystemKeys.CSRF_SECRET_PREVIOUS: None,
+
     SystemKeys.YML_LOCATION: None,
     SystemKeys.YML_TIMESTAMP: None
 })
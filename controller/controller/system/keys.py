@@ -134,5 +134,14 @@ class SystemKeys(object):
 
     AUTH_TIMESTAMP = 'auth-timestamp'
 
+    # '<creation time>:<hex key>' of the CSRF token signing keys.
+    CSRF_SECRET = 'csrf-secret'
+    CSRF_SECRET_PREVIOUS = 'csrf-secret-previous'
+
     YML_TIMESTAMP = 'yml-timestamp'
     YML_LOCATION = 'yml-location'
+
+# Keys holding secrets: left out of todict(), so they never end up in
+# event data, logs or emails.
+SECRET_KEYS = frozenset([SystemKeys.CSRF_SECRET,
+                         SystemKeys.CSRF_SECRET_PREVIOUS])
@@ -331,7 +331,7 @@ class TableauStatusMonitor(threading.Thread):
             line = traceback_string(all_on_one_line=False)
             edata = {'error': line, 'version': self.server.version}
 
-            self.event.gen(EventControl.SYSTEM_EXCEPTION, edata)
+            self.event.gen(EventControl.SYSTEM_EXCEPTION, edata, sync=True)
             logger.error("status-check: Fatal: " + \
                          "Exiting tableau_status_loop on exception.")
             # pylint: disable=protected-access
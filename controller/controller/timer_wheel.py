@@ -0,0 +1,68 @@
+""" A hashed timer wheel: one thread runs all delayed callbacks. """
+import logging
+import threading
+import time
+
+from util import traceback_string
+
+logger = logging.getLogger()
+
+class TimerWheel(object):
+    """Callbacks are placed in one of 'slots' buckets, one bucket per
+       'tick' seconds, wrapping around with a count of the remaining
+       rounds.  Every tick the thread runs the callbacks in the current
+       bucket whose rounds are done, so scheduling is O(1) and there is a
+       single thread no matter how many callbacks are pending."""
+
+    DEFAULT_TICK = 1.0 # seconds
+    DEFAULT_SLOTS = 512
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='timer-wheel')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, func, *args):
+        """Run func(*args) in about 'delay' seconds (rounded up to the
+           next tick)."""
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self.lock:
+            index = (self.current + ticks) % len(self.slots)
+            rounds = (ticks - 1) // len(self.slots)
+            self.slots[index].append([rounds, func, args])
+            self.pending += 1
+
+    def advance(self):
+        """Move to the next bucket and return the callbacks that are due."""
+        with self.lock:
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            due = [entry for entry in slot if entry[0] == 0]
+            remaining = [entry for entry in slot if entry[0] > 0]
+            for entry in remaining:
+                entry[0] -= 1
+            self.slots[self.current] = remaining
+            self.pending -= len(due)
+        return due
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        while True:
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            for _, func, args in self.advance():
+                try:
+                    func(*args)
+                except StandardError:
+                    logger.error("timer wheel callback failed: %s",
+                                 traceback_string(all_on_one_line=False))
@@ -3,14 +3,13 @@ import os
 
 from sqlalchemy import Column, BigInteger, Integer, Boolean, String, DateTime
 from sqlalchemy import UniqueConstraint, Text
-from sqlalchemy import func
-from sqlalchemy import or_
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm import relationship, backref, deferred
 from sqlalchemy.orm.exc import NoResultFound
 
 import akiri.framework.sqlalchemy as meta
 
+from blob_store import BlobEntry
 from archive_mixin import ArchiveUpdateMixin, ArchiveException, ArchiveError
 from mixin import BaseMixin, BaseDictMixin
 from cache import TableauCacheManager #FIXME
@@ -142,7 +141,10 @@ class WorkbookUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     system_user_id = Column(Integer)
     url = Column(String)  # FIXME: make this unique.
     note = Column(String)
-    twb = deferred(Column(Text))    # the contents of the .twb file
+    # the contents of the .twb file are in the blob store.
+    twb_sha256 = Column(String, index=True)
+    # before the blob store: the contents of the .twb file.
+    twb_text = deferred(Column('twb', Text))
 
     # NOTE: system_user_id is not a foreign key to avoid load dependencies.
 
@@ -167,6 +169,34 @@ class WorkbookUpdateEntry(meta.Base, BaseMixin, BaseDictMixin):
     def get_by_url(cls, url, **kwargs):
         return cls.get_unique_by_keys({'url': url}, **kwargs)
 
+    @property
+    def twb(self):
+        if self.twb_sha256:
+            return BlobEntry.get_text(self.twb_sha256)
+        return self.twb_text
+
+    def set_twb(self, contents):
+        """Store 'contents' as the .twb file, as a delta of the previous
+           revision if possible."""
+        session = meta.Session()
+        previous = session.query(WorkbookUpdateEntry.twb_sha256).\
+            filter(WorkbookUpdateEntry.workbookid == self.workbookid).\
+            filter(WorkbookUpdateEntry.wuid != self.wuid).\
+            filter(WorkbookUpdateEntry.twb_sha256 != None).\
+            order_by(WorkbookUpdateEntry.timestamp.desc()).\
+            first()
+        old = self.twb_sha256
+        self.twb_sha256 = BlobEntry.put(contents, previous and previous[0])
+        self.twb_text = None
+        if old:
+            BlobEntry.release(old)
+
+    @classmethod
+    def upgrade_blobs(cls):
+        """Move the .twb contents stored by an older version to the
+           blob store."""
+        BlobEntry.upgrade(cls.__tablename__, 'wuid', 'workbookid', 'twb')
+
 
 class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
     NAME = 'workbook'
@@ -192,7 +222,8 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         rows = session.query(WorkbookUpdateEntry).\
                             filter(WorkbookUpdateEntry.url != '').\
                             filter(WorkbookUpdateEntry.url != None).\
-                            filter(WorkbookUpdateEntry.twb == None).\
+                            filter(WorkbookUpdateEntry.twb_sha256 == None).\
+                            filter(WorkbookUpdateEntry.twb_text == None).\
                             all()
 
         for row in rows:
@@ -204,7 +235,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                 logger.error("move_twb_to_db open failed: %s", str(err))
                 continue
 
-            row.twb = contents
+            row.set_twb(contents)
             session.commit()
 
             twb_path = os.path.join(controller_path, row.url)
@@ -304,6 +335,10 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
 
         session.commit()
 
+        if data['']:
+            # The http_requests events cache what they use of the workbooks.
+            self.server.hrman.workbooks.clear()
+
         prune_count = self._prune_missed_revisions()
 
         if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
@@ -312,8 +347,9 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         elif not self.cred_check():
             result = {u'error': 'Can not load workbooks: missing credentials.'}
         else:
-            # Second pass - build the archive files.
-            result = self._archive_updates(agent, updates)
+            # Second pass - the archive files are built by the ArchiveQueue.
+            queued = self.server.archive_queue.enqueue(self.NAME)
+            result = {u'status': 'OK', u'updates-queued': queued}
 
         result[u'schema'] = self.schema(data)
         result[u'updates-new'] = len(updates)
@@ -333,12 +369,16 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                     "(select workbookid, max(timestamp) "+ \
                     "from workbook_updates where url='' " + \
                     "group by workbookid) " + \
-                    "and url='';"
+                    "and url='' returning twb_sha256;"
 
         connection = meta.get_connection()
         result = connection.execute(stmt)
+        shas = [row[0] for row in result if row[0]]
         connection.close()
 
+        for sha256 in shas:
+            BlobEntry.release(sha256)
+
         if result.rowcount:
             logger.debug("workbooks _prune_missed_revisions pruned %d",
                            result.rowcount)
@@ -355,112 +395,41 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
         if not retain_count or retain_count == -1:
             return 0
 
-        removed_count = 0
-
-        session = meta.Session()
-        # List of workbooks that have excess archived versions:
-        #   [(workbookid, total-count), ...]
-        # Note we select only successfully archived workbook versions
+        # Note we count only successfully archived workbook versions
         # (url != '').  We don't want want to count unsuccessfully
         # archived versions in the count of how many we have.
-        results = session.query(WorkbookUpdateEntry.workbookid, func.count()).\
-                  filter(WorkbookUpdateEntry.url != '').\
-                  group_by(WorkbookUpdateEntry.workbookid).\
-                  having(func.count() > retain_count).\
-                  all()
-
-#        logger.debug("workbooks _retain_some len: %d, results: %s",
-#                                                len(results), str(results))
-
-        for result in results:
-            # Get list of old workbook archive entries to delete
-            rows = session.query(WorkbookUpdateEntry).\
-                    filter(WorkbookUpdateEntry.workbookid == result[0]).\
-                    filter(WorkbookUpdateEntry.url != '').\
-                    order_by(WorkbookUpdateEntry.timestamp.asc()).\
-                    limit(result[1] - retain_count).\
-                    all()
-
-            for row in rows:
-                # We have to remove the WorkbookUpdateEntry first
-                # due to the foreign key constraint in files pointing to it.
-                session.query(WorkbookUpdateEntry).\
-                            filter(WorkbookUpdateEntry.wuid == row.wuid).\
-                            delete()
-                session.commit()
-
-                self.server.files.remove_file_by_id(row.fileid)
-                if row.fileid_twbx:
-                    self.server.files.remove_file_by_id(row.fileid_twbx)
-
-                # Fixme: We could increment only if it successfully deleted.
-                removed_count += 1
-
-        return removed_count
-
-    @synchronized('workbook.fixup')
+        return self.retain_rows(retain_count, 'workbook_updates', 'wuid',
+                                'workbookid', 'timestamp DESC, wuid DESC',
+                                "url != ''", ['fileid', 'fileid_twbx'],
+                                blob_column='twb_sha256')
+
+    # The ArchiveQueue interface.
+    UPDATES = ('workbook_updates', 'wuid', 'workbooks', 'workbookid')
+
+    def archive_enabled(self):
+        return bool(self.system[SystemKeys.WORKBOOK_RETAIN_COUNT])
+
+    def archive_task(self, agent, wuid):
+        """Archive one update for the ArchiveQueue.
+           Returns False if it should be tried again."""
+        update = WorkbookUpdateEntry.get_by_id(wuid, default=None)
+        if update is None or update.url:
+            # pruned, removed or already archived.
+            return True
+        logger.debug("Workbook archive update %d", wuid)
+        self._archive_wb(agent, update)
+        return bool(update.url)
+
     def fixup(self, agent):
+        """Re-queue the archive tasks left running and queue any update
+           that isn't archived or queued."""
+        # pylint: disable=unused-argument
         if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
             logger.debug("Workbook archives are not enabled. Fixup not done.")
             return {u'disabled':
                     'Workbook Archives are not enabled.  Fixup not done.'}
 
-        session = meta.Session()
-
-        # potentially serveral thousand?
-        updates = session.query(WorkbookUpdateEntry).\
-                  filter(or_(WorkbookUpdateEntry.url == "",
-                         WorkbookUpdateEntry.url == None)).\
-                         all()
-
-        return self._archive_updates(agent, updates)
-
-    def _archive_updates(self, agent, updates):
-        """Attempt to archive workbooks from WorkbookUpdate rows."""
-
-        session = meta.Session()
-
-        count = 0
-        data = {}
-        logger.debug("Workbook archive update count: %d\n", len(updates))
-        for update in updates:
-            if not self.system[SystemKeys.WORKBOOK_RETAIN_COUNT]:
-                logger.info(
-                          "Workbook Archive disabled during fixup." + \
-                          "  Exiting for now.")
-                break
-
-            if not self.server.odbc_ok():
-                logger.info("Workbook Archive Fixup: Archive build " + \
-                          "stopping due to current state")
-                break
-
-            logger.debug("Workbook archive update refresh wid %d",
-                           update.workbookid)
-            session.refresh(update)
-            try:
-                self._archive_wb(agent, update)
-            except ArchiveException as ex:
-                if ex.value == ArchiveError.BAD_CREDENTIALS:
-                    msg = "workbook _archive_updates: tabcmd failed due to " + \
-                          "bad credentials. " + \
-                          "Skipping any remaining workbook updates now."
-                    logger.info(msg)
-                    data[u'error'] = msg
-                    break
-                else:
-                    raise # should never happen
-            count += 1
-
-        # Retain only configured number of versions
-        if count:
-            retain_removed_count = self._retain_some()
-        else:
-            retain_removed_count = 0
-
-        data[u'updates-archived'] = count
-        data[u'retain-removed-count'] = retain_removed_count
-        return data
+        return self.server.archive_queue.fixup(self.NAME)
 
     def _archive_wb(self, agent, update):
         """
@@ -549,7 +518,7 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
             logger.debug("Error getting workbook '%s': %s", dst_twb, str(ex))
             return None
 
-        update.twb = contents
+        update.set_twb(contents)
         return True
 
     def _tabcmd_get(self, agent, update, tmpdir):
@@ -608,6 +577,8 @@ class WorkbookManager(TableauCacheManager, ArchiveUpdateMixin):
                            update.wuid)
             return
         session.commit()
+        if update.twb_sha256:
+            BlobEntry.release(update.twb_sha256)
 
     def _extract_twb_from_twbx(self, agent, update, dst):
         """A twbx file is just a zipped twb + associated tde files.
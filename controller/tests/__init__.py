@@ -1 +1,20 @@
 from test_agent import AgentTest
+from test_agentmanager import AgentConnectionTest
+from test_jobs import JobExecutorTest
+from test_system import SystemManagerTest
+from test_metrics import MetricManagerTest
+from test_cache import LRUCacheTest
+from test_event_bus import EventQueueTest, SyncGenTest
+from test_timer_wheel import TimerWheelTest
+from test_odbc import ODBCStreamTest
+from test_bulk_sync import BulkSyncTest
+from test_cli_cmd import CliCmdTest
+from test_filemanager import FileManagerTest
+from test_event_count import EventCountTest
+from test_archive_queue import ArchiveQueueTest
+from test_blob_store import BlobStoreTest
+from test_files import RemoveFilesTest
+from test_extract_replay import ExtractReplayTest
+from test_http_requests import HttpRequestsTest
+from test_rpc import RpcTest
+from test_clihandler import AgentSelectorCacheTest, CliHandlerRpcTest
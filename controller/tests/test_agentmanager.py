@@ -0,0 +1,116 @@
+import threading
+import unittest
+import httplib
+
+from controller.agentmanager import AgentConnection
+
+class FakeResponse(object):
+
+    def __init__(self, headers, body):
+        self.status = httplib.OK
+        self.reason = 'OK'
+        self.headers = headers
+        self.data = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, size=None):
+        if size is None:
+            size = len(self.data)
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+class FakeSocket(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeChannel(object):
+    """A reverse HTTP connection that can be held open by the test."""
+
+    def __init__(self, echo=True, hold=None, body='ok'):
+        self.sock = FakeSocket()
+        self.echo = echo
+        self.hold = hold
+        self.body = body
+        self.headers = {}
+
+    def request(self, method, url, body=None, headers=None):
+        self.headers = dict(headers)
+
+    def getresponse(self):
+        if self.hold:
+            self.hold.wait()
+        headers = {}
+        if self.echo:
+            name = AgentConnection.REQUEST_ID_HEADER
+            headers[name] = self.headers[name]
+        return FakeResponse(headers, self.body)
+
+class AgentConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aconn = AgentConnection(None, None, None, 'test')
+
+    def test_request_ids_increase(self):
+        self.aconn.add_channel(FakeChannel())
+        res1 = self.aconn.request('GET', '/ping')
+        res2 = self.aconn.request('GET', '/ping')
+        self.assertEqual(res1.body, 'ok')
+        name = AgentConnection.REQUEST_ID_HEADER
+        self.assertEqual(int(res2.getheader(name)),
+                         int(res1.getheader(name)) + 1)
+
+    def test_mismatched_request_id(self):
+        channel = FakeChannel(echo=False)
+        channel.getresponse = lambda: FakeResponse(
+            {AgentConnection.REQUEST_ID_HEADER: '999'}, 'ok')
+        self.aconn.add_channel(channel)
+        self.assertRaises(httplib.HTTPException,
+                          self.aconn.request, 'GET', '/ping')
+
+    def test_bulk_leaves_a_channel_free(self):
+        hold = threading.Event()
+        self.aconn.add_channel(FakeChannel(hold=hold))
+        self.aconn.add_channel(FakeChannel(hold=hold))
+
+        bulk = threading.Thread(target=self.aconn.request,
+                                args=('GET', '/file'), kwargs={'bulk': True})
+        bulk.start()
+        while self.aconn.bulk_active == 0:
+            pass
+
+        # The second channel is still available for control traffic.
+        ping = threading.Thread(target=self.aconn.request,
+                                args=('POST', '/ping'))
+        ping.start()
+        while not self.aconn.idle_channels.empty():
+            pass
+        hold.set()
+        bulk.join()
+        ping.join()
+        self.assertEqual(self.aconn.bulk_active, 0)
+        self.assertEqual(self.aconn.idle_channels.qsize(), 2)
+
+    def stop_stream_early(self):
+        with self.aconn.stream('GET', '/file') as res:
+            res.read(1)
+            raise IOError('stopped')
+
+    def test_stream_stopped_early_is_drained(self):
+        channel = FakeChannel(body='x' * 1000)
+        self.aconn.add_channel(channel)
+        self.assertRaises(IOError, self.stop_stream_early)
+        # The rest of the body was read: the channel can be reused.
+        self.assertFalse(channel.sock.closed)
+        self.assertTrue(self.aconn.idle_channels.get() is channel)
+
+    def test_stream_stopped_early_is_closed(self):
+        channel = FakeChannel(body='x' * (AgentConnection.DRAIN_MAX + 2))
+        self.aconn.add_channel(channel)
+        self.assertRaises(IOError, self.stop_stream_early)
+        # Too much left to read: the first channel is closed.
+        self.assertTrue(channel.sock.closed)
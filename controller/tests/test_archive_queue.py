@@ -0,0 +1,74 @@
+import unittest
+
+import akiri.framework.sqlalchemy as meta
+
+from controller.archive_queue import ArchiveQueue
+
+class FakeEnvironment(object):
+    envid = 1
+
+class FakeServer(object):
+    environment = FakeEnvironment()
+
+class FakeManager(object):
+    UPDATES = ('workbook_updates', 'wuid', 'workbooks', 'workbookid')
+
+class FakeResult(object):
+    rowcount = 1
+
+class FakeConnection(object):
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, stmt, **params):
+        self.statements.append(str(stmt))
+        return FakeResult()
+
+    def close(self):
+        pass
+
+class ArchiveQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = ArchiveQueue(FakeServer())
+
+    def test_config_defaults(self):
+        self.assertEqual(self.queue.workers, ArchiveQueue.WORKERS)
+        self.assertEqual(self.queue.agent_workers, ArchiveQueue.AGENT_WORKERS)
+
+    def test_sites_take_turns(self):
+        # site 1 has a backlog (tasks 1-100), sites 2 and 3 one task each.
+        first = {1: 1, 2: 101, 3: 102}
+        claimed = []
+        for _ in range(5):
+            heads = [(site, taskid) for site, taskid in first.items()
+                     if taskid is not None]
+            taskid = self.queue._turn(heads)
+            claimed.append(taskid)
+            for site in first:
+                if first[site] == taskid:
+                    if site == 1 and taskid < 100:
+                        first[site] = taskid + 1
+                    else:
+                        first[site] = None
+        self.assertEqual(claimed, [1, 101, 102, 2, 3])
+
+    def test_retry_delay(self):
+        self.assertEqual(self.queue.retry_delay(1), 60)
+        self.assertEqual(self.queue.retry_delay(3), 240)
+        self.assertEqual(self.queue.retry_delay(20),
+                         ArchiveQueue.MAX_RETRY_DELAY)
+
+    def test_fixup_retries_failed_tasks(self):
+        statements = []
+        get_connection = meta.get_connection
+        meta.get_connection = lambda: FakeConnection(statements)
+        try:
+            self.queue.register('workbook', FakeManager())
+            body = self.queue.fixup('workbook')
+        finally:
+            meta.get_connection = get_connection
+        self.assertEqual(body['tasks-retried'], 1)
+        retry = [stmt for stmt in statements if "status = 'failed'" in stmt]
+        self.assertEqual(len(retry), 1)
+        self.assertTrue('attempts = 0' in retry[0])
@@ -0,0 +1,32 @@
+import unittest
+
+from controller.blob_store import make_delta, apply_delta
+
+BASE = ''.join(['<column name="[c%d]" datatype="string"/>\n' % i
+                for i in range(500)])
+
+class BlobStoreTest(unittest.TestCase):
+
+    def roundtrip(self, base, contents):
+        delta = make_delta(base, contents)
+        self.assertEqual(apply_delta(base, delta), contents)
+        return delta
+
+    def test_small_change(self):
+        contents = BASE.replace('[c250]', '[renamed]')
+        delta = self.roundtrip(BASE, contents)
+        self.assertTrue(len(delta) < 200)
+
+    def test_insert_and_delete(self):
+        lines = BASE.splitlines(True)
+        contents = ''.join(lines[:10] + ['<new/>\n'] + lines[20:])
+        self.roundtrip(BASE, contents)
+        self.roundtrip(contents, BASE)
+
+    def test_edges(self):
+        self.roundtrip('', BASE)
+        self.roundtrip(BASE, '')
+        self.roundtrip(BASE, BASE)
+        # no trailing newline and a changed last line.
+        self.roundtrip('a\nb', 'a\nc')
+        self.roundtrip('a\nb\n', 'a\nb\nb\n')
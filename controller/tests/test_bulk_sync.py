@@ -0,0 +1,124 @@
+import unittest
+
+import akiri.framework.sqlalchemy as meta
+
+from controller.bulk_sync import BulkSync
+
+class FakeColumn(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeDefault(object):
+    is_scalar = True
+
+    def __init__(self, arg):
+        self.arg = arg
+
+class FakePrimaryKey(object):
+    columns = [FakeColumn('siteid'), FakeColumn('envid')]
+
+class FakeTable(object):
+    columns = [FakeColumn(name) for name in
+               ('siteid', 'envid', 'id', 'name', 'status', 'luid')]
+    primary_key = FakePrimaryKey()
+
+class FakeModel(object):
+    __tablename__ = 'sites'
+    __table__ = FakeTable()
+
+class FakeResult(object):
+    def __init__(self, row):
+        self.row = row
+
+    def first(self):
+        return self.row
+
+class FakeTransaction(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class FakeConnection(object):
+    def __init__(self, statements):
+        self.statements = statements
+        self.ddl = []
+
+    def begin(self):
+        return FakeTransaction()
+
+    def execute(self, stmt, **params):
+        if not params:
+            self.ddl.append(stmt)
+            return None
+        self.statements.append(params)
+        # staged keys, inserted, updated, removed
+        return FakeResult((5, 2, 1, 3))
+
+    def close(self):
+        pass
+
+class BulkSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = []
+        self.get_connection = meta.get_connection
+        meta.get_connection = lambda: FakeConnection(self.statements)
+
+    def tearDown(self):
+        meta.get_connection = self.get_connection
+
+    def test_columns(self):
+        sync = BulkSync(FakeModel, 1)
+        self.assertEqual(sync.columns, ['id', 'name', 'status', 'luid'])
+
+    def test_run(self):
+        sync = BulkSync(FakeModel, 1)
+        sync.BATCH_SIZE = 2
+        rows = [(i, 'site%d' % i, 'active') for i in range(5)]
+        stats = sync.run(['id', 'name', 'status'], iter(rows))
+        # three staging INSERTs then the statement that applies them.
+        self.assertEqual([len(params) for params in self.statements],
+                         [6, 6, 3, 1])
+        self.assertEqual(self.statements[1]['v1_1'], 'site3')
+        self.assertEqual(stats['count'], 5)
+        self.assertEqual(stats['inserted'], 2)
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['unchanged'], 2)
+        self.assertEqual(stats['deleted'], 3)
+
+    def test_apply_sql(self):
+        sync = BulkSync(FakeModel, 1)
+        stmt = sync.apply_sql(['id', 'name', 'status'])
+        self.assertTrue("UPDATE sites t SET name = s.name, " + \
+                        "status = s.status FROM sync_sites s" in stmt)
+        self.assertTrue("ROW(t.name, t.status) IS DISTINCT FROM " + \
+                        "ROW(s.name, s.status)" in stmt)
+        self.assertTrue("rm AS (DELETE FROM sites t" in stmt)
+
+    def test_apply_sql_deactivate(self):
+        sync = BulkSync(FakeModel, 1, key='name', ignore_case=True,
+                        deactivate='status', keep_null=['luid'],
+                        insert_defaults={'id': 0}, retain=['palette'])
+        stmt = sync.apply_sql(['name', 'luid'])
+        self.assertTrue("luid = COALESCE(s.luid, t.luid)" in stmt)
+        self.assertTrue("lower(t.name) = lower(s.name)" in stmt)
+        self.assertTrue("(envid, name, luid, id)" in stmt)
+        self.assertTrue("SET status = FALSE" in stmt)
+        self.assertTrue("AND t.name NOT IN (:retain_0)" in stmt)
+
+    def test_column_defaults(self):
+        model = FakeModel()
+        column = FakeColumn('status')
+        column.default = FakeDefault('pending')
+        model.__table__ = FakeTable()
+        model.__table__.columns = [FakeColumn('siteid'), FakeColumn('envid'),
+                                   FakeColumn('id'), column]
+        sync = BulkSync(model, 1, insert_defaults={'name': 'x'})
+        self.assertEqual(sync._insert_defaults(['id']),
+                         {'status': 'pending', 'name': 'x'})
+        # a staged column isn't defaulted.
+        self.assertEqual(sync._insert_defaults(['id', 'status']),
+                         {'name': 'x'})
+        self.assertTrue(':default_status' in sync.apply_sql(['id']))
@@ -0,0 +1,36 @@
+import unittest
+
+from controller.cli_cmd import CliCmd
+
+class FakeAgentManager(object):
+    socket_timeout = 60
+
+class FakeServer(object):
+    agentmanager = FakeAgentManager()
+    cli_status_wait = 20
+
+class FakeConnection(object):
+    def __init__(self, channels):
+        self.channels = [None] * channels
+
+class CliCmdTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cli = CliCmd(FakeServer())
+
+    def test_single_channel_polls(self):
+        self.assertEqual(self.cli._status_wait(FakeConnection(1), 100), 0)
+
+    def test_wait(self):
+        self.assertEqual(self.cli._status_wait(FakeConnection(4), 100), 20)
+        # never past the command timeout.
+        self.assertEqual(self.cli._status_wait(FakeConnection(4), 7.5), 7)
+        self.assertEqual(self.cli._status_wait(FakeConnection(4), -1), 0)
+
+    def test_socket_timeout(self):
+        self.cli.server.agentmanager.socket_timeout = 30
+        try:
+            self.assertEqual(self.cli._status_wait(FakeConnection(2), 100),
+                             15)
+        finally:
+            self.cli.server.agentmanager.socket_timeout = 60
@@ -0,0 +1,122 @@
+import unittest
+import threading
+import time
+import SocketServer as socketserver
+
+from controller import rpc
+from controller.clihandler import AgentSelectorCache, CliHandler
+
+class FakeAgentManager(object):
+    generation = 0
+
+class AgentSelectorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FakeAgentManager()
+        self.cache = AgentSelectorCache(self.manager)
+        self.resolved = []
+
+    def resolve(self, uuid):
+        def func():
+            self.resolved.append(uuid)
+            return uuid
+        return func
+
+    def test_cached(self):
+        key = (1, None, 'host', None)
+        self.assertEqual(self.cache.lookup(key, self.resolve('a')), 'a')
+        self.assertEqual(self.cache.lookup(key, self.resolve('b')), 'a')
+        self.assertEqual(self.resolved, ['a'])
+
+    def test_generation_change(self):
+        key = (1, None, None, 'worker')
+        self.cache.lookup(key, self.resolve('a'))
+        self.manager.generation += 1
+        self.assertEqual(self.cache.lookup(key, self.resolve('b')), 'b')
+        self.assertEqual(self.cache.lookup(key, self.resolve('c')), 'b')
+        self.assertEqual(self.resolved, ['a', 'b'])
+
+    def test_changed_while_resolving(self):
+        key = (1, None, None, 'archive')
+        def resolve():
+            self.manager.generation += 1
+            return 'a'
+        self.assertEqual(self.cache.lookup(key, resolve), 'a')
+        self.assertEqual(self.cache.lookup(key, self.resolve('b')), 'b')
+
+
+class Handler(CliHandler):
+
+    def do_sleep(self, cmd):
+        time.sleep(float(cmd.args[0]))
+        self.ack()
+        self.print_client('slept %s', cmd.args[0])
+
+class FakeDomain(object):
+    domainid = 1
+
+class FakeEnvironment(object):
+    envid = 1
+
+class FakeStateManager(object):
+    def get_state(self):
+        return 'STARTED'
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    system = None
+    domain = FakeDomain()
+    environment = FakeEnvironment()
+    state_manager = FakeStateManager()
+    agent_selectors = None
+
+    def handle_error(self, request, client_address):
+        pass
+
+class CliHandlerRpcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('localhost', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.conn = rpc.RpcConnection('localhost',
+                                      self.server.server_address[1])
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def readlines(self, call):
+        lines = []
+        while True:
+            line = call.readline()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def test_request(self):
+        call = self.conn.call('/uuid=x sleep 0')
+        self.assertEqual(self.readlines(call), ['OK\n', 'slept 0\n'])
+
+    def test_concurrent_requests(self):
+        slow = self.conn.call('/uuid=x sleep 0.5')
+        fast = self.conn.call('/uuid=x sleep 0')
+        start = time.time()
+        self.assertEqual(self.readlines(fast), ['OK\n', 'slept 0\n'])
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.readlines(slow), ['OK\n', 'slept 0.5\n'])
+
+    def test_errors(self):
+        invalid = self.conn.call('/uuid=x no-such-command')
+        missing = self.conn.call(' ')
+        lines = self.readlines(invalid)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('ERROR '))
+        self.assertTrue('invalid command' in lines[0])
+        lines = self.readlines(missing)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue('Missing command' in lines[0])
@@ -0,0 +1,58 @@
+import unittest
+
+from controller.event_bus import EventQueue, EventRecord
+from controller.event_control import EventControlManager
+
+def record(key, agentid):
+    return EventRecord(key, {'agentid': agentid}, None, None, None)
+
+class EventQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = EventQueue(2, timeout=0)
+
+    def test_fifo_batches(self):
+        self.queue.put(record('A', 1))
+        self.queue.put(record('B', 1))
+        batch = self.queue.get_batch(10, timeout=0)
+        self.assertEqual([r.key for r in batch], ['A', 'B'])
+        self.assertEqual(self.queue.get_batch(10, timeout=0), [])
+
+    def test_coalesce_when_full(self):
+        self.queue.put(record('A', 1))
+        self.queue.put(record('B', 1))
+        latest = record('A', 1)
+        latest.data['info'] = 'latest'
+        self.assertTrue(self.queue.put(latest))
+        self.assertEqual(self.queue.coalesced, 1)
+
+        # A different agent can't be coalesced: it's dropped.
+        self.assertFalse(self.queue.put(record('A', 2)))
+        self.assertEqual(self.queue.dropped, 1)
+
+        batch = self.queue.get_batch(10, timeout=0)
+        self.assertEqual([r.key for r in batch], ['A', 'B'])
+        self.assertEqual(batch[0].count, 2)
+        self.assertEqual(batch[0].data['info'], 'latest')
+
+class FakeBus(object):
+    def __init__(self):
+        self.records = []
+
+    def put(self, record):
+        self.records.append(record)
+
+class SyncGenTest(unittest.TestCase):
+
+    def test_sync_bypasses_the_bus(self):
+        manager = EventControlManager.__new__(EventControlManager)
+        manager.bus = FakeBus()
+        handled = []
+        manager.handle = lambda records, sync=False: \
+            handled.append((records, sync))
+        manager.gen('A', {'agentid': 1})
+        manager.gen('B', {'agentid': 1}, sync=True)
+        self.assertEqual([rec.key for rec in manager.bus.records], ['A'])
+        self.assertEqual(len(handled), 1)
+        self.assertEqual(handled[0][0][0].key, 'B')
+        self.assertTrue(handled[0][1])
@@ -0,0 +1,36 @@
+import unittest
+
+from controller.event import EventCount
+
+class FakeResult(object):
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+class FakeSession(object):
+    def __init__(self, existing):
+        self.existing = existing
+        self.statements = []
+
+    def execute(self, stmt, params):
+        self.statements.append(params)
+        if len(self.statements) % 2 and params['envid'] in self.existing:
+            return FakeResult(1)
+        return FakeResult(0)
+
+class EventCountTest(unittest.TestCase):
+
+    def test_increment(self):
+        session = FakeSession(existing=[1])
+        EventCount.increment(session, {(1, 'E', 'backup', None): 3})
+        # an existing key is only updated.
+        self.assertEqual(len(session.statements), 1)
+        self.assertEqual(session.statements[0],
+                         {'envid': 1, 'level': 'E', 'event_type': 'backup',
+                          'userid': None, 'count': 3})
+
+    def test_increment_new(self):
+        session = FakeSession(existing=[])
+        EventCount.increment(session, {(2, 'I', 'system', 7): 1})
+        # the UPDATE didn't match: INSERT.
+        self.assertEqual(len(session.statements), 2)
+        self.assertEqual(session.statements[1]['userid'], 7)
@@ -0,0 +1,96 @@
+import unittest
+from datetime import datetime, timedelta
+
+from controller.event_control import EventControl
+from controller.extracts import ExtractManager, ExtractDeadlines
+from controller.extracts import ExtractState
+from controller.system import SystemKeys
+
+T0 = datetime(2016, 3, 1, 12, 0, 0)
+
+def at(seconds):
+    return T0 + timedelta(seconds=seconds)
+
+THRESHOLDS = {
+    SystemKeys.EXTRACT_DELAY_WARN: 60,
+    SystemKeys.EXTRACT_DELAY_ERROR: 300,
+    SystemKeys.EXTRACT_DURATION_WARN: 120,
+    SystemKeys.EXTRACT_DURATION_ERROR: 600
+}
+
+# Synthetic background_jobs deltas: (poll time, rows updated since the
+# previous poll).
+POLLS = [
+    (30, [{'id': 1, 'created_at': at(0)},
+          {'id': 2, 'created_at': at(0), 'started_at': at(5),
+           'completed_at': at(20), 'finish_code': 1},
+          {'id': 3, 'created_at': at(0)}]),
+    (90, []),
+    (200, [{'id': 1, 'created_at': at(0), 'started_at': at(100)}]),
+    (250, []),
+    (300, [{'id': 1, 'created_at': at(0), 'started_at': at(100),
+            'completed_at': at(290), 'finish_code': 0}]),
+    (310, [{'id': 1, 'created_at': at(0), 'started_at': at(100),
+            'completed_at': at(290), 'finish_code': 0, 'notes': 'x'}]),
+    (400, [{'id': 3, 'created_at': at(0), 'started_at': at(390)}]),
+]
+
+class FakeEntry(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, exid):
+        self.id = exid
+        self.extractid = exid
+        self.state = None
+        self.notification_state = 0
+        self.created_at = None
+        self.started_at = None
+        self.completed_at = None
+        self.finish_code = 0
+
+class ExtractReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = ExtractManager.__new__(ExtractManager)
+        self.events = []
+        self.manager._eventgen = \
+            lambda key, data, entry: self.events.append((key, entry.id))
+        self.deadlines = ExtractDeadlines()
+        self.deadlines.reset(THRESHOLDS)
+        self.entries = {}
+
+    def poll(self, now, rows):
+        """What ExtractManager.load() does with a delta, without the db."""
+        for row in rows:
+            entry = self.entries.setdefault(row['id'], FakeEntry(row['id']))
+            for key, value in row.items():
+                setattr(entry, key, value)
+            self.manager._process(dict(THRESHOLDS), now, entry)
+            self.deadlines.schedule(entry)
+        for extractid in sorted(self.deadlines.due(now)):
+            entry = self.entries[extractid]
+            if entry.state in ExtractState.UNFINISHED:
+                self.manager._check_thresholds(dict(THRESHOLDS), now, entry)
+
+    def test_replay(self):
+        for seconds, rows in POLLS:
+            self.poll(at(seconds), rows)
+        self.assertEqual(self.events, [
+            (EventControl.EXTRACT_FAILED, 2),
+            (EventControl.EXTRACT_DELAY_WARN, 1),
+            (EventControl.EXTRACT_DELAY_WARN, 3),
+            (EventControl.EXTRACT_DURATION_WARN, 1),
+            (EventControl.EXTRACT_OK, 1),
+            (EventControl.EXTRACT_DELAY_ERROR, 3)])
+        self.assertEqual(self.entries[1].state, ExtractState.SUCCESS)
+        self.assertEqual(self.entries[3].state, ExtractState.RUNNING)
+        # only job 3 is still scheduled, for its duration thresholds.
+        self.assertEqual(self.deadlines.scheduled, {3: ExtractState.RUNNING})
+        # job 1's duration error deadline is stale: dropped when due.
+        self.assertEqual(sorted([extractid for _, extractid in
+                                 self.deadlines.heap]), [1, 3, 3])
+
+    def test_thresholds_changed(self):
+        self.assertTrue(self.deadlines.is_current(dict(THRESHOLDS)))
+        thresholds = dict(THRESHOLDS)
+        thresholds[SystemKeys.EXTRACT_DELAY_WARN] = 120
+        self.assertFalse(self.deadlines.is_current(thresholds))
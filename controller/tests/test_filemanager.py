@@ -0,0 +1,98 @@
+import os
+import resource
+import shutil
+import tempfile
+import unittest
+import httplib
+from contextlib import contextmanager
+
+from controller.filemanager import FileManager
+
+class FakeResponse(object):
+    def __init__(self, f, status=httplib.OK):
+        self.f = f
+        self.status = status
+        self.reason = 'OK'
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+class FakeConnection(object):
+    """Serves every GET from a local file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def stream(self, method, uri, body=None, headers=None):
+        # pylint: disable=unused-argument
+        with open(self.path, 'rb') as f:
+            yield FakeResponse(f)
+
+class FakePath(object):
+    basename = staticmethod(os.path.basename)
+
+class FakeAgent(object):
+    server = None
+    path = FakePath()
+
+class CountingFile(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def maxrss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class FileManagerTest(unittest.TestCase):
+
+    SPARSE_SIZE = 2 * 1024 * 1024 * 1024
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.agent = FakeAgent()
+        self.filemanager = FileManager(self.agent)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def source(self, size, data=''):
+        path = os.path.join(self.tmpdir, 'source')
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.truncate(size)
+        self.agent.connection = FakeConnection(path)
+        return path
+
+    def test_copyto_constant_memory(self):
+        self.source(self.SPARSE_SIZE)
+        before = maxrss()
+        sink = CountingFile()
+        size = self.filemanager.copyto('/tmp/big.tsbak', sink)
+        self.assertEqual(size, self.SPARSE_SIZE)
+        self.assertEqual(sink.size, self.SPARSE_SIZE)
+        # never more than a few chunks in memory.
+        self.assertTrue(maxrss() - before < 32 * 1024)
+
+    def test_save(self):
+        self.source(1000, 'workbook')
+        target = os.path.join(self.tmpdir, 'target')
+        os.mkdir(target)
+        body = self.filemanager.save('/tmp/x.twb', target)
+        self.assertEqual(body['size'], 1000)
+        self.assertEqual(body['target'], os.path.join(target, 'x.twb'))
+        self.assertEqual(os.listdir(target), ['x.twb'])
+        with open(body['target'], 'rb') as f:
+            self.assertEqual(f.read(8), 'workbook')
+
+    def test_save_failure_leaves_nothing(self):
+        self.source(0)
+        self.agent.connection.path = os.path.join(self.tmpdir, 'missing')
+        target = os.path.join(self.tmpdir, 'target')
+        os.mkdir(target)
+        self.assertRaises(IOError, self.filemanager.save, '/tmp/x.twb',
+                          target)
+        self.assertEqual(os.listdir(target), [])
@@ -0,0 +1,71 @@
+import threading
+import time
+import unittest
+
+from controller.files import FileManager, run_concurrently
+
+class FakeEntry(object):
+    def __init__(self, fileid):
+        self.fileid = fileid
+        self.name = '/archive/%d.twb' % fileid
+
+class FakeFileManager(object):
+    def __init__(self, bulk):
+        self.bulk = bulk
+        self.requests = []
+        self.deleted = []
+
+    def delete_files(self, paths):
+        if not self.bulk:
+            raise IOError("Invalid action 'DELETE'")
+        self.requests.append(paths)
+        return {'status': 'OK', 'deleted': len(paths), 'errors': {}}
+
+    def delete(self, path):
+        self.deleted.append(path)
+        return {}
+
+class FakeAgent(object):
+    displayname = 'primary'
+    def __init__(self, bulk=True):
+        self.filemanager = FakeFileManager(bulk)
+
+class FakeServer(object):
+    pass
+
+class RemoveFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FileManager.__new__(FileManager)
+        self.manager.server = FakeServer()
+
+    def test_run_concurrently_limit(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0, 'done': 0}
+        def job():
+            with lock:
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+                state['done'] += 1
+        run_concurrently([job] * 10, 3)
+        self.assertEqual(state['done'], 10)
+        self.assertTrue(state['most'] <= 3)
+
+    def test_agent_batches(self):
+        agent = FakeAgent()
+        entries = [FakeEntry(i) for i in range(5)]
+        done = self.manager._delete_agent_files(agent,
+                                                [entries[:3], entries[3:]])
+        self.assertEqual(sorted(done), range(5))
+        self.assertEqual(sorted([len(paths) for paths in
+                                 agent.filemanager.requests]), [2, 3])
+
+    def test_agent_without_bulk_delete(self):
+        agent = FakeAgent(bulk=False)
+        entries = [FakeEntry(i) for i in range(3)]
+        done = self.manager._delete_agent_files(agent, [entries])
+        self.assertEqual(sorted(done), range(3))
+        self.assertEqual(len(agent.filemanager.deleted), 3)
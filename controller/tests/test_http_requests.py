@@ -0,0 +1,50 @@
+import unittest
+
+from controller import http_requests
+from controller.http_requests import VizqlIndex, HttpRequestEntry
+
+class Row(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, reqid, vizql_session, action):
+        self.reqid = reqid
+        self.vizql_session = vizql_session
+        self.action = action
+
+class HttpRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.saved = HttpRequestEntry.get_by_vizql_sessions
+        def lookup(envid, vizql_sessions, action):
+            self.queries.append(sorted(vizql_sessions))
+            return dict([(vizql_session, Row(0, vizql_session, action))
+                         for vizql_session in vizql_sessions
+                         if vizql_session != 'gone'])
+        HttpRequestEntry.get_by_vizql_sessions = staticmethod(lookup)
+
+    def tearDown(self):
+        HttpRequestEntry.get_by_vizql_sessions = self.saved
+
+    def test_first_row_of_batch(self):
+        rows = [Row(1, 'A', 'show'), Row(2, 'A', 'show'),
+                Row(3, 'A', 'bootstrapSession'), Row(4, None, 'show')]
+        index = VizqlIndex(rows)
+        self.assertEqual(index.find('A', 'show').reqid, 1)
+        self.assertEqual(index.find('A', 'bootstrapSession').reqid, 3)
+        self.assertEqual(index.find(None, 'show'), None)
+
+    def test_resolve_one_query(self):
+        index = VizqlIndex([Row(1, 'A', 'show'), Row(2, 'B', 'bootstrapSession'),
+                            Row(3, 'C', 'bootstrapSession')])
+        index.resolve(1, ['A', 'B', 'C', 'C', 'gone'], 'show')
+        self.assertEqual(self.queries, [['B', 'C', 'gone']])
+        self.assertEqual(index.find('A', 'show').reqid, 1)
+        self.assertEqual(index.find('B', 'show').reqid, 0)
+        self.assertEqual(index.find('gone', 'show'), None)
+        index.resolve(1, ['A'], 'show')
+        self.assertEqual(len(self.queries), 1)
+
+    def test_int_or_none(self):
+        self.assertEqual(http_requests.int_or_none('12'), 12)
+        self.assertEqual(http_requests.int_or_none(-1), -1)
+        self.assertEqual(http_requests.int_or_none(None), None)
@@ -0,0 +1,81 @@
+import unittest
+
+from controller.jobs import JobExecutor
+
+class FakeLoader(object):
+    def __init__(self, calls, name, body=None):
+        self.calls = calls
+        self.name = name
+        self.body = body or {}
+
+    def load(self, agent):
+        self.calls.append(self.name + '.load')
+        return self.body
+
+    def fixup(self, agent):
+        self.calls.append(self.name + '.fixup')
+        return {}
+
+class FakeServer(object):
+    def __init__(self, calls, load_body):
+        self.agentmanager = self
+        self.workbooks = FakeLoader(calls, 'workbooks', load_body)
+        self.hrman = FakeLoader(calls, 'hrman', {'count': 1})
+        self.datasources = FakeLoader(calls, 'datasources', load_body)
+
+    def agent_by_type(self, agent_type):
+        return object()
+
+    def odbc_ok(self):
+        return True
+
+class JobExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        # No worker threads: the tests only look at the queue.
+        self.executor = JobExecutor(None, workers=0)
+
+    def test_priority_order(self):
+        self.executor.submit('cpu_load', priority=10)
+        self.executor.submit('yml', priority=None)
+        self.executor.submit('sync', priority=1)
+        self.executor.submit('workbook', priority=2)
+
+        names = []
+        while not self.executor.queue.empty():
+            names.append(self.executor.queue.get()[2].name)
+        self.assertEqual(names, ['sync', 'workbook', 'cpu_load', 'yml'])
+
+    def test_pending_job_is_not_queued_twice(self):
+        job = self.executor.submit('workbook', priority=2)
+        self.assertTrue(job.background)
+        self.assertIsNone(self.executor.submit('workbook', priority=2))
+        self.assertEqual(self.executor.queue.qsize(), 1)
+
+    def test_registered_jobs(self):
+        for name in ('sync', 'auth_import', 'workbook', 'datasource',
+                     'extract', 'cpu_load', 'yml', 'checkports'):
+            self.assertTrue(name in self.executor)
+        self.assertFalse('backup' in self.executor)
+
+    def test_workbook_failure_still_loads_http_requests(self):
+        calls = []
+        executor = JobExecutor(FakeServer(calls, {'error': 'failed'}),
+                               workers=0)
+        body = executor.workbook()
+        self.assertEqual(body, {'error': 'failed'})
+        self.assertEqual(calls,
+                         ['workbooks.load', 'workbooks.fixup', 'hrman.load'])
+
+        calls = []
+        executor = JobExecutor(FakeServer(calls, {}), workers=0)
+        self.assertEqual(executor.workbook(), {'count': 1})
+        self.assertEqual(calls,
+                         ['workbooks.load', 'workbooks.fixup', 'hrman.load'])
+
+    def test_datasource_failure_still_runs_fixup(self):
+        calls = []
+        executor = JobExecutor(FakeServer(calls, {'error': 'failed'}),
+                               workers=0)
+        self.assertEqual(executor.datasource(), {'error': 'failed'})
+        self.assertEqual(calls, ['datasources.load', 'datasources.fixup'])
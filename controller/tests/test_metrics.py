@@ -0,0 +1,100 @@
+import unittest
+
+import akiri.framework.sqlalchemy as meta
+
+from controller.metrics import MetricManager
+
+class FakeAgent(object):
+    agentid = 1
+
+class FakeEnvironment(object):
+    envid = 1
+
+class FakeServer(object):
+    environment = FakeEnvironment()
+
+class FakeTransaction(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class FakeConnection(object):
+    def __init__(self, statements):
+        self.statements = statements
+        self.ddl = []
+        self.fail = False
+
+    def begin(self):
+        return FakeTransaction()
+
+    def execute(self, stmt, **params):
+        if self.fail:
+            raise IOError('database unavailable')
+        if params:
+            self.statements.append(params)
+        else:
+            self.ddl.append(stmt)
+
+    def close(self):
+        pass
+
+class MetricManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.statements = []
+        self.get_connection = meta.get_connection
+        meta.get_connection = lambda: FakeConnection(self.statements)
+        # The flusher thread isn't started: flush() is called directly.
+        self.metrics = MetricManager(FakeServer())
+        self.metrics.batch_size = 3
+        self.metrics.max_pending = 5
+        self.metrics.flush_interval = 0
+
+    def tearDown(self):
+        meta.get_connection = self.get_connection
+
+    def test_flush_in_batches(self):
+        for i in range(7):
+            self.metrics.add(FakeAgent(), 'p%d' % i, float(i), None)
+        self.assertEqual(self.metrics.flush(), 5)
+        # Two samples were dropped, the rest took two INSERTs.
+        self.assertEqual(self.metrics.dropped, 2)
+        self.assertEqual([len(params) / 5 for params in self.statements],
+                         [3, 2])
+        self.assertEqual(self.metrics.pending, [])
+
+    def test_failed_batch_is_dropped(self):
+        connection = FakeConnection(self.statements)
+        meta.get_connection = lambda: connection
+        for i in range(4):
+            self.metrics.add(FakeAgent(), 'p%d' % i, float(i), None)
+        connection.fail = True
+        for _ in range(MetricManager.MAX_RETRIES - 1):
+            self.assertRaises(IOError, self.metrics.flush)
+            self.assertEqual(len(self.metrics.pending), 4)
+        self.assertRaises(IOError, self.metrics.flush)
+        # The first batch is gone, the next one is written.
+        self.assertEqual(self.metrics.dropped, 3)
+        connection.fail = False
+        self.assertEqual(self.metrics.flush(), 1)
+        self.assertEqual(self.metrics.failures, 0)
+
+    def test_shutdown_flushes(self):
+        self.metrics.add(FakeAgent(), '_Total', 10.0, None)
+        self.metrics.shutdown()
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual(self.statements[0]['process_name_0'], '_Total')
+
+    def test_partition_name(self):
+        # 2016-02-29 23:59:59 UTC
+        self.assertEqual(MetricManager.partition_name(1456790399),
+                         'metrics_20160229')
+
+    def test_rollup_sql(self):
+        ctes = MetricManager._rollup_sql('metrics_minute', 'minute')
+        self.assertEqual(len(ctes), 3)
+        self.assertTrue("date_trunc('minute'" in ctes[0])
+        self.assertTrue(ctes[1].startswith('metrics_minute_upd AS (UPDATE'))
+        self.assertTrue('FROM metrics_minute_upd u' in ctes[2])
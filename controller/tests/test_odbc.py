@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from controller.odbc import ODBC, ODBCError
+
+class FakeResponse(object):
+    def __init__(self, text, chunk=7):
+        self.text = text
+        self.chunk = chunk
+
+    def read(self, size):
+        # Return less than asked for to split frames across reads.
+        data = self.text[:self.chunk]
+        self.text = self.text[self.chunk:]
+        return data
+
+SCHEMA = {'$schema': {'Info': ['', 'id', 'System.Int32',
+                               '', 'name', 'System.String']}}
+
+def frames(*objs):
+    return ''.join([json.dumps(obj) + '\n' for obj in objs])
+
+class ODBCStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only the frame parsing is tested: no agent is needed.
+        self.odbc = ODBC.__new__(ODBC)
+
+    def test_rows_across_frames(self):
+        first = dict(SCHEMA)
+        first[''] = [[1, 'a'], [2, 'b']]
+        res = FakeResponse(frames(first, {'': [[3, 'c']]},
+                                  {'status': 'OK', 'count': 3}))
+        rows = list(self.odbc._frames(res))
+        self.assertEqual([row.data['id'] for row in rows], [1, 2, 3])
+        self.assertEqual(rows[2].data['name'], 'c')
+
+    def test_error_frame(self):
+        res = FakeResponse(frames(SCHEMA, {'error': 'query failed'}))
+        self.assertRaises(ODBCError, list, self.odbc._frames(res))
+
+    def test_truncated(self):
+        res = FakeResponse(frames(SCHEMA, {'': [[1, 'a']]}))
+        self.assertRaises(ODBCError, list, self.odbc._frames(res))
@@ -0,0 +1,100 @@
+import unittest
+import socket
+import threading
+import time
+import SocketServer as socketserver
+from StringIO import StringIO
+
+from controller import rpc
+
+class EchoHandler(socketserver.StreamRequestHandler):
+    """Answers 'sleep <seconds>' requests with an ack and the command,
+    running the requests concurrently like the CliHandler does."""
+
+    def handle(self):
+        if self.rfile.readline().strip() != rpc.RPC_COMMAND:
+            print >> self.wfile, 'ERROR 1 invalid command'
+            return
+        print >> self.wfile, 'OK RPC %d' % rpc.RPC_VERSION
+        writer = rpc.FrameWriter(self.wfile)
+        while True:
+            frame = rpc.read_frame(self.rfile)
+            if frame is None:
+                break
+            if frame['command'] == 'close':
+                self.request.shutdown(socket.SHUT_RDWR)
+                break
+            thread = threading.Thread(target=self.run,
+                                      args=(writer, frame))
+            thread.daemon = True
+            thread.start()
+
+    def run(self, writer, frame):
+        seconds = float(frame['command'].split()[1])
+        time.sleep(seconds)
+        try:
+            writer.send({'id': frame['id'], 'line': 'OK'})
+            writer.send({'id': frame['id'], 'line': frame['command']})
+            writer.send({'id': frame['id'], 'done': True})
+        except (EnvironmentError, ValueError):
+            pass
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+class RpcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('localhost', 0), EchoHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_frame(self):
+        wfile = StringIO()
+        rpc.FrameWriter(wfile).send({'id': 1, 'line': u'caf\xe9'})
+        wfile.seek(0)
+        self.assertEqual(rpc.read_frame(wfile), {'id': 1, 'line': u'caf\xe9'})
+        self.assertIsNone(rpc.read_frame(wfile))
+
+    def test_truncated_frame(self):
+        data = rpc.encode_frame({'id': 1})
+        self.assertRaises(rpc.RpcError, rpc.read_frame, StringIO(data[:-1]))
+
+    def test_concurrent_requests(self):
+        conn = rpc.RpcConnection('localhost', self.port)
+        slow = conn.call('sleep 0.5')
+        fast = conn.call('sleep 0')
+        start = time.time()
+        self.assertEqual(fast.readline(), 'OK\n')
+        self.assertEqual(fast.readline(), 'sleep 0\n')
+        self.assertEqual(fast.readline(), '')
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(slow.readline(), 'OK\n')
+        self.assertEqual(slow.readline(), 'sleep 0.5\n')
+        self.assertEqual(slow.readline(), '')
+        conn.close()
+
+    def test_connection_lost(self):
+        pool = rpc.RpcPool('localhost', self.port, size=1)
+        pending = pool.call('sleep 5')
+        pool.call('close')
+        self.assertRaises(rpc.RpcError, pending.readline)
+        # the next call opens a new connection
+        call = pool.call('sleep 0')
+        self.assertEqual(call.readline(), 'OK\n')
+        pool.close()
+
+    def test_unsupported(self):
+        self.server.RequestHandlerClass = socketserver.StreamRequestHandler
+        self.assertRaises(rpc.RpcUnsupported,
+                          rpc.RpcConnection, 'localhost', self.port)
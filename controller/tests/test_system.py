@@ -0,0 +1,84 @@
+import unittest
+
+import akiri.framework.sqlalchemy as meta
+
+import controller.system as system
+from controller.system import SystemManager, SystemKeys
+
+class FakeEntry(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def typed(self):
+        return system.cast(self.key, self.value)
+
+class FakeEnvironment(object):
+    envid = 1
+
+class FakeServer(object):
+    environment = FakeEnvironment()
+
+class SystemManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.rows = [FakeEntry(SystemKeys.DEBUG_LEVEL, 'INFO')]
+        def get_all(envid):
+            self.loads += 1
+            return self.rows
+        self.get_all = system.SystemEntry.get_all
+        system.SystemEntry.get_all = staticmethod(get_all)
+        self.manager = SystemManager(FakeServer())
+
+    def tearDown(self):
+        system.SystemEntry.get_all = self.get_all
+
+    def test_table_is_loaded_once(self):
+        for _ in range(3):
+            self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'INFO')
+        self.manager.todict(include_defaults=True)
+        self.assertEqual(self.loads, 1)
+        stats = self.manager.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 3)
+
+    def test_invalidate_reloads(self):
+        self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'INFO')
+        self.rows = [FakeEntry(SystemKeys.DEBUG_LEVEL, 'DEBUG')]
+        self.manager.invalidate()
+        self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'DEBUG')
+        self.assertEqual(self.loads, 2)
+
+    def test_todict_excludes_secrets(self):
+        self.rows.append(FakeEntry(SystemKeys.CSRF_SECRET, '1:abcd'))
+        self.assertEqual(self.manager[SystemKeys.CSRF_SECRET], '1:abcd')
+        data = self.manager.todict(include_defaults=True)
+        for key in data:
+            self.assertFalse(key.startswith('csrf'), key)
+        self.assertFalse('1:abcd' in data.values())
+
+    def test_changes_wait_for_commit(self):
+        # pylint: disable=protected-access
+        self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'INFO')
+        session = meta.Session()
+        try:
+            pending = self.manager._pending(session)
+            pending[SystemKeys.DEBUG_LEVEL] = 'DEBUG'
+            self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'INFO')
+            session.rollback()
+            self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'INFO')
+
+            pending = self.manager._pending(session)
+            pending[SystemKeys.DEBUG_LEVEL] = 'DEBUG'
+            session.commit()
+            self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL], 'DEBUG')
+
+            self.manager._pending(session)[SystemKeys.DEBUG_LEVEL] = \
+                SystemManager.DELETED
+            session.commit()
+            self.assertEqual(self.manager[SystemKeys.DEBUG_LEVEL],
+                             system.DEFAULTS[SystemKeys.DEBUG_LEVEL])
+        finally:
+            meta.Session.remove()
+        self.assertEqual(self.loads, 1)
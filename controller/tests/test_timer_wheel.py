@@ -0,0 +1,34 @@
+import unittest
+
+from controller.timer_wheel import TimerWheel
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        # The thread isn't started: the tests call advance() directly.
+        self.wheel = TimerWheel(tick=1.0, slots=4)
+        self.fired = []
+
+    def run_ticks(self, ticks):
+        for _ in range(ticks):
+            for _, func, args in self.wheel.advance():
+                func(*args)
+
+    def test_fires_after_delay(self):
+        self.wheel.schedule(2, self.fired.append, 'a')
+        self.run_ticks(1)
+        self.assertEqual(self.fired, [])
+        self.run_ticks(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_delay_longer_than_the_wheel(self):
+        self.wheel.schedule(9, self.fired.append, 'a')
+        self.wheel.schedule(4, self.fired.append, 'b')
+        self.run_ticks(4)
+        self.assertEqual(self.fired, ['b'])
+        self.assertEqual(self.wheel.pending, 1)
+        self.run_ticks(4)
+        self.assertEqual(self.fired, ['b'])
+        self.run_ticks(1)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.assertEqual(self.wheel.pending, 0)
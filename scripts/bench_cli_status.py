@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Benchmark how the controller learns that an agent command has finished:
+run commands through the agent's ProcessManager and follow them the way
+CliCmd._get_cli_status() does, once polling the status every 'interval'
+seconds (the old behavior) and once with long-polling (GET /cli?wait=S).
+Reports the latency from start to seen-finished for short commands and
+the number of status requests for a long command.  No agent connection
+or database is used.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.join(HERE, '..', 'agent')
+sys.path.insert(0, AGENT_DIR)
+
+# pylint: disable=import-error,wrong-import-position
+from processmanager import ProcessManager
+
+parser = argparse.ArgumentParser(description='CLI status benchmark')
+parser.add_argument('-n', '--num_commands', help='Number of short commands',
+                    type=int, default=10)
+parser.add_argument('-i', '--interval', help='Status poll interval',
+                    type=float, default=1.0)
+parser.add_argument('-w', '--wait', help='Long-poll wait',
+                    type=float, default=20.0)
+parser.add_argument('-l', '--long', help='Seconds the long command runs',
+                    type=int, default=15)
+args = parser.parse_args()
+
+xid_dir = tempfile.mkdtemp(prefix='bench_cli_')
+manager = ProcessManager(xid_dir, os.path.join(AGENT_DIR, 'bin'))
+next_xid = [0]
+
+def run(command, long_poll):
+    """Start 'command' and get its status until it finishes.
+       Returns (seconds, status requests)."""
+    next_xid[0] += 1
+    xid = next_xid[0]
+    start = time.time()
+    manager.start(xid, command)
+    requests = 0
+    while True:
+        requests += 1
+        if long_poll:
+            manager.wait(xid, args.wait)
+        data = manager.getinfo(xid)
+        if data['run-status'] == 'finished':
+            break
+        if not long_poll:
+            time.sleep(args.interval)
+    elapsed = time.time() - start
+    manager.cleanup(xid)
+    return elapsed, requests
+
+def report(label, long_poll):
+    latencies = [run('true', long_poll)[0]
+                 for _ in range(args.num_commands)]
+    elapsed, requests = run('sleep %d' % args.long, long_poll)
+    print '%-10s short: avg %.3f max %.3f seconds, ' \
+        'long (%ds): %d status requests in %.1f seconds' % \
+        (label, sum(latencies) / len(latencies), max(latencies),
+         args.long, requests, elapsed)
+
+try:
+    report('poll', False)
+    report('long-poll', True)
+finally:
+    shutil.rmtree(xid_dir)
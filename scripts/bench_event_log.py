@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Benchmark paging through the event log: seed the events table of a
+scratch database with --rows events and time fetching one page at
+increasing depths, with OFFSET/LIMIT and an exact count (the previous
+EventHandler.query_page) and with a keyset cursor and the event_counts
+table (EventHandler.query_keyset), unfiltered and filtered by level.
+Don't point it at a production database: it adds rows.
+"""
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'app'))
+sys.path.insert(0, os.path.join(HERE, '..', 'controller'))
+
+# pylint: disable=import-error,wrong-import-position
+import akiri.framework.sqlalchemy as meta
+
+from controller.domain import Domain
+from controller.environment import Environment
+from controller.event import EventEntry, EventCount
+
+from palette.event import EventHandler, parse_cursor
+
+parser = argparse.ArgumentParser(description='event paging benchmark')
+parser.add_argument('database', help='URL of a scratch database')
+parser.add_argument('-r', '--rows', help='Number of events',
+                    type=int, default=1000000)
+parser.add_argument('-l', '--limit', help='Page size',
+                    type=int, default=25)
+parser.add_argument('-n', '--repeat', help='Runs per measurement',
+                    type=int, default=5)
+args = parser.parse_args()
+
+ENVID = 1
+
+def seed():
+    session = meta.Session()
+    count = session.query(EventEntry).count()
+    if count < args.rows:
+        print 'seeding %d events...' % (args.rows - count)
+        session.execute(
+            "INSERT INTO events (envid, complete, key, title, " + \
+            "description, level, color, event_type, userid, timestamp) " + \
+            "SELECT 1, TRUE, 'BENCH', 'event ' || i, 'description', " + \
+            "(ARRAY['E', 'W', 'I'])[1 + i % 3], 'green', " + \
+            "(ARRAY['backup', 'extract', 'workbook', 'system'])" + \
+            "[1 + i % 4], i % 20, " + \
+            "now() - (i || ' seconds')::interval " + \
+            "FROM generate_series(1, :n) i", {'n': args.rows - count})
+        session.execute("DELETE FROM event_counts")
+        session.commit()
+        EventCount.populate()
+    session.execute("ANALYZE events")
+    session.commit()
+
+def timed(func):
+    """Best of 'repeat' runs in milliseconds, and the result."""
+    best = None
+    for _ in range(args.repeat):
+        start = time.time()
+        result = func()
+        elapsed = (time.time() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+        meta.Session.remove()
+    return best, result
+
+def cursor(event):
+    return parse_cursor(event['reference-time'] + ',' + str(event['eventid']))
+
+def bench(handler, label, status=None):
+    print label
+    print '%8s %14s %14s' % ('page', 'offset (ms)', 'keyset (ms)')
+    pages = args.rows / args.limit
+    if status:
+        pages /= 3
+    for page in (2, 10, 100, 1000, 10000, pages):
+        if page > pages:
+            break
+
+        def offset():
+            data = handler.query_page(ENVID, page, status=status,
+                                      limit=args.limit)
+            # the exact count, as before event_counts
+            filters = {'envid': ENVID}
+            if status:
+                filters['level'] = status
+            data['count'] = EventEntry.count(filters)
+            return data
+
+        # The cursor of the page before: where the 'next' link starts.
+        previous = handler.query_page(ENVID, page - 1, status=status,
+                                      limit=args.limit)['events']
+        before = cursor(previous[-1])
+        meta.Session.remove()
+
+        def keyset():
+            return handler.query_keyset(ENVID, before=before, status=status,
+                                        limit=args.limit)
+
+        offset_ms, expected = timed(offset)
+        keyset_ms, data = timed(keyset)
+        same = [e['eventid'] for e in data['events']] == \
+               [e['eventid'] for e in expected['events']] and \
+               data['count'] == expected['count']
+        print '%8d %14.1f %14.1f %s' % (page, offset_ms, keyset_ms,
+                                        same and '' or 'MISMATCH')
+
+def main():
+    meta.create_engine(args.database, echo=False)
+    Domain.populate()
+    Environment.populate()
+    EventEntry.upgrade_indexes()
+    seed()
+
+    handler = EventHandler()
+    bench(handler, 'all events:')
+    bench(handler, 'errors only:', status='E')
+
+if __name__ == '__main__':
+    main()
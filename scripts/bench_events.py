@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""
+Benchmark the event template rendering done by EventControlManager.gen()
+and AlertEmail.send(): replay the events in stress_events.json against the
+templates in event_control.json, once compiling every template from source
+(the old behavior) and once through the TemplateCache.  No database is used.
+"""
+import argparse
+import json
+import os
+import time
+
+from mako.template import Template
+from mako.exceptions import MakoException
+
+from controller.event_control import TemplateCache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='Event template benchmark')
+parser.add_argument('-f', '--filename', help='JSON event file',
+                    default=os.path.join(HERE, 'stress_events.json'))
+parser.add_argument('-c', '--control', help='event_control JSON file',
+                    default=os.path.join(HERE, '..', 'controller',
+                                         'controller', 'event_control.json'))
+parser.add_argument('-n', '--num_events', help='Number of events',
+                    type=int, default=10000)
+args = parser.parse_args()
+
+with open(args.control, "r") as f:
+    controls = dict((r['key'], r) for r in json.load(f)['RECORDS'])
+
+with open(args.filename, "r") as f:
+    events = [r for r in json.load(f)['RECORDS'] if r['key'] in controls]
+
+if not events:
+    print 'No events in %s match %s' % (args.filename, args.control)
+    raise SystemExit(1)
+
+def compile_uncached(key, source, **kwargs):
+    # pylint: disable=unused-argument
+    return Template(source, **kwargs)
+
+def render(get_template, count):
+    """Render subject, description and email for 'count' events."""
+    for i in xrange(count):
+        event = events[i % len(events)]
+        key = event['key']
+        control = controls[key]
+        data = dict(event['data'])
+        data['eventid'] = i
+        try:
+            control['subject'] % data
+        except (ValueError, KeyError):
+            pass
+        for source, kwargs, name in \
+                ((control['event_description'], {'default_filters': ['h']},
+                  key + ':description'),
+                 (control.get('email_message'), {}, key + ':email')):
+            if not source:
+                continue
+            try:
+                get_template(name, source, **kwargs).render(**data)
+            except (MakoException, TypeError, NameError):
+                pass
+
+def run(label, get_template):
+    start = time.time()
+    render(get_template, args.num_events)
+    elapsed = time.time() - start
+    print '%-10s %d events in %.2f seconds: %.1f events/sec' % \
+        (label, args.num_events, elapsed, args.num_events / elapsed)
+
+run('uncached', compile_uncached)
+cache = TemplateCache()
+run('cached', cache.get)
+print 'template cache:', cache.stats()
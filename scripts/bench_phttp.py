@@ -0,0 +1,126 @@
+#!/usr/bin/python
+"""
+Benchmark agent-to-agent file transfer: serve a file with the agent's
+/file handler (the source agent) on loopback and download it with phttp
+(as the target agent does for Controller.copy_cmd), with one stream and
+with several parallel ranged streams.  Pass --baseline with the path of
+another phttp (e.g. the previous version) to compare against it.
+The sha256 reported by phttp is checked against the source file; for a
+phttp that doesn't report one the time includes a separate sha256 pass.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from SocketServer import ThreadingMixIn, TCPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.join(HERE, '..', 'agent')
+sys.path.insert(0, AGENT_DIR)
+# the agent's util module uses tz.py from the controller.
+sys.path.append(os.path.join(HERE, '..', 'controller', 'controller'))
+
+# pylint: disable=import-error,wrong-import-position
+from agent import AgentHandler
+
+parser = argparse.ArgumentParser(description='phttp transfer benchmark')
+parser.add_argument('-s', '--size', help='File size in MB',
+                    type=int, default=512)
+parser.add_argument('-n', '--streams', help='Parallel streams',
+                    type=int, default=4)
+parser.add_argument('--baseline', help='Another phttp to compare against')
+args = parser.parse_args()
+
+class QuietHandler(AgentHandler):
+    def log_message(self, *args):
+        pass
+
+class SourceAgent(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_file(path, size):
+    sha = hashlib.sha256()
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for i in xrange(size):
+            # vary the blocks so ranges mixed up would be noticed.
+            buf = block[i % 1024:] + block[:i % 1024]
+            f.write(buf)
+            sha.update(buf)
+    return sha.hexdigest()
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            sha.update(buf)
+    return sha.hexdigest()
+
+def run(label, phttp, url, target_dir, streams, expected):
+    """Download and report the throughput.  Without a rolling sha256 in
+       the phttp output the time includes hashing the file afterwards,
+       as the integrity check needed before."""
+    # pylint: disable=too-many-arguments
+    env = dict(os.environ)
+    env.update({'BASIC_USERNAME': 'palette', 'BASIC_PASSWORD': 'palette',
+                'PHTTP_STREAMS': str(streams)})
+    dest = os.path.join(target_dir, 'file')
+    if os.path.exists(dest):
+        os.remove(dest)
+    start = time.time()
+    output = subprocess.check_output([sys.executable, phttp, 'GET', url,
+                                      target_dir], env=env)
+    if 'sha256: ' in output:
+        sha256 = output.split('sha256: ')[1].split()[0]
+        elapsed = time.time() - start
+        status = sha256 == expected and 'ok' or 'BAD ROLLING SHA256'
+        if sha256_file(dest) != expected:
+            status = 'MISMATCH'
+    else:
+        sha256 = sha256_file(dest)
+        elapsed = time.time() - start
+        status = sha256 == expected and 'ok' or 'MISMATCH'
+        label += ' + sha256'
+    print '%-24s %6.2f seconds  %7.1f MB/s  %s' % \
+        (label, elapsed, args.size / elapsed, status)
+
+def main():
+    tmpdir = tempfile.mkdtemp(prefix='bench_phttp_')
+    try:
+        source = os.path.join(tmpdir, 'source.bin')
+        target_dir = os.path.join(tmpdir, 'target')
+        os.mkdir(target_dir)
+        expected = make_file(source, args.size)
+
+        server = SourceAgent(('127.0.0.1', 0), QuietHandler)
+        server.log = logging.getLogger('bench')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/file?path=%s' % \
+            (server.server_address[1], urllib.quote_plus(source))
+
+        phttp = os.path.join(AGENT_DIR, 'bin', 'phttp')
+        print 'transfer of %d MB over loopback:' % args.size
+        if args.baseline:
+            run('baseline', args.baseline, url, target_dir, 1, expected)
+        run('phttp, 1 stream', phttp, url, target_dir, 1, expected)
+        run('phttp, %d streams' % args.streams, phttp, url, target_dir,
+            args.streams, expected)
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
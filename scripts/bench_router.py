@@ -0,0 +1,72 @@
+#!/usr/bin/python
+"""
+Micro-benchmark of akiri.framework Router.match(): 200 routes shaped like the
+Palette ones (static '\\Z' paths, paths with named groups and prefixes that
+mount sub-routers) are matched against paths hitting each of them, once by
+trying every route in order (the previous behavior) and once through the
+route index.  Both must pick the same route.  No database is used.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'akiri.framework'))
+
+# pylint: disable=import-error,wrong-import-position
+from akiri.framework.route import Router
+
+parser = argparse.ArgumentParser(description='Router match benchmark')
+parser.add_argument('-r', '--routes', help='Number of routes',
+                    type=int, default=200)
+parser.add_argument('-n', '--number', help='Matches per path',
+                    type=int, default=1000)
+args = parser.parse_args()
+
+def build(count):
+    """The router and a path for each route."""
+    router = Router()
+    paths = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            router.add_route(r'/rest/item%d\Z' % i, None)
+            paths.append('/rest/item%d' % i)
+        elif kind == 1:
+            router.add_route(r'/rest/item%d(/(?P<id>[\d]+))?\Z' % i, None)
+            paths.append('/rest/item%d/%d' % (i, i))
+        elif kind == 2:
+            router.add_route(r'/api/v1/item%d/(?P<key>[^\s]+)\Z' % i, None)
+            paths.append('/api/v1/item%d/key' % i)
+        else:
+            router.add_route(r'/item%d/' % i, None)
+            paths.append('/item%d/data/file.json' % i)
+    router.add_route(r'/', None)
+    paths.append('/not/routed')
+    return router, paths
+
+def linear_match(router, path):
+    """The route the previous implementation would match."""
+    for route in router.routes:
+        if route.compiled_pattern.match(path) is not None:
+            return route
+    return None
+
+def main():
+    router, paths = build(args.routes)
+    for path in paths:
+        match = router.match(path)
+        assert match.route is linear_match(router, path), path
+
+    for label, func in (('linear', lambda path: linear_match(router, path)),
+                        ('indexed', router.match)):
+        seconds = 0.0
+        for path in paths:
+            seconds += timeit.timeit(lambda: func(path), number=args.number)
+        count = len(paths) * args.number
+        print '%-8s %d routes: %.2f usec/match' % \
+            (label, len(router.routes), seconds * 1000000 / count)
+
+if __name__ == '__main__':
+    main()
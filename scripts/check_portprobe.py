@@ -0,0 +1,128 @@
+#!/usr/bin/python
+"""
+Local harness for the agent port prober (POST /ports): probes loopback
+listeners, a closed port and 'blackholed' ports - listeners whose accept
+queue is full, so the kernel drops the SYNs and the connect only ends with
+its timeout - in one batch, checks every result and that the batch takes
+about one timeout instead of the sum of them.  Then checks that a batch
+with more timeouts than workers ends within its time limit.  No agent or
+network needed.
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'agent'))
+
+# pylint: disable=import-error,wrong-import-position
+from portprobe import PortProber
+
+parser = argparse.ArgumentParser(description='Port prober harness')
+parser.add_argument('-n', '--listeners', help='Open loopback ports',
+                    type=int, default=20)
+parser.add_argument('-b', '--blackholed', help='Blackholed loopback ports',
+                    type=int, default=4)
+parser.add_argument('-t', '--timeout', help='Connect timeout (seconds)',
+                    type=float, default=1.0)
+args = parser.parse_args()
+
+def listener(backlog=5):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(backlog)
+    return sock
+
+def blackhole():
+    """A listener that never accepts, with its accept queue filled."""
+    sock = listener(backlog=0)
+    port = sock.getsockname()[1]
+    fillers = []
+    for _ in range(8):
+        filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        filler.setblocking(False)
+        filler.connect_ex(('127.0.0.1', port))
+        fillers.append(filler)
+    time.sleep(0.1)
+    return sock, fillers
+
+def closed_port():
+    sock = listener()
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def main():
+    keep = []
+    targets = []
+    expected = []
+    for _ in range(args.listeners):
+        sock = listener()
+        keep.append(sock)
+        targets.append({'host': 'localhost',
+                        'port': sock.getsockname()[1]})
+        expected.append('ok')
+    targets.append({'host': '127.0.0.1', 'port': closed_port()})
+    expected.append('refused')
+    for _ in range(args.blackholed):
+        sock, fillers = blackhole()
+        keep.append(sock)
+        keep.extend(fillers)
+        targets.append({'host': '127.0.0.1',
+                        'port': sock.getsockname()[1]})
+        expected.append('timeout')
+    targets.append({'host': 'no-such-host.invalid', 'port': 80})
+    expected.append('resolve')
+
+    start = time.time()
+    results = PortProber().probe_all(targets, timeout=args.timeout)
+    elapsed = time.time() - start
+
+    errors = 0
+    for target, want, result in zip(targets, expected, results):
+        if want == 'ok':
+            good = 'error' not in result and 'milliseconds' in result
+        elif want == 'timeout':
+            good = 'timed out' in result.get('error', '')
+        elif want == 'resolve':
+            good = 'resolve' in result.get('error', '')
+        else:
+            good = 'error' in result and 'timed out' not in result['error']
+        if not good:
+            errors += 1
+            print 'FAIL %s:%d expected %s: %s' % \
+                (target['host'], target['port'], want, result)
+
+    serial = args.blackholed * args.timeout
+    print '%d targets in %.2f seconds (%.2f seconds of timeouts if serial)' \
+        % (len(targets), elapsed, serial)
+    if args.blackholed and elapsed > 2 * args.timeout + 1:
+        errors += 1
+        print 'FAIL the timeouts were not concurrent'
+
+    # One worker for all the blackholed ports: the time limit must cut the
+    # batch short and the targets left over must be skipped.
+    blackholed = [target for target, want in zip(targets, expected) \
+                      if want == 'timeout']
+    if len(blackholed) > 2:
+        time_limit = 1.5 * args.timeout
+        start = time.time()
+        results = PortProber(workers=1).probe_all(blackholed,
+                                                  timeout=args.timeout,
+                                                  time_limit=time_limit)
+        elapsed = time.time() - start
+        skipped = len([result for result in results if result.get('skipped')])
+        print '%d blackholed targets, 1 worker: %d skipped in %.2f seconds' \
+            ' (time limit %.2f)' % (len(blackholed), skipped, elapsed,
+                                    time_limit)
+        if elapsed > time_limit + 0.5 or skipped != len(blackholed) - 2:
+            errors += 1
+            print 'FAIL the time limit was not respected'
+    if errors:
+        sys.exit(1)
+    print 'OK'
+
+if __name__ == '__main__':
+    main()